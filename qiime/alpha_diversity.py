@@ -38,10 +38,18 @@ import warnings
 warnings.filterwarnings('ignore', 'Not using MPI as mpi4py not found')
 
 import skbio.diversity.alpha as alph
-from numpy import array, zeros
+from numpy import (array, zeros, inf, log, log2, sqrt, errstate, arange,
+                   repeat, diff, lexsort, bincount, int32, float64)
+from multiprocessing import Pool
+from biom.table import Table
 
-from qiime.util import FunctionWithParams
+from qiime.util import FunctionWithParams, write_biom_table
+from qiime.tree_index import TreeIndex
 from qiime.format import format_matrix
+from qiime.filter import filter_otus_from_otu_table
+from qiime.rarefaction import get_rare_data, get_multiple_rare_data
+from qiime.collate_alpha import (make_output_row, get_sample_index,
+                                 write_output_file)
 from sys import exit, stderr
 
 
@@ -89,7 +97,8 @@ class AlphaDiversityCalc(FunctionWithParams):
         self.Params = params or {}
 
     def getResult(self, data_path, taxon_names=None, sample_names=None,
-                  tree_path=None):
+                  tree_path=None, sample_counts=None, pool=None,
+                  tree_index=None):
         """Returns per-sample diversity from incidence matrix and optional tree.
 
         Parameters:
@@ -105,6 +114,16 @@ class AlphaDiversityCalc(FunctionWithParams):
 
         tree: cogent.tree.PhyloNode object, or file path
 
+        sample_counts: the result of get_sample_counts for the table, which
+        can be passed to avoid recomputing it for each metric
+
+        pool: multiprocessing Pool used for metrics without a batched
+        implementation (see getNonphylogeneticResult)
+
+        tree_index: TreeIndex of the tree, used by phylogenetic metrics with
+        a batched implementation (metric.batched_phylogenetic). It can be
+        passed to avoid re-indexing the tree for each table.
+
         output:
         1d/2d array containing diversity of each sample, preserving order from
         input data  sample by (metric name or metric.return_name)
@@ -112,36 +131,78 @@ class AlphaDiversityCalc(FunctionWithParams):
         2d: [(return val 1 from sample1),(return val 2)...]
             [(return val 1 on sample2),...]
         """
+        if not self.IsPhylogenetic:
+            if sample_counts is None:
+                sample_counts = get_sample_counts(self.getBiomData(data_path))
+            return self.getNonphylogeneticResult(sample_counts, pool)
+
         otu_table = self.getBiomData(data_path)
-        data = otu_table.iter_data(axis='sample')
-        if self.IsPhylogenetic:
-            tree = self.getTree(tree_path)
-            # build envs dict: envs = {otu_id:{sample_id:count}}
-            envs = {}
-            sample_ids = otu_table.ids()
-            for obs_v, obs_id, obs_md in otu_table.iter(axis='observation'):
-                obs = {}
-                for sample_id, v in zip(sample_ids, obs_v):
-                    obs[sample_id] = v
-                envs[obs_id] = obs
-
-            new_sample_names, result = self.Metric(tree, envs, **self.Params)
+        if sample_names is None:
+            sample_names = otu_table.ids()
+        batched = getattr(self.Metric, 'batched_phylogenetic', None)
+        if batched is not None and not self.Params:
+            if tree_index is None:
+                tree_index = TreeIndex(self.getTree(tree_path))
+            if sample_counts is None:
+                sample_counts = get_sample_counts(otu_table)
+            result = batched(sample_counts,
+                             otu_table.ids(axis='observation'),
+                             tree_index)
+            sample_index = dict((s, i) for i, s in enumerate(otu_table.ids()))
             ordered_res = zeros(len(sample_names), 'float')
             for i, sample in enumerate(sample_names):
-                try:
-                    # idx is sample's index in result from metric
-                    idx = new_sample_names.index(sample)
-                    ordered_res[i] = result[idx]
-                except ValueError:
-                    pass  # already is zero
-            return array(ordered_res)
-
-        else:
-            def metric(row):
-                return self.Metric(row.astype(int), **self.Params)
-            result = map(metric, data)
-
-            return array(result)
+                if sample in sample_index:
+                    ordered_res[i] = result[sample_index[sample]]
+            return ordered_res
+
+        tree = self.getTree(tree_path)
+        # build envs dict: envs = {otu_id:{sample_id:count}}
+        envs = {}
+        sample_ids = otu_table.ids()
+        for obs_v, obs_id, obs_md in otu_table.iter(axis='observation'):
+            obs = {}
+            for sample_id, v in zip(sample_ids, obs_v):
+                obs[sample_id] = v
+            envs[obs_id] = obs
+
+        new_sample_names, result = self.Metric(tree, envs, **self.Params)
+        ordered_res = zeros(len(sample_names), 'float')
+        for i, sample in enumerate(sample_names):
+            try:
+                # idx is sample's index in result from metric
+                idx = new_sample_names.index(sample)
+                ordered_res[i] = result[idx]
+            except ValueError:
+                pass  # already is zero
+        return array(ordered_res)
+
+    def getNonphylogeneticResult(self, sample_counts, pool=None):
+        """Returns per-sample diversity from the result of get_sample_counts
+
+        If the metric has a batched implementation (metric.batched, which
+        takes the sample_counts matrix and returns an array with one value
+        per sample), it is used unless params were provided. Otherwise the
+        metric is applied to each sample; if pool is provided, the samples
+        are split into chunks which are processed by the pool.
+        """
+        batched = getattr(self.Metric, 'batched', None)
+        if batched is not None and not self.Params:
+            return array(batched(sample_counts))
+
+        if pool is None:
+            return array(_apply_metric((self.Metric, self.Params,
+                                        sample_counts)))
+
+        num_samples = sample_counts.shape[0]
+        # several chunks per process, so that the processes are kept busy if
+        # the metric's run time differs between samples
+        chunk_size = max(1, -(-num_samples // (4 * pool._processes)))
+        tasks = [(self.Metric, self.Params, sample_counts[i:i + chunk_size])
+                 for i in range(0, num_samples, chunk_size)]
+        result = []
+        for chunk_result in pool.map(_apply_metric, tasks):
+            result.extend(chunk_result)
+        return array(result)
 
     def formatResult(self, result):
         """Generate formatted vector, here just tab-delimited text.
@@ -161,7 +222,8 @@ class AlphaDiversityCalcs(FunctionWithParams):
         self.Params = params or {}
         self.Calcs = alpha_calcs
 
-    def getResult(self, data_path, tree_path=None):
+    def getResult(self, data_path, tree_path=None, jobs_to_start=1,
+                  tree_index=None):
         """computes matrix of (samples vs alpha diversity methods) on data
 
         Specificially, will produce matrix where each col is one of the alpha
@@ -172,6 +234,13 @@ class AlphaDiversityCalcs(FunctionWithParams):
         * data_path: file path, tab delimited, otu table format --OR --
         tuple: (sample_names, taxon_names, data (2d numpy), lineages)
         * tree: newick tree path --OR-- cogent.core.tree.PhyloNode object
+        * jobs_to_start: if greater than 1, metrics that don't have a
+        batched implementation are computed by a pool of this many processes
+        * tree_index: TreeIndex of the tree, which is built from the tree
+        if needed and not provided
+
+        The table is loaded, and converted for the nonphylogenetic metrics,
+        only once.
 
         output:
         result: a matrix of sample by alpha diversity method, sample_names,
@@ -189,21 +258,38 @@ class AlphaDiversityCalcs(FunctionWithParams):
             tree = self.getTree(tree_path)
         else:
             tree = None
+        if tree_index is None and needs_tree_index(self.Calcs):
+            tree_index = TreeIndex(tree)
+        sample_counts = get_sample_counts(otu_table)
+        needs_pool = [c for c in self.Calcs if not c.IsPhylogenetic and
+                      (c.Params or not hasattr(c.Metric, 'batched'))]
+        if jobs_to_start > 1 and needs_pool:
+            pool = Pool(jobs_to_start)
+        else:
+            pool = None
         # calculations
         res = []
-        for c in self.Calcs:
-            # add either calc's multiple return value names, or fn name
-            metric_res = c(data_path=data_path,
-                           taxon_names=otu_table.ids(axis='observation'),
-                           tree_path=tree,
-                           sample_names=otu_table.ids())
-            if len(metric_res.shape) == 1:
-                res.append(metric_res)
-            elif len(metric_res.shape) == 2:
-                for met in metric_res.T:
-                    res.append(met)
-            else:
-                raise RuntimeError("alpha div shape not as expected")
+        try:
+            for c in self.Calcs:
+                # add either calc's multiple return value names, or fn name
+                metric_res = c(data_path=otu_table,
+                               taxon_names=otu_table.ids(axis='observation'),
+                               tree_path=tree,
+                               sample_names=otu_table.ids(),
+                               sample_counts=sample_counts,
+                               pool=pool,
+                               tree_index=tree_index)
+                if len(metric_res.shape) == 1:
+                    res.append(metric_res)
+                elif len(metric_res.shape) == 2:
+                    for met in metric_res.T:
+                        res.append(met)
+                else:
+                    raise RuntimeError("alpha div shape not as expected")
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
         res_data = array(res).T
 
         return res_data, otu_table.ids(), calc_names
@@ -215,6 +301,164 @@ class AlphaDiversityCalcs(FunctionWithParams):
         return res
 
 
+def faith_pd(sample_counts, otu_ids, tree_index):
+    """Returns Faith's phylogenetic diversity of each sample
+
+    sample_counts: the result of get_sample_counts for a table
+    otu_ids: the observation ids of the table
+    tree_index: TreeIndex of the tree
+
+    The diversity of a sample is the total branch length of the union of the
+    paths from its OTUs to the root, as computed by PD_whole_tree. The
+    branch of the root itself (if it has a length) is included for samples
+    with at least one OTU in the tree. OTUs which aren't tips of the tree are
+    ignored. With the OTUs of a sample
+    ordered as in a depth first traversal of the tree, this is the sum of
+    their distances from the root, minus the distance from the root of the
+    lowest common ancestor of each consecutive pair, so it is computed for
+    all samples at once from the non-zero entries of sample_counts.
+    """
+    num_samples = sample_counts.shape[0]
+    if num_samples == 0:
+        return zeros(0, dtype=float64)
+    tips = tree_index.tip_indices(otu_ids)
+    samples = repeat(arange(num_samples, dtype=int32),
+                     diff(sample_counts.indptr))
+    nodes = tips[sample_counts.indices]
+    in_tree = nodes >= 0
+    samples = samples[in_tree]
+    nodes = nodes[in_tree]
+
+    order = lexsort((tree_index.First[nodes], samples))
+    samples = samples[order]
+    nodes = nodes[order]
+
+    result = bincount(samples, weights=tree_index.Distance[nodes],
+                      minlength=num_samples)
+    consecutive = samples[1:] == samples[:-1]
+    if consecutive.any():
+        ancestors = tree_index.lowest_common_ancestors(
+            nodes[:-1][consecutive], nodes[1:][consecutive])
+        result -= bincount(samples[1:][consecutive],
+                           weights=tree_index.Distance[ancestors],
+                           minlength=num_samples)
+    if tree_index.RootLength:
+        # Distance is measured from the root node, so excludes its branch
+        result += tree_index.RootLength * (bincount(
+            samples, minlength=num_samples) > 0)
+    return result
+
+
+def get_sample_counts(otu_table):
+    """Returns the counts of otu_table as an integer scipy.sparse.csr_matrix
+
+    Each row of the result holds the counts of one sample, in the order of
+    otu_table.ids(). Counts are truncated to integers, as they are when
+    metrics are applied to individual samples.
+    """
+    result = otu_table.matrix_data.T.tocsr().astype(int)
+    result.eliminate_zeros()
+    return result
+
+
+def _apply_metric(args):
+    """Returns [metric(counts, **params) for each row of sample_counts]
+
+    This is a module-level function so that it can be passed to a
+    multiprocessing Pool.
+    """
+    metric, params, sample_counts = args
+    return [metric(sample_counts[i].toarray()[0], **params)
+            for i in range(sample_counts.shape[0])]
+
+
+def _row_sums(sample_counts, values):
+    """Returns the sum of values over the non-zero entries of each row
+
+    values is an array with one entry per non-zero entry of sample_counts
+    (i.e., derived from sample_counts.data).
+    """
+    m = sample_counts.copy()
+    m.data = values
+    return array(m.sum(axis=1)).ravel()
+
+
+def _batched_observed_otus(sample_counts):
+    return sample_counts.getnnz(axis=1)
+
+
+def _batched_singles(sample_counts):
+    return _row_sums(sample_counts, (sample_counts.data == 1).astype(int))
+
+
+def _batched_doubles(sample_counts):
+    return _row_sums(sample_counts, (sample_counts.data == 2).astype(int))
+
+
+def _batched_dominance(sample_counts):
+    n = _row_sums(sample_counts, sample_counts.data)
+    with errstate(divide='ignore', invalid='ignore'):
+        return _row_sums(sample_counts,
+                         sample_counts.data.astype(float) ** 2) / n ** 2
+
+
+def _batched_enspie(sample_counts):
+    with errstate(divide='ignore', invalid='ignore'):
+        return 1 / _batched_dominance(sample_counts)
+
+
+def _batched_simpson(sample_counts):
+    return 1 - _batched_dominance(sample_counts)
+
+
+def _batched_shannon(sample_counts):
+    # -sum(p log2 p) = log2 N - sum(c log2 c) / N
+    counts = sample_counts.data.astype(float)
+    n = _row_sums(sample_counts, counts)
+    with errstate(divide='ignore', invalid='ignore'):
+        return log2(n) - _row_sums(sample_counts, counts * log2(counts)) / n
+
+
+def _batched_chao1(sample_counts):
+    # bias-corrected chao1, which skbio uses by default
+    o = _batched_observed_otus(sample_counts)
+    s = _batched_singles(sample_counts)
+    d = _batched_doubles(sample_counts)
+    return o + s * (s - 1) / (2.0 * (d + 1))
+
+
+def _batched_goods_coverage(sample_counts):
+    n = _row_sums(sample_counts, sample_counts.data)
+    with errstate(divide='ignore', invalid='ignore'):
+        return 1 - _batched_singles(sample_counts) / n.astype(float)
+
+
+def _batched_margalef(sample_counts):
+    n = _row_sums(sample_counts, sample_counts.data)
+    with errstate(divide='ignore', invalid='ignore'):
+        return (_batched_observed_otus(sample_counts) - 1) / log(n)
+
+
+def _batched_menhinick(sample_counts):
+    n = _row_sums(sample_counts, sample_counts.data)
+    with errstate(divide='ignore', invalid='ignore'):
+        return _batched_observed_otus(sample_counts) / sqrt(n)
+
+
+def _batched_berger_parker_d(sample_counts):
+    n = _row_sums(sample_counts, sample_counts.data)
+    with errstate(divide='ignore', invalid='ignore'):
+        return array(sample_counts.max(axis=1).todense()).ravel() / \
+            n.astype(float)
+
+
+def _batched_mcintosh_d(sample_counts):
+    n = _row_sums(sample_counts, sample_counts.data).astype(float)
+    u = sqrt(_row_sums(sample_counts, sample_counts.data.astype(float) ** 2))
+    with errstate(divide='ignore', invalid='ignore'):
+        return (n - u) / (n - sqrt(n))
+
+
 def get_nonphylogenetic_metric(name):
     """Gets metric by name from list in this module
     """
@@ -251,6 +495,7 @@ alph.lladser_ci.return_names = ('lladser_lower_bound', 'lladser_upper_bound')
 # hand curated lists of metrics, these either return one value, or
 # are modified above
 phylogenetic_metrics = [fast_unifrac.PD_whole_tree]
+fast_unifrac.PD_whole_tree.batched_phylogenetic = faith_pd
 
 # maintain additional aliases for backwards compatibility
 def observed_species(counts):
@@ -260,6 +505,24 @@ def observed_species(counts):
 def simpson_reciprocal(counts):
     return alph.enspie(counts)
 
+# batched implementations of metrics, which compute the metric for every
+# sample (row) of the result of get_sample_counts at once
+alph.observed_otus.batched = _batched_observed_otus
+observed_species.batched = _batched_observed_otus
+alph.singles.batched = _batched_singles
+alph.doubles.batched = _batched_doubles
+alph.dominance.batched = _batched_dominance
+alph.enspie.batched = _batched_enspie
+simpson_reciprocal.batched = _batched_enspie
+alph.simpson.batched = _batched_simpson
+alph.shannon.batched = _batched_shannon
+alph.chao1.batched = _batched_chao1
+alph.goods_coverage.batched = _batched_goods_coverage
+alph.margalef.batched = _batched_margalef
+alph.menhinick.batched = _batched_menhinick
+alph.berger_parker_d.batched = _batched_berger_parker_d
+alph.mcintosh_d.batched = _batched_mcintosh_d
+
 nonphylogenetic_metrics = [
     alph.ace,
     alph.berger_parker_d,
@@ -295,7 +558,8 @@ nonphylogenetic_metrics = [
 cup_metrics = [alph.lladser_pe, alph.lladser_ci]
 
 
-def single_file_alpha(infilepath, metrics, outfilepath, tree_path):
+def single_file_alpha(infilepath, metrics, outfilepath, tree_path,
+                      jobs_to_start=1):
     metrics_list = metrics
     try:
         metrics_list = metrics_list.split(',')
@@ -323,7 +587,8 @@ def single_file_alpha(infilepath, metrics, outfilepath, tree_path):
 
     try:
         result = all_calcs(data_path=infilepath, tree_path=tree_path,
-                           result_path=outfilepath, log_path=None)
+                           result_path=outfilepath, log_path=None,
+                           jobs_to_start=jobs_to_start)
         if result:  # can send to stdout instead of file
             print all_calcs.formatResult(result)
     except IOError as e:
@@ -332,7 +597,8 @@ def single_file_alpha(infilepath, metrics, outfilepath, tree_path):
         exit(1)
 
 
-def multiple_file_alpha(input_path, output_path, metrics, tree_path=None):
+def multiple_file_alpha(input_path, output_path, metrics, tree_path=None,
+                        jobs_to_start=1):
     """ performs minimal error checking on input args, then calls os.system
     to execute single_file_alpha for each file in the input directory
 
@@ -376,7 +642,7 @@ def multiple_file_alpha(input_path, output_path, metrics, tree_path=None):
         output_fp = os.path.join(output_path, output_fname)
 
         single_file_alpha(os.path.join(input_path, fname), metrics_list,
-                          output_fp, tree_path)
+                          output_fp, tree_path, jobs_to_start)
 
 
 def single_file_cup(otu_filepath, metrics, outfilepath, r):
@@ -436,3 +702,190 @@ def get_cup_metric(name):
 def list_known_cup_metrics():
     """Show the names of available metrics."""
     return [metric.__name__ for metric in cup_metrics]
+
+
+def get_alpha_calcs(metrics):
+    """Returns an AlphaDiversityCalc for each metric name in metrics
+
+    metrics: comma separated list of metric names; or list
+
+    A ValueError is raised if a metric isn't known.
+    """
+    try:
+        metrics = metrics.split(',')
+    except AttributeError:
+        pass
+
+    calcs = []
+    for metric in metrics:
+        try:
+            calcs.append(AlphaDiversityCalc(get_nonphylogenetic_metric(metric),
+                                            False))
+        except AttributeError:
+            try:
+                calcs.append(AlphaDiversityCalc(
+                    get_phylogenetic_metric(metric), True))
+            except AttributeError:
+                raise ValueError(
+                    "could not find metric.  %s.\n Known metrics are: %s\n"
+                    % (metric, ', '.join(list_known_metrics())))
+    return calcs
+
+
+def needs_tree_index(calcs):
+    """Returns True if any of calcs computes a batched phylogenetic metric"""
+    for calc in calcs:
+        if calc.IsPhylogenetic and not calc.Params and \
+                hasattr(calc.Metric, 'batched_phylogenetic'):
+            return True
+    return False
+
+
+# tree and its TreeIndex used by the processes of the pool in
+# collated_rarefied_alpha, which are set once per process rather than being
+# sent with every task
+_worker_tree = None
+_worker_tree_index = None
+
+
+def _init_alpha_worker(tree, tree_index=None):
+    global _worker_tree, _worker_tree_index
+    _worker_tree = tree
+    _worker_tree_index = tree_index
+
+
+def _alpha_for_samples(args):
+    """Returns AlphaDiversityCalcs result for an OTU table of some samples"""
+    otu_table, metrics = args
+    return AlphaDiversityCalcs(get_alpha_calcs(metrics)).getResult(
+        otu_table, _worker_tree, tree_index=_worker_tree_index)
+
+
+def collated_rarefied_alpha(otu_table,
+                            depths,
+                            num_reps,
+                            metrics,
+                            tree=None,
+                            empty_otus_removed=True,
+                            subsample_f=None,
+                            jobs_to_start=1,
+                            rarefaction_dir=None,
+                            alpha_diversity_dir=None):
+    """Computes alpha diversity of rarefied tables, collated by metric
+
+    This is the in-process equivalent of multiple_rarefactions.py,
+    alpha_diversity.py and collate_alpha.py: the rarefied tables (see
+    get_multiple_rare_data) are passed directly to the alpha diversity
+    calculations, and the results are collated in memory.
+
+    otu_table: biom Table
+    depths: rarefaction depths
+    num_reps: number of rarefied tables at each depth
+    metrics: comma separated list of alpha diversity metric names; or list
+    tree: cogent PhyloNode, required for phylogenetic metrics. It is indexed
+     (see TreeIndex) once for all the rarefied tables.
+    empty_otus_removed: if True, OTUs which aren't observed in a rarefied
+     table are removed from it, as multiple_rarefactions.py does by default
+    subsample_f: if not None, each table is rarefied separately with
+     get_rare_data using subsample_f
+    jobs_to_start: if greater than 1, the samples of each rarefied table are
+     split over a pool of this many processes to compute alpha diversity
+    rarefaction_dir, alpha_diversity_dir: if provided, the rarefied tables
+     and their alpha diversity are also written to these directories, as
+     multiple_rarefactions.py and alpha_diversity.py would write them
+
+    Returns (calc_names, all_samples, collated), where collated maps each
+     metric name in calc_names to its rows, formatted as by
+     collate_alpha.make_output_row, and all_samples are the samples in the
+     tables of the smallest depth.
+    """
+    calcs = get_alpha_calcs(metrics)
+    tree_index = None
+    if tree is not None:
+        tree = AlphaDiversityCalcs(calcs).getTree(tree)
+        # index the tree once for all rarefied tables
+        if needs_tree_index(calcs):
+            tree_index = TreeIndex(tree)
+    if jobs_to_start > 1:
+        pool = Pool(jobs_to_start, _init_alpha_worker, (tree, tree_index))
+    else:
+        pool = None
+        _init_alpha_worker(tree, tree_index)
+
+    if subsample_f is None:
+        rare_data = get_multiple_rare_data(otu_table, depths, num_reps)
+    else:
+        rare_data = ((depth, rep, get_rare_data(otu_table, depth,
+                                                subsample_f=subsample_f))
+                     for depth in depths for rep in range(num_reps))
+
+    # (fname, depth, sample ids, alpha diversity) for each rarefied table
+    results = []
+    calc_names = None
+    try:
+        for depth, rep, rare_table in rare_data:
+            if rare_table.is_empty():
+                # multiple_rarefactions.py doesn't write empty tables
+                continue
+            if empty_otus_removed:
+                rare_table = filter_otus_from_otu_table(
+                    rare_table, rare_table.ids(axis='observation'),
+                    1, inf, 0, inf)
+            fname = 'rarefaction_%d_%d' % (depth, rep)
+            if rarefaction_dir is not None:
+                write_biom_table(rare_table, os.path.join(rarefaction_dir,
+                                                          fname + '.biom'))
+
+            sample_ids = list(rare_table.ids())
+            if pool is None:
+                chunk_results = [_alpha_for_samples((rare_table, metrics))]
+            else:
+                # split the samples over the processes. Metadata isn't
+                # needed to compute alpha diversity, and may not be
+                # picklable, so the tables sent to the pool don't have any.
+                matrix = rare_table.matrix_data.tocsc()
+                obs_ids = rare_table.ids(axis='observation')
+                chunk_size = -(-len(sample_ids) // jobs_to_start)
+                tasks = [(Table(matrix[:, i:i + chunk_size], obs_ids,
+                                sample_ids[i:i + chunk_size]), metrics)
+                         for i in range(0, len(sample_ids), chunk_size)]
+                chunk_results = pool.map(_alpha_for_samples, tasks)
+            data = []
+            for chunk_data, chunk_sample_ids, calc_names in chunk_results:
+                data.extend(chunk_data.tolist())
+            data = array(data)
+
+            if alpha_diversity_dir is not None:
+                f = open(os.path.join(alpha_diversity_dir,
+                                      'alpha_%s.txt' % fname), 'w')
+                f.write(format_matrix(data, sample_ids, calc_names))
+                f.close()
+            results.append(('alpha_%s.txt' % fname, depth, sample_ids, data))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if not results:
+        return [], [], {}
+
+    # collate_alpha.py takes the samples from a table of the smallest depth
+    all_samples = min(results, key=lambda r: r[1])[2]
+    all_samples_index = get_sample_index(all_samples)
+    collated = {}
+    for metric in calc_names:
+        collated[metric] = [
+            make_output_row(calc_names, metric, sample_ids, data, fname,
+                            len(all_samples), all_samples, all_samples_index)
+            for fname, depth, sample_ids, data in results]
+    return calc_names, all_samples, collated
+
+
+def write_collated_alpha(collated_alpha, output_dir):
+    """Writes the result of collated_rarefied_alpha to output_dir
+
+    One file is written per metric, as collate_alpha.py writes them.
+    """
+    calc_names, all_samples, collated = collated_alpha
+    for metric in calc_names:
+        write_output_file(collated[metric], output_dir, metric, all_samples)
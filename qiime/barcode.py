@@ -1,4 +1,6 @@
 #!/usr/bin/env python
+from itertools import combinations, product
+
 import numpy
 
 __author__ = "Justin Kuczynski"
@@ -17,6 +19,10 @@ uses bit encoding to determine closest match
 """
 DEFAULT_GOLAY_NT_TO_BITS = {"A": "11", "C": "00", "T": "10", "G": "01"}
 DEFAULT_HAMMING_NT_TO_BITS = {"A": "11", "C": "10", "T": "00", "G": "01"}
+# number of barcodes whose correction is cached by cache_barcode_correction
+BARCODE_CORRECTION_CACHE_SIZE = 2 ** 20
+# nucleotides substituted into barcodes by get_barcode_neighborhoods
+BARCODE_NEIGHBORHOOD_NTS = "ACGT"
 
 
 def correct_barcode(query_seq, seq_possibilities):
@@ -56,6 +62,63 @@ def _edit_dist(s1, s2):
     return dist
 
 
+def get_barcode_neighborhoods(barcodes, max_mismatches=2,
+                              nts=BARCODE_NEIGHBORHOOD_NTS):
+    """ maps each sequence within max_mismatches of a barcode to its hit
+
+    returns a dict of sequence: (best_hit, min_dist), where best_hit and
+    min_dist are what correct_barcode(sequence, barcodes) returns, i.e.
+    best_hit is None if several barcodes are min_dist from the sequence.
+    Only sequences of nts and of the characters in the barcodes are
+    included, so e.g. barcode reads containing N are not in the dict.
+
+    With 12 nt barcodes, each barcode has 630 sequences within 2 mismatches.
+    """
+    barcodes = set(barcodes)
+    nts = sorted(set(nts).union(*barcodes))
+    neighborhoods = dict([(barcode, (barcode, 0)) for barcode in barcodes])
+    for dist in range(1, max_mismatches + 1):
+        tie = (None, dist)
+        for barcode in barcodes:
+            hit = (barcode, dist)
+            for neighbor in _mismatched_seqs(barcode, dist, nts):
+                curr_hit = neighborhoods.get(neighbor)
+                if curr_hit is None:
+                    neighborhoods[neighbor] = hit
+                elif curr_hit[1] == dist and curr_hit[0] != barcode:
+                    # closer hits were added first, so this is a tie
+                    neighborhoods[neighbor] = tie
+    return neighborhoods
+
+
+def _mismatched_seqs(seq, num_mismatches, nts):
+    """ yields each sequence of nts with num_mismatches mismatches to seq"""
+    for positions in combinations(range(len(seq)), num_mismatches):
+        substitutions = [[nt for nt in nts if nt != seq[position]]
+                         for position in positions]
+        for nts_at_positions in product(*substitutions):
+            mismatched_seq = list(seq)
+            for position, nt in zip(positions, nts_at_positions):
+                mismatched_seq[position] = nt
+            yield ''.join(mismatched_seq)
+
+
+def correct_barcode_from_neighborhoods(query_seq, seq_possibilities,
+                                       neighborhoods):
+    """ finds closest match to query_seq, as correct_barcode does
+
+    neighborhoods: result of get_barcode_neighborhoods(seq_possibilities)
+
+    query_seq is looked up in neighborhoods, and only compared with each of
+    seq_possibilities if it is further from them than the neighborhoods
+    reach (or contains other characters than the neighborhoods' nts).
+    """
+    try:
+        return neighborhoods[query_seq]
+    except KeyError:
+        return correct_barcode(query_seq, seq_possibilities)
+
+
 def correct_barcode_bitwise(query_seq, seq_possibilities,
                             nt_to_bits=DEFAULT_GOLAY_NT_TO_BITS):
     """ finds closest (by bit distance) match to query_seq
@@ -78,12 +141,12 @@ def correct_barcode_bitwise(query_seq, seq_possibilities,
     cw4 = AAACCCGGGTCC (hamming distance of 4 from cw1)
     """
     if nt_to_bits is None:
-        nt_to_bits = DEFAULT_NT_TO_BITS
-    dists = []
-    query_seq_bits = seq_to_bits(query_seq, nt_to_bits)
-    for seq in seq_possibilities:
-        possible_seq_bits = seq_to_bits(seq, nt_to_bits)
-        dists.append(hamming_dist(query_seq_bits, possible_seq_bits))
+        nt_to_bits = DEFAULT_GOLAY_NT_TO_BITS
+    # the bitwise hamming distance is the number of 1s in the xor of the
+    # bits of the sequences packed into ints
+    query_seq_int = seq_to_int(query_seq, nt_to_bits)
+    dists = [bin(query_seq_int ^ seq_to_int(seq, nt_to_bits)).count('1')
+             for seq in seq_possibilities]
     min_dist = min(dists)
     number_mins = dists.count(min_dist)
     if number_mins > 1:
@@ -99,6 +162,34 @@ def hamming_dist(v1, v2):
     return edits.sum()
 
 
+def seq_to_int(seq, nt_to_bits):
+    """ e.g.: "AAG" -> 61 (0b111101), for a specific nt_to_bits
+    """
+    return int(''.join([nt_to_bits[nt] for nt in seq]), 2)
+
+
+def cache_barcode_correction(correction_fn,
+                             cache_size=BARCODE_CORRECTION_CACHE_SIZE):
+    """ returns correction_fn, caching its result for each barcode
+
+    correction_fn takes a barcode and returns (corrected barcode, errors),
+    e.g. qiime.golay.decode. The cache is emptied when it holds cache_size
+    barcodes, so a new cached function should be made for each run (e.g.
+    each input file) to correct each erroneous barcode seen in the run once.
+    """
+    cache = {}
+
+    def cached_correction_fn(barcode):
+        try:
+            return cache[barcode]
+        except KeyError:
+            if len(cache) >= cache_size:
+                cache.clear()
+            result = cache[barcode] = correction_fn(barcode)
+            return result
+    return cached_correction_fn
+
+
 def seq_to_bits(seq, nt_to_bits):
     """ e.g.: "AAG" -> array([1,1,1,1,0,1]), for a specific nt_to_bits
     """
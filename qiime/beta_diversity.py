@@ -40,8 +40,12 @@ from biom import load_table
 
 from qiime.util import (FunctionWithParams, TreeMissingError,
                         OtuMissingError)
-from qiime.format import format_matrix, format_distance_matrix
+from qiime.format import (format_matrix, format_distance_matrix,
+                          write_binary_distance_matrix,
+                          write_binary_distance_matrix_rows)
 from qiime.parse import parse_newick, PhyloNode
+from qiime.tree_index import TreeIndex
+from qiime.beta_metrics import UnifracBranches
 import qiime.beta_metrics
 
 
@@ -82,6 +86,19 @@ def get_phylogenetic_metric(name):
                            name.lower())
 
 
+def is_symmetric_metric(name):
+    """Returns whether the distance matrices of the metric are symmetric
+
+    The metrics of distance_transform are symmetric, while phylogenetic
+    metrics may not be (e.g. unifrac_g), see metric.is_symmetric.
+    """
+    try:
+        get_nonphylogenetic_metric(name)
+        return True
+    except AttributeError:
+        return getattr(get_phylogenetic_metric(name), 'is_symmetric', True)
+
+
 def get_phylogenetic_row_metric(name):
     """Gets metric by name from qiime.beta_metrics
 
@@ -92,6 +109,20 @@ def get_phylogenetic_row_metric(name):
     return getattr(qiime.beta_metrics, 'one_sample_' + name.lower())
 
 
+def get_nonphylogenetic_rows_metric(metric_f):
+    """Gets the rows function of a distance_transform metric, or None
+
+    The result is f(data, rows, stats) -> distances from each of rows to all
+    samples, see qiime.beta_metrics.
+    """
+    name = metric_f.__name__
+    if name.startswith('binary_dist_'):
+        name = 'binary_' + name[len('binary_dist_'):]
+    elif name.startswith('dist_'):
+        name = name[len('dist_'):]
+    return getattr(qiime.beta_metrics, 'rows_' + name, None)
+
+
 def list_known_nonphylogenetic_metrics():
     """Lists known metrics by name from distance_transform.
 
@@ -122,8 +153,36 @@ def list_known_metrics():
         list_known_phylogenetic_metrics()
 
 
+def _write_distance_matrix(outfilepath, sample_ids, dissims, binary_output):
+    """Writes the distance matrix of single_file_beta"""
+    if binary_output:
+        write_binary_distance_matrix(outfilepath, sample_ids, dissims)
+    else:
+        f = open(outfilepath, 'w')
+        f.write(format_distance_matrix(sample_ids, dissims))
+        f.close()
+
+
+def _write_distance_matrix_rows(outfilepath, sample_ids, rowids_list,
+                                row_dissims, binary_output):
+    """Writes the rows of the distance matrix computed by single_file_beta
+
+    With binary_output, the rows are written in place into the existing
+    binary distance matrix outfilepath.
+    """
+    if binary_output:
+        write_binary_distance_matrix_rows(outfilepath, sample_ids,
+                                          rowids_list, row_dissims)
+    else:
+        f = open(outfilepath, 'w')
+        f.write(format_matrix(row_dissims, rowids_list, sample_ids,
+                              convert_matching_names_to_zero=True))
+        f.close()
+
+
 def single_file_beta(input_path, metrics, tree_path, output_dir,
-                     rowids=None, full_tree=False):
+                     rowids=None, full_tree=False, tree_index=None,
+                     jobs_to_start=1, binary_output=False):
     """ does beta diversity calc on a single otu table
 
     uses name in metrics to name output beta diversity files
@@ -132,9 +191,20 @@ def single_file_beta(input_path, metrics, tree_path, output_dir,
     inputs:
      input_path (str)
      metrics (str, comma delimited if more than 1 metric; or list)
-     tree_path (str)
+     tree_path (str, or PhyloNode)
      output_dir (str)
      rowids (comma separated str)
+     tree_index (TreeIndex of the tree, built if needed and not provided)
+     jobs_to_start (number of threads computing phylogenetic metrics with
+      batched implementations)
+     binary_output (write binary distance matrices named metric_input.dm,
+      see qiime.format.write_binary_distance_matrix. With rowids, the rows
+      are written in place into these files, which must already exist, e.g.
+      created by qiime.format.preallocate_binary_distance_matrix)
+
+    Phylogenetic metrics with batched implementations (metric.batched) are
+    computed from the sparse counts of the table; the table is only
+    converted to a dense matrix for the other metrics.
     """
     metrics_list = metrics
     try:
@@ -144,9 +214,17 @@ def single_file_beta(input_path, metrics, tree_path, output_dir,
 
     otu_table = load_table(input_path)
 
-    otumtx = asarray([v for v in otu_table.iter_data(axis='sample')])
-
-    if tree_path:
+    # dense samples by OTUs matrix, built on first use
+    otumtx = None
+    # UnifracBranches of the table, built on first use
+    branches = None
+    # statistics of the table used by the rows functions of nonphylogenetic
+    # metrics, shared by all metrics
+    column_stats = {}
+
+    if isinstance(tree_path, PhyloNode):
+        tree = tree_path
+    elif tree_path:
         tree = parse_newick(open(tree_path, 'U'),
                             PhyloNode)
     else:
@@ -154,9 +232,13 @@ def single_file_beta(input_path, metrics, tree_path, output_dir,
 
     input_dir, input_filename = os.path.split(input_path)
     input_basename, input_ext = os.path.splitext(input_filename)
+    if binary_output:
+        output_ext = '.dm'
+    else:
+        output_ext = '.txt'
     for metric in metrics_list:
         outfilepath = os.path.join(output_dir, metric + '_' +
-                                   input_basename + '.txt')
+                                   input_basename + output_ext)
         try:
             metric_f = get_nonphylogenetic_metric(metric)
             is_phylogenetic = False
@@ -172,6 +254,32 @@ def single_file_beta(input_path, metrics, tree_path, output_dir,
                 stderr.write("Could not find metric %s.\n\nKnown metrics are: %s\n"
                              % (metric, ', '.join(list_known_metrics())))
                 exit(1)
+        batched = getattr(metric_f, 'batched', None)
+        if is_phylogenetic and batched is not None:
+            if branches is None:
+                if tree_index is None:
+                    tree_index = TreeIndex(tree)
+                branches = UnifracBranches(otu_table.matrix_data.T.tocsr(),
+                                           otu_table.ids(),
+                                           otu_table.ids(axis='observation'),
+                                           tree_index,
+                                           make_subtree=(not full_tree))
+            if rowids is None:
+                dissims = batched(branches, jobs_to_start=jobs_to_start)
+                _write_distance_matrix(outfilepath, otu_table.ids(), dissims,
+                                       binary_output)
+            else:
+                rowids_list = rowids.split(',')
+                rows = [otu_table.index(rowid, axis='sample')
+                        for rowid in rowids_list]
+                row_dissims = batched(branches, rows=rows,
+                                      jobs_to_start=jobs_to_start)
+                _write_distance_matrix_rows(outfilepath, otu_table.ids(),
+                                            rowids_list, row_dissims,
+                                            binary_output)
+            continue
+        if otumtx is None:
+            otumtx = asarray([v for v in otu_table.iter_data(axis='sample')])
         if rowids is None:
             # standard, full way
             if is_phylogenetic:
@@ -180,26 +288,24 @@ def single_file_beta(input_path, metrics, tree_path, output_dir,
                                    make_subtree=(not full_tree))
             else:
                 dissims = metric_f(otumtx)
-            f = open(outfilepath, 'w')
-            f.write(format_distance_matrix(otu_table.ids(), dissims))
-            f.close()
+            _write_distance_matrix(outfilepath, otu_table.ids(), dissims,
+                                   binary_output)
         else:
             # only calc d(rowid1, *) for each rowid
             rowids_list = rowids.split(',')
-            row_dissims = []  # same order as rowids_list
-            for rowid in rowids_list:
-                rowidx = otu_table.index(rowid, axis='sample')
-
-                # first test if we can the dissim is a fn of only the pair
-                # if not, just calc the whole matrix
-                if metric_f.__name__ == 'dist_chisq' or \
-                        metric_f.__name__ == 'dist_gower' or \
-                        metric_f.__name__ == 'dist_hellinger' or\
-                        metric_f.__name__ == 'binary_dist_chisq':
-                    warnings.warn('dissimilarity ' + metric_f.__name__ +
-                                  ' is not parallelized, calculating the whole matrix...')
-                    row_dissims.append(metric_f(otumtx)[rowidx])
-                else:
+            rows_metric = None
+            if not is_phylogenetic:
+                rows_metric = get_nonphylogenetic_rows_metric(metric_f)
+            if rows_metric is not None:
+                # all rows at once
+                row_dissims = rows_metric(
+                    otumtx, [otu_table.index(rowid, axis='sample')
+                             for rowid in rowids_list], column_stats)
+            else:
+                row_dissims = []  # same order as rowids_list
+                for rowid in rowids_list:
+                    rowidx = otu_table.index(rowid, axis='sample')
+
                     try:
                         row_metric = get_phylogenetic_row_metric(metric)
                     except AttributeError:
@@ -225,18 +331,19 @@ def single_file_beta(input_path, metrics, tree_path, output_dir,
                                              make_subtree=(not full_tree))
                         row_dissims.append(dissims)
 
-            with open(outfilepath, 'w') as f:
-                f.write(format_matrix(row_dissims, rowids_list,
-                                      otu_table.ids(),
-                                      convert_matching_names_to_zero=True))
+            _write_distance_matrix_rows(outfilepath, otu_table.ids(),
+                                        rowids_list, row_dissims,
+                                        binary_output)
 
 
 def multiple_file_beta(input_path, output_dir, metrics, tree_path,
-                       rowids=None, full_tree=False):
+                       rowids=None, full_tree=False, jobs_to_start=1,
+                       binary_output=False):
     """ runs beta diversity for each input file in the input directory
 
     performs minimal error checking on input args, then calls single_file_beta
-    for each file in the input directory
+    for each file in the input directory. The tree is parsed, and indexed for
+    the batched phylogenetic metrics, only once for all files.
 
     inputs:
      input_path (str)
@@ -270,6 +377,15 @@ def multiple_file_beta(input_path, output_dir, metrics, tree_path,
                     "Could not find metric %s.\n\nKnown metrics are: %s\n"
                     % (metric, ', '.join(list_known_metrics())))
 
+    if tree_path:
+        tree = parse_newick(open(tree_path, 'U'), PhyloNode)
+        tree_index = TreeIndex(tree)
+    else:
+        tree = None
+        tree_index = None
+
     for fname in file_names:
         single_file_beta(os.path.join(input_path, fname),
-                         metrics, tree_path, output_dir, rowids, full_tree)
+                         metrics, tree, output_dir, rowids, full_tree,
+                         tree_index=tree_index, jobs_to_start=jobs_to_start,
+                         binary_output=binary_output)
@@ -18,7 +18,10 @@ import cogent.maths.unifrac.fast_tree as fast_tree
  #    G, unnormalized_G, weighted_unifrac)
 from cogent.maths.unifrac.fast_unifrac import fast_unifrac, fast_unifrac_one_sample
 from qiime.parse import make_envs_dict
+from qiime.tree_index import TreeIndex
 import numpy as np
+from scipy.sparse import csr_matrix
+from multiprocessing.pool import ThreadPool
 import warnings
 
 
@@ -45,6 +48,7 @@ def make_unifrac_metric(weighted, metric, is_symmetric):
         dist_mtx = _reorder_unifrac_res(unifrac_res['distance_matrix'],
                                         sample_names)
         return dist_mtx
+    result.is_symmetric = is_symmetric
     return result
 
 # these should start with dist_ to be discoverable by beta_diversity.py
@@ -66,6 +70,331 @@ dist_unifrac_g_full_tree = make_unifrac_metric(False,
                                                fast_tree.unnormalized_G, False)
 
 
+def _nodes_to_root(tree_index, nodes):
+    """Returns mask of the nodes on the path from any of nodes to the root"""
+    result = np.zeros(len(tree_index.Parent), dtype=bool)
+    result[nodes] = True
+    for level in tree_index.Levels[:-1]:
+        level = level[result[level]]
+        result[tree_index.Parent[level]] = True
+    result[-1] = True
+    return result
+
+
+class UnifracBranches(object):
+
+    """Per-sample counts on the branches of a tree, for UniFrac metrics
+
+    The counts of each sample on the tips of the tree are indexed once, and
+    summed from the tips to the root for blocks of samples at a time (see
+    values), so that UniFrac distances can be computed for all pairs of
+    samples from a few array operations per pair of blocks (see distances)
+    rather than by walking the tree for each pair.
+
+    Only the branches on the path from an OTU observed in the table to the
+    root are represented, as the other branches don't contribute to the
+    distances, except through TotalLength.
+    """
+
+    def __init__(self, sample_counts, sample_ids, otu_ids, tree_index,
+                 make_subtree=True, block_size=None):
+        """
+        sample_counts: scipy.sparse matrix of counts, samples by OTUs
+        sample_ids: the sample of each row of sample_counts
+        otu_ids: the OTU of each column of sample_counts
+        tree_index: TreeIndex of the tree, which can be shared by any number
+         of tables
+        make_subtree: if True, TotalLength (used by the full_tree metrics)
+         is the length of the branches on the path from an OTU of the table
+         to the root, as if the tree was reduced to the OTUs of the table;
+         otherwise it is the length of the whole tree
+        block_size: number of samples of each block, by default chosen so
+         that a block's values take up about 32MB
+        """
+        counts = sample_counts.tocoo()
+        tips = tree_index.tip_indices(otu_ids)
+        # OTUs which aren't in the tree are ignored
+        keep = (tips[counts.col] >= 0) & (counts.data != 0)
+        rows = counts.row[keep]
+        nodes = tips[counts.col[keep]]
+        data = counts.data[keep].astype(np.float64)
+
+        # the nodes on the path from each observed tip to the root
+        used = _nodes_to_root(tree_index, nodes)
+        used_nodes = np.nonzero(used)[0]
+        local = np.empty(len(used), dtype=np.int32)
+        local[used_nodes] = np.arange(len(used_nodes))
+
+        self.Length = tree_index.Length[used_nodes]
+        parents = tree_index.Parent[used_nodes]
+        self.Parent = np.where(parents >= 0, local[parents], -1)
+        if make_subtree:
+            # as fast_unifrac, keep the tips of all OTUs of the table, even
+            # if they aren't observed
+            self.TotalLength = tree_index.Length[
+                _nodes_to_root(tree_index, tips[tips >= 0])].sum()
+        else:
+            self.TotalLength = tree_index.Length.sum()
+
+        # for each level, the nodes sorted by parent, their parents, and the
+        # start of each parent's children
+        self._steps = []
+        for level in tree_index.Levels[:-1]:
+            level = local[level[used[level]]]
+            if not len(level):
+                continue
+            level = level[np.argsort(self.Parent[level], kind='mergesort')]
+            parents = self.Parent[level]
+            starts = np.concatenate(([0], np.nonzero(np.diff(parents))[0] + 1))
+            self._steps.append((level, parents[starts], starts))
+
+        num_samples = sample_counts.shape[0]
+        self.SampleIds = list(sample_ids)
+        self.TipCounts = csr_matrix((data, (rows, local[nodes])),
+                                    shape=(num_samples, len(used_nodes)))
+        self.Totals = np.bincount(rows, weights=data, minlength=num_samples)
+        # mean distance from the root of each sample's sequences
+        self.TipDistances = np.bincount(
+            rows, weights=data * tree_index.Distance[nodes],
+            minlength=num_samples)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.TipDistances /= self.Totals
+        self.Present = self.Totals > 0
+
+        if block_size is None:
+            block_size = 4194304 // len(used_nodes)
+        self.BlockSize = max(1, min(block_size, num_samples))
+
+    def values(self, samples):
+        """Returns the counts of samples on each branch, branches by samples
+
+        samples: array of sample indices
+        """
+        result = self.TipCounts[samples].T.toarray()
+        for level, parents, starts in self._steps:
+            result[parents] += np.add.reduceat(result[level], starts, axis=0)
+        return result
+
+    def proportions(self, samples, values):
+        """Returns values scaled by the total count of each sample"""
+        totals = self.Totals[samples]
+        return values / np.where(totals > 0, totals, 1)
+
+    def distances(self, block_metric, is_symmetric=True, rows=None,
+                  jobs_to_start=1):
+        """Returns the distance matrix of the samples
+
+        block_metric: f(branches, a, values_a, b, values_b) -> distances
+         between samples a and samples b, where a and b are arrays of sample
+         indices and values_a, values_b their result from values
+        is_symmetric: if True, block_metric is only computed for one of each
+         pair of blocks
+        rows: if not None, array of the sample indices of the rows of the
+         distance matrix, which otherwise includes all samples
+        jobs_to_start: number of threads computing rows of blocks
+
+        Samples with no counts on the tree are at distance 1 from the other
+        samples, and at distance 0 from each other, with a warning, as by
+        the distance matrices of make_unifrac_metric.
+        """
+        num_samples = len(self.Totals)
+        if not self.Present.any():
+            raise ValueError("No valid samples/environments found. Check "
+                             "whether tree tips match otus/taxa present in "
+                             "samples/environments")
+        blocks = [np.arange(i, min(i + self.BlockSize, num_samples))
+                  for i in range(0, num_samples, self.BlockSize)]
+        if rows is None:
+            result = np.zeros((num_samples, num_samples))
+
+            def compute(i):
+                a = blocks[i]
+                values_a = self.values(a)
+                for j in range(i, len(blocks)):
+                    b = blocks[j]
+                    values_b = values_a if j == i else self.values(b)
+                    block = block_metric(self, a, values_a, b, values_b)
+                    result[a[0]:a[-1] + 1, b[0]:b[-1] + 1] = block
+                    if is_symmetric:
+                        block = block.T
+                    else:
+                        block = block_metric(self, b, values_b, a, values_a)
+                    result[b[0]:b[-1] + 1, a[0]:a[-1] + 1] = block
+            tasks = range(len(blocks))
+            result_rows = np.arange(num_samples)
+        else:
+            rows = np.asarray(rows)
+            result = np.zeros((len(rows), num_samples))
+            values_rows = self.values(rows)
+
+            def compute(j):
+                b = blocks[j]
+                result[:, b[0]:b[-1] + 1] = block_metric(
+                    self, rows, values_rows, b, self.values(b))
+            tasks = range(len(blocks))
+            result_rows = rows
+
+        if jobs_to_start > 1:
+            pool = ThreadPool(jobs_to_start)
+            try:
+                pool.map(compute, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for task in tasks:
+                compute(task)
+
+        # distances involving samples with no counts on the tree
+        absent = ~self.Present
+        if absent.any():
+            for i in np.nonzero(absent)[0]:
+                warnings.warn('unifrac had no information for sample ' +
+                              self.SampleIds[i] + ". Distances involving "
+                              "that sample aren't meaningful")
+            result[:, absent] = 1.0
+            result[absent[result_rows]] = 1.0
+            if rows is None:
+                result[np.ix_(absent, absent)] = 0.0
+        result[np.arange(len(result_rows)), result_rows] = 0.0
+        return result
+
+
+def _unweighted_block(branches, a, values_a, b, values_b):
+    """Returns the shared and the observed branch length of each pair"""
+    present_a = (values_a > 0).astype(np.float64)
+    present_b = (values_b > 0).astype(np.float64)
+    length_a = np.dot(branches.Length, present_a)
+    length_b = np.dot(branches.Length, present_b)
+    shared = np.dot((present_a * branches.Length[:, np.newaxis]).T,
+                    present_b)
+    observed = length_a[:, np.newaxis] + length_b - shared
+    return length_a, shared, observed
+
+
+def unweighted_unifrac_block(branches, a, values_a, b, values_b):
+    """Unique over observed branch length, see fast_tree.unifrac"""
+    length_a, shared, observed = _unweighted_block(branches, a, values_a,
+                                                   b, values_b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (observed - shared) / observed
+
+
+def unweighted_unifrac_full_tree_block(branches, a, values_a, b, values_b):
+    """Unique over total branch length, see fast_tree.unnormalized_unifrac"""
+    length_a, shared, observed = _unweighted_block(branches, a, values_a,
+                                                   b, values_b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (observed - shared) / branches.TotalLength
+
+
+def unifrac_g_block(branches, a, values_a, b, values_b):
+    """Branch length only in a over observed length, see fast_tree.G"""
+    length_a, shared, observed = _unweighted_block(branches, a, values_a,
+                                                   b, values_b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (length_a[:, np.newaxis] - shared) / observed
+
+
+def unifrac_g_full_tree_block(branches, a, values_a, b, values_b):
+    """Branch length only in a over total length, see fast_tree.unnormalized_G
+    """
+    length_a, shared, observed = _unweighted_block(branches, a, values_a,
+                                                   b, values_b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (length_a[:, np.newaxis] - shared) / branches.TotalLength
+
+
+def weighted_unifrac_block(branches, a, values_a, b, values_b):
+    """Branch length weighted by the difference in proportions of each pair,
+    see fast_tree.weighted_unifrac
+    """
+    proportions_a = branches.proportions(a, values_a)
+    proportions_b = branches.proportions(b, values_b)
+    result = np.empty((len(a), len(b)))
+    for i in range(len(a)):
+        result[i] = np.dot(branches.Length,
+                           np.abs(proportions_b -
+                                  proportions_a[:, i:i + 1]))
+    return result
+
+
+def weighted_normalized_unifrac_block(branches, a, values_a, b, values_b):
+    """Weighted UniFrac divided by the sum of the mean distances of each
+    sample's sequences from the root, as by fast_unifrac(weighted='correct')
+    """
+    result = weighted_unifrac_block(branches, a, values_a, b, values_b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return result / (branches.TipDistances[a][:, np.newaxis] +
+                         branches.TipDistances[b])
+
+
+def make_generalized_unifrac_block(alpha):
+    """Returns the block metric of generalized UniFrac with parameter alpha
+
+    The distance between samples with proportions p and q on the branches is
+    sum(l * (p + q) ** alpha * |p - q| / (p + q)) / sum(l * (p + q) ** alpha)
+    over branches of length l (Chen et al., 2012, Bioinformatics 28:2106).
+    """
+    def result(branches, a, values_a, b, values_b):
+        proportions_a = branches.proportions(a, values_a)
+        proportions_b = branches.proportions(b, values_b)
+        lengths = branches.Length[:, np.newaxis]
+        result = np.empty((len(a), len(b)))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in range(len(a)):
+                p = proportions_a[:, i:i + 1]
+                total = proportions_b + p
+                # branches observed in neither sample are left out
+                weights = np.where(total > 0, lengths * total ** alpha, 0)
+                numerator = np.where(
+                    total > 0, weights * np.abs(proportions_b - p) / total, 0)
+                result[i] = numerator.sum(0) / weights.sum(0)
+        return result
+    return result
+
+
+def make_batched_unifrac_metric(block_metric, is_symmetric):
+    """Make the batched implementation of a unifrac-like metric
+
+    The result is f(branches, rows=None, jobs_to_start=1) -> distance
+     matrix, where branches is an UnifracBranches of the table (see
+     UnifracBranches.distances).
+    """
+    def result(branches, rows=None, jobs_to_start=1):
+        return branches.distances(block_metric, is_symmetric, rows,
+                                  jobs_to_start)
+    return result
+
+dist_unweighted_unifrac.batched = make_batched_unifrac_metric(
+    unweighted_unifrac_block, True)
+dist_unweighted_unifrac_full_tree.batched = make_batched_unifrac_metric(
+    unweighted_unifrac_full_tree_block, True)
+dist_weighted_unifrac.batched = make_batched_unifrac_metric(
+    weighted_unifrac_block, True)
+dist_weighted_normalized_unifrac.batched = make_batched_unifrac_metric(
+    weighted_normalized_unifrac_block, True)
+dist_unifrac_g.batched = make_batched_unifrac_metric(unifrac_g_block, False)
+dist_unifrac_g_full_tree.batched = make_batched_unifrac_metric(
+    unifrac_g_full_tree_block, False)
+
+
+def dist_generalized_unifrac(data, taxon_names, tree, sample_names,
+                             make_subtree=True, alpha=0.5):
+    """Generalized UniFrac distance matrix, in the order of sample_names
+
+    data: samples by taxa counts
+    alpha: weight of abundant lineages, between 0 (close to unweighted
+     UniFrac) and 1 (weighted normalized UniFrac)
+    """
+    branches = UnifracBranches(csr_matrix(data), sample_names, taxon_names,
+                               TreeIndex(tree), make_subtree)
+    return branches.distances(make_generalized_unifrac_block(alpha))
+
+dist_generalized_unifrac.batched = make_batched_unifrac_metric(
+    make_generalized_unifrac_block(0.5), True)
+
+
 def make_unifrac_row_metric(weighted, metric, is_symmetric):
     """Make a unifrac-like metric, for only one row of the dissm mtx
 
@@ -118,6 +447,245 @@ one_sample_unifrac_g_full_tree = make_unifrac_row_metric(False,
                                                          fast_tree.unnormalized_G, False)
 
 
+# Rows of the distance matrices of distance_transform metrics.
+# rows_<name>(data, rows, stats=None) returns the distances from each of rows
+# (indices of rows of data) to every row of data, as the corresponding
+# distance_transform function would compute them on the whole of data.
+# Statistics of the whole matrix (e.g. column sums for chisq) are stored in
+# stats the first time they're needed, so the same dict should be passed for
+# every block of rows of the same data.
+
+
+def _get_stat(stats, name, f):
+    """Returns stats[name], setting it to f() if needed"""
+    if name not in stats:
+        stats[name] = f()
+    return stats[name]
+
+
+def _binary(data, stats):
+    """Returns data converted to presence/absence, and its stats dict"""
+    binary_stats = _get_stat(stats, 'binary', dict)
+    return (_get_stat(binary_stats, 'data',
+                      lambda: data.astype(bool).astype(float)),
+            binary_stats)
+
+
+def _row_sums(data, stats):
+    return _get_stat(stats, 'row_sums', lambda: data.sum(axis=1))
+
+
+def _rows(data, rows, row_f):
+    """Returns array of row_f(data[i]) for i in rows, with 0 for d(i, i)"""
+    result = np.empty((len(rows), data.shape[0]))
+    for k, i in enumerate(rows):
+        result[k] = row_f(i, data[i])
+        result[k, i] = 0.0
+    return result
+
+
+def _zero_sums(dists, row_sum, row_sums):
+    """Sets distances involving rows of zeros, as distance_transform does
+
+    two rows of all zeros are at distance 0, and an all zero row is at
+    distance 1 from a row which isn't all zeros.
+    """
+    if row_sum == 0.0:
+        return np.where(row_sums == 0.0, 0.0, 1.0)
+    dists[row_sums == 0.0] = 1.0
+    return dists
+
+
+def rows_chisq(data, rows, stats=None):
+    """Rows of distance_transform.dist_chisq(data)"""
+    if stats is None:
+        stats = {}
+    row_sums = _row_sums(data, stats)
+
+    def column_sums():
+        result = data.sum(axis=0)
+        result[result == 0.0] = 1.0
+        return result
+    column_sums = _get_stat(stats, 'column_sums', column_sums)
+    sqrt_grand_sum = np.sqrt(row_sums.sum())
+    with np.errstate(divide='ignore', invalid='ignore'):
+        profiles = _get_stat(stats, 'profiles',
+                             lambda: data / row_sums[:, np.newaxis])
+
+    def row_f(i, row):
+        with np.errstate(invalid='ignore'):
+            dists = sqrt_grand_sum * np.sqrt(
+                ((profiles - profiles[i]) ** 2 / column_sums).sum(axis=1))
+        return _zero_sums(dists, row_sums[i], row_sums)
+    return _rows(data, rows, row_f)
+
+
+def rows_binary_chisq(data, rows, stats=None):
+    """Rows of distance_transform.binary_dist_chisq(data)"""
+    if stats is None:
+        stats = {}
+    binary_data, binary_stats = _binary(data, stats)
+    return rows_chisq(binary_data, rows, binary_stats)
+
+
+def rows_gower(data, rows, stats=None):
+    """Rows of distance_transform.dist_gower(data)"""
+    if stats is None:
+        stats = {}
+
+    def column_ranges():
+        result = data.max(axis=0) - data.min(axis=0)
+        result[result == 0.0] = 1.0
+        return result
+    column_ranges = _get_stat(stats, 'column_ranges', column_ranges)
+    return _rows(data, rows, lambda i, row:
+                 (np.abs(data - row) / column_ranges).sum(axis=1))
+
+
+def _rows_normalized_euclidean(data, rows, norms, transform):
+    """Rows of the distances between transform(row / norm) of each row"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        transformed = transform(data / norms[:, np.newaxis])
+
+    def row_f(i, row):
+        with np.errstate(invalid='ignore'):
+            dists = np.sqrt(((transformed - transformed[i]) ** 2).sum(axis=1))
+        return _zero_sums(dists, norms[i], norms)
+    return _rows(data, rows, row_f)
+
+
+def rows_hellinger(data, rows, stats=None):
+    """Rows of distance_transform.dist_hellinger(data)"""
+    if stats is None:
+        stats = {}
+    return _rows_normalized_euclidean(data, rows, _row_sums(data, stats),
+                                      np.sqrt)
+
+
+def rows_specprof(data, rows, stats=None):
+    """Rows of distance_transform.dist_specprof(data)"""
+    if stats is None:
+        stats = {}
+    return _rows_normalized_euclidean(data, rows, _row_sums(data, stats),
+                                      lambda profiles: profiles)
+
+
+def rows_chord(data, rows, stats=None):
+    """Rows of distance_transform.dist_chord(data)"""
+    if stats is None:
+        stats = {}
+    norms = _get_stat(stats, 'norms', lambda: np.sqrt((data ** 2).sum(axis=1)))
+    return _rows_normalized_euclidean(data, rows, norms,
+                                      lambda profiles: profiles)
+
+
+def rows_euclidean(data, rows, stats=None):
+    """Rows of distance_transform.dist_euclidean(data)"""
+    return _rows(data, rows, lambda i, row:
+                 np.sqrt(((data - row) ** 2).sum(axis=1)))
+
+
+def rows_binary_euclidean(data, rows, stats=None):
+    """Rows of distance_transform.binary_dist_euclidean(data)"""
+    if stats is None:
+        stats = {}
+    return rows_euclidean(_binary(data, stats)[0], rows)
+
+
+def rows_manhattan(data, rows, stats=None):
+    """Rows of distance_transform.dist_manhattan(data)"""
+    return _rows(data, rows, lambda i, row: np.abs(data - row).sum(axis=1))
+
+
+def rows_bray_curtis(data, rows, stats=None):
+    """Rows of distance_transform.dist_bray_curtis(data)"""
+    if stats is None:
+        stats = {}
+    row_sums = _row_sums(data, stats)
+
+    def row_f(i, row):
+        totals = row_sums + row_sums[i]
+        dists = np.abs(data - row).sum(axis=1)
+        return np.where(totals > 0, dists / np.where(totals > 0, totals, 1),
+                        0.0)
+    return _rows(data, rows, row_f)
+
+
+def rows_kulczynski(data, rows, stats=None):
+    """Rows of distance_transform.dist_kulczynski(data)"""
+    if stats is None:
+        stats = {}
+    row_sums = _row_sums(data, stats)
+
+    def row_f(i, row):
+        min_sums = np.minimum(data, row).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dists = 1.0 - (min_sums / row_sums[i] + min_sums / row_sums) / 2.0
+        return _zero_sums(dists, row_sums[i], row_sums)
+    return _rows(data, rows, row_f)
+
+
+def rows_soergel(data, rows, stats=None):
+    """Rows of distance_transform.dist_soergel(data)"""
+    def row_f(i, row):
+        top = np.abs(data - row).sum(axis=1)
+        bottom = np.maximum(data, row).sum(axis=1)
+        return np.where(bottom > 0.0,
+                        top / np.where(bottom > 0.0, bottom, 1.0), 0.0)
+    return _rows(data, rows, row_f)
+
+
+def rows_canberra(data, rows, stats=None):
+    """Rows of distance_transform.dist_canberra(data)"""
+    def row_f(i, row):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            net = np.nan_to_num(np.abs(data - row) / (data + row))
+            return np.nan_to_num(net.sum(axis=1) /
+                                 (net != 0).sum(axis=1))
+    return _rows(data, rows, row_f)
+
+
+def _rows_binary_shared(data, rows, stats, dist_f):
+    """Rows of dist_f(a, b, c) of presence/absence data, where a and b are
+    the number of columns present in each row, and c in both
+    """
+    data, binary_stats = _binary(data, stats)
+    row_sums = _row_sums(data, binary_stats)
+    return _rows(data, rows, lambda i, row:
+                 dist_f(row_sums[i], row_sums, np.dot(data, row)))
+
+
+def rows_binary_jaccard(data, rows, stats=None):
+    """Rows of distance_transform.binary_dist_jaccard(data)"""
+    if stats is None:
+        stats = {}
+
+    def dist_f(a, b, c):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where((a == 0.0) & (b == 0.0), 0.0,
+                            1.0 - (c / (a + b - c)))
+    return _rows_binary_shared(data, rows, stats, dist_f)
+
+
+def rows_binary_sorensen_dice(data, rows, stats=None):
+    """Rows of distance_transform.binary_dist_sorensen_dice(data)"""
+    if stats is None:
+        stats = {}
+
+    def dist_f(a, b, c):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(a + b != 0, 1 - (2 * c / (a + b)), 0.0)
+    return _rows_binary_shared(data, rows, stats, dist_f)
+
+
+def rows_binary_hamming(data, rows, stats=None):
+    """Rows of distance_transform.binary_dist_hamming(data)"""
+    if stats is None:
+        stats = {}
+    return _rows_binary_shared(data, rows, stats,
+                               lambda a, b, c: a + b - (2.0 * c))
+
+
 def _reorder_unifrac_res(unifrac_res, sample_names_in_desired_order):
     """ reorder unifrac result
 
@@ -47,9 +47,24 @@ def write_output_file(metric_file_data, output_dir, metric, all_samples):
     f.close()
 
 
+def get_sample_index(all_samples):
+    """Returns dict mapping each sample id to its first index in all_samples"""
+    result = {}
+    for i, sample in enumerate(all_samples):
+        result.setdefault(sample, i)
+    return result
+
+
 def make_output_row(f_metrics, metric, f_samples, f_data,
-                    fname, num_cols, all_samples):
+                    fname, num_cols, all_samples, all_samples_index=None):
+    """Returns the collated row of metric for one alpha diversity file
+
+    all_samples_index: the result of get_sample_index(all_samples), which
+     can be passed when building many rows to avoid rebuilding it
+    """
     f_col = f_metrics.index(metric)
+    if all_samples_index is None:
+        all_samples_index = get_sample_index(all_samples)
 
     # first 3 cols are fname, seqs/sample, iteration
     try:
@@ -59,12 +74,13 @@ def make_output_row(f_metrics, metric, f_samples, f_data,
     output_row = [fname] + ['n/a'] * num_cols
     for f_row, sample in enumerate(f_samples):
         try:
-            output_row[all_samples.index(sample) + 1] = \
+            output_row[all_samples_index[sample] + 1] = \
                 str(f_data[f_row, f_col])
-        except IndexError:
+        except KeyError:
             print("warning, didn't find sample in example file." +
                   "exiting", sample, fname, metric)
-            raise  # re-raise error
+            raise ValueError("%s is not in the example file's samples" %
+                             sample)
 
     output_row.insert(1, seqs)
     output_row.insert(2, iter)
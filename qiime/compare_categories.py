@@ -14,10 +14,9 @@ from os.path import join
 from types import ListType
 
 import pandas as pd
-from skbio.stats.distance import DistanceMatrix
 from skbio.stats.distance import anosim, permanova, bioenv
 
-from qiime.parse import parse_mapping_file_to_dict
+from qiime.parse import parse_mapping_file_to_dict, parse_distmat_to_skbio
 from qiime.util import get_qiime_temp_dir, MetadataMap, RExecutor
 
 methods = ['adonis', 'anosim', 'bioenv', 'morans_i', 'mrpp', 'permanova',
@@ -60,7 +59,7 @@ def compare_categories(dm_fp, map_fp, method, categories, num_perms, out_dir):
                          "analyses). Please choose a different metadata "
                          "column to perform statistical tests on.")
 
-    dm = DistanceMatrix.read(dm_fp)
+    dm = parse_distmat_to_skbio(dm_fp)
 
     if method in ('anosim', 'permanova', 'bioenv'):
         with open(map_fp, 'U') as map_f:
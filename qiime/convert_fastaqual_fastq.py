@@ -12,9 +12,9 @@ __email__ = "adam.robbinspianka@colorado.edu"
 
 from os import path
 from itertools import izip
-from collections import defaultdict
 
 from qiime.parse import QiimeParseError, MinimalQualParser
+from qiime.sequence_writer import SequenceWriter
 from skbio.parse.sequences import parse_fasta
 from skbio.parse.sequences import parse_fastq
 
@@ -90,9 +90,12 @@ def convert_fastq(fasta_file_path, qual_file_path, output_directory='.',
                                                      '.fastq',
                                                      output_directory)
 
-        fastq_file = open(output_file_path, 'w')
+        fastq_file = SequenceWriter(output_file_path, background=True)
     else:
-        fastq_lookup = defaultdict(str)
+        # one writer per output file, each of which opens its file only
+        # when per_file_buffer_size bytes of records have accumulated, to
+        # avoid using up all the OS's filehandles
+        fastq_lookup = {}
 
     # iterate through the FASTA and QUAL files entry by entry (assume the
     # entries are synchronized)
@@ -123,10 +126,13 @@ def convert_fastq(fasta_file_path, qual_file_path, output_directory='.',
                                                          '.fastq',
                                                          output_directory)
 
-            # when we use multiple output files, we close each file after each
-            # sequence is written to avoid using up all the file handles, so
-            # we must open the file each time in append mode
-            # fastq_file = open(output_file_path, 'a')
+            try:
+                fastq_file = fastq_lookup[output_file_path]
+            except KeyError:
+                fastq_file = fastq_lookup[output_file_path] =\
+                    SequenceWriter(output_file_path,
+                                   buffer_size=per_file_buffer_size,
+                                   append=True, reopen=True)
 
         if full_fasta_headers:
             fastq_sequence_header = fasta_header
@@ -138,51 +144,18 @@ def convert_fastq(fasta_file_path, qual_file_path, output_directory='.',
         else:
             fastq_quality_header = ''
 
-        # Writing to FASTQ file
-        record = '@%s\n%s\n+%s\n' % (fastq_sequence_header,
-                                     sequence,
-                                     fastq_quality_header)
-
-        if multiple_output_files:
-            fastq_lookup[output_file_path] += record
-        else:
-            fastq_file.write(record)
-
-        for qual_score in qual:
-            # increment the qual score by the asciiIncrement (default 33),
-            # and print the corresponding character, which represents that
-            # position's quality.
-            qual_score += ascii_increment
-            if qual_score < 32 or qual_score > 126:
-                raise ValueError("Cannot convert quality score to ASCII code" +
-                                 " between 32 and 126: " + str(qual_score - ascii_increment) +
-                                 "using ascii_increment = " + str(ascii_increment))
-
-            if multiple_output_files:
-                fastq_lookup[output_file_path] += chr(qual_score)
-            else:
-                fastq_file.write(chr(qual_score))
-
-        if multiple_output_files:
-            fastq_lookup[output_file_path] += '\n'
-        else:
-            fastq_file.write('\n')
-
-        if multiple_output_files:
-            if len(fastq_lookup[output_file_path]) >= per_file_buffer_size:
-                fastq_file = open(output_file_path, 'a')
-                fastq_file.write(fastq_lookup[output_file_path])
-                fastq_lookup[output_file_path] = ''
-                fastq_file.close()
+        # Writing to FASTQ file, each qual score is incremented by the
+        # ascii_increment (default 33), and written as the corresponding
+        # character, which represents that position's quality. A ValueError
+        # is raised if the character isn't printable.
+        fastq_file.write_fastq(fastq_sequence_header, sequence, qual,
+                               ascii_increment, fastq_quality_header)
 
     # write last seqs to output files, or close the output file if thre is only
     # one
     if multiple_output_files:
-        for output_file_path, records in fastq_lookup.iteritems():
-            if records:
-                fastq_file = open(output_file_path, 'a')
-                fastq_file.write(records)
-                fastq_file.close()
+        for fastq_file in fastq_lookup.values():
+            fastq_file.close()
     else:
         fastq_file.close()
 
@@ -215,12 +188,15 @@ def convert_fastaqual(fasta_file_path, output_directory='.',
                                                 '.qual',
                                                 output_directory)
 
-        fasta_out_f = open(fasta_out_fp, 'w')
-        qual_out_f = open(qual_out_fp, 'w')
+        fasta_out_f = SequenceWriter(fasta_out_fp, background=True)
+        qual_out_f = SequenceWriter(qual_out_fp, background=True)
 
     else:
-        fasta_out_lookup = defaultdict(str)
-        qual_out_lookup = defaultdict(str)
+        # one writer per output file, each of which opens its file only
+        # when per_file_buffer_size bytes of records have accumulated, to
+        # avoid using up all the OS's filehandles
+        fasta_out_lookup = {}
+        qual_out_lookup = {}
 
     fpo = ascii_increment
     for header, sequence, qual in parse_fastq(open(fastq_fp, 'U'),
@@ -237,6 +213,18 @@ def convert_fastaqual(fasta_file_path, output_directory='.',
             qual_out_fp = get_filename_with_new_ext(fastq_fp,
                                                     '_' + sample_id + '.qual',
                                                     output_directory)
+            try:
+                fasta_out_f = fasta_out_lookup[fasta_out_fp]
+                qual_out_f = qual_out_lookup[qual_out_fp]
+            except KeyError:
+                fasta_out_f = fasta_out_lookup[fasta_out_fp] =\
+                    SequenceWriter(fasta_out_fp,
+                                   buffer_size=per_file_buffer_size,
+                                   append=True, reopen=True)
+                qual_out_f = qual_out_lookup[qual_out_fp] =\
+                    SequenceWriter(qual_out_fp,
+                                   buffer_size=per_file_buffer_size,
+                                   append=True, reopen=True)
 
         if full_fasta_headers:
             label = header
@@ -247,51 +235,15 @@ def convert_fastaqual(fasta_file_path, output_directory='.',
                              str(ascii_increment))
 
         # write QUAL file, 60 qual scores per line
-        qual_record = [">%s\n" % label]
-        for i in range(0, len(qual), 60):
-            qual_record.append(' '.join([str(q) for q in qual[i:i + 60]]))
-            qual_record.append('\n')
-        qual_record = ''.join(qual_record)
-
-        if multiple_output_files:
-            qual_out_lookup[qual_out_fp] += qual_record
-        else:
-            qual_out_f.write(qual_record)
+        qual_out_f.write_qual(label, qual)
 
         # write FASTA file
-        fasta_record = '>%s\n%s\n' % (label, sequence)
-        if multiple_output_files:
-            fasta_out_lookup[fasta_out_fp] += fasta_record
-        else:
-            fasta_out_f.write(fasta_record)
-
-        # if we're writing multiple output files, we must close after each
-        # sequeunce write to avoid potentiallyusing up all the OS's filehandles
-        if multiple_output_files:
-            if fasta_out_lookup[fasta_out_fp] >= per_file_buffer_size:
-                fasta_f = open(fasta_out_fp, 'a')
-                fasta_f.write(fasta_out_lookup[fasta_out_fp])
-                fasta_f.close()
-                fasta_out_lookup[fasta_out_fp] = ''
-
-                qual_f = open(qual_out_fp, 'a')
-                qual_f.write(qual_out_lookup[qual_out_fp])
-                qual_f.close()
-                qual_out_lookup[qual_out_fp] = ''
+        fasta_out_f.write_fasta(label, sequence)
 
     # if we have one output file, close it now
     if multiple_output_files:
-        for fasta_out_fp, records in fasta_out_lookup.iteritems():
-            if records:
-                fasta_f = open(fasta_out_fp, 'a')
-                fasta_f.write(records)
-                fasta_f.close()
-
-        for qual_out_fp, records in qual_out_lookup.iteritems():
-            if records:
-                qual_f = open(qual_out_fp, 'a')
-                qual_f.write(records)
-                qual_f.close()
+        for output_f in fasta_out_lookup.values() + qual_out_lookup.values():
+            output_f.close()
     else:
         fasta_out_f.close()
         qual_out_f.close()
@@ -32,7 +32,9 @@ from qiime.parse import QiimeParseError, MinimalQualParser
 from qiime.hamming import decode_barcode_8
 from qiime.golay import decode as decode_golay_12
 from qiime.check_id_map import process_id_map
-from qiime.barcode import correct_barcode
+from qiime.sequence_writer import SequenceWriter, format_qual_scores
+from qiime.barcode import (correct_barcode, get_barcode_neighborhoods,
+                           correct_barcode_from_neighborhoods)
 
 """ This library contains the code for demultiplexing 454 data.  Apart from
     barcode correction/mismatch counts, this code does not quality
@@ -47,6 +49,11 @@ from qiime.barcode import correct_barcode
     not be demultiplexed will be written to seqs_not_assigned.fna (and .qual
     if qual score file(s) are supplied)."""
 
+# generic barcodes are corrected with precomputed neighborhoods of up to this
+# many mismatches, barcode reads further from all barcodes are compared with
+# each barcode
+BC_NEIGHBORHOOD_MAX_MISMATCHES = 2
+
 
 def process_files_and_demultiplex_sequences(mapping_file,
                                             fasta_files,
@@ -90,17 +97,19 @@ def process_files_and_demultiplex_sequences(mapping_file,
     file_data['qual_files'] = qual_files
     file_data['mapping_file'] = open(mapping_file, "U")
 
-    file_data['demultiplexed_seqs_f'] = open(join(output_dir,
-                                                  "demultiplexed_seqs.fna.incomplete"), "w")
+    # Output is buffered and written in large blocks by background threads
+    file_data['demultiplexed_seqs_f'] = SequenceWriter(join(output_dir,
+                                                            "demultiplexed_seqs.fna.incomplete"), background=True)
     if qual_files:
-        file_data['demultiplexed_qual_f'] = open(join(output_dir,
-                                                      "demultiplexed_seqs.qual.incomplete"), "w")
+        file_data['demultiplexed_qual_f'] = SequenceWriter(join(output_dir,
+                                                                "demultiplexed_seqs.qual.incomplete"), background=True)
     if write_unassigned_reads:
-        file_data['unassigned_seqs_f'] = open(join(output_dir,
-                                                   "unassigned_seqs.fna.incomplete"), "w")
+        file_data['unassigned_seqs_f'] = SequenceWriter(join(output_dir,
+                                                             "unassigned_seqs.fna.incomplete"), background=True)
         if qual_files:
             file_data['unassigned_qual_f'] =\
-                open(join(output_dir, "unassigned_seqs.qual.incomplete"), "w")
+                SequenceWriter(join(output_dir,
+                                    "unassigned_seqs.qual.incomplete"), background=True)
 
     log_data, bc_freqs, seq_counts, corrected_bc_count =\
         demultiplex_sequences(file_data, keep_barcode, barcode_type,
@@ -121,7 +130,12 @@ def process_files_and_demultiplex_sequences(mapping_file,
         bc_freqs_f.write("Barcode frequencies\n")
         bc_freqs_f.write("\n".join(bcs_sorted_list))
 
-    # Rename .incomplete files to .fna/.qual files
+    # Rename .incomplete files to .fna/.qual files, once all buffered
+    # sequences are written
+    for output_f in ['demultiplexed_seqs_f', 'demultiplexed_qual_f',
+                     'unassigned_seqs_f', 'unassigned_qual_f']:
+        if output_f in file_data:
+            file_data[output_f].close()
 
     rename(file_data['demultiplexed_seqs_f'].name, join(output_dir,
                                                         "demultiplexed_seqs.fna"))
@@ -219,6 +233,10 @@ def assign_seqs(file_data,
     log_data = initialize_log_data(ids_bcs_added_field)
     bc_freqs = defaultdict(int)
 
+    demultiplex_index = get_demultiplex_index(ids_bcs_added_field,
+                                              barcode_type,
+                                              disable_bc_correction)
+
     seq_counts = 0
     enum_val = start_index
     corrected_bc_count = [0, 0]
@@ -236,7 +254,8 @@ def assign_seqs(file_data,
                 bc, corrected_bc, num_errors, added_field =\
                     get_demultiplex_data(ids_bcs_added_field,
                                          fasta_label, fasta_seq, bc_lens, all_bcs, barcode_type,
-                                         max_bc_errors, disable_bc_correction, added_demultiplex_field)
+                                         max_bc_errors, disable_bc_correction, added_demultiplex_field,
+                                         demultiplex_index)
 
                 bc_freqs[bc] += 1
 
@@ -257,12 +276,12 @@ def assign_seqs(file_data,
                     write_fasta_line(file_data['unassigned_seqs_f'],
                                      fasta_seq, label_line, True, len(bc))
                     write_qual_line(file_data['unassigned_qual_f'],
-                                    list(qual_seq), label_line, True, len(bc))
+                                    qual_seq, label_line, True, len(bc))
                 elif not sample_id.startswith("Unassigned"):
                     write_fasta_line(file_data['demultiplexed_seqs_f'],
                                      fasta_seq, label_line, keep_barcode, len(bc))
                     write_qual_line(file_data['demultiplexed_qual_f'],
-                                    list(qual_seq), label_line, keep_barcode, len(bc))
+                                    qual_seq, label_line, keep_barcode, len(bc))
 
                 if log_id:
                     log_data[log_id] += 1
@@ -276,7 +295,8 @@ def assign_seqs(file_data,
                 bc, corrected_bc, num_errors, added_field =\
                     get_demultiplex_data(ids_bcs_added_field,
                                          fasta_label, fasta_seq, bc_lens, all_bcs, barcode_type,
-                                         max_bc_errors, disable_bc_correction, added_demultiplex_field)
+                                         max_bc_errors, disable_bc_correction, added_demultiplex_field,
+                                         demultiplex_index)
 
                 bc_freqs[bc] += 1
 
@@ -432,8 +452,7 @@ def write_fasta_line(demultiplexed_seqs_f,
     else:
         final_seq = fasta_seq[bc_len:]
 
-    demultiplexed_seqs_f.write(">%s\n" % label_line)
-    demultiplexed_seqs_f.write("%s\n" % final_seq)
+    demultiplexed_seqs_f.write(">%s\n%s\n" % (label_line, final_seq))
 
 
 def write_qual_line(demultiplexed_qual_f,
@@ -444,7 +463,7 @@ def write_qual_line(demultiplexed_qual_f,
     """ Writes quality score sequence out in proper format
 
     demultiplexed_qual_f:  open file object to write label/qual scores to.
-    qual_seq:  current qual sequence, list of scores.
+    qual_seq:  current qual sequence, list or array of scores.
     label_line:  qual label to write
     keep_barcode:  If True, do not slice out barcode from sequence
     bc_len:  Length of barcode, used to slice out from sequence
@@ -455,19 +474,10 @@ def write_qual_line(demultiplexed_qual_f,
     else:
         final_seq = qual_seq[bc_len:]
 
-    qual_line_size = 60
-
-    current_qual_scores_lines = []
     # Quality score format is a string of 60 base calls, followed by a
     # newline, until the last N bases are written
-    for slice in range(0, len(final_seq), qual_line_size):
-
-        current_segment = final_seq[slice:slice + qual_line_size]
-        current_qual_scores_lines.append(" ".join(map(str, current_segment)))
-
-    demultiplexed_qual_f.write(">%s\n" % label_line)
-    demultiplexed_qual_f.write('\n'.join(current_qual_scores_lines))
-    demultiplexed_qual_f.write('\n')
+    demultiplexed_qual_f.write(">%s\n%s" % (label_line,
+                                             format_qual_scores(final_seq) or '\n'))
 
 
 def get_demultiplex_data(ids_bcs_added_field,
@@ -478,7 +488,8 @@ def get_demultiplex_data(ids_bcs_added_field,
                          barcode_type="golay_12",
                          max_bc_errors=1.5,
                          disable_bc_correction=False,
-                         added_demultiplex_field=None):
+                         added_demultiplex_field=None,
+                         demultiplex_index=None):
     """ Attempts to find bc in a given sequence and added demultiplex field
 
     ids_bcs_added_field:  dict of (barcode,added_demultiplex): SampleID
@@ -493,6 +504,8 @@ def get_demultiplex_data(ids_bcs_added_field,
     disable_bc_correction:  Only tests for exact matches to barcodes.
     added_demultiplex_field:  Uses data supplied in metadata mapping field
      and demultiplexes according to data in fasta labels.
+    demultiplex_index:  Precomputed lookups from get_demultiplex_index, if
+     None the barcodes and added fields are searched for each sequence.
     """
 
     # To allow for variable length barcodes, need to step down from largest
@@ -503,13 +516,13 @@ def get_demultiplex_data(ids_bcs_added_field,
         corrected_bc, num_errors, added_field = get_curr_bc_added_field(
             curr_bc,
             ids_bcs_added_field, fasta_label, all_bcs, barcode_type,
-            disable_bc_correction, added_demultiplex_field)
+            disable_bc_correction, added_demultiplex_field, demultiplex_index)
 
         # Escape if exact hit found for barcode, only matters for variable
         # length barcodes.  Need special case for variable length barcodes
         # that have overlapping sequences and added demultiplex field.
         if added_field:
-            if (corrected_bc, added_field) in ids_bcs_added_field.keys():
+            if (corrected_bc, added_field) in ids_bcs_added_field:
                 break
         elif corrected_bc is not None:
             break
@@ -523,7 +536,8 @@ def get_curr_bc_added_field(curr_bc,
                             all_bcs,
                             barcode_type="golay_12",
                             disable_bc_correction=False,
-                            added_demultiplex_field=None):
+                            added_demultiplex_field=None,
+                            demultiplex_index=None):
     """ Attempts to correct barcode, get added demultiplex data
 
     curr_bc: current barcode sequence to attempt correction with
@@ -535,35 +549,58 @@ def get_curr_bc_added_field(curr_bc,
     disable_bc_correction:  Only tests for exact matches to barcodes.
     added_demultiplex_field:  Uses data supplied in metadata mapping field
      and demultiplexes according to data in fasta labels.
+    demultiplex_index:  Precomputed lookups from get_demultiplex_index, if
+     None the barcodes and added fields are searched for each sequence.
     """
 
     if added_demultiplex_field:
         added_field = get_added_demultiplex_field(ids_bcs_added_field,
-                                                  fasta_label, added_demultiplex_field)
+                                                  fasta_label, added_demultiplex_field, demultiplex_index)
     else:
         added_field = None
 
+    # Generic barcodes are only corrected to the barcodes used with the
+    # current added field, if these have been indexed
+    bc_neighborhoods = None
+    if demultiplex_index is not None and\
+            demultiplex_index['bc_neighborhoods'] is not None:
+        if added_field is None:
+            bc_neighborhoods = demultiplex_index['bc_neighborhoods'].get('')
+        else:
+            bc_neighborhoods =\
+                demultiplex_index['bc_neighborhoods'].get(added_field)
+
     if disable_bc_correction:
         num_errors = 0
         corrected_bc = get_exact_bc_matches(curr_bc, all_bcs)
     else:
         corrected_bc, num_errors = attempt_bc_correction(curr_bc,
-                                                         all_bcs, barcode_type)
+                                                         all_bcs, barcode_type, bc_neighborhoods)
 
     return corrected_bc, num_errors, added_field
 
 
 def attempt_bc_correction(curr_bc,
                           all_bcs,
-                          barcode_type="golay_12"):
+                          barcode_type="golay_12",
+                          bc_neighborhoods=None):
     """ Gets corrected barcode and number of errors
 
     curr_bc: current barcode sequence to attempt correction with
     all_bcs: List of all barcode sequences.
     barcode_type:  Specified barcode, can be golay_12, hamming_8,
      variable_length, or an integer specifying length.
+    bc_neighborhoods:  (barcodes, neighborhoods) of generic barcodes, from
+     get_demultiplex_index. If supplied, curr_bc is matched and corrected
+     with these barcodes instead of all_bcs.
     """
 
+    # Exact matches and corrections are looked up in the neighborhoods
+    if bc_neighborhoods is not None:
+        bcs, neighborhoods = bc_neighborhoods
+        return correct_barcode_from_neighborhoods(curr_bc, bcs,
+                                                  neighborhoods)
+
     # First check for exact matches
     corrected_bc = get_exact_bc_matches(curr_bc, all_bcs)
     if corrected_bc:
@@ -597,14 +634,34 @@ def get_exact_bc_matches(curr_bc,
 
 def get_added_demultiplex_field(ids_bcs_added_field,
                                 fasta_label,
-                                added_demultiplex_field):
+                                added_demultiplex_field,
+                                demultiplex_index=None):
     """ Returns matches to added demultiplex field from fasta label
 
     ids_bcs_added_field: dict of (barcode,added_demultiplex): SampleID
     added_demultiplex_field:  Uses data supplied in metadata mapping field
      and demultiplexes according to data in fasta labels.
+    demultiplex_index:  Precomputed lookups from get_demultiplex_index, if
+     supplied the label is sliced once per length of the added fields, and
+     the longest matching added field is returned.
     """
 
+    if demultiplex_index is not None:
+        if added_demultiplex_field == 'run_prefix':
+            label_start = fasta_label
+        else:
+            field_start = fasta_label.find(added_demultiplex_field + "=")
+            if field_start == -1:
+                return None
+            label_start =\
+                fasta_label[field_start + len(added_demultiplex_field) + 1:]
+        added_fields = demultiplex_index['added_fields']
+        for added_field_len in demultiplex_index['added_field_lens']:
+            curr_label_slice = label_start[0:added_field_len]
+            if curr_label_slice in added_fields:
+                return curr_label_slice
+        return None
+
     for curr_bc_added_field in ids_bcs_added_field.keys():
         curr_added_field = curr_bc_added_field[1]
         if added_demultiplex_field == 'run_prefix':
@@ -625,6 +682,50 @@ def get_added_demultiplex_field(ids_bcs_added_field,
     return None
 
 
+def get_demultiplex_index(ids_bcs_added_field,
+                          barcode_type="golay_12",
+                          disable_bc_correction=False,
+                          max_mismatches=BC_NEIGHBORHOOD_MAX_MISMATCHES):
+    """ Precomputes lookups of barcodes and added fields for demultiplexing
+
+    ids_bcs_added_field: dict of (barcode,added_demultiplex): SampleID
+    barcode_type:  Specified barcode, can be golay_12, hamming_8,
+     variable_length, or an integer specifying length.
+    disable_bc_correction:  Only tests for exact matches to barcodes.
+    max_mismatches:  Mismatches included in the barcode neighborhoods.
+
+    Returns dict of
+     'added_fields': set of all added demultiplex fields
+     'added_field_lens': lengths of the added fields, largest to smallest
+     'bc_neighborhoods': dict of added field: (barcodes, neighborhoods),
+      where neighborhoods maps each barcode of the added field and each
+      sequence within max_mismatches of these to (corrected barcode, number
+      of mismatches), with None as the corrected barcode for ties. This is
+      None unless generic barcodes of a single length are corrected.
+    """
+
+    added_fields = set([curr_added_field for curr_bc, curr_added_field
+                        in ids_bcs_added_field.keys()])
+    added_field_lens = sorted(set(map(len, added_fields)), reverse=True)
+
+    bc_lens = get_bc_lens(ids_bcs_added_field)
+    if disable_bc_correction or len(bc_lens) != 1 or\
+            barcode_type in ("golay_12", "hamming_8", 0):
+        bc_neighborhoods = None
+    else:
+        bcs_by_added_field = defaultdict(list)
+        for curr_bc, curr_added_field in ids_bcs_added_field.keys():
+            bcs_by_added_field[curr_added_field].append(curr_bc)
+        bc_neighborhoods = {}
+        for curr_added_field, bcs in bcs_by_added_field.items():
+            bc_neighborhoods[curr_added_field] =\
+                (bcs, get_barcode_neighborhoods(bcs, max_mismatches))
+
+    return {'added_fields': added_fields,
+            'added_field_lens': added_field_lens,
+            'bc_neighborhoods': bc_neighborhoods}
+
+
 def check_map(mapping_file,
               barcode_type="golay_12",
               added_demultiplex_field=None):
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""Memory-bounded dereplication of sequence collections.
+
+Sequences (or fixed-length sequence prefixes) are hashed to fixed-width
+digests and buffered in memory. When the buffer exceeds the memory budget it
+is sorted and spilled to a temporary partition file, and all partitions are
+merged externally at the end (in several passes if there are many of them,
+so that only a bounded number of files is open at once), so peak memory
+usage is governed by the budget rather than by the size of the input.
+"""
+
+from __future__ import division
+
+__author__ = "The QIIME Development Team"
+__copyright__ = "Copyright 2011, The QIIME Project"
+__credits__ = ["The QIIME Development Team"]
+__license__ = "GPL"
+__version__ = "1.9.1-dev"
+__maintainer__ = "The QIIME Development Team"
+__email__ = "qiime.help@gmail.com"
+
+from heapq import merge
+from hashlib import md5
+from itertools import groupby
+from operator import itemgetter
+from os import close
+from tempfile import mkstemp
+
+from skbio.util import remove_files
+
+# rough per-record cost (in bytes) of the Python objects held in the buffer,
+# in addition to the length of the sequence and sequence identifier
+_RECORD_OVERHEAD = 192
+# default maximum number of partition files open at once while merging
+MAX_OPEN_PARTITIONS = 64
+
+
+class SequenceDereplicator(object):
+
+    """Collapse identical sequences (or sequence prefixes) into groups
+
+    Groups are yielded as (rep_id, rep_seq, seq_ids) tuples, in the order in
+    which each group was first observed in the input. seq_ids lists the
+    (whitespace-truncated) identifiers of every sequence in the group in
+    input order, and the representative is the longest sequence in the group
+    (the first one observed, in the case of ties).
+    """
+
+    def __init__(self, prefix_length=None, max_memory=None, temp_dir=None,
+                 max_open_partitions=MAX_OPEN_PARTITIONS):
+        """Return new SequenceDereplicator
+
+        prefix_length: if None, sequences are collapsed when they are
+         identical; otherwise they are collapsed when their first
+         prefix_length bases are identical
+        max_memory: approximate number of bytes of sequence data to buffer
+         before spilling sorted partitions to disk. If None, all data is
+         kept in memory. The records are sorted twice (by digest, then by
+         first occurrence) and the buffers of both sorts can be in memory at
+         once, so each sort is given half of max_memory.
+        temp_dir: directory where partition files should be written
+        max_open_partitions: maximum number of partition files read at once
+         by each sort. If there are more partitions, they are first merged
+         into fewer, larger partitions (at least 2).
+        """
+        self.PrefixLength = prefix_length
+        self.MaxMemory = max_memory
+        self.TempDir = temp_dir
+        self.MaxOpenPartitions = max(max_open_partitions, 2)
+        self.NumPartitions = 0
+        self.NumMergedPartitions = 0
+        self._partition_fps = []
+
+    def __call__(self, seqs):
+        """Yield (rep_id, rep_seq, seq_ids) for each group in seqs
+
+        seqs: iterable of (seq_id, seq) tuples
+        """
+        try:
+            groups = self._group_by_digest(seqs)
+            for first_index, rep_id, rep_seq, seq_ids in \
+                    self._sort_records(groups, self._format_group,
+                                       self._parse_group):
+                yield rep_id, rep_seq, seq_ids
+        finally:
+            remove_files(self._partition_fps, error_on_missing=False)
+            self._partition_fps = []
+
+    def _get_key(self, seq):
+        if self.PrefixLength is None:
+            return seq
+        return seq[:self.PrefixLength]
+
+    def _group_by_digest(self, seqs):
+        """Yield (first_index, rep_id, rep_seq, seq_ids) in digest order"""
+        records = ((md5(self._get_key(seq)).hexdigest(), i,
+                    seq_id.split()[0], seq)
+                   for i, (seq_id, seq) in enumerate(seqs))
+        sorted_records = self._sort_records(records, self._format_record,
+                                            self._parse_record)
+        for digest, digest_records in groupby(sorted_records, itemgetter(0)):
+            # distinct keys sharing a digest are possible in principle, so
+            # group on the key itself within each digest
+            groups = {}
+            for _, index, seq_id, seq in digest_records:
+                key = self._get_key(seq)
+                try:
+                    group = groups[key]
+                except KeyError:
+                    groups[key] = [index, seq_id, seq, [seq_id]]
+                else:
+                    if len(seq) > len(group[2]):
+                        group[1] = seq_id
+                        group[2] = seq
+                    group[3].append(seq_id)
+            for group in groups.values():
+                yield tuple(group)
+
+    def _sort_records(self, records, format_f, parse_f):
+        """Sort tuples of records, spilling to disk to respect MaxMemory"""
+        if self.MaxMemory is None:
+            max_memory = None
+        else:
+            # the two sorts of __call__ can hold full buffers at once
+            max_memory = self.MaxMemory / 2
+        buffered = []
+        buffered_size = 0
+        partition_fps = []
+        for record in records:
+            buffered.append(record)
+            buffered_size += self._record_size(record)
+            if max_memory is not None and buffered_size > max_memory:
+                buffered.sort()
+                partition_fps.append(
+                    self._write_partition(buffered, format_f))
+                self.NumPartitions += 1
+                buffered = []
+                buffered_size = 0
+        buffered.sort()
+
+        # merge partitions in passes until they can be read at once, along
+        # with the buffer
+        while len(partition_fps) >= self.MaxOpenPartitions:
+            partition_fps = [
+                self._merge_partitions(
+                    partition_fps[i:i + self.MaxOpenPartitions],
+                    format_f, parse_f)
+                for i in range(0, len(partition_fps),
+                               self.MaxOpenPartitions)]
+
+        partitions = [self._read_partition(fp, parse_f)
+                      for fp in partition_fps]
+        partitions.append(iter(buffered))
+        return merge(*partitions)
+
+    def _merge_partitions(self, partition_fps, format_f, parse_f):
+        """Merge sorted partition files into one, returning its filepath"""
+        if len(partition_fps) == 1:
+            return partition_fps[0]
+        merged_fp = self._write_partition(
+            merge(*[self._read_partition(fp, parse_f)
+                    for fp in partition_fps]), format_f)
+        self.NumMergedPartitions += 1
+        remove_files(partition_fps)
+        for fp in partition_fps:
+            self._partition_fps.remove(fp)
+        return merged_fp
+
+    def _record_size(self, record):
+        size = _RECORD_OVERHEAD
+        for field in record:
+            if isinstance(field, str):
+                size += len(field)
+            elif isinstance(field, list):
+                size += sum([len(e) + _RECORD_OVERHEAD for e in field])
+        return size
+
+    def _write_partition(self, records, format_f):
+        """Write sorted records to a new partition file"""
+        fd, partition_fp = mkstemp(dir=self.TempDir,
+                                   prefix='QiimeDereplication',
+                                   suffix='.txt')
+        close(fd)
+        self._partition_fps.append(partition_fp)
+        partition_f = open(partition_fp, 'w')
+        partition_f.writelines(format_f(r) for r in records)
+        partition_f.close()
+        return partition_fp
+
+    def _read_partition(self, partition_fp, parse_f):
+        with open(partition_fp, 'U') as partition_f:
+            for line in partition_f:
+                yield parse_f(line)
+
+    def _format_record(self, record):
+        return '%s\t%d\t%s\t%s\n' % record
+
+    def _parse_record(self, line):
+        digest, index, seq_id, seq = line.rstrip('\n').split('\t', 3)
+        return digest, int(index), seq_id, seq
+
+    def _format_group(self, group):
+        first_index, rep_id, rep_seq, seq_ids = group
+        return '%d\t%s\t%s\t%s\n' % (first_index, rep_id, rep_seq,
+                                     '\t'.join(seq_ids))
+
+    def _parse_group(self, line):
+        fields = line.rstrip('\n').split('\t')
+        return int(fields[0]), fields[1], fields[2], fields[3:]
+
+
+def dereplicate_seqs(seqs, prefix_length=None, max_memory=None,
+                     temp_dir=None):
+    """Yield (rep_id, rep_seq, seq_ids) for each group of identical seqs
+
+    Convenience wrapper around SequenceDereplicator; see its documentation
+    for a description of the parameters.
+    """
+    dereplicator = SequenceDereplicator(prefix_length=prefix_length,
+                                        max_memory=max_memory,
+                                        temp_dir=temp_dir)
+    return dereplicator(seqs)
@@ -17,7 +17,6 @@ from os.path import join
 from os import rename
 from re import compile
 
-from skbio.parse.sequences import parse_fastq
 from skbio.sequence import DNA
 from skbio.format.sequences import format_fastq_record
 
@@ -26,6 +25,7 @@ from qiime.split_libraries_fastq import (check_header_match_pre180,
                                          check_header_match_180_or_later)
 from qiime.parse import is_casava_v180_or_later
 from qiime.pycogent_backports.fastq import FastqParseError
+from qiime.sequence_reader import read_fastq_records
 
 
 def extract_barcodes(fastq1,
@@ -114,8 +114,8 @@ def extract_barcodes(fastq1,
     header_index = 0
 
     for read1_data, read2_data in izip(
-            parse_fastq(fastq1, strict=False, enforce_qual_range=False),
-            parse_fastq(fastq2, strict=False, enforce_qual_range=False)):
+            read_fastq_records(fastq1, strict=False, enforce_qual_range=False),
+            read_fastq_records(fastq2, strict=False, enforce_qual_range=False)):
         if not disable_header_match:
             if not check_header_match_f(read1_data[header_index],
                                         read2_data[header_index]):
@@ -21,6 +21,8 @@ from skbio.sequence import BiologicalSequence
 from biom.table import Table
 
 from qiime.util import get_qiime_library_version, load_qiime_config
+from qiime.parse import (BINARY_DISTMAT_MAGIC, load_binary_distmat,
+                         parse_binary_distmat_header, parse_distmat)
 from qiime.colors import data_color_hsv
 
 """Contains formatters for the files we expect to encounter in 454 workflow.
@@ -279,6 +281,178 @@ def format_distance_matrix(labels, data):
                          convert_matching_names_to_zero=True)
 
 
+def format_binary_distance_matrix_header(labels, layout='condensed',
+                                         dtype='float64'):
+    """Returns the header of a binary distance matrix file
+
+    The header is padded so that the distances, which follow it, are aligned
+    on 8 bytes. See write_binary_distance_matrix.
+    """
+    labels = map(str, labels)
+    dtype = numpy.dtype(dtype)
+    if dtype not in (numpy.dtype('float32'), numpy.dtype('float64')):
+        raise ValueError("Binary distance matrices must be float32 or "
+                         "float64, not %s." % dtype)
+    if layout not in ('condensed', 'square'):
+        raise ValueError("Unknown distance matrix layout: %s" % layout)
+    ids_line = '\t'.join(labels) + '\n'
+    # the offset is written with a fixed width, so the header length is
+    # known before the offset is
+    header_len = (len(BINARY_DISTMAT_MAGIC) + len(ids_line) +
+                  len('%s\t%s\t%d\t%020d\n' % (layout, dtype.str,
+                                               len(labels), 0)))
+    offset = -(-header_len // 8) * 8
+    return (BINARY_DISTMAT_MAGIC +
+            '%s\t%s\t%d\t%020d\n' % (layout, dtype.str, len(labels),
+                                     offset) +
+            ids_line + '\0' * (offset - header_len))
+
+
+def _is_symmetric_and_hollow(data, block_size=1024):
+    """Returns True if data is symmetric with zeros on its diagonal"""
+    if (numpy.diagonal(data) != 0).any():
+        return False
+    for start in range(0, data.shape[0], block_size):
+        block = data[start:start + block_size]
+        if (block != data[:, start:start + block_size].T).any():
+            return False
+    return True
+
+
+def write_binary_distance_matrix(output_fp, labels, data, dtype='float64',
+                                 layout=None):
+    """Writes distance matrix in the binary format
+
+    The file holds a text header (see format_binary_distance_matrix_header)
+    with the sample ids, followed by the distances as an array of dtype
+    (float32 or float64) which can be memory-mapped (see
+    qiime.parse.load_binary_distmat). With the condensed layout only the
+    upper triangle is stored, row by row. By default, the condensed layout
+    is used if data is symmetric with zeros on the diagonal, and the square
+    layout otherwise.
+
+    Binary files are much smaller and faster to read and write than the
+    text format written by format_distance_matrix, and parse_distmat reads
+    both.
+    """
+    data = asarray(data)
+    if data.shape != (len(labels), len(labels)):
+        raise ValueError("Data shape of %s doesn't match number of labels %d"
+                         % (data.shape, len(labels)))
+    if layout is None:
+        if _is_symmetric_and_hollow(data):
+            layout = 'condensed'
+        else:
+            layout = 'square'
+    f = open(output_fp, 'wb')
+    try:
+        f.write(format_binary_distance_matrix_header(labels, layout, dtype))
+        for i, row in enumerate(data):
+            if layout == 'condensed':
+                row = row[i + 1:]
+            row.astype(dtype).tofile(f)
+    finally:
+        f.close()
+
+
+def preallocate_binary_distance_matrix(output_fp, labels, dtype='float64',
+                                       layout='condensed'):
+    """Creates a binary distance matrix file whose distances are all zero
+
+    The distances can then be filled in, e.g. by several processes, with
+    write_binary_distance_matrix_rows. The file is created with truncate, so
+    on most filesystems no space is used for distances until they're written.
+    """
+    header = format_binary_distance_matrix_header(labels, layout, dtype)
+    num_labels = len(labels)
+    if layout == 'condensed':
+        size = num_labels * (num_labels - 1) // 2
+    else:
+        size = num_labels * num_labels
+    f = open(output_fp, 'wb')
+    try:
+        f.write(header)
+        f.truncate(len(header) + size * numpy.dtype(dtype).itemsize)
+    finally:
+        f.close()
+
+
+def write_binary_distance_matrix_rows(output_fp, labels, row_labels, data):
+    """Writes rows of a distance matrix in place into a binary distance matrix
+
+    output_fp: existing binary distance matrix file, with sample ids labels
+     (see preallocate_binary_distance_matrix)
+    row_labels: the ids of the samples whose rows are in data
+    data: the rows, with one column per label
+
+    Only the distances stored in the file are written: for the condensed
+    layout, the part of each row right of the diagonal. Rows are written with
+    seek and write, rather than through a memory map, so that processes on
+    different hosts can safely write different rows of the same file.
+    """
+    f = open(output_fp, 'r+b')
+    try:
+        ids, layout, data_dtype, offset = parse_binary_distmat_header(f)
+        if ids != map(str, labels):
+            raise ValueError("The sample ids of %s don't match the sample "
+                             "ids of the distance matrix." % output_fp)
+        num_labels = len(ids)
+        index = dict([(id_, i) for i, id_ in enumerate(ids)])
+        for row_label, row in zip(row_labels, data):
+            i = index[str(row_label)]
+            row = numpy.array(row, dtype=float)
+            if layout == 'condensed':
+                start = i * num_labels - i * (i + 1) // 2
+                row = row[i + 1:]
+            else:
+                start = i * num_labels
+                if numpy.isclose(row[i], 0.0):
+                    row[i] = 0.0
+            f.seek(offset + start * data_dtype.itemsize)
+            row.astype(data_dtype).tofile(f)
+    finally:
+        f.close()
+
+
+def convert_distance_matrix_to_binary(input_fp, output_fp, dtype='float64'):
+    """Converts a text distance matrix file to the binary format"""
+    f = open(input_fp, 'U')
+    try:
+        labels, data = parse_distmat(f)
+    finally:
+        f.close()
+    write_binary_distance_matrix(output_fp, labels, data, dtype)
+
+
+def convert_distance_matrix_to_text(input_fp, output_fp):
+    """Converts a binary distance matrix file to the text format
+
+    The rows are written one at a time, as format_distance_matrix would
+    write them, so the whole matrix is never held in memory.
+    """
+    labels, layout, data = load_binary_distmat(input_fp)
+    num_labels = len(labels)
+    f = open(output_fp, 'w')
+    try:
+        f.write('\t'.join([''] + labels))
+        for i, label in enumerate(labels):
+            if layout == 'condensed':
+                row = numpy.zeros(num_labels)
+                # d(j, i) for j < i is in row j of the upper triangle, and
+                # d(i, j) for j > i is a contiguous slice of row i
+                j = numpy.arange(i)
+                row[:i] = data[j * num_labels - j * (j + 1) // 2 + i - j - 1]
+                start = i * num_labels - i * (i + 1) // 2
+                row[i + 1:] = data[start:start + num_labels - i - 1]
+            else:
+                row = numpy.asarray(data[i], dtype=float)
+                if numpy.isclose(row[i], 0.0):
+                    row[i] = 0.0
+            f.write('\n' + '\t'.join([label] + map(str, row)))
+    finally:
+        f.close()
+
+
 def format_matrix(data, row_names, col_names,
                   convert_matching_names_to_zero=False):
     """Writes matrix as tab-delimited text.
@@ -68,16 +68,32 @@ def decode(seq, nt_to_bits=None):
     - nt_to_bits, e.g.: { "A":"11",  "C":"00", "T":"10", "G":"01"}
     output:
     corrected_seq (str), num_bit_errors
-    corrected_seq is None if 4 bit error detected"""
+    corrected_seq is None if 4 bit error detected
+
+    the received seq is packed into a 24 bit int, whose syndrome is the xor
+    of the syndromes of its nucleotides (looked up per position), and the
+    error is looked up in a list indexed by the syndrome. this is equivalent
+    to decode_bits on the bitvector of seq, without building any arrays."""
     if nt_to_bits is None:
         nt_to_bits = DEFAULT_GOLAY_NT_TO_BITS
-    received_bits = _seq_to_bits(seq, nt_to_bits)
-    corrected_bits, num_errors = decode_bits(received_bits)  # errors in # bits
-    if corrected_bits is None:
-        return None, num_errors
-    else:
-        # put match into nucleotide format
-        return _bits_to_seq(corrected_bits, nt_to_bits), num_errors
+    nt_values, int_to_nt, position_syndromes = _get_nt_tables(nt_to_bits)
+    if len(seq) != 12:
+        raise ValueError("golay barcodes must be 12 nt long.")
+    received = 0
+    syn = 0
+    for nt, nt_syndromes in zip(seq, position_syndromes):
+        received = (received << 2) | nt_values[nt]
+        syn ^= nt_syndromes[nt]
+    err = DEFAULT_SYNDROME_ERRORS[syn]
+    if err is None:
+        return None, 4
+    elif err == 0:
+        return seq, 0
+    corrected = received ^ err
+    # put match into nucleotide format
+    return (''.join([int_to_nt[(corrected >> shift) & 3]
+                     for shift in range(22, -1, -2)]),
+            DEFAULT_SYNDROME_ERROR_COUNTS[syn])
 # alt name for the decode function for consistency with hamming decoding
 decode_golay_12 = decode
 
@@ -176,6 +192,50 @@ def _seq_to_bits(seq, nt_to_bits):
     return bits
 
 
+def _bits_to_int(bits):
+    """ e.g.: [0,1,1,0] -> 6, the first bit being the most significant"""
+    result = 0
+    for bit in bits:
+        result = (result << 1) | int(bit)
+    return result
+
+
+def _get_nt_tables(nt_to_bits):
+    """ returns the lookup tables used by decode() for nt_to_bits
+
+    output is (nt_values, int_to_nt, position_syndromes):
+    - nt_values maps each nucleotide to its 2 bits as an int
+    - int_to_nt maps each 2 bit int back to its nucleotide
+    - position_syndromes is a list of 12 dicts, mapping each nucleotide to
+    the syndrome (12 bit int) of the 24 bits of the nucleotide at that
+    position, all other bits being 0
+    the tables are built once per nt_to_bits and cached
+    """
+    key = tuple(sorted(nt_to_bits.items()))
+    try:
+        return _NT_TABLES[key]
+    except KeyError:
+        pass
+    nt_values = dict([(nt, int(bits, 2)) for nt, bits in nt_to_bits.items()])
+    int_to_nt = [None] * 4
+    for nt, value in nt_values.items():
+        int_to_nt[value] = nt
+    h_columns = [_bits_to_int(col) for col in DEFAULT_H.T]
+    position_syndromes = []
+    for i in range(12):
+        nt_syndromes = {}
+        for nt, value in nt_values.items():
+            syn = 0
+            if value & 2:
+                syn ^= h_columns[2 * i]
+            if value & 1:
+                syn ^= h_columns[2 * i + 1]
+            nt_syndromes[nt] = syn
+        position_syndromes.append(nt_syndromes)
+    result = _NT_TABLES[key] = (nt_values, int_to_nt, position_syndromes)
+    return result
+
+
 def _bits_to_seq(bits, nt_to_bits):
     """ e.g.: array([0,0,0,0,1,0]) -> "AAG"
 
@@ -242,4 +302,15 @@ for errvec in _ALL_3BIT_ERRORS:
     syn = tuple(numpy.dot(DEFAULT_H, errvec) % 2)
     DEFAULT_SYNDROME_LUT[syn] = (errvec)
 
+# the same table indexed by the syndrome as a 12 bit int, with the error as
+# a 24 bit int (None for the syndromes of 4 bit errors), used by decode()
+DEFAULT_SYNDROME_ERRORS = [None] * 2 ** 12
+DEFAULT_SYNDROME_ERROR_COUNTS = [4] * 2 ** 12
+for syn, errvec in DEFAULT_SYNDROME_LUT.items():
+    DEFAULT_SYNDROME_ERRORS[_bits_to_int(syn)] = _bits_to_int(errvec)
+    DEFAULT_SYNDROME_ERROR_COUNTS[_bits_to_int(syn)] = sum(errvec)
+
+# lookup tables of decode(), per nt_to_bits (see _get_nt_tables)
+_NT_TABLES = {}
+
 # END module level constants
@@ -25,6 +25,20 @@ INT_TO_BS = {0: "00", 1: "01", 2: "10", 3: "11"}
 CUR_ENC_FO = {'A': 3, 'C': 2, 'T': 0, 'G': 1}
 CUR_REV_ENC_SI = {"11": "A", "10": "C", "00": "T", "01": "G"}
 
+# lookup tables of decode_barcode_8 for 16 bit codewords packed into ints,
+# bit i of calc_syndrome's codeword being bit 15 - i of the int. The
+# syndromes are the xor of the positions i of the bits set in each byte.
+_INT_TO_NT = dict([(v, k) for k, v in CUR_ENC_FO.items()])
+_BYTE_SYNDROMES_HIGH = [reduce(lambda x, y: x ^ y,
+                               [7 - k for k in range(8) if b >> k & 1], 0)
+                        for b in range(256)]
+_BYTE_SYNDROMES_LOW = [reduce(lambda x, y: x ^ y,
+                              [15 - k for k in range(8) if b >> k & 1], 0)
+                       for b in range(256)]
+_BYTE_PARITIES = [bin(b).count('1') & 1 for b in range(256)]
+# decode_barcode_8 results by barcode
+_DECODED_BARCODES_8 = {}
+
 
 def calc_parity_vector(parity_vector):
     """ Returns even or odd parit for parity vector """
@@ -65,7 +79,19 @@ def unpack_bitstr(rev_cur_bit, bitstr):
 
 
 def decode_barcode_8(nt_barcode):
-    """ Decode length 8 barcode (16 bits) """
+    """ Decode length 8 barcode (16 bits)
+
+    The codeword is packed into a 16 bit int, and its syndrome and parity are
+    looked up per byte, which gives the same result as calc_syndrome on the
+    codeword array. There are only 4 ** 8 valid barcodes, so results are
+    cached.
+    """
+    barcode = nt_barcode
+    try:
+        return _DECODED_BARCODES_8[barcode]
+    except KeyError:
+        pass
+
     # check proper length
     if len(nt_barcode) != 8:
         raise ValueError("barcode must be 8 nt long.")
@@ -75,16 +101,28 @@ def decode_barcode_8(nt_barcode):
         raise ValueError("Only A,T,C,G valid chars.")
 
     # decode
-    decoded = nt_to_cw(CUR_ENC_FO, nt_barcode)
-    num_errors, sym = calc_syndrome(decoded, 16)
+    decoded = 0
+    for x in nt_barcode:
+        decoded = (decoded << 2) | CUR_ENC_FO[x]
+    high, low = decoded >> 8, decoded & 255
+    sym = _BYTE_SYNDROMES_HIGH[high] ^ _BYTE_SYNDROMES_LOW[low]
+    # parity of all bits but the first (the extra parity bit)
+    extra_parity = _BYTE_PARITIES[high & 127] ^ _BYTE_PARITIES[low]
+    if extra_parity == high >> 7:
+        num_errors = 0 if sym == 0 else 2
+    else:
+        num_errors = 1
+        decoded ^= 1 << (15 - sym)
 
     # convert corrected codeword back to nt sequence
     if num_errors == 1:
-        nt_barcode = unpack_bitstr(CUR_REV_ENC_SI, ''.join(map(str, decoded)))
+        nt_barcode = ''.join([_INT_TO_NT[(decoded >> shift) & 3]
+                              for shift in range(14, -1, -2)])
     elif num_errors > 1:
         nt_barcode = None
 
-    return nt_barcode, num_errors / 2.0
+    result = _DECODED_BARCODES_8[barcode] = (nt_barcode, num_errors / 2.0)
+    return result
 # alt name for function to support consistency with golay
 decode_hamming_8 = decode_barcode_8
 
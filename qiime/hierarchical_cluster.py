@@ -14,10 +14,9 @@ with distances to specified output file
 import warnings
 warnings.filterwarnings('ignore', 'Not using MPI as mpi4py not found')
 from optparse import OptionParser
-from qiime.parse import parse_distmat
+from qiime.parse import parse_distmat, parse_distmat_to_skbio
 from scipy.cluster.hierarchy import linkage
 from skbio.tree import TreeNode
-from skbio.stats.distance import DistanceMatrix
 from skbio.tree import nj
 import os.path
 
@@ -36,7 +35,7 @@ def multiple_file_upgma(input_dir, output_dir):
 
 def single_file_upgma(input_file, output_file):
     # read in dist matrix
-    dist_mat = DistanceMatrix.read(input_file)
+    dist_mat = parse_distmat_to_skbio(input_file)
 
     # SciPy uses average as UPGMA:
     # http://docs.scipy.org/doc/scipy/reference/generated/
@@ -58,7 +57,7 @@ def single_file_upgma(input_file, output_file):
 
 
 def single_file_nj(input_file, output_file):
-    dm = DistanceMatrix.read(input_file)
+    dm = parse_distmat_to_skbio(input_file)
 
     tree = nj(dm)
 
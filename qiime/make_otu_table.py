@@ -16,16 +16,19 @@ M3FclSwb_1023. Will not work if this assumption is not met. Splits on last
 underscore only so should be relatively robust to underscore in sample id.
 """
 
+from array import array as typed_array
 from datetime import datetime
 from collections import defaultdict
+from itertools import islice
+from multiprocessing import Pool
 from string import strip
 from sys import stderr
 
-from numpy import array, zeros
+from numpy import array, zeros, concatenate, int32
+from scipy.sparse import coo_matrix
 from cogent.util.misc import flatten
 from biom.table import Table
 
-from qiime.parse import parse_otu_map
 from qiime.util import get_generated_by_for_biom_tables
 
 
@@ -40,8 +43,149 @@ def seqids_from_otu_to_seqid(otu_to_seqid):
     return set(flatten(otu_to_seqid.values()))
 
 
+def _parse_otu_map_lines(args):
+    """Returns the OTU ids, sample ids and COO arrays for lines of an OTU map
+
+    The row and column indices in the returned arrays index the returned
+    OTU ids and sample ids, which are listed in order of first appearance.
+    Each (row, column) pair occurs at most once. This is a module-level
+    function so that it can be passed to a multiprocessing Pool.
+    """
+    lines, delim = args
+    otu_ids = []
+    sample_ids = []
+    sample_id_idx = {}
+    rows = typed_array('i')
+    cols = typed_array('i')
+    counts = typed_array('i')
+    for line in lines:
+        fields = line.strip().split('\t')
+        otu_index = len(otu_ids)
+        otu_ids.append(fields[0])
+        # reduce each line before appending it to the arrays, so they hold
+        # one entry per (OTU, sample) pair rather than one per sequence
+        sample_counts = defaultdict(int)
+        for seq_id in fields[1:]:
+            sample_id = seq_id.split(delim)[0]
+            try:
+                sample_index = sample_id_idx[sample_id]
+            except KeyError:
+                sample_index = len(sample_ids)
+                sample_id_idx[sample_id] = sample_index
+                sample_ids.append(sample_id)
+            sample_counts[sample_index] += 1
+        for sample_index in sorted(sample_counts):
+            rows.append(otu_index)
+            cols.append(sample_index)
+            counts.append(sample_counts[sample_index])
+    return (otu_ids, sample_ids, array(rows, dtype=int32),
+            array(cols, dtype=int32), array(counts, dtype=int32))
+
+
+def _iter_otu_map_chunks(otu_map_f, otu_ids_to_exclude, delim, chunk_size):
+    """Yields (lines, delim) for successive chunks of chunk_size OTUs"""
+    lines = (line for line in otu_map_f
+             if line.split('\t', 1)[0].strip() not in otu_ids_to_exclude)
+    while True:
+        chunk = list(islice(lines, chunk_size))
+        if not chunk:
+            break
+        yield chunk, delim
+
+
+def otu_map_to_sparse_matrix(otu_map_f, otu_ids_to_exclude=None, delim='_',
+                             jobs_to_start=1, chunk_size=10000):
+    """Tabulate an OTU map as a sparse OTU x sample matrix
+
+    Parameters
+    ----------
+    otu_map_f : file-like object
+        The OTU map. Jagged tab-separated file where the first column contains
+        the OTU ID and subsequent columns contain sequence IDs belonging to
+        that OTU
+    otu_ids_to_exclude : iterable, optional
+        Defaults to ``None``. If present, these OTUs will not be tabulated
+    delim : str, optional
+        Defaults to "_". The delimiter that is used in the sequence IDs to join
+        the sample ID to the sequence number
+    jobs_to_start : int, optional
+        Defaults to 1. If greater than 1, chunks of the OTU map are parsed by
+        a pool of this many processes
+    chunk_size : int, optional
+        Defaults to 10000. The number of OTUs in each chunk of the OTU map
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        The number of sequences in each OTU (rows) and sample (columns)
+    list
+        The sample IDs, in order of first appearance in the OTU map
+    list
+        The OTU IDs, in the order they appear in the OTU map
+
+    Notes
+    -----
+    The OTU map is streamed in chunks, and the counts are accumulated in
+    int32 row, column and count arrays which are converted to CSR format
+    once, so memory use is proportional to the number of non-zero counts
+    rather than to the number of (OTU, sample) keys of a dict.
+    """
+    if otu_ids_to_exclude is None:
+        otu_ids_to_exclude = set()
+    else:
+        otu_ids_to_exclude = set(otu_ids_to_exclude)
+
+    chunks = _iter_otu_map_chunks(otu_map_f, otu_ids_to_exclude, delim,
+                                  chunk_size)
+    if jobs_to_start > 1:
+        pool = Pool(jobs_to_start)
+        results = pool.imap(_parse_otu_map_lines, chunks)
+    else:
+        pool = None
+        results = (_parse_otu_map_lines(chunk) for chunk in chunks)
+
+    otu_ids = []
+    sample_ids = []
+    sample_id_idx = {}
+    all_rows = []
+    all_cols = []
+    all_counts = []
+    try:
+        for chunk_otu_ids, chunk_sample_ids, rows, cols, counts in results:
+            # map the chunk's sample indices to indices in sample_ids
+            sample_index_map = zeros(len(chunk_sample_ids), dtype=int32)
+            for i, sample_id in enumerate(chunk_sample_ids):
+                try:
+                    sample_index_map[i] = sample_id_idx[sample_id]
+                except KeyError:
+                    sample_index_map[i] = len(sample_ids)
+                    sample_id_idx[sample_id] = len(sample_ids)
+                    sample_ids.append(sample_id)
+            all_rows.append(rows + len(otu_ids))
+            all_cols.append(sample_index_map[cols])
+            all_counts.append(counts)
+            otu_ids.extend(chunk_otu_ids)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if all_rows:
+        rows = concatenate(all_rows)
+        cols = concatenate(all_cols)
+        counts = concatenate(all_counts)
+    else:
+        rows = cols = counts = zeros(0, dtype=int32)
+    # counts are stored as floats, as they are in tables built from dicts
+    data = coo_matrix((counts, (rows, cols)),
+                      shape=(len(otu_ids), len(sample_ids)),
+                      dtype=float).tocsr()
+    return data, sample_ids, otu_ids
+
+
 def make_otu_table(otu_map_f, otu_to_taxonomy=None, delim='_', table_id=None,
-                   otu_ids_to_exclude=None, sample_metadata=None):
+                   otu_ids_to_exclude=None, sample_metadata=None,
+                   jobs_to_start=1):
     """Generate a BIOM table from an OTU map
 
     Parameters
@@ -64,9 +208,13 @@ def make_otu_table(otu_map_f, otu_to_taxonomy=None, delim='_', table_id=None,
     sample_metadata : dict of dicts, optional
         Defaults to ``None``. If supplied, keys in the outer dict should be
         sample IDs, and keys in the inner dicts should be column names.
+    jobs_to_start : int, optional
+        Defaults to 1. If greater than 1, the OTU map is parsed in chunks by
+        a pool of this many processes (see ``otu_map_to_sparse_matrix``)
     """
-    data, sample_ids, otu_ids = parse_otu_map(
-        otu_map_f, delim=delim, otu_ids_to_exclude=otu_ids_to_exclude)
+    data, sample_ids, otu_ids = otu_map_to_sparse_matrix(
+        otu_map_f, otu_ids_to_exclude=otu_ids_to_exclude, delim=delim,
+        jobs_to_start=jobs_to_start)
 
     if otu_to_taxonomy is not None:
         otu_metadata = []
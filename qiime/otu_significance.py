@@ -12,13 +12,22 @@ __email__ = "lkursell@gmail.com"
 
 from qiime.parse import parse_mapping_file_to_dict
 from numpy import (array, argsort, vstack, isnan, inf, nan, apply_along_axis,
-                   mean, zeros, isinf, logical_or)
+                   mean, zeros, isinf, logical_or, column_stack, hstack)
+from numpy.random import RandomState
+from multiprocessing import Pool
 
 from qiime.stats import (fisher_population_correlation,
                                   pearson, spearman, g_fit, ANOVA_one_way, 
                                   kruskal_wallis, mw_t, mw_boot, t_paired, 
                                   mc_t_two_sample, t_two_sample, fisher, 
-                                  kendall, assign_correlation_pval, cscore)
+                                  kendall, assign_correlation_pval, cscore,
+                                  ANOVA_one_way_rows, g_fit_rows,
+                                  kruskal_wallis_rows, t_two_sample_rows,
+                                  mc_t_two_sample_rows, mw_t_rows,
+                                  mw_boot_rows, sample_permutations,
+                                  sample_bootstrap_indices, correlate_rows,
+                                  assign_correlation_pvals,
+                                  bootstrapped_correlation_pvals)
 
 from qiime.util import biom_taxonomy_formatter
 from collections import defaultdict
@@ -60,6 +69,14 @@ GROUP_TEST_CHOICES = {'ANOVA': ANOVA_one_way, 'g_test': g_fit,
                       'mann_whitney_u': mw_t,
                       'bootstrap_mann_whitney_u': mw_boot}
 
+# the same tests, computed for all rows of the grouped OTU table at once.
+BATCHED_GROUP_TEST_CHOICES = {'ANOVA': ANOVA_one_way_rows, 'g_test': g_fit_rows,
+                              'kruskal_wallis': kruskal_wallis_rows,
+                              'parametric_t_test': t_two_sample_rows,
+                              'nonparametric_t_test': mc_t_two_sample_rows,
+                              'mann_whitney_u': mw_t_rows,
+                              'bootstrap_mann_whitney_u': mw_boot_rows}
+
 TWO_GROUP_TESTS = ['parametric_t_test', 'nonparametric_t_test',
                    'mann_whitney_u', 'bootstrap_mann_whitney_u']
 
@@ -122,7 +139,8 @@ def group_significance_row_generator(bt, cat_sam_indices):
     return izip(*[data.take(i, axis=1) for i in indices])
 
 
-def run_group_significance_test(data_generator, test, test_choices, reps=1000):
+def run_group_significance_test(data_generator, test, test_choices, reps=1000,
+                                seed=None):
     """Run any of the group significance tests.
 
     Inputs:
@@ -134,13 +152,19 @@ def run_group_significance_test(data_generator, test, test_choices, reps=1000):
      test_choices - dictionary, defined as global at top of library.
      reps - int, number of reps or permutations to do for the bootstrapped
       tests.
+     seed - int or numpy RandomState, seed of the permutations of the
+      nonparametric t-test, shared by all rows. If None, numpy's global random
+      state is used.
     Ouputs are lists of test statistics, p values, and means of each group.
     """
     pvals, test_stats, means = [], [], []
+    if seed is not None and not isinstance(seed, RandomState):
+        seed = RandomState(seed)
     for row in data_generator:
         if test == 'nonparametric_t_test':
             test_stat, _, _, pval = test_choices[test](row[0], row[1],
-                                                       permutations=reps)
+                                                       permutations=reps,
+                                                       seed=seed)
         elif test == 'bootstrap_mann_whitney_u':
             test_stat, pval = test_choices[test](row[0], row[1], num_reps=reps)
         elif test in ['parametric_t_test', 'mann_whitney_u']:
@@ -158,6 +182,91 @@ def run_group_significance_test(data_generator, test, test_choices, reps=1000):
     return test_stats, pvals, means
 
 
+def group_significance_groups(bt, cat_sam_indices):
+    """Create list of arrays of the OTU values in each group of samples.
+
+    Each array has a row for every OTU in bt and a column for every sample in
+    the group; the groups are in the same order as the arrays of each row of
+    group_significance_row_generator.
+    Inputs:
+     bt - biom table object. Described at top of library.
+     cat_sam_indices - dict, output of get_sample_indices.
+    """
+    data = bt.matrix_data.toarray()
+    return [data.take(i, axis=1) for i in cat_sam_indices.values()]
+
+
+def _group_significance_chunk(args):
+    """Run a batched group significance test on a chunk of OTUs.
+
+    args is a tuple of the test name, the groups of the chunk (see
+    group_significance_groups), the number of reps and the permutations or
+    bootstrap samples shared by all OTUs (or None). Defined at module level so
+    that chunks can be run by a multiprocessing Pool.
+    """
+    test, groups, reps, random_inds = args
+    test_f = BATCHED_GROUP_TEST_CHOICES[test]
+    if test == 'nonparametric_t_test':
+        return test_f(groups[0], groups[1], reps, perms=random_inds)
+    elif test == 'bootstrap_mann_whitney_u':
+        return test_f(groups[0], groups[1], reps, indices=random_inds)
+    elif test in TWO_GROUP_TESTS:
+        return test_f(groups[0], groups[1])
+    else:
+        # ANOVA, kruskal_wallis, g_fit will get caught here
+        return test_f(groups)
+
+
+def run_batched_group_significance_test(groups, test, reps=1000, seed=None,
+                                        jobs_to_start=1):
+    """Run any of the group significance tests on all OTUs at once.
+
+    Computes the same statistics as run_group_significance_test, but with
+    array operations over all rows of the groups instead of a call per OTU.
+    Rows that can't be tested get nan statistics and p values.
+    Inputs:
+     groups - list of 2D arrays, output of group_significance_groups.
+     test - string, key of BATCHED_GROUP_TEST_CHOICES. the script interface
+      name for the functions.
+     reps - int, number of reps or permutations to do for the bootstrapped
+      tests.
+     seed - int or numpy RandomState, seed of the permutations (or bootstrap
+      samples) of the nonparametric tests. These are drawn once and shared by
+      all OTUs. If None, numpy's global random state is used.
+     jobs_to_start - int, number of processes the OTUs are split over.
+    Ouputs are lists of test statistics, p values, and means of each group.
+    """
+    num_rows = groups[0].shape[0]
+    if num_rows == 0:
+        return [], [], []
+    if test == 'nonparametric_t_test':
+        n = groups[0].shape[1] + groups[1].shape[1]
+        random_inds = sample_permutations(n, reps, seed)
+    elif test == 'bootstrap_mann_whitney_u':
+        n = groups[0].shape[1] + groups[1].shape[1]
+        random_inds = sample_bootstrap_indices(n, reps, seed)
+    else:
+        random_inds = None
+
+    if jobs_to_start > 1 and num_rows > 1:
+        chunk_size = -(-num_rows // jobs_to_start)
+        tasks = [(test, [g[i:i + chunk_size] for g in groups], reps,
+                  random_inds) for i in range(0, num_rows, chunk_size)]
+        pool = Pool(jobs_to_start)
+        try:
+            results = pool.map(_group_significance_chunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+        test_stats = hstack([r[0] for r in results])
+        pvals = hstack([r[1] for r in results])
+    else:
+        test_stats, pvals = _group_significance_chunk((test, groups, reps,
+                                                       random_inds))
+    means = column_stack([g.mean(axis=1) for g in groups])
+    return test_stats.tolist(), pvals.tolist(), means.tolist()
+
+
 def group_significance_output_formatter(bt, test_stats, pvals, fdr_pvals,
                                         bon_pvals, means, cat_sample_indices, md_key):
     """Format the output for gradient tests so it can be easily written.
@@ -329,6 +438,39 @@ def run_correlation_test(data_generator, test, test_choices,
     return corr_coefs, pvals
 
 
+def run_batched_correlation_test(data, md_vals, test, pval_assignment_method,
+                                 permutations=None, seed=None):
+    """Run correlation tests on all rows of data at once.
+
+    Computes the same correlations and pvalues as run_correlation_test, with
+    matrix operations over the whole table instead of calls for each OTU.
+    Inputs:
+     data - 2D array, one row per OTU and one column per sample, in the same
+      order as md_vals.
+     md_vals - 1D array, continuous metadata of each sample.
+     test - str, one of CORRELATION_TEST_CHOICES keys.
+     pval_assignment_method - str, one of CORRELATION_PVALUE_CHOICES.
+     permutations - int or None, number of permutations to use for bootstrapped
+      methods.
+     seed - int or numpy RandomState, seed of the permutations of md_vals for
+      bootstrapped methods. These are drawn once and shared by all OTUs. If
+      None, numpy's global random state is used.
+    Outputs are lists of correlation coefficients and pvalues.
+    """
+    corr_coefs = correlate_rows(data, md_vals, test)
+    if pval_assignment_method == 'bootstrapped':
+        if permutations is None:
+            raise ValueError('You must specify the number of permutations to '
+                             'calc bootstrapped pvalues. Cant continue.')
+        pvals = bootstrapped_correlation_pvals(data, md_vals, test,
+                                               corr_coefs, permutations,
+                                               seed=seed)
+    else:
+        pvals = assign_correlation_pvals(corr_coefs, len(md_vals),
+                                         pval_assignment_method)
+    return corr_coefs.tolist(), pvals.tolist()
+
+
 def correlate_output_formatter(bt, test_stats, pvals, fdr_pvals, bon_pvals,
                                md_key):
     '''Produce lines for a tab delimited text file for correlations.py.
@@ -10,12 +10,23 @@ __version__ = "1.9.1-dev"
 __maintainer__ = "Greg Caporaso"
 __email__ = "gregcaporaso@gmail.com"
 
+from os import remove, rename
 from os.path import join, split, splitext
-from skbio.util import create_dir
 from biom import load_table
 
 from qiime.parallel.util import ParallelWrapper
-from qiime.format import format_distance_matrix
+from qiime.format import (format_distance_matrix,
+                          preallocate_binary_distance_matrix,
+                          convert_distance_matrix_to_text)
+from qiime.parse import is_binary_distmat
+from qiime.beta_diversity import is_symmetric_metric
+
+
+def get_output_ext(params):
+    """Returns the extension of the distance matrix files written by jobs"""
+    if params.get('binary_output'):
+        return '.dm'
+    return '.txt'
 
 
 class ParallelBetaDiversity(ParallelWrapper):
@@ -38,6 +49,8 @@ class ParallelBetaDiversity(ParallelWrapper):
 
 
 class ParallelBetaDiversitySingle(ParallelBetaDiversity):
+    _process_run_results_f =\
+        'qiime.parallel.beta_diversity.parallel_beta_diversity_process_run_results_f'
 
     def _identify_files_to_remove(self, job_result_filepaths, params):
         """ The output of the individual jobs are the files we want to keep
@@ -50,19 +63,19 @@ class ParallelBetaDiversitySingle(ParallelBetaDiversity):
                               params,
                               output_dir,
                               merge_map_filepath):
-
+        """ Each job writes its rows into a binary distance matrix per metric
+            (see _get_job_commands), which only has to be moved, or written
+            as text, once all jobs are complete
+        """
         merge_map_f = open(merge_map_filepath, 'w')
 
         for metric in params['metrics'].split(','):
-            fps_to_merge = [
-                fp for fp in job_result_filepaths if '/%s_' %
-                metric in fp]
             output_fp = join(
-                output_dir, '%s_%s.txt' %
-                (metric, input_file_basename))
+                output_dir, '%s_%s%s' %
+                (metric, input_file_basename, get_output_ext(params)))
             merge_map_f.write(
                 '%s\t%s\n' %
-                ('\t'.join(fps_to_merge), output_fp))
+                (self._dm_fps[metric], output_fp))
 
         merge_map_f.close()
 
@@ -78,11 +91,31 @@ class ParallelBetaDiversitySingle(ParallelBetaDiversity):
 
         full_tree=True is faster: beta_diversity.py -f will make things
         go faster, but be sure you already have the correct minimal tree.
+
+        An empty binary distance matrix is created in working_dir for each
+        metric (with the square layout if the metric isn't symmetric), and
+        each job writes its rows in place into these files
+        (beta_diversity.py -B -r). A job's result file is only created
+        once the job has written all its rows.
         """
         commands = []
         result_filepaths = []
 
         sids = load_table(input_fp).ids()
+        input_dir, input_fn = split(input_fp)
+        input_basename, input_ext = splitext(input_fn)
+
+        self._dm_fps = {}
+        for metric in params['metrics'].split(','):
+            dm_fp = join(working_dir, '%s_%s.dm' % (metric, input_basename))
+            # only the upper triangle of symmetric distance matrices is
+            # stored, see qiime.format.write_binary_distance_matrix
+            if is_symmetric_metric(metric):
+                layout = 'condensed'
+            else:
+                layout = 'square'
+            preallocate_binary_distance_matrix(dm_fp, sids, layout=layout)
+            self._dm_fps[metric] = dm_fp
 
         if params['full_tree']:
             full_tree_str = '-f'
@@ -94,8 +127,6 @@ class ParallelBetaDiversitySingle(ParallelBetaDiversity):
         else:
             tree_str = ''
 
-        metrics = params['metrics']
-
         # this is a little bit of an abuse of _merge_to_n_commands, so may
         # be worth generalizing that method - this determines the correct
         # number of samples to process in each command
@@ -106,32 +137,21 @@ class ParallelBetaDiversitySingle(ParallelBetaDiversity):
                                                      command_suffix='')
 
         for i, sample_id_group in enumerate(sample_id_groups):
-            working_dir_i = join(working_dir, str(i))
-            create_dir(working_dir_i)
-            output_dir_i = join(output_dir, str(i))
-            create_dir(output_dir_i)
-            result_filepaths.append(output_dir_i)
-            input_dir, input_fn = split(input_fp)
-            input_basename, input_ext = splitext(input_fn)
-            sample_id_desc = sample_id_group.replace(',', '_')
-            output_fns = ['%s_%s.txt' % (metric, input_basename)
-                          for metric in metrics.split(',')]
-            rename_command, current_result_filepaths = self._get_rename_command(
-                output_fns, working_dir_i, output_dir_i)
-
-            result_filepaths += current_result_filepaths
+            done_fp = join(working_dir, '%s%d.done' % (job_prefix, i))
+            result_filepaths.append(done_fp)
 
-            bdiv_command = '%s -i %s -o %s %s -m %s %s -r %s' %\
+            bdiv_command = '%s -i %s -o %s %s -m %s %s -r %s -B && touch %s' %\
                 (self._script_name,
                  input_fp,
-                 working_dir_i,
+                 working_dir,
                  tree_str,
                  params['metrics'],
                  full_tree_str,
-                 sample_id_group)
+                 sample_id_group,
+                 done_fp)
 
-            shell_script_fp = '%s/%s%d.sh' % (working_dir_i, job_prefix, i)
-            shell_script_commands = [bdiv_command] + rename_command.split(';')
+            shell_script_fp = '%s/%s%d.sh' % (working_dir, job_prefix, i)
+            shell_script_commands = [bdiv_command]
             self._commands_to_shell_script(shell_script_commands,
                                            shell_script_fp)
             commands.append('bash %s' % shell_script_fp)
@@ -157,7 +177,7 @@ class ParallelBetaDiversitySingle(ParallelBetaDiversity):
              merge_map_filepath,
              deletion_list_filepath,
              self._seconds_to_sleep,
-             'qiime.parallel.beta_diversity.parallel_beta_diversity_process_run_results_f',
+             self._process_run_results_f,
              command_suffix)
 
         return result, []
@@ -186,6 +206,11 @@ class ParallelBetaDiversityMultiple(ParallelBetaDiversity):
         else:
             tree_str = ''
 
+        if params.get('binary_output'):
+            binary_str = '-B'
+        else:
+            binary_str = ''
+
         commands = []
         result_filepaths = []
 
@@ -195,13 +220,13 @@ class ParallelBetaDiversityMultiple(ParallelBetaDiversity):
             input_path, input_fn = split(input_fp)
             input_basename, input_ext = splitext(input_fn)
             output_fns = \
-                ['%s_%s.txt' % (metric, input_basename)
+                ['%s_%s%s' % (metric, input_basename, get_output_ext(params))
                  for metric in metrics.split(',')]
             rename_command, current_result_filepaths = self._get_rename_command(
                 output_fns, working_dir, output_dir)
             result_filepaths += current_result_filepaths
 
-            command = '%s %s -i %s -o %s %s -m %s %s %s %s' %\
+            command = '%s %s -i %s -o %s %s -m %s %s %s %s %s' %\
                 (command_prefix,
                  self._script_name,
                  input_fp,
@@ -209,6 +234,7 @@ class ParallelBetaDiversityMultiple(ParallelBetaDiversity):
                  tree_str,
                  params['metrics'],
                  full_tree_str,
+                 binary_str,
                  rename_command,
                  command_suffix)
 
@@ -224,12 +250,23 @@ class ParallelBetaDiversityMultiple(ParallelBetaDiversity):
 
 def parallel_beta_diversity_process_run_results_f(f):
     """ Handles re-assembling of a distance matrix from component vectors
+
+    A single binary distance matrix component, into which the jobs wrote
+    their rows, is moved to output_fp if that's a binary distance matrix
+    (.dm), and otherwise written as text.
     """
     # iterate over component, output fp lines
     for line in f:
         fields = line.strip().split('\t')
         dm_components = fields[:-1]
         output_fp = fields[-1]
+        if len(dm_components) == 1 and is_binary_distmat(dm_components[0]):
+            if output_fp.endswith('.dm'):
+                rename(dm_components[0], output_fp)
+            else:
+                convert_distance_matrix_to_text(dm_components[0], output_fp)
+                remove(dm_components[0])
+            continue
         # assemble the current dm
         dm = assemble_distance_matrix(map(open, dm_components))
         # and write it to file
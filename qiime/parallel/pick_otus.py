@@ -20,7 +20,8 @@ from bfillings.sortmerna_v2 import build_database_sortmerna
 
 from skbio.parse.sequences import parse_fasta
 
-from qiime.parallel.util import ParallelWrapper, BufferedWriter
+from qiime.parallel.util import (ParallelWrapper, BufferedWriter,
+                                 greedy_partition)
 from qiime.parallel.poller import basic_process_run_results_f
 
 
@@ -105,6 +106,7 @@ class ParallelPickOtus(ParallelWrapper):
 class ParallelPickOtusSortMeRNA(ParallelPickOtus):
     """ Run pick_otus.py in parallel for SortMeRNA
     """
+    _input_splitter = ParallelWrapper._split_fasta_into_chunks
 
     def _precommand_initiation(
             self, input_fp, output_dir, working_dir, params):
@@ -169,6 +171,7 @@ class ParallelPickOtusSortMeRNA(ParallelPickOtus):
 
 
 class ParallelPickOtusUclustRef(ParallelPickOtus):
+    _input_splitter = ParallelWrapper._split_fasta_into_chunks
 
     def _identify_files_to_remove(self, job_result_filepaths, params):
         """ Select the files to remove: by default remove all files
@@ -329,6 +332,7 @@ class ParallelPickOtusUsearch61Ref(ParallelPickOtus):
 
 
 class ParallelPickOtusBlast(ParallelPickOtus):
+    _input_splitter = ParallelWrapper._split_fasta_into_chunks
 
     def _precommand_initiation(
             self, input_fp, output_dir, working_dir, params):
@@ -651,21 +655,3 @@ def parallel_pick_otus_trie_process_run_results_f(f):
     # you'll get an error right away rather than going into an infinite loop
     return True
 
-
-def greedy_partition(counts, n):
-    """Distribute k counts evenly across n buckets,
-
-    counts: dict of key, counts pairs
-    n: number of buckets that the counts should be distributed over
-    """
-
-    buckets = [[] for i in range(n)]
-    fill_levels = [0 for i in range(n)]
-
-    for key in sorted(counts, reverse=True,
-                      key=lambda c: counts[c]):
-        smallest = fill_levels.index(min(fill_levels))
-        buckets[smallest].append(key)
-        fill_levels[smallest] += counts[key]
-
-    return buckets, fill_levels
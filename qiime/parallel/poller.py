@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 
 from __future__ import division
-from time import sleep
+from ctypes import CDLL, get_errno
+from ctypes.util import find_library
+from select import select
+from struct import calcsize
+from time import sleep, time
 from optparse import OptionParser
-from os import getenv, remove
-from os.path import exists, isdir
+from os import getenv, remove, listdir, read, close
+from os.path import exists, isdir, split
 from shutil import rmtree
 from skbio.util import remove_files
 from qiime.parse import parse_tmp_to_final_filepath_map_file
@@ -40,6 +44,29 @@ def remove_all(paths_to_remove):
     return
 
 
+def find_existing_filepaths(filepaths):
+    """ Return the subset of filepaths which exist
+
+        Each directory is listed once, rather than each filepath being
+         stat'ed individually, which is much cheaper when polling many files
+         on a network file system.
+    """
+    filepaths_by_dir = {}
+    for fp in filepaths:
+        dir_path, fn = split(fp)
+        filepaths_by_dir.setdefault(dir_path or '.', []).append((fn, fp))
+
+    result = []
+    for dir_path, fns in filepaths_by_dir.items():
+        try:
+            dir_contents = set(listdir(dir_path))
+        except OSError:
+            # directory doesn't exist (yet)
+            continue
+        result.extend([fp for fn, fp in fns if fn in dir_contents])
+    return result
+
+
 def basic_check_run_complete_f(f):
     """ Return True if all filepaths exist
 
@@ -55,10 +82,7 @@ def basic_check_run_complete_f(f):
 
     """
     filepaths = [l.strip() for l in f]
-    for fp in filepaths:
-        if not exists(fp):
-            return False
-    return True
+    return len(set(find_existing_filepaths(filepaths))) == len(set(filepaths))
 
 
 def basic_process_run_results_f(f):
@@ -187,17 +211,143 @@ def verbose_clean_up_f(f):
     return True
 
 
+# inotify event masks (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+
+def _inotify_watch(dir_paths):
+    """ Return an inotify file descriptor watching dir_paths, or None
+
+        None is returned if inotify is not available on this platform (or
+         if none of the directories can be watched), in which case callers
+         should fall back to polling.
+    """
+    try:
+        libc = CDLL(find_library('c') or 'libc.so.6', use_errno=True)
+        inotify_init = libc.inotify_init
+        inotify_add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+
+    fd = inotify_init()
+    if fd < 0:
+        return None
+    num_watches = 0
+    for dir_path in dir_paths:
+        if inotify_add_watch(fd, dir_path,
+                             IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) >= 0:
+            num_watches += 1
+    if num_watches == 0:
+        close(fd)
+        return None
+    return fd
+
+
+class CompletionWatcher(object):
+
+    """ Watches for the creation of a list of output files
+
+        On Linux, inotify is used to wake up as soon as files are created in
+         (or moved into) the directories being watched. Each wake-up (or,
+         where inotify is unavailable, each tick of an exponential backoff
+         between min_seconds_to_sleep and max_seconds_to_sleep) triggers a
+         single listing of each directory. inotify does not see changes
+         made by other hosts on network file systems, so the backoff bounds
+         how long a change can go unnoticed in that case too.
+
+        The number of seconds after the watcher was created at which each
+         file was first observed is recorded in CompletionTimes.
+    """
+
+    def __init__(self,
+                 filepaths,
+                 min_seconds_to_sleep=1,
+                 max_seconds_to_sleep=60,
+                 use_inotify=True):
+        self.Filepaths = list(filepaths)
+        self.CompletionTimes = {}
+        self.MinSecondsToSleep = min(min_seconds_to_sleep,
+                                     max_seconds_to_sleep)
+        self.MaxSecondsToSleep = max_seconds_to_sleep
+        self._start_time = time()
+        self._inotify_fd = None
+        if use_inotify:
+            self._inotify_fd = _inotify_watch(
+                set([split(fp)[0] or '.' for fp in self.Filepaths]))
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """ Release the inotify file descriptor, if one is open """
+        if self._inotify_fd is not None:
+            close(self._inotify_fd)
+            self._inotify_fd = None
+
+    def update(self):
+        """ Check for newly created files, returning True if all exist """
+        pending = [fp for fp in self.Filepaths
+                   if fp not in self.CompletionTimes]
+        if pending:
+            elapsed = time() - self._start_time
+            for fp in find_existing_filepaths(pending):
+                self.CompletionTimes[fp] = elapsed
+        return len(self.CompletionTimes) == len(set(self.Filepaths))
+
+    def wait_for_change(self, timeout):
+        """ Block until a watched directory changes or timeout seconds pass
+        """
+        if self._inotify_fd is None:
+            sleep(timeout)
+            return
+        readable, _, _ = select([self._inotify_fd], [], [], timeout)
+        if readable:
+            # drain the pending events: only the fact that something
+            # happened is needed, as the directories are re-listed anyway
+            read(self._inotify_fd, 64 * (calcsize('iIII') + 256))
+
+    def wait(self, check_run_complete_f=None, check_run_complete_file=None):
+        """ Block until all files exist, returning the elapsed seconds
+
+            check_run_complete_f: if provided, this function (called with
+             check_run_complete_file) rather than the existence of the
+             watched files determines when the run is complete
+        """
+        if check_run_complete_f is None:
+            is_complete = self.update
+        else:
+            def is_complete():
+                self.update()
+                return check_run_complete_f(check_run_complete_file)
+
+        seconds_to_sleep = self.MinSecondsToSleep
+        num_completed = len(self.CompletionTimes)
+        while not is_complete():
+            if len(self.CompletionTimes) > num_completed:
+                # more files appeared, so check again soon
+                num_completed = len(self.CompletionTimes)
+                seconds_to_sleep = self.MinSecondsToSleep
+            self.wait_for_change(seconds_to_sleep)
+            seconds_to_sleep = min(seconds_to_sleep * 2,
+                                   self.MaxSecondsToSleep)
+        return time() - self._start_time
+
+
 def poller(check_run_complete_f,
            process_run_results_f,
            clean_up_f,
            check_run_complete_file,
            process_run_results_file,
            clean_up_file,
-           seconds_to_sleep):
+           seconds_to_sleep,
+           watcher=None):
     """ Polls for completion of job(s) and then processes/cleans up results
 
         check_run_complete_f: function which returns True when polled
-         job(s) complete and False otherwise
+         job(s) complete and False otherwise. If None, the run is complete
+         when all of the files watched by watcher exist.
         process_run_results_f: function applied to process the results
          of the polled job(s) -- run only after check_run_complete_f => True
         clean_up_f: function applied to clean up after the polled
@@ -206,15 +356,24 @@ def poller(check_run_complete_f,
          on each call
         process_run_results_file: file passed to process_run_results_f
         clean_up_file: file passed to clean_up_f
-        seconds_to_sleep: number of seconds to sleep between calls
-         to check_run_complete_f
-
+        seconds_to_sleep: maximum number of seconds to sleep between calls
+         to check_run_complete_f if watcher is not provided
+        watcher: CompletionWatcher used to wait between calls to
+         check_run_complete_f. If not provided, the time between calls
+         backs off exponentially from one second up to seconds_to_sleep.
+
+        Returns the number of seconds the job(s) ran for after polling
+         started.
     """
-    number_of_loops = 0
-    while(not check_run_complete_f(check_run_complete_file)):
-        sleep(seconds_to_sleep)
-        number_of_loops += 1
+    if watcher is None:
+        if check_run_complete_f is None:
+            raise ValueError("A watcher must be provided if "
+                             "check_run_complete_f is None.")
+        watcher = CompletionWatcher([],
+                                    max_seconds_to_sleep=seconds_to_sleep,
+                                    use_inotify=False)
+    est_per_proc_run_time = watcher.wait(check_run_complete_f,
+                                         check_run_complete_file)
     process_run_results_f(process_run_results_file)
     clean_up_f(clean_up_file)
-    est_per_proc_run_time = number_of_loops * seconds_to_sleep
     return est_per_proc_run_time
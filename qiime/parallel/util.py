@@ -12,12 +12,18 @@ __maintainer__ = "Greg Caporaso"
 __email__ = "gregcaporaso@gmail.com"
 
 from math import ceil
-from os.path import split, splitext, join
+from multiprocessing import Pool
+from os.path import split, splitext, join, exists
 from os import makedirs, mkdir
 from random import choice
+from time import time
+from numpy import array, maximum
+from numpy.linalg import lstsq
 from skbio.parse.sequences import parse_fasta
 from qiime.split import split_fasta
 from qiime.util import load_qiime_config, qiime_system_call, count_seqs
+from qiime.parallel.poller import (get_function_handle, remove_all, poller,
+                                   basic_clean_up_f, CompletionWatcher)
 
 qiime_config = load_qiime_config()
 
@@ -25,11 +31,97 @@ RANDOM_JOB_PREFIX_CHARS = "abcdefghigklmnopqrstuvwxyz"
 RANDOM_JOB_PREFIX_CHARS += RANDOM_JOB_PREFIX_CHARS.upper()
 RANDOM_JOB_PREFIX_CHARS += "0123456790"
 
+# subcommands which are only required when jobs are run via a cluster_jobs
+# script, and which must be stripped before running the jobs locally
+CLUSTER_ONLY_SUBCOMMANDS = set(['/bin/bash', 'exit'])
+
+PARALLEL_BACKENDS = ['cluster_jobs', 'multiprocessing']
+
+# maximum number of chunk run times retained in a chunk run times file (the
+# most recent are kept)
+MAX_CHUNK_RUN_TIMES = 1000
+
+
+def run_local_job(job):
+    """ Run a single job command, returning its exit status and run time
+
+        job: (job_index, command) tuple
+
+        This is defined at the module level so it can be dispatched to a
+         multiprocessing Pool.
+    """
+    job_index, command = job
+    start_time = time()
+    stdout, stderr, return_value = qiime_system_call(command)
+    return job_index, stdout, stderr, return_value, time() - start_time
+
+
+def greedy_partition(counts, n):
+    """Distribute k counts evenly across n buckets,
+
+    counts: dict of key, counts pairs
+    n: number of buckets that the counts should be distributed over
+    """
+
+    buckets = [[] for i in range(n)]
+    fill_levels = [0 for i in range(n)]
+
+    for key in sorted(counts, reverse=True,
+                      key=lambda c: counts[c]):
+        smallest = fill_levels.index(min(fill_levels))
+        buckets[smallest].append(key)
+        fill_levels[smallest] += counts[key]
+
+    return buckets, fill_levels
+
+
+def estimate_chunk_costs(chunk_sizes, chunk_run_times=None):
+    """ Return the estimated relative run time of each input chunk
+
+        chunk_sizes: list of (number of sequences, number of bases) tuples
+        chunk_run_times: list of (number of sequences, number of bases,
+         run time in seconds) tuples recorded in previous runs. If
+         provided, the run time of a chunk is modeled as a linear function
+         of its number of sequences and bases, fit to these observations.
+         Otherwise (or if the observations can't be fit) the number of bases
+         in each chunk is used as its cost.
+    """
+    if chunk_run_times:
+        observed = array(chunk_run_times, dtype=float)
+        coefficients = maximum(
+            lstsq(observed[:, :2], observed[:, 2], rcond=-1)[0], 0)
+        if coefficients.any():
+            return [float(coefficients.dot(size)) for size in chunk_sizes]
+    return [num_bases for num_seqs, num_bases in chunk_sizes]
+
+
+def parse_chunk_run_times(lines):
+    """ Parse (num seqs, num bases, run time) tuples from lines """
+    result = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            num_seqs, num_bases, run_time = line.split('\t')
+            result.append((int(num_seqs), int(num_bases), float(run_time)))
+    return result
+
+
+def format_chunk_run_times(chunk_run_times):
+    """ Format (num seqs, num bases, run time) tuples as lines """
+    lines = ['#num_seqs\tnum_bases\trun_time']
+    for num_seqs, num_bases, run_time in chunk_run_times:
+        lines.append('%d\t%d\t%f' % (num_seqs, num_bases, run_time))
+    return lines
+
 
 class ParallelWrapper(object):
 
     """
     """
+    _process_run_results_f =\
+        'qiime.parallel.poller.basic_process_run_results_f'
+    # number of chunks per job created by _split_fasta_into_chunks
+    _chunks_per_job = 4
 
     def __init__(self,
                  cluster_jobs_fp=qiime_config['cluster_jobs_fp'],
@@ -37,8 +129,19 @@ class ParallelWrapper(object):
                  poller_fp='poller.py',
                  retain_temp_files=False,
                  suppress_polling=False,
-                 seconds_to_sleep=int(qiime_config['seconds_to_sleep'])):
-        """  """
+                 seconds_to_sleep=int(qiime_config['seconds_to_sleep']),
+                 backend=qiime_config.get('parallel_backend') or
+                 'cluster_jobs'):
+        """
+            backend: 'cluster_jobs' to submit jobs with cluster_jobs_fp and
+             monitor them with the poller, or 'multiprocessing' to run the
+             jobs on a pool of jobs_to_start processes in the current
+             process, merging the results as soon as the last job completes
+        """
+        if backend not in PARALLEL_BACKENDS:
+            raise ValueError("Unknown parallel backend: %s. Valid choices "
+                             "are: %s" % (backend,
+                                          ', '.join(PARALLEL_BACKENDS)))
 
         self._cluster_jobs_fp = cluster_jobs_fp
         self._jobs_to_start = jobs_to_start
@@ -46,6 +149,11 @@ class ParallelWrapper(object):
         self._retain_temp_files = retain_temp_files
         self._suppress_polling = suppress_polling
         self._seconds_to_sleep = seconds_to_sleep
+        self._backend = backend
+        self.job_run_times = {}
+        self.output_completion_times = {}
+        self.chunk_sizes = []
+        self.chunk_run_times = []
 
     def _call_initialization(self,
                              input_fp,
@@ -79,6 +187,7 @@ class ParallelWrapper(object):
         """ """
         # Generate a list of files and directories that will be cleaned up
         self.files_to_remove = []
+        self.chunk_sizes = []
 
         # Allow the user to override the default job_prefix (defined by the
         # base classes)
@@ -139,6 +248,7 @@ class ParallelWrapper(object):
                                                                 params,
                                                                 job_prefix,
                                                                 working_dir)
+        commands = self._schedule_chunks(commands, params)
         self.files_to_remove += \
             self._identify_files_to_remove(job_result_filepaths, params)
 
@@ -150,6 +260,22 @@ class ParallelWrapper(object):
                                                   input_file_basename,
                                                   params)
 
+        # Run the jobs in the current process if requested, processing
+        # the results directly rather than via the poller
+        if self._backend == 'multiprocessing' and not suppress_submit_jobs:
+            self._run_jobs_locally(commands,
+                                   expected_files_filepath,
+                                   merge_map_filepath)
+            self._record_chunk_run_times(params)
+            self.files_to_remove = []
+            self._call_cleanup(input_fp,
+                               output_dir,
+                               params,
+                               job_prefix,
+                               poll_directly,
+                               suppress_submit_jobs)
+            return
+
         # Set up poller apparatus if the user does not suppress polling
         if not self._suppress_polling:
             poller_command = self._initiate_polling(job_result_filepaths,
@@ -179,18 +305,9 @@ class ParallelWrapper(object):
         # If the poller is going to be run by the current process,
         # start polling
         if poll_directly:
-            # IMPORTANT: the following line MUST use qiime_system_call()
-            # instead of subprocess.call, .check_call, or .check_output in case
-            # we are invoked in a child process with PIPEs (a deadlock will
-            # occur otherwise). This can happen if this code is tested by
-            # all_tests.py, for example.
-            stdout, stderr, return_value = qiime_system_call(poller_command)
-            if return_value != 0:
-                print '**Error occuring when calling the poller directly. ' +\
-                    'Jobs may have been submitted, but are not being polled.'
-                print stderr
-                print poller_command
-                exit(-1)
+            self._poll_directly(expected_files_filepath,
+                                merge_map_filepath,
+                                deletion_list_filepath)
         self.files_to_remove = []
 
         # Perform any method-specific cleanup. This should prevent the need to
@@ -234,6 +351,127 @@ class ParallelWrapper(object):
                 deletion_list_filepath,
                 expected_files_filepath)
 
+    def _run_jobs_locally(self,
+                          commands,
+                          expected_files_filepath,
+                          merge_map_filepath):
+        """ Run commands on a process pool and process the results directly
+
+            Completion of each job is reported by the pool as soon as it
+             happens, so no polling for output files is necessary. The run
+             time of each job is stored in self.job_run_times, keyed by the
+             index of the job's command.
+        """
+        jobs = [(i, self._get_local_command(c))
+                for i, c in enumerate(commands)]
+        self.job_run_times = {}
+        failures = []
+        if jobs:
+            pool = Pool(min(max(self._jobs_to_start, 1), len(jobs)))
+            try:
+                for job_index, stdout, stderr, return_value, run_time in \
+                        pool.imap_unordered(run_local_job, jobs):
+                    self.job_run_times[job_index] = run_time
+                    if return_value != 0:
+                        failures.append((jobs[job_index][1], return_value,
+                                         stdout, stderr))
+            finally:
+                pool.close()
+                pool.join()
+
+        if failures:
+            msg = "\n\n*** %d parallel job(s) failed.\n" % len(failures)
+            for command, return_value, stdout, stderr in failures:
+                msg += "Command run was:\n %s\n" % command +\
+                    "Command returned exit status: %d\n" % return_value +\
+                    "Stdout:\n%s\nStderr\n%s\n" % (stdout, stderr)
+            raise RuntimeError(msg)
+
+        expected_files = [l.strip() for l in open(expected_files_filepath)
+                          if l.strip()]
+        missing_files = [fp for fp in expected_files if not exists(fp)]
+        if missing_files:
+            raise RuntimeError("Parallel jobs completed without creating "
+                               "the following output files:\n%s"
+                               % '\n'.join(missing_files))
+
+        if not self._suppress_polling:
+            process_run_results_f = \
+                get_function_handle(self._process_run_results_f)
+            process_run_results_f(list(open(merge_map_filepath)))
+            if not self._retain_temp_files:
+                remove_all(self.files_to_remove)
+
+    def _schedule_chunks(self, commands, params):
+        """ Distribute the commands for each input chunk over the workers
+
+            This only applies when the input was split by
+             _split_fasta_into_chunks. With the multiprocessing backend,
+             each chunk is run as a separate job, most expensive first, and
+             the pool hands the next chunk to each process as soon as it
+             becomes free. Otherwise, the chunks are partitioned into
+             jobs_to_start jobs of roughly equal estimated cost. Costs are
+             estimated from the run times of previous runs if
+             params['chunk_run_times_fp'] exists.
+        """
+        self._scheduled_chunks = None
+        if not self.chunk_sizes:
+            return commands
+
+        chunk_run_times_fp = params.get('chunk_run_times_fp')
+        if chunk_run_times_fp and exists(chunk_run_times_fp):
+            chunk_run_times = parse_chunk_run_times(open(chunk_run_times_fp))
+        else:
+            chunk_run_times = None
+        costs = estimate_chunk_costs(self.chunk_sizes, chunk_run_times)
+
+        if self._backend == 'multiprocessing':
+            order = sorted(range(len(commands)), key=lambda i: -costs[i])
+            self._scheduled_chunks = [[i] for i in order]
+            return [commands[i] for i in order]
+
+        buckets, _ = greedy_partition(dict(enumerate(costs)),
+                                      self._jobs_to_start)
+        buckets = [sorted(b) for b in buckets if b]
+        return [self._merge_to_n_commands([commands[i] for i in b], 1)[0]
+                for b in buckets]
+
+    def _record_chunk_run_times(self, params):
+        """ Record the run time of each chunk run as a separate job
+
+            The run times are appended to params['chunk_run_times_fp'], if
+             provided, so they can be used to estimate chunk costs in later
+             runs. Only the most recent MAX_CHUNK_RUN_TIMES run times are
+             kept in the file.
+        """
+        if not self._scheduled_chunks:
+            return
+        self.chunk_run_times = []
+        for job_index, chunk_indices in enumerate(self._scheduled_chunks):
+            num_seqs, num_bases = self.chunk_sizes[chunk_indices[0]]
+            self.chunk_run_times.append(
+                (num_seqs, num_bases, self.job_run_times[job_index]))
+
+        chunk_run_times_fp = params.get('chunk_run_times_fp')
+        if chunk_run_times_fp:
+            if exists(chunk_run_times_fp):
+                previous = parse_chunk_run_times(open(chunk_run_times_fp))
+            else:
+                previous = []
+            f = open(chunk_run_times_fp, 'w')
+            chunk_run_times = previous + self.chunk_run_times
+            f.write('\n'.join(format_chunk_run_times(
+                chunk_run_times[-MAX_CHUNK_RUN_TIMES:])))
+            f.write('\n')
+            f.close()
+
+    def _get_local_command(self, command):
+        """ Strip subcommands that are only needed by cluster_jobs scripts
+        """
+        return ' ; '.join([c.strip() for c in command.split(';')
+                           if c.strip() and
+                           c.strip() not in CLUSTER_ONLY_SUBCOMMANDS])
+
     def _submit_jobs(self,
                      jobs_fp,
                      job_prefix):
@@ -340,6 +578,36 @@ class ParallelWrapper(object):
 
         return poller_command
 
+    def _poll_directly(self,
+                       expected_files_filepath,
+                       merge_map_filepath,
+                       deletion_list_filepath):
+        """ Wait for the expected files and process the results in-process
+
+            Rather than running poller.py in a subprocess, the poller is
+             called directly with a CompletionWatcher, so completion is
+             noticed as soon as the last expected file appears. The number
+             of seconds after polling started at which each expected file
+             appeared is stored in self.output_completion_times, keyed by
+             filepath.
+        """
+        expected_files = [l.strip() for l in open(expected_files_filepath)]
+        watcher = CompletionWatcher(
+            expected_files,
+            max_seconds_to_sleep=self._seconds_to_sleep)
+        try:
+            poller(None,
+                   get_function_handle(self._process_run_results_f),
+                   basic_clean_up_f,
+                   None,
+                   list(open(merge_map_filepath)),
+                   list(open(deletion_list_filepath)),
+                   seconds_to_sleep=self._seconds_to_sleep,
+                   watcher=watcher)
+        finally:
+            watcher.close()
+        self.output_completion_times = watcher.CompletionTimes
+
     def _get_poller_command(self,
                             expected_files_filepath,
                             merge_map_filepath,
@@ -486,6 +754,50 @@ class ParallelWrapper(object):
 
         return tmp_fasta_fps, True
 
+    def _split_fasta_into_chunks(self,
+                                 input_fp,
+                                 params,
+                                 jobs_to_start,
+                                 job_prefix,
+                                 output_dir):
+        """ Split input_fp into many chunks with similar numbers of bases
+
+            _chunks_per_job chunks are created per job, so that the chunks
+             can be balanced over the jobs by _schedule_chunks. The number of
+             sequences and bases in each chunk is stored in
+             self.chunk_sizes.
+        """
+        num_chunks = max(jobs_to_start, 1) * self._chunks_per_job
+        total_bases = 0
+        for seq_id, seq in parse_fasta(open(input_fp, 'U')):
+            total_bases += len(seq)
+        bases_per_chunk = total_bases / num_chunks
+
+        if not output_dir.endswith('/'):
+            output_dir += '/'
+        self.chunk_sizes = []
+        chunk_fps = []
+        chunk_f = None
+        for seq_id, seq in parse_fasta(open(input_fp, 'U')):
+            if chunk_f is None:
+                chunk_fp = '%s%s.%d.fasta' % (output_dir, job_prefix,
+                                              len(chunk_fps))
+                chunk_f = open(chunk_fp, 'w')
+                chunk_fps.append(chunk_fp)
+                num_seqs = num_bases = 0
+            chunk_f.write('>%s\n%s\n' % (seq_id, seq))
+            num_seqs += 1
+            num_bases += len(seq)
+            if num_bases >= bases_per_chunk:
+                chunk_f.close()
+                chunk_f = None
+                self.chunk_sizes.append((num_seqs, num_bases))
+        if chunk_f is not None:
+            chunk_f.close()
+            self.chunk_sizes.append((num_seqs, num_bases))
+
+        return chunk_fps, True
+
     def _input_existing_filepaths(self,
                                   input_fps,
                                   params,
@@ -19,10 +19,12 @@ from os.path import expandvars
 import re
 from types import GeneratorType
 
-from numpy import concatenate, repeat, zeros, nan, asarray
+from numpy import concatenate, repeat, zeros, nan, asarray, memmap, dtype
 from numpy.random import permutation
+from scipy.spatial.distance import squareform
 
 from skbio.stats.ordination import OrdinationResults
+from skbio.stats.distance import DistanceMatrix
 from skbio.parse.record_finder import LabeledRecordFinder
 from cogent.parse.tree import DndParser
 from skbio.parse.sequences import parse_fastq
@@ -215,13 +217,100 @@ def group_by_fields(table, names):
     return result
 
 
+# first line of binary distance matrix files, see
+# qiime.format.write_binary_distance_matrix
+BINARY_DISTMAT_MAGIC = '#QIIME binary distance matrix v1\n'
+
+
+def is_binary_distmat(fp):
+    """Returns True if fp is the path of a binary distance matrix file"""
+    if not os.path.isfile(fp):
+        return False
+    f = open(fp, 'rb')
+    try:
+        return f.read(len(BINARY_DISTMAT_MAGIC)) == BINARY_DISTMAT_MAGIC
+    finally:
+        f.close()
+
+
+def parse_binary_distmat_header(f):
+    """Parses the header of a binary distance matrix file
+
+    f: file open in binary mode, positioned at the start of the file
+
+    Returns (sample ids, layout, dtype, offset of the distances), where
+    layout is 'condensed' (the upper triangle of a symmetric matrix with
+    zeros on the diagonal, row by row) or 'square' (all rows).
+    """
+    if f.readline() != BINARY_DISTMAT_MAGIC:
+        raise ValueError("Not a binary distance matrix file.")
+    layout, dtype_str, num_ids, offset = f.readline().rstrip('\n').split('\t')
+    num_ids = int(num_ids)
+    if layout not in ('condensed', 'square'):
+        raise ValueError("Unknown distance matrix layout: %s" % layout)
+    ids = f.readline().rstrip('\n').split('\t')
+    if num_ids == 0:
+        ids = []
+    if len(ids) != num_ids:
+        raise ValueError("Expected %d sample ids in the binary distance "
+                         "matrix header, found %d." % (num_ids, len(ids)))
+    return ids, layout, dtype(dtype_str), int(offset)
+
+
+def load_binary_distmat(fp, mode='r'):
+    """Returns (sample ids, layout, distances) from a binary distance matrix
+
+    The distances are memory-mapped from fp (numpy.memmap opened with mode),
+    so they're only read from disk when accessed: a condensed array for the
+    condensed layout, and a square array otherwise.
+    """
+    f = open(fp, 'rb')
+    try:
+        ids, layout, data_dtype, offset = parse_binary_distmat_header(f)
+    finally:
+        f.close()
+    num_ids = len(ids)
+    if layout == 'condensed':
+        shape = (num_ids * (num_ids - 1) // 2,)
+    else:
+        shape = (num_ids, num_ids)
+    if shape[0] == 0:
+        # empty files can't be memory-mapped
+        return ids, layout, zeros(shape, dtype=data_dtype)
+    return ids, layout, memmap(fp, dtype=data_dtype, mode=mode,
+                               offset=offset, shape=shape)
+
+
+def parse_binary_distmat(fp):
+    """Parser for binary distance matrix files, see parse_distmat
+
+    Returns sample ids and the square distance matrix. Square float64
+    matrices are returned memory-mapped rather than read into memory.
+    """
+    ids, layout, data = load_binary_distmat(fp)
+    if not ids:
+        return ids, zeros((0, 0))
+    if layout == 'condensed':
+        data = squareform(data, force='tomatrix', checks=False)
+    if data.dtype != float:
+        data = data.astype(float)
+    return ids, data
+
+
 def parse_distmat(lines):
     """Parser for distance matrix file (e.g. UniFrac dist matrix).
 
     The examples I have of this file are just sample x sample tab-delimited
     text, so easiest way to handle is just to convert into a numpy array
     plus a list of field names.
+
+    If lines is a file whose path is a binary distance matrix (see
+    qiime.format.write_binary_distance_matrix), it is parsed with
+    parse_binary_distmat instead.
     """
+    fp = getattr(lines, 'name', None)
+    if isinstance(fp, str) and is_binary_distmat(fp):
+        return parse_binary_distmat(fp)
     header = None
     result = []
     for line in lines:
@@ -251,6 +340,19 @@ def parse_matrix(lines):
     return col_headers, row_headers, asarray(result)
 
 
+def parse_distmat_to_skbio(dm):
+    """Returns skbio DistanceMatrix from a distance matrix file
+
+    dm: path or file, in the text format or the binary format (see
+     parse_binary_distmat)
+    """
+    fp = getattr(dm, 'name', dm)
+    if isinstance(fp, str) and is_binary_distmat(fp):
+        ids, data = parse_binary_distmat(fp)
+        return DistanceMatrix(data, ids)
+    return DistanceMatrix.read(dm)
+
+
 def parse_distmat_to_dict(table):
     """Parse a dist matrix into an 2d dict indexed by sample ids.
 
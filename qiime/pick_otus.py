@@ -25,12 +25,13 @@ from tempfile import mkstemp
 from bfillings.mothur import parse_otu_list as mothur_parse
 
 from skbio.util import remove_files, flatten
-from skbio.tree import CompressedTrie, fasta_to_pairlist
 from skbio.parse.sequences import parse_fasta
 from skbio.alignment import SequenceCollection
 from skbio.sequence import DNA
 
 from qiime.util import FunctionWithParams, get_qiime_temp_dir
+from qiime.dereplicate import SequenceDereplicator
+from qiime.trie import ArrayCompressedTrie
 from qiime.sort import sort_fasta_by_abundance
 from qiime.parse import fields_to_dict
 
@@ -82,84 +83,61 @@ class OtuPicker(FunctionWithParams):
         """
         raise NotImplementedError("OtuPicker is an abstract class")
 
+    def _get_dereplicator(self, prefix_length=None):
+        """Return a SequenceDereplicator honoring the prefilter memory budget
+
+        The budget is taken from Params['prefilter_max_memory'] (in bytes);
+        if it is not set, dereplication is performed entirely in memory.
+        """
+        return SequenceDereplicator(
+            prefix_length=prefix_length,
+            max_memory=self.Params.get('prefilter_max_memory'),
+            temp_dir=get_qiime_temp_dir())
+
     def _prefilter_exact_prefixes(self, seqs, prefix_length=100):
         """
         """
-        unique_prefixes = {}
-        for seq_id, seq in seqs:
-            seq_len = len(seq)
-            seq_id = seq_id.split()[0]
-            current_prefix = seq[:prefix_length]
-            try:
-                prefix_data = unique_prefixes[current_prefix]
-                if seq_len > prefix_data[2]:
-                    # if this is the longest seq with this prefix so far,
-                    # update the list of seq_ids, the best seq_len, and the
-                    # best hit seq_id
-                    prefix_data[0].append(seq_id)
-                    prefix_data[1] = seq_id
-                    prefix_data[2] = seq_len
-                    prefix_data[3] = seq
-                else:
-                    # if longer have been seen, only update the list of seq_ids
-                    prefix_data[0].append(seq_id)
-            except KeyError:
-                # list of seq_ids mapped to this prefix, best hit seq_id, best
-                # hit seq_len
-                unique_prefixes[current_prefix] = [[seq_id],
-                                                   seq_id,
-                                                   seq_len,
-                                                   seq]
-
-        # construct the result objects
         filtered_seqs = []
         seq_id_map = {}
-        for data in unique_prefixes.values():
-            filtered_seqs.append((data[1], data[3]))
-            seq_id_map[data[1]] = data[0]
-
+        dereplicator = self._get_dereplicator(prefix_length)
+        for rep_id, rep_seq, seq_ids in dereplicator(seqs):
+            filtered_seqs.append((rep_id, rep_seq))
+            seq_id_map[rep_id] = seq_ids
         return filtered_seqs, seq_id_map
 
+    def _iter_exact_matches(self, seqs):
+        """Yield (temp_seq_id, seq, seq_ids) for each unique sequence
+
+        Groups are yielded in the order of the first occurrence of each
+        unique sequence, so callers can stream them to disk without holding
+        the unique sequences in memory.
+        """
+        dereplicator = self._get_dereplicator()
+        for rep_id, seq, seq_ids in dereplicator(seqs):
+            yield 'QiimeExactMatch.%s' % rep_id, seq, seq_ids
+
     def _prefilter_exact_matches(self, seqs):
         """
         """
-        unique_sequences = {}
         seq_id_map = {}
         filtered_seqs = []
-        for seq_id, seq in seqs:
-            seq_id = seq_id.split()[0]
-            try:
-                temp_seq_id = unique_sequences[seq]
-            except KeyError:
-                # unseen sequence so create a new temp_seq_id,
-                # a new unique_sequence entry, and new seq_id_map
-                # entry, and add the sequence to the list of
-                # filtered seqs -- this will retain the order
-                # of the input sequences too
-                temp_seq_id = 'QiimeExactMatch.%s' % seq_id
-                unique_sequences[seq] = temp_seq_id
-                seq_id_map[temp_seq_id] = []
-                filtered_seqs.append((temp_seq_id, seq))
-            seq_id_map[temp_seq_id].append(seq_id)
+        for temp_seq_id, seq, seq_ids in self._iter_exact_matches(seqs):
+            seq_id_map[temp_seq_id] = seq_ids
+            filtered_seqs.append((temp_seq_id, seq))
         return filtered_seqs, seq_id_map
 
     def _prefilter_with_trie(self, seq_path):
 
         trunc_id = lambda a_b: (a_b[0].split()[0], a_b[1])
-        # get the prefix map
+        # get the prefix map, reading the input only once
         with open(seq_path, 'U') as seq_lines:
-            t = CompressedTrie(fasta_to_pairlist(imap(trunc_id,
-                                                      parse_fasta(seq_lines))))
+            t = ArrayCompressedTrie(imap(trunc_id, parse_fasta(seq_lines)))
         mapping = t.prefix_map
         for key in mapping.keys():
                 mapping[key].append(key)
 
-        # collect the representative seqs
-        filtered_seqs = []
-        for (label, seq) in parse_fasta(open(seq_path)):
-            label = label.split()[0]
-            if label in mapping:
-                filtered_seqs.append((label, seq))
+        # collect the representative seqs from the packed sequences
+        filtered_seqs = list(t.representative_seqs())
         return filtered_seqs, mapping
 
     def _map_filtered_clusters_to_full_clusters(self, clusters, filter_map):
@@ -328,11 +306,6 @@ class SortmernaV2OtuPicker(OtuPicker):
                     unique_seqs_fp, filepath to FASTA file
                     holding only de-replicated sequences
         """
-        # Creating mapping for de-replicated reads
-        with open(seq_path, 'U') as s_path:
-            seqs_to_cluster, exact_match_id_map =\
-                self._prefilter_exact_matches(parse_fasta(s_path))
-
         # Create temporary file for storing the de-replicated reads
         fd, unique_seqs_fp = mkstemp(
             prefix='SortMeRNAExactMatchFilter', suffix='.fasta')
@@ -340,19 +313,18 @@ class SortmernaV2OtuPicker(OtuPicker):
 
         self.files_to_remove.append(unique_seqs_fp)
 
-        # Write de-replicated reads to file
+        # Create mapping for de-replicated reads, writing the reads to
+        # file as they are de-replicated
+        exact_match_id_map = {}
         unique_seqs_f = open(unique_seqs_fp, 'w')
-        for seq_id, seq in seqs_to_cluster:
-            unique_seqs_f.write('>%s count=%d;\n%s\n' %
-                                (seq_id,
-                                 len(exact_match_id_map[seq_id]),
-                                 seq))
+        with open(seq_path, 'U') as s_path:
+            for seq_id, seq, seq_ids in \
+                    self._iter_exact_matches(parse_fasta(s_path)):
+                exact_match_id_map[seq_id] = seq_ids
+                unique_seqs_f.write('>%s count=%d;\n%s\n' %
+                                    (seq_id, len(seq_ids), seq))
         unique_seqs_f.close()
 
-        # Clean up the seqs_to_cluster as we don't need
-        # it again
-        del(seqs_to_cluster)
-
         return exact_match_id_map, unique_seqs_fp
 
 
@@ -645,10 +617,6 @@ class SumaClustOtuPicker(OtuPicker):
                     unique_seqs_fp, filepath to FASTA file
                     holding only de-replicated sequences
         """
-        # creating mapping for de-replicated reads
-        seqs_to_cluster, exact_match_id_map =\
-            self._prefilter_exact_matches(parse_fasta(open(seq_path, 'U')))
-
         # create temporary file for storing the de-replicated reads
         fd, unique_seqs_fp = mkstemp(
             prefix='SumaClustExactMatchFilter', suffix='.fasta')
@@ -656,17 +624,17 @@ class SumaClustOtuPicker(OtuPicker):
 
         self.files_to_remove.append(unique_seqs_fp)
 
-        # write de-replicated reads to file
+        # create mapping for de-replicated reads, writing the reads to
+        # file as they are de-replicated
+        exact_match_id_map = {}
         unique_seqs_f = open(unique_seqs_fp, 'w')
-        for seq_id, seq in seqs_to_cluster:
-            unique_seqs_f.write('>%s count=%d;\n%s\n'
-                                % (seq_id,
-                                   len(exact_match_id_map[seq_id]),
-                                   seq))
+        with open(seq_path, 'U') as s_path:
+            for seq_id, seq, seq_ids in \
+                    self._iter_exact_matches(parse_fasta(s_path)):
+                exact_match_id_map[seq_id] = seq_ids
+                unique_seqs_f.write('>%s count=%d;\n%s\n'
+                                    % (seq_id, len(seq_ids), seq))
         unique_seqs_f.close()
-        # clean up the seqs_to_cluster list as it can be big and we
-        # don't need it again
-        del(seqs_to_cluster)
 
         return exact_match_id_map, unique_seqs_fp
 
@@ -957,17 +925,16 @@ class TrieOtuPicker(OtuPicker):
             # Reverse the sequences prior to building the prefix map.
             # This effectively creates a suffix map.
             # Also removes descriptions from seq identifier lines
-            seqs = imap(lambda s: (s[0].split()[0], s[1][::-1]),
-                        parse_fasta(open(seq_path)))
+            seq_f = lambda s: (s[0].split()[0], s[1][::-1])
             log_lines.append(
                 'Seqs reversed for suffix mapping (rather than prefix mapping).')
         else:
             # remove descriptions from seq identifier lines
-            seqs = imap(lambda s: (s[0].split()[0], s[1]),
-                        parse_fasta(open(seq_path)))
+            seq_f = lambda s: (s[0].split()[0], s[1])
 
         # Build the mapping
-        t = CompressedTrie(fasta_to_pairlist(seqs))
+        with open(seq_path, 'U') as seq_lines:
+            t = ArrayCompressedTrie(imap(seq_f, parse_fasta(seq_lines)))
         mapping = t.prefix_map
         log_lines.append('Num OTUs: %d' % len(mapping))
 
@@ -1181,16 +1148,17 @@ class UclustOtuPickerBase(OtuPicker):
         fd, unique_seqs_fp = mkstemp(
             prefix='UclustExactMatchFilter', suffix='.fasta')
         close(fd)
-        seqs_to_cluster, exact_match_id_map =\
-            self._prefilter_exact_matches(parse_fasta(open(seq_path, 'U')))
         self.files_to_remove.append(unique_seqs_fp)
+        # stream the unique sequences to file as they are de-replicated so
+        # they never need to be held in memory
+        exact_match_id_map = {}
         unique_seqs_f = open(unique_seqs_fp, 'w')
-        for seq_id, seq in seqs_to_cluster:
-            unique_seqs_f.write('>%s\n%s\n' % (seq_id, seq))
+        with open(seq_path, 'U') as s_path:
+            for seq_id, seq, seq_ids in \
+                    self._iter_exact_matches(parse_fasta(s_path)):
+                exact_match_id_map[seq_id] = seq_ids
+                unique_seqs_f.write('>%s\n%s\n' % (seq_id, seq))
         unique_seqs_f.close()
-        # clean up the seqs_to_cluster list as it can be big and we
-        # don't need it again
-        # del(seqs_to_cluster)
         return exact_match_id_map, unique_seqs_fp
 
 
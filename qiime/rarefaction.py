@@ -18,9 +18,12 @@ replacement) otu tables.
 import os.path
 
 import numpy
-from numpy import inf
+from numpy import inf, arange, repeat, bincount, concatenate, zeros
+from numpy.random import permutation
+from scipy.sparse import coo_matrix
 from skbio.stats import subsample
 from biom.err import errstate
+from biom.table import Table
 
 from qiime.util import FunctionWithParams, write_biom_table
 from qiime.filter import (filter_samples_from_otu_table,
@@ -95,10 +98,14 @@ class RarefactionMaker(FunctionWithParams):
 
     def rarefy_to_files(self, output_dir, small_included=False,
                         include_full=False, include_lineages=False,
-                        empty_otus_removed=False, subsample_f=subsample):
+                        empty_otus_removed=False, subsample_f=None):
         """ computes rarefied otu tables and writes them, one at a time
 
-        this prevents large memory usage"""
+        this prevents large memory usage
+
+        if subsample_f is None, the tables of each rep are computed
+        together with get_multiple_rare_data, otherwise each table is
+        computed separately with get_rare_data using subsample_f"""
         if not include_lineages:
             for (val, id, meta) in self.otu_table.iter(axis='observation'):
                 try:
@@ -108,18 +115,14 @@ class RarefactionMaker(FunctionWithParams):
                     pass
 
         self.output_dir = output_dir
-        for depth in self.rare_depths:
-            for rep in range(self.num_reps):
-                sub_otu_table = get_rare_data(self.otu_table,
-                                              depth,
-                                              small_included,
-                                              subsample_f=subsample_f)
-                if empty_otus_removed:
-                    sub_otu_table = filter_otus_from_otu_table(
-                        sub_otu_table, sub_otu_table.ids(axis='observation'),
-                        1, inf, 0, inf)
-
-                self._write_rarefaction(depth, rep, sub_otu_table)
+        for depth, rep, sub_otu_table in self._iter_rare_data(small_included,
+                                                              subsample_f):
+            if empty_otus_removed:
+                sub_otu_table = filter_otus_from_otu_table(
+                    sub_otu_table, sub_otu_table.ids(axis='observation'),
+                    1, inf, 0, inf)
+
+            self._write_rarefaction(depth, rep, sub_otu_table)
 
         if include_full:
             self._write_rarefaction('full', 0, self.otu_table)
@@ -136,17 +139,32 @@ class RarefactionMaker(FunctionWithParams):
             otu_lineages = self.lineages
         else:
             otu_lineages = None
-        res = []
-        for depth in self.rare_depths:
-            for rep in range(self.num_reps):
-                sub_otu_table = get_rare_data(self.otu_table,
-                                              depth, small_included)
-                res.append([depth, rep, sub_otu_table])
+        res = [[depth, rep, sub_otu_table] for depth, rep, sub_otu_table in
+               self._iter_rare_data(small_included)]
+        # order by depth, then by rep
+        res.sort(key=lambda r: (r[0], r[1]))
 
         if include_full:
             res.append(['full', 0, self.otu_table])
         return res
 
+    def _iter_rare_data(self, small_included=False, subsample_f=None):
+        """ yields (depth, rep, rarefied otu table) for each depth and rep
+        """
+        if subsample_f is None:
+            for result in get_multiple_rare_data(self.otu_table,
+                                                 self.rare_depths,
+                                                 self.num_reps,
+                                                 small_included):
+                yield result
+        else:
+            for depth in self.rare_depths:
+                for rep in range(self.num_reps):
+                    yield depth, rep, get_rare_data(self.otu_table,
+                                                    depth,
+                                                    small_included,
+                                                    subsample_f=subsample_f)
+
     def _write_rarefaction(self, depth, rep, sub_otu_table):
         """ depth and rep can be numbers or strings
         """
@@ -187,3 +205,95 @@ def get_rare_data(otu_table,
         subsampled_otu_table = otu_table.transform(func, axis='sample')
 
         return subsampled_otu_table
+
+
+def get_multiple_rare_data(otu_table,
+                           depths,
+                           num_reps,
+                           include_small_samples=False):
+    """Yield (depth, rep, rarefied OTU table) for each depth and rep
+
+    Tables are rarefied (subsampled without replacement) as by
+    get_rare_data, but all depths of a rep are computed together: the
+    sequences of each sample are randomly permuted once, and the table at
+    each depth counts the first depth sequences of the permutation. Each
+    table is a uniform random subsample of the input table, although the
+    tables of a single rep are nested. Tables are yielded one rep at a time,
+    in the order of depths.
+
+    - include_small_samples=False => do not include samples with < depth
+    total sequences in the table at that depth
+    - otu_table is otus(rows) by samples (cols)
+    - no otus are removed, even if they are absent in the rarefied table
+    - no tables are yielded at depths greater than the number of sequences
+    in every sample (unless include_small_samples=True), where get_rare_data
+    raises a TableException
+    """
+    depths = list(depths)
+    if not depths:
+        return
+    max_depth = max(depths)
+    # visit depths in increasing order, so each depth's counts are those of
+    # the previous depth plus those of the next slice of the permutation
+    depth_order = sorted(range(len(depths)), key=lambda i: depths[i])
+
+    data = otu_table.matrix_data.tocsc()
+    sample_ids = otu_table.ids()
+    obs_ids = otu_table.ids(axis='observation')
+    sample_md = otu_table.metadata()
+    obs_md = otu_table.metadata(axis='observation')
+
+    for rep in range(num_reps):
+        # per depth, the coordinates and counts of the rarefied table, and
+        # the indices of the samples in it
+        rows = [[] for d in depths]
+        cols = [[] for d in depths]
+        counts = [[] for d in depths]
+        sample_indices = [[] for d in depths]
+        for i in range(len(sample_ids)):
+            start, end = data.indptr[i], data.indptr[i + 1]
+            otu_indices = data.indices[start:end]
+            sample_counts = data.data[start:end].astype(int)
+            total = sample_counts.sum()
+            if total > 0:
+                seqs = permutation(repeat(arange(len(otu_indices)),
+                                          sample_counts))[:max_depth]
+            rare_counts = zeros(len(otu_indices), dtype=int)
+            last_depth = 0
+            for j in depth_order:
+                depth = depths[j]
+                if total < depth:
+                    if not include_small_samples:
+                        continue
+                    depth_counts = sample_counts
+                else:
+                    if depth > last_depth:
+                        rare_counts += bincount(seqs[last_depth:depth],
+                                                minlength=len(otu_indices))
+                        last_depth = depth
+                    depth_counts = rare_counts
+                nonzero = depth_counts.nonzero()[0]
+                rows[j].append(otu_indices[nonzero])
+                cols[j].append(repeat(len(sample_indices[j]), len(nonzero)))
+                counts[j].append(depth_counts[nonzero])
+                sample_indices[j].append(i)
+
+        for j, depth in enumerate(depths):
+            if not sample_indices[j]:
+                # biom can't represent a table without samples
+                continue
+            matrix = coo_matrix(
+                (concatenate(counts[j]),
+                 (concatenate(rows[j]), concatenate(cols[j]))),
+                shape=(len(obs_ids), len(sample_indices[j])),
+                dtype=float).tocsr()
+            if sample_md is None:
+                rare_sample_md = None
+            else:
+                rare_sample_md = [sample_md[i] for i in sample_indices[j]]
+            yield depth, rep, Table(
+                matrix, obs_ids, [sample_ids[i] for i in sample_indices[j]],
+                observation_metadata=obs_md,
+                sample_metadata=rare_sample_md,
+                table_id=otu_table.table_id,
+                type=otu_table.type)
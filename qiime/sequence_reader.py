@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+"""Block-based readers for large fasta and fastq files
+
+The readers in this module read their input in large blocks, locate record
+boundaries with str.find, and yield one record at a time. Fastq records keep
+a reference to the block they were found in and decode their quality scores
+only when these are accessed, so reads which are discarded before quality
+filtering (e.g., because their barcode is not in the mapping file) never have
+their quality scores decoded. The range of the quality scores is still checked
+as each record is parsed.
+"""
+
+from __future__ import division
+
+__author__ = "The QIIME Development Team"
+__copyright__ = "Copyright 2011, The QIIME Project"
+__credits__ = ["The QIIME Development Team"]
+__license__ = "GPL"
+__version__ = "1.9.1-dev"
+__maintainer__ = "The QIIME Development Team"
+__email__ = "qiime.help@gmail.com"
+
+from gzip import GzipFile
+from itertools import islice
+from Queue import Queue, Full
+from threading import Thread, Event
+from sys import exc_info
+
+import numpy as np
+
+from skbio.io import RecordError
+from skbio.parse.sequences import FastqParseError
+
+# bytes read from the input at a time
+SEQUENCE_READER_BLOCK_SIZE = 2 ** 22
+# lines joined into one block when the input is a list of lines
+SEQUENCE_READER_LINES_PER_BLOCK = 2 ** 14
+# blocks decompressed ahead of the parser when reading gzipped files
+GZIP_READ_AHEAD_BLOCKS = 4
+
+
+class FastqRecord(object):
+
+    """A fastq record whose quality scores are decoded when first accessed
+
+    A record can be used as a (header, sequence, quality) tuple, like the
+    records yielded by skbio's parse_fastq: indexing it or unpacking it gives
+    the header, the sequence and the array of phred scores.
+    """
+    __slots__ = ('header', 'sequence', '_block', '_qual_start', '_qual_end',
+                 '_phred_offset', '_quality')
+
+    def __init__(self, header, sequence, block, qual_start, qual_end,
+                 phred_offset=33):
+        self.header = header
+        self.sequence = sequence
+        self._block = block
+        self._qual_start = qual_start
+        self._qual_end = qual_end
+        self._phred_offset = phred_offset
+        self._quality = None
+
+    @property
+    def quality_string(self):
+        """The undecoded quality line of the record"""
+        return self._block[self._qual_start:self._qual_end]
+
+    @property
+    def quality(self):
+        """The phred scores of the record, as an int8 array like skbio's"""
+        if self._quality is None:
+            quality = np.frombuffer(self._block, dtype=np.uint8,
+                                    count=self._qual_end - self._qual_start,
+                                    offset=self._qual_start).astype(np.int8)
+            quality -= self._phred_offset
+            self._quality = quality
+        return self._quality
+
+    def __len__(self):
+        return 3
+
+    def __iter__(self):
+        yield self.header
+        yield self.sequence
+        yield self.quality
+
+    def __getitem__(self, index):
+        if index == 0 or index == -3:
+            return self.header
+        elif index == 1 or index == -2:
+            return self.sequence
+        elif index == 2 or index == -1:
+            return self.quality
+        else:
+            raise IndexError("FastqRecord index out of range: %r" % index)
+
+
+def _open_sequence_file(fp):
+    """Opens fp, which may be gzipped, for reading"""
+    f = open(fp, 'rb')
+    is_gzipped = f.read(2) == '\x1f\x8b'
+    f.close()
+    if is_gzipped:
+        return GzipFile(fp, 'rb')
+    return open(fp, 'U')
+
+
+def _read_blocks_in_thread(f, block_size,
+                           read_ahead=GZIP_READ_AHEAD_BLOCKS):
+    """Yields blocks of f, which are read by a background thread
+
+    zlib releases the GIL while decompressing, so gzipped input is
+    decompressed while the blocks already read are parsed.
+    """
+    blocks = Queue(read_ahead)
+    stop = Event()
+
+    def fill_queue():
+        try:
+            while not stop.is_set():
+                block = f.read(block_size)
+                item = (block, None)
+                while not stop.is_set():
+                    try:
+                        blocks.put(item, timeout=0.1)
+                        break
+                    except Full:
+                        pass
+                if not block:
+                    return
+        except Exception:
+            blocks.put(('', exc_info()))
+
+    reader = Thread(target=fill_queue)
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            block, error = blocks.get()
+            if error is not None:
+                raise error[0], error[1], error[2]
+            if not block:
+                break
+            yield block
+    finally:
+        stop.set()
+        reader.join()
+
+
+def read_blocks(data, block_size=SEQUENCE_READER_BLOCK_SIZE):
+    """Yields the text of data in blocks of about block_size bytes
+
+    data: a filepath (the file may be gzipped), an open file, or an iterable
+     of lines (e.g., a list of lines, with or without trailing newlines)
+
+    Gzipped files are decompressed by a background thread.
+    """
+    if isinstance(data, basestring):
+        f = _open_sequence_file(data)
+        try:
+            for block in read_blocks(f, block_size):
+                yield block
+        finally:
+            f.close()
+    elif hasattr(data, 'read'):
+        if isinstance(data, GzipFile):
+            blocks = _read_blocks_in_thread(data, block_size)
+        else:
+            blocks = iter(lambda: data.read(block_size), '')
+        for block in blocks:
+            yield block
+    else:
+        lines = iter(data)
+        while True:
+            block_lines = list(islice(lines, SEQUENCE_READER_LINES_PER_BLOCK))
+            if not block_lines:
+                break
+            yield ''.join([line if line.endswith('\n') else line + '\n'
+                           for line in block_lines])
+
+
+def _line_content_end(block, start, end):
+    """Returns end moved back past the trailing whitespace of block[start:end]
+    """
+    while end > start and block[end - 1] in ' \t\r':
+        end -= 1
+    return end
+
+
+def _parse_fastq_block(block, strict, enforce_qual_range, phred_offset):
+    """Returns the complete fastq records of block and where they end
+
+    The result is (records, end), where block[end:] is the start of an
+    incomplete record (or blank lines).
+    """
+    # the characters of phred scores 0 to 62, which are deleted from quality
+    # lines to find any others
+    qual_chars = ''.join([chr(phred_offset + score) for score in range(63)])
+    records = []
+    find = block.find
+    block_end = len(block)
+    pos = 0
+    while True:
+        # blank lines between records are ignored
+        while pos < block_end and block[pos] == '\n':
+            pos += 1
+        header_end = find('\n', pos)
+        if header_end == -1:
+            break
+        sequence_end = find('\n', header_end + 1)
+        if sequence_end == -1:
+            break
+        plus_end = find('\n', sequence_end + 1)
+        if plus_end == -1:
+            break
+        qual_end = find('\n', plus_end + 1)
+        if qual_end == -1:
+            break
+
+        if block[pos] != '@':
+            raise FastqParseError("Malformed header: %s" %
+                                  block[pos:header_end])
+        if block[sequence_end + 1] != '+':
+            raise FastqParseError("Malformed quality header: %s" %
+                                  block[sequence_end + 1:plus_end])
+        # trailing whitespace is not part of the lines, as in skbio
+        header = block[pos + 1:_line_content_end(block, pos + 1, header_end)]
+        plus_header = block[sequence_end + 2:
+                            _line_content_end(block, sequence_end + 2,
+                                              plus_end)]
+        if strict and plus_header and plus_header != header:
+            raise FastqParseError("Header mismatch: %s != %s" %
+                                  (header, plus_header))
+
+        qual_content_end = _line_content_end(block, plus_end + 1, qual_end)
+        if enforce_qual_range and \
+           block[plus_end + 1:qual_content_end].translate(None, qual_chars):
+            raise FastqParseError(
+                "Failed qual conversion for seq id: %s. This may be because "
+                "you passed an incorrect value for phred_offset." % header)
+
+        sequence = block[header_end + 1:
+                         _line_content_end(block, header_end + 1,
+                                           sequence_end)]
+        records.append(FastqRecord(header,
+                                   sequence,
+                                   block,
+                                   plus_end + 1,
+                                   qual_content_end,
+                                   phred_offset))
+        pos = qual_end + 1
+    return records, pos
+
+
+def read_fastq_records(data, strict=False, enforce_qual_range=True,
+                       phred_offset=33,
+                       block_size=SEQUENCE_READER_BLOCK_SIZE):
+    """Yields the records of a fastq file as FastqRecord objects
+
+    data: a filepath (the file may be gzipped), an open file, or an iterable
+     of lines
+    strict: if True, the header repeated on '+' lines (if any) must match
+     the record's header
+    enforce_qual_range: if True, a FastqParseError is raised when a record
+     with a phred score outside of [0, 62] is parsed
+    phred_offset: the ascii offset of the quality scores (33 or 64)
+
+    The records can be used in place of the (header, sequence, quality)
+    tuples yielded by skbio's parse_fastq; records must be four lines long.
+    """
+    if phred_offset not in (33, 64):
+        raise ValueError("Unknown PHRED offset of %s" % phred_offset)
+
+    remainder = ''
+    for block in read_blocks(data, block_size):
+        if remainder:
+            block = remainder + block
+        if '\r' in block:
+            block = block.replace('\r\n', '\n')
+        records, end = _parse_fastq_block(block, strict, enforce_qual_range,
+                                          phred_offset)
+        for record in records:
+            yield record
+        remainder = block[end:]
+
+    # the last record need not end with a newline
+    if remainder.strip():
+        if not remainder.endswith('\n'):
+            remainder += '\n'
+        records, end = _parse_fastq_block(remainder, strict,
+                                          enforce_qual_range, phred_offset)
+        for record in records:
+            yield record
+        if not records:
+            raise FastqParseError("Incomplete fastq record: %s" %
+                                  remainder.strip())
+
+
+def _parse_fasta_text(text):
+    """Returns the (label, sequence) pairs of complete fasta records"""
+    if text[0] != '>':
+        raise RecordError("Found Fasta record without label line: %s" %
+                          text.split('\n', 1)[0])
+    records = []
+    for record in text[1:].split('\n>'):
+        label, _, sequence = record.partition('\n')
+        sequence = ''.join(sequence.split())
+        if not sequence:
+            raise RecordError("Found label line without sequences: %s" %
+                              label.strip())
+        records.append((label.strip(), sequence))
+    return records
+
+
+def read_fasta_records(data, block_size=SEQUENCE_READER_BLOCK_SIZE):
+    """Yields the (label, sequence) pairs of a fasta file
+
+    data: a filepath (the file may be gzipped), an open file, or an iterable
+     of lines
+
+    Sequences can span multiple lines, and blank lines are ignored.
+    """
+    pending = []
+    at_start = True
+    for block in read_blocks(data, block_size):
+        if at_start:
+            block = block.lstrip()
+            if not block:
+                continue
+            at_start = False
+        # records end where a line starts with '>'
+        last_record_start = block.rfind('\n>')
+        if last_record_start == -1:
+            pending.append(block)
+            continue
+        pending.append(block[:last_record_start + 1])
+        for record in _parse_fasta_text(''.join(pending)):
+            yield record
+        pending = [block[last_record_start + 1:]]
+
+    text = ''.join(pending)
+    if text.strip():
+        for record in _parse_fasta_text(text):
+            yield record
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""Buffered writers for large fasta, qual and fastq files
+
+SequenceWriter accumulates formatted records in a bytearray and writes them
+to its file once several megabytes have accumulated, optionally from a
+background thread (so formatting continues while a buffer is written or
+compressed) and optionally gzip compressed. Quality scores are formatted
+with numpy from lookup tables of the digits of each score, rather than with
+str() and ' '.join for each score.
+"""
+
+from __future__ import division
+
+__author__ = "The QIIME Development Team"
+__copyright__ = "Copyright 2011, The QIIME Project"
+__credits__ = ["The QIIME Development Team"]
+__license__ = "GPL"
+__version__ = "1.9.1-dev"
+__maintainer__ = "The QIIME Development Team"
+__email__ = "qiime.help@gmail.com"
+
+from gzip import GzipFile
+from Queue import Queue
+from threading import Thread
+from sys import exc_info
+
+import numpy as np
+
+# bytes of formatted records held by a SequenceWriter before they are written
+SEQUENCE_WRITER_BUFFER_SIZE = 2 ** 23
+# buffers waiting to be written by a SequenceWriter's background thread
+SEQUENCE_WRITER_QUEUED_BUFFERS = 4
+# quality scores per line of qual files
+QUAL_SCORES_PER_LINE = 60
+
+
+def _make_qual_score_tables():
+    """Returns the ascii digits of 0-255, left aligned, and their lengths"""
+    digits = np.zeros((256, 3), dtype=np.uint8)
+    lengths = np.zeros(256, dtype=np.intp)
+    for score in range(256):
+        score_str = str(score)
+        digits[score, :len(score_str)] = [ord(c) for c in score_str]
+        lengths[score] = len(score_str)
+    return digits, lengths
+
+_QUAL_SCORE_DIGITS, _QUAL_SCORE_LENGTHS = _make_qual_score_tables()
+
+
+def format_qual_scores(qual_scores, scores_per_line=QUAL_SCORES_PER_LINE):
+    """Returns qual_scores as the lines of a qual file record
+
+    qual_scores: sequence of integer quality scores (e.g., a uint8 array)
+    scores_per_line: number of scores on each line
+
+    Each line, including the last, ends with a newline; an empty string is
+    returned if there are no scores. Scores between 0 and 255 are formatted
+    with lookup tables, other scores (e.g., negative or float scores) with
+    str.
+    """
+    scores = np.asarray(qual_scores)
+    num_scores = len(scores)
+    if num_scores == 0:
+        return ''
+    if scores.dtype != np.uint8:
+        if scores.dtype.kind not in 'iu' or \
+           scores.min() < 0 or scores.max() > 255:
+            return ''.join(
+                [' '.join(map(str, scores[i:i + scores_per_line])) + '\n'
+                 for i in range(0, num_scores, scores_per_line)])
+        scores = scores.astype(np.uint8)
+
+    lengths = _QUAL_SCORE_LENGTHS[scores]
+    # each score is followed by a space, or a newline at the end of a line
+    separators = np.empty(num_scores, dtype=np.uint8)
+    separators.fill(ord(' '))
+    separators[scores_per_line - 1::scores_per_line] = ord('\n')
+    separators[-1] = ord('\n')
+    chars = np.zeros((num_scores, 4), dtype=np.uint8)
+    chars[:, :3] = _QUAL_SCORE_DIGITS[scores]
+    chars[np.arange(num_scores), lengths] = separators
+    return chars[np.arange(4) <= lengths[:, np.newaxis]].tostring()
+
+
+def format_fastq_quality(qual_scores, phred_offset=33):
+    """Returns qual_scores as the quality line of a fastq record
+
+    qual_scores: a quality string (returned unchanged), or a sequence of
+     integer phred scores
+    phred_offset: ascii offset of the phred scores
+
+    Raises a ValueError if a score can't be written as a printable character.
+    """
+    if isinstance(qual_scores, str):
+        return qual_scores
+    codes = np.asarray(qual_scores, dtype=int) + phred_offset
+    if len(codes) and (codes.min() < 32 or codes.max() > 126):
+        bad_score = codes[(codes < 32) | (codes > 126)][0] - phred_offset
+        raise ValueError("Cannot convert quality score to ASCII code" +
+                         " between 32 and 126: " + str(bad_score) +
+                         " using ascii_increment = " + str(phred_offset))
+    return codes.astype(np.uint8).tostring()
+
+
+class SequenceWriter(object):
+
+    """Writes fasta, qual and fastq records to a file in large blocks
+
+    f: filepath or open file object. Filepaths ending in .gz (or any
+     filepath, if compress is True) are written gzip compressed.
+    buffer_size: bytes of records accumulated before they are written
+    background: if True, buffers are written (and compressed) by a
+     background thread
+    compress: gzip compress a filepath's output, defaults to whether the
+     filepath ends with .gz
+    append: append to the file at filepath rather than overwriting it
+    reopen: open the file at filepath (in append mode) each time a buffer is
+     written and close it afterwards, so that many writers can be used at
+     once without running out of file handles
+
+    Records are only guaranteed to be in the file once the writer is flushed
+    or closed. Errors of the background thread are raised by the next write,
+    flush or close.
+    """
+
+    def __init__(self, f, buffer_size=SEQUENCE_WRITER_BUFFER_SIZE,
+                 background=False, compress=None, append=False,
+                 reopen=False):
+        if isinstance(f, basestring):
+            self.name = f
+            if compress is None:
+                compress = f.endswith('.gz')
+            self._compress = compress
+            self._mode = 'ab' if append else 'wb'
+            if reopen:
+                self._f = None
+                # the file is created (or emptied) now unless appending,
+                # and each buffer is appended to it
+                if not append:
+                    self._open().close()
+                    self._mode = 'ab'
+            else:
+                self._f = self._open()
+        else:
+            if reopen:
+                raise ValueError("reopen requires a filepath.")
+            self.name = getattr(f, 'name', None)
+            self._compress = False
+            self._f = f
+        self._reopen = reopen
+        self._buffer_size = buffer_size
+        self._buffer = bytearray()
+        self._error = None
+        self.closed = False
+
+        if background:
+            self._queue = Queue(SEQUENCE_WRITER_QUEUED_BUFFERS)
+            self._thread = Thread(target=self._write_queued_buffers)
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._queue = None
+            self._thread = None
+
+    def _open(self):
+        if self._compress:
+            return GzipFile(self.name, self._mode)
+        return open(self.name, self._mode)
+
+    def _write_buffer(self, buffer):
+        if self._reopen:
+            f = self._open()
+            try:
+                f.write(str(buffer))
+            finally:
+                f.close()
+        else:
+            self._f.write(str(buffer))
+
+    def _write_queued_buffers(self):
+        while True:
+            buffer = self._queue.get()
+            try:
+                if buffer is None:
+                    return
+                # after an error, queued buffers are discarded so that the
+                # writer doesn't block
+                if self._error is None:
+                    try:
+                        self._write_buffer(buffer)
+                    except Exception:
+                        self._error = exc_info()
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error[0], error[1], error[2]
+
+    def write(self, data):
+        """Adds data (a str) to the buffer, writing it if it is full"""
+        self._buffer += data
+        if len(self._buffer) >= self._buffer_size:
+            self._write_full_buffer()
+
+    def _write_full_buffer(self):
+        buffer = self._buffer
+        self._buffer = bytearray()
+        if self._queue is None:
+            self._write_buffer(buffer)
+        else:
+            self._raise_error()
+            self._queue.put(buffer)
+
+    def write_fasta(self, label, sequence):
+        """Writes a fasta record"""
+        self.write('>%s\n%s\n' % (label, sequence))
+
+    def write_qual(self, label, qual_scores,
+                   scores_per_line=QUAL_SCORES_PER_LINE):
+        """Writes a qual record, see format_qual_scores"""
+        self.write('>%s\n%s' % (label,
+                                format_qual_scores(qual_scores,
+                                                   scores_per_line)))
+
+    def write_fastq(self, header, sequence, qual_scores, phred_offset=33,
+                    quality_header=''):
+        """Writes a fastq record
+
+        qual_scores: a quality string, or a sequence of phred scores
+        quality_header: text written after the + of the quality header line
+        """
+        self.write('@%s\n%s\n+%s\n%s\n' % (header, sequence, quality_header,
+                                           format_fastq_quality(qual_scores,
+                                                                phred_offset)))
+
+    def flush(self):
+        """Writes all buffered records to the file"""
+        if self._buffer:
+            self._write_full_buffer()
+        if self._queue is not None:
+            # wait for the background thread to write the queued buffers
+            self._queue.join()
+            self._raise_error()
+        if self._f is not None and hasattr(self._f, 'flush'):
+            self._f.flush()
+
+    def close(self):
+        """Writes all buffered records and closes the file"""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self._buffer:
+                self._write_full_buffer()
+        finally:
+            if self._queue is not None:
+                self._queue.put(None)
+                self._thread.join()
+            if self._f is not None:
+                self._f.close()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -59,6 +59,7 @@ from qiime.golay import decode as decode_golay_12
 from qiime.format import format_histograms
 from qiime.parse import QiimeParseError, parse_qual_scores
 from qiime.util import create_dir, median_absolute_deviation
+from qiime.sequence_writer import SequenceWriter, format_qual_scores
 
 # Including new=True in the histogram() call is necessary to
 # get the correct result in versions prior to NumPy 1.2.0,
@@ -907,14 +908,14 @@ def check_seqs(fasta_out, fasta_files, starting_ix, valid_map, qual_mappings,
         final_written_lens = []
 
         # Create final seqs.fna
-        final_fasta_out = open(fasta_out.name.replace('.tmp', ''), "w")
+        final_fasta_out = SequenceWriter(fasta_out.name.replace('.tmp', ''))
 
         for label, seq in parse_fasta(fasta_out):
             curr_len = len(seq)
             if curr_len < min_corrected_len or curr_len > max_corrected_len:
                 seqs_discarded_median += 1
             else:
-                final_fasta_out.write(">%s\n%s\n" % (label, seq))
+                final_fasta_out.write_fasta(label, seq)
                 final_written_lens.append(len(seq))
 
         final_fasta_out.close()
@@ -932,10 +933,10 @@ def check_seqs(fasta_out, fasta_files, starting_ix, valid_map, qual_mappings,
         fasta_out = open(fasta_out.name, "U")
 
         # Create final seqs.fna
-        final_fasta_out = open(fasta_out.name.replace('.tmp', ''), "w")
+        final_fasta_out = SequenceWriter(fasta_out.name.replace('.tmp', ''))
 
         for label, seq in parse_fasta(fasta_out):
-            final_fasta_out.write(">%s\n%s\n" % (label, seq))
+            final_fasta_out.write_fasta(label, seq)
 
         final_fasta_out.close()
         fasta_out.close()
@@ -963,22 +964,8 @@ def check_seqs(fasta_out, fasta_files, starting_ix, valid_map, qual_mappings,
 def format_qual_output(qual_array):
     """ Converts to string from numpy arrays, removes brackets """
 
-    # Size of lines needed for proper quality score file format
-    qual_line_size = 60
-
-    qual_scores = ""
-
-    for slice in range(0, len(qual_array), qual_line_size):
-        current_segment = qual_array[slice:slice + qual_line_size]
-        current_segment =\
-            " ".join(str(score) for score in current_segment) + "\n"
-
-        qual_scores += current_segment
-
-    '''qual_array = str(qual_array)
-    qual_array = qual_array.replace('[','')
-    qual_array = qual_array.replace(']','') '''
-    return qual_scores
+    # Lines of 60 scores, as needed for proper quality score file format
+    return format_qual_scores(qual_array, 60)
 
 
 def format_log(bc_counts, corr_ct, valid_map, seq_lengths, filters,
@@ -1425,10 +1412,13 @@ def preprocess(fasta_files, qual_files, mapping_file,
         lambda id_, seq, qual: seq_exceeds_homopolymers(
             seq[barcode_len:], max_homopolymer)))
 
-    # Check seqs and write out
-    fasta_out = open(dir_prefix + '/' + 'seqs.fna.tmp', 'w+')
+    # Check seqs and write out, output is buffered and written in large
+    # blocks by background threads
+    fasta_out = SequenceWriter(dir_prefix + '/' + 'seqs.fna.tmp',
+                               background=True)
     if record_qual_scores:
-        qual_out = open(dir_prefix + '/' + 'seqs_filtered.qual', 'w+')
+        qual_out = SequenceWriter(dir_prefix + '/' + 'seqs_filtered.qual',
+                                  background=True)
     else:
         qual_out = False
 
@@ -1445,6 +1435,8 @@ def preprocess(fasta_files, qual_files, mapping_file,
                                                           discard_bad_windows, min_qual_score, min_seq_len,
                                                           median_length_filtering, added_demultiplex_field,
                                                           reverse_primer_mismatches, truncate_ambi_bases)
+    if qual_out:
+        qual_out.close()
 
     # Write log file
     log_file = open(dir_prefix + '/' + "split_library_log.txt", 'w+')
@@ -10,22 +10,33 @@ __version__ = "1.9.1-dev"
 __maintainer__ = "Greg Caporaso"
 __email__ = "gregcaporaso@gmail.com"
 
-from itertools import izip, cycle
+from itertools import izip, cycle, islice
 from os.path import split, splitext, join
 from os import makedirs
+from collections import deque
+from multiprocessing import Pool
 
 import numpy as np
 
-from skbio.parse.sequences import parse_fastq
 from skbio.sequence import DNA
-from skbio.format.sequences import format_fastq_record
 
 from qiime.format import (format_histogram_one_count,
                           format_split_libraries_fastq_log)
 from qiime.parse import is_casava_v180_or_later
 from qiime.hamming import decode_hamming_8
 from qiime.golay import decode_golay_12
-from qiime.util import qiime_open
+from qiime.barcode import cache_barcode_correction
+from qiime.sequence_reader import read_fastq_records
+from qiime.sequence_writer import SequenceWriter
+from qiime.util import qiime_open, is_gzip
+
+# fastq records processed by each task of
+# process_fastq_single_end_read_file_parallel
+FASTQ_RECORDS_PER_CHUNK = 100000
+# bytes read at a time when splitting fastq files into chunks
+FASTQ_OFFSETS_BLOCK_SIZE = 2 ** 20
+# reads quality filtered at once by quality_filter_sequences
+QUALITY_FILTER_BLOCK_SIZE = 1024
 
 
 class FastqParseError(Exception):
@@ -55,46 +66,118 @@ def bad_chars_from_threshold(first_bad_char):
         bad_chars = list(get_illumina_qual_chars()[:first_bad_char_index + 1])
         return {}.fromkeys(bad_chars)
 
-def _contiguous_regions(condition):
-    """Finds contiguous True regions of the boolean array "condition". Returns
-    a 2D array where the first column is the start index of the region and the
-    second column is the end index.
 
-    This function was derived from SO:
-    http://stackoverflow.com/a/4495197/579416
+def reads_to_matrices(sequences, qualities):
+    """Packs a block of reads into fixed-width matrices
+
+    sequences: list of sequence strings
+    qualities: list of arrays of phred scores, one per sequence
+
+    Returns (sequence_matrix, quality_matrix, lengths), where the rows of the
+    uint8 matrices hold the sequence characters and phred scores of each read,
+    padded with zeros to the length of the longest read.
     """
+    lengths = np.array([len(seq) for seq in sequences], dtype=int)
+    num_reads = len(lengths)
+    width = lengths.max() if num_reads else 0
+    in_read = np.arange(width) < lengths[:, np.newaxis]
 
-    # Find the indicies of changes in "condition"
-    d = np.diff(condition)
-    idx, = d.nonzero()
+    sequence_matrix = np.zeros((num_reads, width), dtype=np.uint8)
+    quality_matrix = np.zeros((num_reads, width), dtype=np.uint8)
+    if num_reads:
+        sequence_matrix[in_read] = np.frombuffer(''.join(sequences),
+                                                 dtype=np.uint8)
+        quality_matrix[in_read] = np.concatenate(qualities)
+    return sequence_matrix, quality_matrix, lengths
 
-    # We need to start things after the change in "condition". Therefore,
-    # we'll shift the index by 1 to the right.
-    idx += 1
 
-    if condition[0]:
-        # If the start of condition is True prepend a 0
-        idx = np.r_[0, idx]
+def _bad_run_truncation_points(qualities, lengths, max_run_length, threshold):
+    """Returns the length each read is truncated to by the quality filter
 
-    if condition[-1]:
-        # If the end of condition is True, append the length of the array
-        idx = np.r_[idx, condition.size]
+    Each read is truncated at the start of its first run of more than
+    max_run_length phred scores less than or equal to threshold.
+    """
+    lengths = np.asarray(lengths)
+    if threshold is None or qualities.shape[1] == 0:
+        return lengths.copy()
+
+    positions = np.arange(qualities.shape[1])
+    bad = (qualities <= threshold) & (positions < lengths[:, np.newaxis])
+    # the length of the run of bad scores ending at each position is the
+    # distance to the last good score
+    last_good = np.where(bad, -1, positions)
+    np.maximum.accumulate(last_good, axis=1, out=last_good)
+    too_long = (positions - last_good) > max_run_length
+    has_long_run = too_long.any(axis=1)
+    run_starts = too_long.argmax(axis=1) - max_run_length
+    return np.where(has_long_run, run_starts, lengths)
 
-    # Reshape the result into two columns
-    idx.shape = (-1,2)
-    return idx
 
 def read_qual_score_filter(seq, qual, max_run_length, threshold):
     """slices illumina sequence and quality line based on quality filter
     """
-    last_good_slice_end_pos = 0
-    bad_run_length = 0
-    mask = qual <= threshold
-    for starts, ends in _contiguous_regions(mask):
-        if ends - starts > max_run_length:
-            return seq[:starts], qual[:starts]
+    qual = np.asarray(qual)
+    end = _bad_run_truncation_points(qual[np.newaxis, :], [len(qual)],
+                                     max_run_length, threshold)[0]
+    return seq[:end], qual[:end]
 
-    return seq, qual
+
+def has_bad_illumina_qual_digit(header):
+    """Returns True if the Illumina quality digit of header is 0"""
+    h = header.split()[0]
+    try:
+        # this block is a little strange because each of these
+        # can throw a ValueError. The same thing needs to be done
+        # in either case, so it doesn't really make sense to split
+        # into two separate try/excepts, particulary because that would
+        # complicate the logic
+        quality_char = header[h.index('#') + 1]
+        illumina_quality_digit = int(quality_char)
+    except ValueError:
+        return False
+    else:
+        return illumina_quality_digit == 0
+
+
+def quality_filter_sequences(sequences,
+                             qualities,
+                             lengths,
+                             max_bad_run_length,
+                             phred_quality_threshold,
+                             min_per_read_length,
+                             seq_max_N,
+                             bad_illumina_qual_digit=None):
+    """Quality filters a block of reads at once
+
+    sequences, qualities, lengths: a block of reads, as returned by
+     reads_to_matrices
+    bad_illumina_qual_digit: boolean array flagging the reads whose Illumina
+     quality digit is 0, or None if these aren't filtered
+
+    Returns (results, lengths) arrays, where results holds the
+    quality_filter_sequence result code of each read, and lengths the length
+    each read is truncated to (i.e., read i is sequences[i, :lengths[i]]).
+    """
+    lengths = np.asarray(lengths)
+    truncated_lengths = _bad_run_truncation_points(qualities,
+                                                   lengths,
+                                                   max_bad_run_length,
+                                                   phred_quality_threshold)
+    positions = np.arange(sequences.shape[1])
+    in_read = positions < truncated_lengths[:, np.newaxis]
+    n_counts = ((sequences == ord('N')) & in_read).sum(axis=1)
+
+    results = np.zeros(len(lengths), dtype=int)
+    results[n_counts > seq_max_N] = 2
+    results[truncated_lengths < min_per_read_length] = 1
+    if bad_illumina_qual_digit is not None:
+        bad_illumina_qual_digit = np.asarray(bad_illumina_qual_digit,
+                                             dtype=bool)
+        results[bad_illumina_qual_digit] = 3
+        # reads failing this check are not truncated
+        truncated_lengths = np.where(bad_illumina_qual_digit, lengths,
+                                     truncated_lengths)
+    return results, truncated_lengths
 
 
 def quality_filter_sequence(header,
@@ -105,33 +188,20 @@ def quality_filter_sequence(header,
                             min_per_read_length,
                             seq_max_N,
                             filter_bad_illumina_qual_digit):
-    if filter_bad_illumina_qual_digit:
-        h = header.split()[0]
-        try:
-            # this block is a little strange because each of these
-            # can throw a ValueError. The same thing needs to be done
-            # in either case, so it doesn't really make sense to split
-            # into two separate try/excepts, particulary because that would
-            # complicate the logic
-            quality_char = header[h.index('#') + 1]
-            illumina_quality_digit = int(quality_char)
-        except ValueError:
-            pass
-        else:
-            if illumina_quality_digit == 0:
-                return 3, sequence, quality
-
-    sequence, quality = read_qual_score_filter(sequence,
-                                               quality,
-                                               max_bad_run_length,
-                                               phred_quality_threshold)
-
-    if (len(sequence) < min_per_read_length):
-        return 1, sequence, quality
-    elif (sequence.count('N') > seq_max_N):
-        return 2, sequence, quality
-    else:
-        return 0, sequence, quality
+    if filter_bad_illumina_qual_digit and \
+       has_bad_illumina_qual_digit(header):
+        return 3, sequence, quality
+
+    sequences, qualities, lengths = reads_to_matrices([sequence], [quality])
+    results, lengths = quality_filter_sequences(sequences,
+                                                qualities,
+                                                lengths,
+                                                max_bad_run_length,
+                                                phred_quality_threshold,
+                                                min_per_read_length,
+                                                seq_max_N)
+    end = lengths[0]
+    return int(results[0]), sequence[:end], quality[:end]
 
 
 def check_header_match_pre180(header1, header2):
@@ -260,10 +330,6 @@ def process_fastq_single_end_read_file(fastq_read_f,
                                        phred_offset=None):
     """parses fastq single-end read file
     """
-    header_index = 0
-    sequence_index = 1
-    quality_index = 2
-
     seq_id = start_seq_id
     # grab the first lines and then seek back to the beginning of the file
     try:
@@ -274,6 +340,63 @@ def process_fastq_single_end_read_file(fastq_read_f,
         fastq_read_f_line1 = fastq_read_f[0]
         fastq_read_f_line2 = fastq_read_f[1]
 
+    phred_offset, check_header_match_f, barcode_length, min_per_read_length =\
+        _get_read_file_settings(fastq_read_f_line1,
+                                fastq_read_f_line2,
+                                barcode_to_sample_id,
+                                min_per_read_length_fraction,
+                                phred_offset)
+
+    # correct each distinct erroneous barcode in this file only once
+    if barcode_correction_fn is not None:
+        barcode_correction_fn = cache_barcode_correction(
+            barcode_correction_fn)
+
+    stats = _new_split_libraries_fastq_stats()
+    records = izip(
+        read_fastq_records(fastq_barcode_f, strict=False,
+                           phred_offset=phred_offset),
+        read_fastq_records(fastq_read_f, strict=False,
+                           phred_offset=phred_offset))
+    for (sample_id, header, barcode, corrected_barcode, num_barcode_errors,
+         sequence, quality) in _demultiplex_fastq_records(
+            records,
+            barcode_to_sample_id,
+            barcode_length,
+            min_per_read_length,
+            check_header_match_f,
+            stats,
+            store_unassigned=store_unassigned,
+            max_bad_run_length=max_bad_run_length,
+            phred_quality_threshold=phred_quality_threshold,
+            rev_comp=rev_comp,
+            rev_comp_barcode=rev_comp_barcode,
+            seq_max_N=seq_max_N,
+            filter_bad_illumina_qual_digit=filter_bad_illumina_qual_digit,
+            barcode_correction_fn=barcode_correction_fn,
+            max_barcode_errors=max_barcode_errors,
+            strict_header_match=strict_header_match):
+        fasta_header = '%s_%s %s orig_bc=%s new_bc=%s bc_diffs=%d' %\
+            (sample_id, seq_id, header, barcode,
+             corrected_barcode, num_barcode_errors)
+        yield fasta_header, sequence, quality, seq_id
+        seq_id += 1
+
+    _write_split_libraries_fastq_stats(stats, barcode_to_sample_id, log_f,
+                                       histogram_f)
+
+
+def _get_read_file_settings(fastq_read_f_line1,
+                            fastq_read_f_line2,
+                            barcode_to_sample_id,
+                            min_per_read_length_fraction,
+                            phred_offset=None):
+    """Returns the settings derived from the first record of a read file
+
+    The result is (phred_offset, check_header_match_f, barcode_length,
+    min_per_read_length); these apply to the whole read file, including when
+    it is processed in chunks.
+    """
     if phred_offset is None:
         post_casava_v180 = is_casava_v180_or_later(fastq_read_f_line1)
         if post_casava_v180:
@@ -303,18 +426,88 @@ def process_fastq_single_end_read_file(fastq_read_f,
     min_per_read_length = min_per_read_length_fraction * \
         len(fastq_read_f_line2)
 
-    # prep data for logging
+    return phred_offset, check_header_match_f, barcode_length, \
+        min_per_read_length
+
+
+def _new_split_libraries_fastq_stats():
+    """Returns empty logging statistics, keyed by the arguments of
+    format_split_libraries_fastq_log
+    """
+    return {'count_barcode_not_in_map': 0,
+            'count_too_short': 0,
+            'count_too_many_N': 0,
+            'count_bad_illumina_qual_digit': 0,
+            'count_barcode_errors_exceed_max': 0,
+            'input_sequence_count': 0,
+            'sequence_lengths': [],
+            'seqs_per_sample_counts': {}}
+
+
+def _merge_split_libraries_fastq_stats(stats, other_stats):
+    """Adds other_stats (e.g., those of one chunk of a file) to stats"""
+    for key, value in other_stats.items():
+        if key == 'sequence_lengths':
+            stats[key].extend(value)
+        elif key == 'seqs_per_sample_counts':
+            sample_counts = stats[key]
+            for sample_id, count in value.items():
+                sample_counts[sample_id] = \
+                    sample_counts.get(sample_id, 0) + count
+        else:
+            stats[key] += value
+
+
+def _write_split_libraries_fastq_stats(stats, barcode_to_sample_id, log_f,
+                                       histogram_f):
+    """Writes the log and length histogram of one demultiplexed read file"""
+    seqs_per_sample_counts = stats['seqs_per_sample_counts']
+    sequence_lengths = stats['sequence_lengths']
+
+    # Add sample IDs with zero counts to dictionary for logging
+    for curr_sample_id in barcode_to_sample_id.values():
+        if curr_sample_id not in seqs_per_sample_counts:
+            seqs_per_sample_counts[curr_sample_id] = 0
+
+    if log_f is not None:
+        log_str = format_split_libraries_fastq_log(**stats)
+        log_f.write(log_str)
+
+    if len(sequence_lengths) and histogram_f is not None:
+        counts, bin_edges = make_histograms(sequence_lengths)
+        histogram_str = format_histogram_one_count(counts, bin_edges)
+        histogram_f.write(histogram_str)
+        histogram_f.write('\n--\n\n')
+
+
+def _assign_fastq_records(records,
+                          barcode_to_sample_id,
+                          barcode_length,
+                          check_header_match_f,
+                          stats,
+                          store_unassigned=False,
+                          rev_comp_barcode=False,
+                          barcode_correction_fn=None,
+                          max_barcode_errors=1.5,
+                          strict_header_match=True):
+    """Assigns (barcode, read) fastq record pairs to samples
+
+    records: iterable of pairs of parsed barcode and read fastq records
+    stats: logging statistics, as returned by
+     _new_split_libraries_fastq_stats, which are updated in place
+
+    Yields (sample_id, header, barcode, corrected_barcode,
+     num_barcode_errors, sequence, quality) for each read assigned to a
+     sample (or to 'Unassigned' if store_unassigned).
+    """
+    header_index = 0
+    sequence_index = 1
+    quality_index = 2
+
     input_sequence_count = 0
     count_barcode_not_in_map = 0
-    count_too_short = 0
-    count_too_many_N = 0
-    count_bad_illumina_qual_digit = 0
     count_barcode_errors_exceed_max = 0
-    sequence_lengths = []
-    seqs_per_sample_counts = {}
-    for bc_data, read_data in izip(
-            parse_fastq(fastq_barcode_f, strict=False, phred_offset=phred_offset),
-            parse_fastq(fastq_read_f, strict=False, phred_offset=phred_offset)):
+    for bc_data, read_data in records:
         input_sequence_count += 1
         # Confirm match between barcode and read headers
         if strict_header_match and \
@@ -338,10 +531,6 @@ def process_fastq_single_end_read_file(fastq_read_f,
             barcode = bc_data[sequence_index]
         if rev_comp_barcode:
             barcode = str(DNA(barcode).rc())
-        # Grab the read sequence
-        sequence = read_data[1]
-        # Grab the read quality
-        quality = read_data[2]
 
         # correct the barcode (if applicable) and map to sample id
         num_barcode_errors, corrected_barcode, correction_attempted, sample_id = \
@@ -362,70 +551,353 @@ def process_fastq_single_end_read_file(fastq_read_f,
             else:
                 sample_id = 'Unassigned'
 
-        quality_filter_result, sequence, quality =\
-            quality_filter_sequence(header,
-                                    sequence,
-                                    quality,
-                                    max_bad_run_length,
-                                    phred_quality_threshold,
-                                    min_per_read_length,
-                                    seq_max_N,
-                                    filter_bad_illumina_qual_digit)
-
-        # process quality result
-        if quality_filter_result != 0:
-            # if the quality filter didn't pass record why and
-            # move on to the next record
-            if quality_filter_result == 1:
-                count_too_short += 1
-            elif quality_filter_result == 2:
-                count_too_many_N += 1
-            elif quality_filter_result == 3:
-                count_bad_illumina_qual_digit += 1
-            else:
-                raise ValueError(
-                    "Unknown quality filter result: %d" %
-                    quality_filter_result)
-            continue
+        yield (sample_id, header, barcode, corrected_barcode,
+               num_barcode_errors, read_data[sequence_index],
+               read_data[quality_index])
+
+    stats['input_sequence_count'] += input_sequence_count
+    stats['count_barcode_not_in_map'] += count_barcode_not_in_map
+    stats['count_barcode_errors_exceed_max'] += \
+        count_barcode_errors_exceed_max
+
+
+def _demultiplex_fastq_records(records,
+                               barcode_to_sample_id,
+                               barcode_length,
+                               min_per_read_length,
+                               check_header_match_f,
+                               stats,
+                               store_unassigned=False,
+                               max_bad_run_length=0,
+                               phred_quality_threshold=2,
+                               rev_comp=False,
+                               rev_comp_barcode=False,
+                               seq_max_N=0,
+                               filter_bad_illumina_qual_digit=False,
+                               barcode_correction_fn=None,
+                               max_barcode_errors=1.5,
+                               strict_header_match=True):
+    """Assigns (barcode, read) fastq record pairs to samples and filters them
+
+    records: iterable of pairs of parsed barcode and read fastq records
+    stats: logging statistics, as returned by
+     _new_split_libraries_fastq_stats, which are updated in place
+
+    The reads assigned to samples are quality filtered in blocks of
+    QUALITY_FILTER_BLOCK_SIZE reads by quality_filter_sequences.
+
+    Yields (sample_id, header, barcode, corrected_barcode,
+     num_barcode_errors, sequence, quality) for each read passing the filters.
+    """
+    assigned_reads = _assign_fastq_records(
+        records,
+        barcode_to_sample_id,
+        barcode_length,
+        check_header_match_f,
+        stats,
+        store_unassigned=store_unassigned,
+        rev_comp_barcode=rev_comp_barcode,
+        barcode_correction_fn=barcode_correction_fn,
+        max_barcode_errors=max_barcode_errors,
+        strict_header_match=strict_header_match)
 
-        sequence_lengths.append(len(sequence))
+    count_too_short = 0
+    count_too_many_N = 0
+    count_bad_illumina_qual_digit = 0
+    sequence_lengths = stats['sequence_lengths']
+    seqs_per_sample_counts = stats['seqs_per_sample_counts']
+    while True:
+        block = list(islice(assigned_reads, QUALITY_FILTER_BLOCK_SIZE))
+        if not block:
+            break
+
+        if filter_bad_illumina_qual_digit:
+            bad_illumina_qual_digit = [has_bad_illumina_qual_digit(read[1])
+                                       for read in block]
+        else:
+            bad_illumina_qual_digit = None
+        sequences, qualities, lengths = reads_to_matrices(
+            [read[5] for read in block], [read[6] for read in block])
+        quality_filter_results, lengths = \
+            quality_filter_sequences(sequences,
+                                     qualities,
+                                     lengths,
+                                     max_bad_run_length,
+                                     phred_quality_threshold,
+                                     min_per_read_length,
+                                     seq_max_N,
+                                     bad_illumina_qual_digit)
+
+        for read, quality_filter_result, length in izip(
+                block, quality_filter_results.tolist(), lengths.tolist()):
+            # process quality result
+            if quality_filter_result != 0:
+                # if the quality filter didn't pass record why and
+                # move on to the next record
+                if quality_filter_result == 1:
+                    count_too_short += 1
+                elif quality_filter_result == 2:
+                    count_too_many_N += 1
+                elif quality_filter_result == 3:
+                    count_bad_illumina_qual_digit += 1
+                else:
+                    raise ValueError(
+                        "Unknown quality filter result: %d" %
+                        quality_filter_result)
+                continue
 
-        try:
-            seqs_per_sample_counts[sample_id] += 1
-        except KeyError:
-            seqs_per_sample_counts[sample_id] = 1
+            (sample_id, header, barcode, corrected_barcode,
+             num_barcode_errors, sequence, quality) = read
+            sequence = sequence[:length]
+            quality = quality[:length]
+            sequence_lengths.append(length)
 
-        if rev_comp:
-            sequence = str(DNA(sequence).rc())
-            quality = quality[::-1]
+            try:
+                seqs_per_sample_counts[sample_id] += 1
+            except KeyError:
+                seqs_per_sample_counts[sample_id] = 1
 
-        fasta_header = '%s_%s %s orig_bc=%s new_bc=%s bc_diffs=%d' %\
-            (sample_id, seq_id, header, barcode,
-             corrected_barcode, num_barcode_errors)
-        yield fasta_header, sequence, quality, seq_id
-        seq_id += 1
+            if rev_comp:
+                sequence = str(DNA(sequence).rc())
+                quality = quality[::-1]
 
-    # Add sample IDs with zero counts to dictionary for logging
-    for curr_sample_id in barcode_to_sample_id.values():
-        if curr_sample_id not in seqs_per_sample_counts.keys():
-            seqs_per_sample_counts[curr_sample_id] = 0
+            yield (sample_id, header, barcode, corrected_barcode,
+                   num_barcode_errors, sequence, quality)
 
-    if log_f is not None:
-        log_str = format_split_libraries_fastq_log(count_barcode_not_in_map,
-                                                   count_too_short,
-                                                   count_too_many_N,
-                                                   count_bad_illumina_qual_digit,
-                                                   count_barcode_errors_exceed_max,
-                                                   input_sequence_count,
-                                                   sequence_lengths,
-                                                   seqs_per_sample_counts)
-        log_f.write(log_str)
+    stats['count_too_short'] += count_too_short
+    stats['count_too_many_N'] += count_too_many_N
+    stats['count_bad_illumina_qual_digit'] += count_bad_illumina_qual_digit
 
-    if len(sequence_lengths) and histogram_f is not None:
-        counts, bin_edges = make_histograms(sequence_lengths)
-        histogram_str = format_histogram_one_count(counts, bin_edges)
-        histogram_f.write(histogram_str)
-        histogram_f.write('\n--\n\n')
+
+def get_fastq_record_offsets(fastq_fp, records_per_chunk,
+                             block_size=FASTQ_OFFSETS_BLOCK_SIZE):
+    """Returns the byte offsets of every records_per_chunk-th fastq record
+
+    fastq_fp: path to an uncompressed fastq file with four-line records
+    records_per_chunk: the number of records between consecutive offsets
+
+    The file is scanned in blocks of block_size bytes, counting newlines
+    rather than parsing records. Returns (offsets, num_records), where
+    offsets[i] is the offset of record i * records_per_chunk; the last offset
+    can be the end of the file.
+    """
+    lines_per_chunk = 4 * records_per_chunk
+    offsets = [0]
+    next_offset_line = lines_per_chunk
+    line_count = 0
+    position = 0
+    last_char = ''
+    f = open(fastq_fp, 'rb')
+    try:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            block_start = 0
+            block_line_count = block.count('\n')
+            while line_count + block_line_count >= next_offset_line:
+                for i in xrange(next_offset_line - line_count):
+                    block_start = block.index('\n', block_start) + 1
+                offsets.append(position + block_start)
+                line_count = next_offset_line
+                block_line_count = block.count('\n', block_start)
+                next_offset_line += lines_per_chunk
+            line_count += block_line_count
+            position += len(block)
+            last_char = block[-1]
+    finally:
+        f.close()
+
+    # the last line need not end with a newline
+    if last_char not in ('', '\n'):
+        line_count += 1
+    return offsets, line_count // 4
+
+
+def _iter_fastq_line_chunks(fastq_f, records_per_chunk):
+    """Yields lists of the lines of records_per_chunk fastq records"""
+    lines_per_chunk = 4 * records_per_chunk
+    while True:
+        lines = list(islice(fastq_f, lines_per_chunk))
+        if not lines:
+            break
+        yield lines
+
+
+def _read_fastq_chunk(chunk):
+    """Returns the lines of a chunk of a fastq file
+
+    chunk is either a list of lines, or a (filepath, offset, num_records)
+    tuple as built by process_fastq_single_end_read_file_parallel.
+    """
+    if isinstance(chunk, list):
+        return chunk
+    fastq_fp, offset, num_records = chunk
+    fastq_f = open(fastq_fp, 'U')
+    try:
+        fastq_f.seek(offset)
+        return list(islice(fastq_f, 4 * num_records))
+    finally:
+        fastq_f.close()
+
+
+def _demultiplex_fastq_chunk(args):
+    """Demultiplexes one chunk of a pair of read and barcode fastq files
+
+    This is a top-level function so it can be called by a multiprocessing
+    Pool. Returns the list of records yielded by _demultiplex_fastq_records
+    and the logging statistics of the chunk.
+    """
+    read_chunk, barcode_chunk, params = args
+    params = params.copy()
+    phred_offset = params.pop('phred_offset')
+    if params['barcode_correction_fn'] is not None:
+        params['barcode_correction_fn'] = cache_barcode_correction(
+            params['barcode_correction_fn'])
+
+    stats = _new_split_libraries_fastq_stats()
+    records = izip(
+        read_fastq_records(_read_fastq_chunk(barcode_chunk), strict=False,
+                           phred_offset=phred_offset),
+        read_fastq_records(_read_fastq_chunk(read_chunk), strict=False,
+                           phred_offset=phred_offset))
+    result = list(_demultiplex_fastq_records(records, stats=stats, **params))
+    return result, stats
+
+
+def _imap_bounded(pool, func, tasks, max_pending):
+    """Like pool.imap, but submits at most max_pending tasks ahead
+
+    Results are yielded in the order of tasks. Unlike pool.imap, tasks is
+    not consumed ahead of the results, which bounds memory use when the
+    tasks themselves are large.
+    """
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def process_fastq_single_end_read_file_parallel(
+        fastq_read_fp,
+        fastq_barcode_fp,
+        barcode_to_sample_id,
+        jobs_to_start=2,
+        records_per_chunk=FASTQ_RECORDS_PER_CHUNK,
+        store_unassigned=False,
+        max_bad_run_length=0,
+        phred_quality_threshold=2,
+        min_per_read_length_fraction=0.75,
+        rev_comp=False,
+        rev_comp_barcode=False,
+        seq_max_N=0,
+        start_seq_id=0,
+        filter_bad_illumina_qual_digit=False,
+        log_f=None,
+        histogram_f=None,
+        barcode_correction_fn=None,
+        max_barcode_errors=1.5,
+        strict_header_match=True,
+        phred_offset=None):
+    """Demultiplexes a pair of read and barcode fastq files with a process pool
+
+    fastq_read_fp, fastq_barcode_fp: paths to the read and barcode fastq
+     files, which may be gzipped
+    jobs_to_start: the number of worker processes
+    records_per_chunk: the number of fastq records processed by each task
+
+    The remaining parameters, the yielded records, their seq ids and the
+    log and histogram written at the end are the same as for
+    process_fastq_single_end_read_file. barcode_correction_fn must be
+    picklable (e.g., decode_golay_12).
+
+    Uncompressed files must have four-line records; they are split at record
+    boundaries into byte ranges which the workers read themselves. Gzipped
+    files can't be read from an offset, so their records are read here and
+    passed to the workers in chunks.
+    """
+    fastq_read_f = qiime_open(fastq_read_fp)
+    try:
+        fastq_read_f_line1 = fastq_read_f.readline()
+        fastq_read_f_line2 = fastq_read_f.readline()
+    finally:
+        fastq_read_f.close()
+
+    phred_offset, check_header_match_f, barcode_length, min_per_read_length =\
+        _get_read_file_settings(fastq_read_f_line1,
+                                fastq_read_f_line2,
+                                barcode_to_sample_id,
+                                min_per_read_length_fraction,
+                                phred_offset)
+    params = {'phred_offset': phred_offset,
+              'barcode_to_sample_id': barcode_to_sample_id,
+              'barcode_length': barcode_length,
+              'min_per_read_length': min_per_read_length,
+              'check_header_match_f': check_header_match_f,
+              'store_unassigned': store_unassigned,
+              'max_bad_run_length': max_bad_run_length,
+              'phred_quality_threshold': phred_quality_threshold,
+              'rev_comp': rev_comp,
+              'rev_comp_barcode': rev_comp_barcode,
+              'seq_max_N': seq_max_N,
+              'filter_bad_illumina_qual_digit': filter_bad_illumina_qual_digit,
+              'barcode_correction_fn': barcode_correction_fn,
+              'max_barcode_errors': max_barcode_errors,
+              'strict_header_match': strict_header_match}
+
+    open_files = []
+    if is_gzip(fastq_read_fp) or is_gzip(fastq_barcode_fp):
+        fastq_read_f = qiime_open(fastq_read_fp)
+        fastq_barcode_f = qiime_open(fastq_barcode_fp)
+        open_files = [fastq_read_f, fastq_barcode_f]
+        chunks = izip(_iter_fastq_line_chunks(fastq_read_f, records_per_chunk),
+                      _iter_fastq_line_chunks(fastq_barcode_f,
+                                              records_per_chunk))
+    else:
+        # records are paired by their index, so both files are split at the
+        # same record indices
+        read_offsets, num_read_records = get_fastq_record_offsets(
+            fastq_read_fp, records_per_chunk)
+        barcode_offsets, num_barcode_records = get_fastq_record_offsets(
+            fastq_barcode_fp, records_per_chunk)
+        num_records = min(num_read_records, num_barcode_records)
+        chunks = []
+        for i, (read_offset, barcode_offset) in enumerate(
+                izip(read_offsets, barcode_offsets)):
+            chunk_size = min(records_per_chunk,
+                             num_records - i * records_per_chunk)
+            if chunk_size <= 0:
+                break
+            chunks.append(((fastq_read_fp, read_offset, chunk_size),
+                           (fastq_barcode_fp, barcode_offset, chunk_size)))
+    tasks = ((read_chunk, barcode_chunk, params)
+             for read_chunk, barcode_chunk in chunks)
+
+    seq_id = start_seq_id
+    stats = _new_split_libraries_fastq_stats()
+    pool = Pool(jobs_to_start)
+    try:
+        for chunk_records, chunk_stats in _imap_bounded(
+                pool, _demultiplex_fastq_chunk, tasks, 2 * jobs_to_start):
+            _merge_split_libraries_fastq_stats(stats, chunk_stats)
+            for (sample_id, header, barcode, corrected_barcode,
+                 num_barcode_errors, sequence, quality) in chunk_records:
+                fasta_header = '%s_%s %s orig_bc=%s new_bc=%s bc_diffs=%d' %\
+                    (sample_id, seq_id, header, barcode,
+                     corrected_barcode, num_barcode_errors)
+                yield fasta_header, sequence, quality, seq_id
+                seq_id += 1
+    finally:
+        pool.close()
+        pool.join()
+        for f in open_files:
+            f.close()
+
+    _write_split_libraries_fastq_stats(stats, barcode_to_sample_id, log_f,
+                                       histogram_f)
 
 
 def make_histograms(lengths, binwidth=10):
@@ -450,16 +922,17 @@ def extract_reads_from_interleaved(
     """
     forward_fp = join(output_dir, "forward_reads.fastq")
     reverse_fp = join(output_dir, "reverse_reads.fastq")
-    ffp = open(forward_fp, 'w')
-    rfp = open(reverse_fp, 'w')
+    ffp = SequenceWriter(forward_fp)
+    rfp = SequenceWriter(reverse_fp)
 
-    for label, seq, qual in parse_fastq(qiime_open(input_fp), strict=False,
-                                        enforce_qual_range=False):
-        fastq_string = format_fastq_record(label, seq, qual)
+    # the quality strings are copied without decoding them
+    for record in read_fastq_records(input_fp, strict=False,
+                                     enforce_qual_range=False):
+        label = record.header
         if forward_id in label:
-            ffp.write(fastq_string)
+            ffp.write_fastq(label, record.sequence, record.quality_string)
         elif reverse_id in label and forward_id not in label:
-            rfp.write(fastq_string)
+            rfp.write_fastq(label, record.sequence, record.quality_string)
         else:
             ffp.close()
             rfp.close()
@@ -19,9 +19,10 @@ from qiime.golay import get_invalid_golay_barcodes
 from qiime.parse import parse_mapping_file_to_dict
 from qiime.split_libraries import check_map, expand_degeneracies
 from qiime.split_libraries_fastq import correct_barcode
+from qiime.sequence_reader import read_fastq_records
 from qiime.util import get_qiime_temp_dir, qiime_system_call
 from burrito.util import ApplicationError
-from skbio.parse.sequences import parse_fasta, parse_fastq
+from skbio.parse.sequences import parse_fasta
 from skbio.util import remove_files
 from skbio.sequence import DNASequence
 from bfillings.uclust import get_clusters_from_fasta_filepath
@@ -651,11 +652,12 @@ def read_fwd_rev_read(fwd_read_f,
     seq_idx = 1
     qual_idx = 2
 
-    for fwd_read, rev_read in izip(parse_fastq(fwd_read_f, strict=False,
-                                   enforce_qual_range=False),
-                                   parse_fastq(rev_read_f,
-                                   strict=False,
-                                   enforce_qual_range=False)):
+    for fwd_read, rev_read in izip(read_fastq_records(fwd_read_f,
+                                                      strict=False,
+                                                      enforce_qual_range=False),
+                                   read_fastq_records(rev_read_f,
+                                                      strict=False,
+                                                      enforce_qual_range=False)):
 
         # confirm match between headers
 
@@ -26,9 +26,10 @@ from scipy.stats import (spearmanr, kruskal, mannwhitneyu, kendalltau,
                          power_divergence, ttest_1samp, ttest_ind)
 from scipy.stats.distributions import (chi2, norm, f as fdist, t as tdist)
 
-from scipy.special import ndtri
+from scipy.special import ndtri, xlogy
 
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 from os.path import join
 from types import ListType
 from copy import deepcopy
@@ -45,11 +46,12 @@ from numpy import (argsort, array, ceil, empty, fill_diagonal, finfo,
                    log, mean, nan, nonzero, sqrt, std, take, tanh,
                    transpose, seterr as np_seterr, var, arange, corrcoef,
                    trace, ravel, float as np_float, finfo, asarray, isnan,
-                   isinf, abs)
+                   isinf, abs, errstate, triu_indices, minimum, maximum,
+                   newaxis, bincount, column_stack, diff, repeat, sign)
 
-from numpy.random import permutation, shuffle, randint
+from numpy.random import permutation, shuffle, randint, RandomState
 from biom.table import Table
-from skbio.stats.distance import DistanceMatrix, mantel
+from skbio.stats.distance import DistanceMatrix
 from skbio.util import create_dir
 
 from qiime.format import format_p_value_for_num_iters
@@ -58,6 +60,14 @@ from qiime.util import MetadataMap, write_biom_table
 np_seterr(divide='warn')
 MACHEP = finfo(np_float).eps
 
+# maximum number of permuted observations (or distances) held in memory at
+# once by permuted_t_two_sample and permuted_correlations
+PERMUTATION_BLOCK_SIZE = 2 ** 22
+# relative difference below which a permuted correlation is considered equal
+# to the original one, as the correlations are computed with different
+# floating point rounding (see count_extreme_permuted_stats)
+PERMUTED_STAT_TOLERANCE = 1e-10
+
 # Top-level stats functions.
 
 tail_types = ['low', 'high', 'two-sided']
@@ -69,7 +79,7 @@ tail_type_desc = {
 
 
 def all_pairs_t_test(labels, dists, tail_type='two-sided',
-                     num_permutations=999):
+                     num_permutations=999, seed=None):
     """Perform two-sample t-test on all pairs of grouped distances.
 
     Performs Student's two-sample t-test on all pairs of distributions,
@@ -91,6 +101,8 @@ def all_pairs_t_test(labels, dists, tail_type='two-sided',
         num_permutations - the number of Monte Carlo permutations to use. If
             zero, the nonparametric p-value will not be calculated and will be
             'N/A' in the returned string.
+        seed - seed of the permutations (int or numpy RandomState), shared by
+            all pairs. If None, numpy's global random state is used
     """
     result = ''
 
@@ -125,7 +137,8 @@ def all_pairs_t_test(labels, dists, tail_type='two-sided',
               '(Bonferroni-corrected)\tNonparametric p-value\t' + \
               'Nonparametric p-value (Bonferroni-corrected)\n'
 
-    stats = _perform_pairwise_tests(labels, dists, tail_type, num_permutations)
+    stats = _perform_pairwise_tests(labels, dists, tail_type, num_permutations,
+                                    _get_random_state(seed))
     for stat in stats:
         stat = ['N/A' if e is nan else e for e in stat]
         result += '%s\t%s\t%s\t%s\t%s\t%s\t%s\n' % (stat[0], stat[1], stat[2],
@@ -137,7 +150,8 @@ def all_pairs_t_test(labels, dists, tail_type='two-sided',
     return result
 
 
-def _perform_pairwise_tests(labels, dists, tail_type, num_permutations):
+def _perform_pairwise_tests(labels, dists, tail_type, num_permutations,
+                            seed=None):
     """Perform t-test for all pairs of distributions.
 
     Computes corrected p-values in addition to uncorrected.
@@ -158,7 +172,7 @@ def _perform_pairwise_tests(labels, dists, tail_type, num_permutations):
             else:
                 obs_t, param_p_val, _, nonparam_p_val = mc_t_two_sample(
                     g1_dist, g2_dist, tails=tail_type,
-                    permutations=num_permutations)
+                    permutations=num_permutations, seed=seed)
             result.append([g1_label, g2_label, obs_t, param_p_val, None,
                            nonparam_p_val, None])
             if not isnan(obs_t):
@@ -238,6 +252,124 @@ def _quantile(data, quantile):
     return output
 
 
+def sample_permutations(n, num_perms, seed=None):
+    """Returns num_perms random permutations of range(n), one per row
+
+    The permutations are drawn one at a time with numpy.random.permutation,
+    as permutation tests of distance matrices have always drawn them, so
+    results for a given numpy.random.seed don't change.
+
+    seed: int or numpy RandomState the permutations are drawn from instead
+     of numpy's global random state
+    """
+    permutation_f = permutation
+    random_state = _get_random_state(seed)
+    if random_state is not None:
+        permutation_f = random_state.permutation
+    perms = empty((num_perms, n), dtype=int)
+    for perm in perms:
+        perm[:] = permutation_f(n)
+    return perms
+
+
+def condensed_permutation_indices(perms):
+    """Returns the indices of permuted condensed distance matrices
+
+    perms: 2D array of permutations of range(n), one per row
+
+    Returns a 2D array with a row per permutation, such that x[indices[k]]
+    is the condensed form (see DistanceMatrix.condensed_form) of the distance
+    matrix whose condensed form is x, permuted by perms[k] (as permute_2d
+    would permute it).
+    """
+    perms = asarray(perms)
+    n = perms.shape[1]
+    rows, cols = triu_indices(n, 1)
+    a = perms[:, rows]
+    b = perms[:, cols]
+    i = minimum(a, b)
+    j = maximum(a, b)
+    return i * n - i * (i + 1) // 2 + j - i - 1
+
+
+def _standardize(x):
+    """Returns x centered and scaled to unit norm (nan if x is constant)
+
+    The Pearson correlation of two vectors is the sum of the products of
+    their standardized values.
+    """
+    x = asarray(x, dtype=float)
+    x = x - x.mean()
+    with errstate(divide='ignore', invalid='ignore'):
+        return x / sqrt((x * x).sum())
+
+
+def permuted_correlations(x, ys, perms, jobs_to_start=1):
+    """Returns Pearson correlations of permutations of a distance matrix
+
+    x: condensed form of the distance matrix which is permuted
+    ys: list of condensed distance matrices which x is correlated with
+    perms: 2D array of permutations of the samples, one per row (e.g.
+     sample_permutations(n, num_perms))
+    jobs_to_start: number of threads computing blocks of permutations
+
+    Returns a 2D array with a row per permutation and a column per matrix of
+    ys. The permuted distances are gathered from x with
+    condensed_permutation_indices, rather than by permuting and validating a
+    distance matrix, and x and ys are standardized once so that each
+    correlation is a sum of products. The permutations are processed in
+    blocks of at most PERMUTATION_BLOCK_SIZE distances.
+    """
+    std_x = _standardize(x)
+    std_ys = [_standardize(y) for y in ys]
+    perms = asarray(perms)
+    result = empty((len(perms), len(std_ys)))
+    block_size = max(1, PERMUTATION_BLOCK_SIZE // max(len(std_x), 1))
+
+    def compute(start):
+        end = start + block_size
+        permuted_x = std_x[condensed_permutation_indices(perms[start:end])]
+        for k, std_y in enumerate(std_ys):
+            result[start:end, k] = (permuted_x * std_y).sum(axis=1)
+
+    starts = range(0, len(perms), block_size)
+    if jobs_to_start > 1 and len(starts) > 1:
+        pool = ThreadPool(jobs_to_start)
+        try:
+            pool.map(compute, starts)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for start in starts:
+            compute(start)
+    return result
+
+
+def count_extreme_permuted_stats(perm_stats, orig_stat, tail='high'):
+    """Returns the number of perm_stats at least as extreme as orig_stat
+
+    perm_stats: array of statistics of permuted data
+    orig_stat: statistic of the original data
+    tail: 'high' to count perm_stats >= orig_stat, 'low' to count
+     perm_stats <= orig_stat
+
+    Statistics gathered from permuted data (e.g. by permuted_correlations)
+    are summed in a different order than the original statistic, so
+    statistics which are mathematically equal (which is common with integer
+    distances) can differ in their last bits. These are counted as ties:
+    statistics within PERMUTED_STAT_TOLERANCE of orig_stat (relative to
+    max(abs(orig_stat), 1)) are counted.
+    """
+    eps = PERMUTED_STAT_TOLERANCE * max(abs(orig_stat), 1.0)
+    if tail == 'high':
+        return (perm_stats >= orig_stat - eps).sum()
+    elif tail == 'low':
+        return (perm_stats <= orig_stat + eps).sum()
+    else:
+        raise ValueError("Unrecognized tail type '%s'." % tail)
+
+
 class DistanceMatrixStats(object):
 
     """Base class for distance matrix-based statistical methods.
@@ -431,7 +563,7 @@ class MantelCorrelogram(CorrelationStats):
         else:
             raise ValueError("Alpha must be between 0 and 1.")
 
-    def __call__(self, num_perms=999):
+    def __call__(self, num_perms=999, jobs_to_start=1):
         """Runs a Mantel correlogram test over the current distance matrices.
 
         Returns a dict containing the results. The following keys are set:
@@ -449,6 +581,8 @@ class MantelCorrelogram(CorrelationStats):
         Arguments:
             num_perms - the number of permutations to use when calculating the
                 p-values
+            jobs_to_start - the number of threads computing the permuted
+                statistics
 
         Note: This code is heavily based on the implementation of
         mantel.correlog in R's vegan package.
@@ -471,6 +605,9 @@ class MantelCorrelogram(CorrelationStats):
         # class.
         dist_class_matrix, class_indices = self._find_distance_classes(
             geo_dm, num_classes)
+        dist_class_flat = dist_class_matrix[triu_indices(dm_size, 1)]
+        eco_flat = eco_dm.condensed_form()
+        identity = arange(dm_size)[newaxis]
 
         # Start assembling the results.
         results['method_name'] = 'Mantel Correlogram'
@@ -485,24 +622,18 @@ class MantelCorrelogram(CorrelationStats):
         # and zeros otherwise (zeros on the diagonal as well).
         for class_num in range(num_classes):
             results['class_index'].append(class_indices[class_num])
-            model_matrix = zeros([dm_size, dm_size], dtype=int)
-            for i in range(dm_size):
-                for j in range(dm_size):
-                    curr_ele = dist_class_matrix[i][j]
-                    if curr_ele == class_num and i != j:
-                        model_matrix[i][j] = 1
-            model_matrix = DistanceMatrix(model_matrix, geo_dm.ids)
-
-            # Count the number of distances in the current distance class.
-            num_distances = int(model_matrix.data.sum())
+            model_flat = (dist_class_flat == class_num).astype(float)
+
+            # Count the number of distances in the current distance class
+            # (in both triangles of the model matrix).
+            num_distances = 2 * int(model_flat.sum())
             results['num_dist'].append(num_distances)
             if num_distances == 0:
                 results['mantel_r'].append(None)
                 results['mantel_p'].append(None)
             else:
-                row_sums = model_matrix.data.sum(axis=1)
-                row_sums = map(int, row_sums)
-                has_zero_sum = 0 in row_sums
+                row_sums = (dist_class_matrix == class_num).sum(axis=1)
+                has_zero_sum = (row_sums == 0).any()
 
                 # Only stop running Mantel tests if we've gone through half of
                 # the distance classes and at least one row has a sum of zero
@@ -511,9 +642,8 @@ class MantelCorrelogram(CorrelationStats):
                 if not (class_num > ((num_classes // 2) - 1) and has_zero_sum):
                     # Compute the correlation coefficient without performing
                     # permutation tests in order to check its sign below.
-                    orig_stat, _, _ = mantel(
-                        model_matrix, eco_dm, method='pearson',
-                        permutations=0, strict=True)
+                    orig_stat = permuted_correlations(
+                        model_flat, [eco_flat], identity)[0, 0]
 
                     # Negate the Mantel r statistic because we are using
                     # distance matrices, not similarity matrices (this is a
@@ -523,15 +653,20 @@ class MantelCorrelogram(CorrelationStats):
 
                     # Compute a one-tailed p-value in the direction of the
                     # sign.
-                    if orig_stat < 0:
-                        tail_type = 'less'
+                    if num_perms == 0 or isnan(orig_stat):
+                        p_val = nan
                     else:
-                        tail_type = 'greater'
-
-                    _, p_val, _ = mantel(
-                        model_matrix, eco_dm, method='pearson',
-                        permutations=num_perms, alternative=tail_type,
-                        strict=True)
+                        perm_stats = permuted_correlations(
+                            model_flat, [eco_flat],
+                            sample_permutations(dm_size, num_perms),
+                            jobs_to_start)[:, 0]
+                        if orig_stat < 0:
+                            better = count_extreme_permuted_stats(
+                                perm_stats, orig_stat, 'low')
+                        else:
+                            better = count_extreme_permuted_stats(
+                                perm_stats, orig_stat, 'high')
+                        p_val = (better + 1) / (num_perms + 1)
 
                     results['mantel_p'].append(p_val)
                 else:
@@ -630,22 +765,22 @@ class MantelCorrelogram(CorrelationStats):
                                      (0.5 * (next_bp - break_point)))
 
             # Create the matrix of distance classes. Every element in the
-            # matrix tells what distance class the original element belongs to.
+            # matrix tells what distance class the original element belongs
+            # to: the index of the first breakpoint greater than or equal to
+            # the element, minus one.
+            dist_classes = asarray(break_points).searchsorted(
+                dm_lower_flat, side='left') - 1
+
+            # If we somehow got a negative breakpoint (possible sometimes due
+            # to rounding error), put it in the first distance class.
+            dist_classes[dist_classes < 0] = 0
+
+            # Matrix is symmetric.
             dist_class_matrix = empty([size, size], dtype=int)
-            for i in range(size):
-                for j in range(size):
-                    if i != j:
-                        curr_ele = dm[i][j]
-                        bps = [(k - 1) for k, bp in enumerate(break_points)
-                               if bp >= curr_ele]
-                        min_bp = min(bps)
-
-                        # If we somehow got a negative breakpoint (possible
-                        # sometimes due to rounding error), put it in the first
-                        # distance class.
-                        dist_class_matrix[i][j] = min_bp if min_bp >= 0 else 0
-                    else:
-                        dist_class_matrix[i][j] = -1
+            rows, cols = triu_indices(size, 1)
+            dist_class_matrix[rows, cols] = dist_classes
+            dist_class_matrix[cols, rows] = dist_classes
+            fill_diagonal(dist_class_matrix, -1)
 
         return dist_class_matrix, class_indices
 
@@ -789,7 +924,7 @@ class PartialMantel(CorrelationStats):
         super(PartialMantel, self).__init__([dm1, dm2, cdm], num_dms=3,
                                             min_dm_size=3)
 
-    def __call__(self, num_perms=999):
+    def __call__(self, num_perms=999, jobs_to_start=1):
         """Runs a partial Mantel test on the current distance matrices.
 
         Returns a dict containing the results. The following keys are set:
@@ -800,6 +935,8 @@ class PartialMantel(CorrelationStats):
         Arguments:
             num_perms - the number of times to permute the distance matrix
                 while calculating the p-value
+            jobs_to_start - the number of threads computing the permuted
+                statistics
 
         Credit: The code herein is based loosely on the implementation found in
         R's vegan package.
@@ -818,31 +955,27 @@ class PartialMantel(CorrelationStats):
         dm1_flat = dm1.condensed_form()
         dm2_flat = dm2.condensed_form()
         cdm_flat = cdm.condensed_form()
+        size = dm1.shape[0]
 
-        # Get the initial r-values before permuting.
-        rval1 = pearson(dm1_flat, dm2_flat)
-        rval2 = pearson(dm1_flat, cdm_flat)
-        rval3 = pearson(dm2_flat, cdm_flat)
+        # Get the initial r-values before permuting. They're computed as the
+        # permuted r-values are, so that permutations which don't change the
+        # distances give exactly the same statistic.
+        rval1, rval2 = permuted_correlations(dm1_flat, [dm2_flat, cdm_flat],
+                                             arange(size)[newaxis])[0]
+        rval3 = (_standardize(dm2_flat) * _standardize(cdm_flat)).sum()
 
         # Calculate the original test statistic (r-value).
         orig_stat = corr(rval1, rval2, rval3)
 
-        # Calculate permuted r-values and p-values, storing them for use in the
-        # calculation of the final statistic.
-        perm_stats = []
-        numerator = 0
-        for i in range(0, num_perms):
-            # Permute the first distance matrix and calculate new r and
-            # p-values.
-            p1 = permute_2d(dm1, permutation(dm1.shape[0]))
-            dm1_perm = DistanceMatrix(p1, dm1.ids)
-            dm1_perm_flat = dm1_perm.condensed_form()
-            rval1 = pearson(dm1_perm_flat, dm2_flat)
-            rval2 = pearson(dm1_perm_flat, cdm_flat)
-            perm_stats.append(corr(rval1, rval2, rval3))
-
-            if perm_stats[-1] >= orig_stat:
-                numerator += 1
+        # Calculate the r-values of all permutations of the first distance
+        # matrix at once.
+        perm_rvals = permuted_correlations(dm1_flat, [dm2_flat, cdm_flat],
+                                           sample_permutations(size,
+                                                               num_perms),
+                                           jobs_to_start)
+        perm_stats = corr(perm_rvals[:, 0], perm_rvals[:, 1], rval3)
+        numerator = count_extreme_permuted_stats(perm_stats, orig_stat)
+
         # Load the final statistics into the result dictionary.
         res['mantel_r'] = orig_stat
         res['mantel_p'] = (numerator + 1) / (num_perms + 1)
@@ -1309,7 +1442,7 @@ def t_two_sample(a, b, tails='two-sided', exp_diff=0):
 
 
 def mc_t_two_sample(x_items, y_items, tails='two-sided', permutations=999,
-                    exp_diff=0):
+                    exp_diff=0, seed=None):
     """Performs a two-sample t-test with Monte Carlo permutations.
 
     x_items and y_items must be INDEPENDENT observations (sequences of
@@ -1333,6 +1466,8 @@ def mc_t_two_sample(x_items, y_items, tails='two-sided', permutations=999,
             the list of t statistics obtained from permutations will be empty,
             and the nonparametric p-value will be NaN
         exp_diff - the expected difference in means (x_items - y_items)
+        seed - seed of the permutations (int or numpy RandomState). If None,
+            numpy's global random state is used
     """
     if permutations < 0:
         raise ValueError("Invalid number of permutations: %d. Must be greater "
@@ -1353,11 +1488,8 @@ def mc_t_two_sample(x_items, y_items, tails='two-sided', permutations=999,
     nonparam_p_val = nan
     perm_t_stats = []
     if permutations > 0 and not isnan(obs_t) and not isnan(param_p_val):
-        perm_t_stats = zeros(permutations, dtype=float)
-        px, py = _permute_observations(x_items, y_items, permutations)
-        for i in range(permutations):
-            perm_t_stats[i] = t_two_sample(px[i], py[i], tails=tails,
-                                           exp_diff=exp_diff)[0]
+        perm_t_stats = permuted_t_two_sample(x_items, y_items, permutations,
+                                             exp_diff=exp_diff, seed=seed)
 
         # Compute nonparametric p-value based on the permuted t-test results.
         if tails == 'two-sided':
@@ -1371,6 +1503,105 @@ def mc_t_two_sample(x_items, y_items, tails='two-sided', permutations=999,
     return obs_t, param_p_val, perm_t_stats, nonparam_p_val
 
 
+def _get_random_state(seed):
+    """Returns a RandomState for seed, or None if seed is None
+
+    seed can be an int, or a RandomState which is returned as is, so that
+    several tests can draw from the same random state.
+    """
+    if seed is None or isinstance(seed, RandomState):
+        return seed
+    return RandomState(seed)
+
+
+def _permutation_index_blocks(n, num_perms, block_size, seed=None):
+    """Yields arrays of num_perms random permutations of range(n)
+
+    Each array holds (at most) block_size permutations, one per row. The
+    permutations are generated by shuffling the same index array repeatedly,
+    like _permute_observations, so that they're the same for a given seed.
+    """
+    shuffle_f = shuffle
+    random_state = _get_random_state(seed)
+    if random_state is not None:
+        shuffle_f = random_state.shuffle
+    inds = arange(n)
+    for start in range(0, num_perms, block_size):
+        perm_inds = empty((min(block_size, num_perms - start), n), dtype=int)
+        for perm in perm_inds:
+            shuffle_f(inds)
+            perm[:] = inds
+        yield perm_inds
+
+
+def _t_two_sample_stats(x, y, exp_diff=0):
+    """Returns the t statistics of t_two_sample for pairs of samples
+
+    x, y: arrays of the observations of each pair of samples, along their
+     last axis (e.g. 2D arrays with one pair per row). The statistics are
+     computed as t_two_sample computes them for a single pair (including the
+     test of a single observation against a sample), so that they're equal,
+     but for all pairs at once.
+    """
+    len_x, len_y = x.shape[-1], y.shape[-1]
+    with errstate(divide='ignore', invalid='ignore'):
+        if len_x == 1 or len_y == 1:
+            if len_x <= len_y:
+                obs, sample = x[..., 0], y
+            else:
+                obs, sample = y[..., 0], x
+            n = sample.shape[-1]
+            sample_std = sample.std(axis=-1, ddof=1)
+            t = (obs - sample.mean(axis=-1) - exp_diff) / sample_std / \
+                sqrt((n + 1) / n)
+            t[sample_std == 0] = nan
+        else:
+            x = x - exp_diff
+            df = len_x + len_y - 2
+            svar = ((len_x - 1) * x.var(axis=-1, ddof=1) +
+                    (len_y - 1) * y.var(axis=-1, ddof=1)) / df
+            t = (x.mean(axis=-1) - y.mean(axis=-1)) / \
+                sqrt(svar * (1.0 / len_x + 1.0 / len_y))
+    t[isinf(t)] = nan
+    return t
+
+
+def permuted_t_two_sample(x_items, y_items, permutations, exp_diff=0,
+                          seed=None, block_size=None):
+    """Returns the t statistics of random permutations of two samples
+
+    The observations of x_items and y_items are randomly reassigned to
+    samples of the same sizes permutations times, and the t statistic of
+    t_two_sample (nan where it can't be computed) is returned for each
+    permutation. Rather than calling t_two_sample for each permutation, the
+    permutations are generated as a matrix of indices, and the means and
+    variances of all permuted samples are computed with array operations,
+    block_size permutations at a time (by default, as many as fit in
+    PERMUTATION_BLOCK_SIZE observations).
+
+    seed: seed of the permutations (int or numpy RandomState). If None,
+     numpy's global random state is used, and the permutations are the same
+     as those of _permute_observations
+    """
+    vals = hstack([array(x_items, dtype=float), array(y_items, dtype=float)])
+    # see _permute_observations
+    vals.sort()
+    len_x = len(x_items)
+    if block_size is None:
+        block_size = max(1, PERMUTATION_BLOCK_SIZE // max(vals.size, 1))
+    result = empty(permutations)
+    start = 0
+    for perm_inds in _permutation_index_blocks(vals.size, permutations,
+                                               block_size, seed):
+        perm_vals = vals[perm_inds]
+        end = start + len(perm_inds)
+        result[start:end] = _t_two_sample_stats(perm_vals[:, :len_x],
+                                                perm_vals[:, len_x:],
+                                                exp_diff)
+        start = end
+    return result
+
+
 def _permute_observations(x, y, num_perms):
     """Return num_perms pairs of permuted vectors x,y.
 
@@ -1971,6 +2202,324 @@ def kruskal_wallis(data):
     return kruskal(*data)
 
 
+def _tprob_array(t, df, tails='two-sided'):
+    """Returns tprob(t, df, tails) for each value of the array t"""
+    t = asarray(t, dtype=float)
+    if tails == 'two-sided':
+        p = 2 * tdist.cdf(t, df)
+        high = t >= 0
+        p[high] = 2 * (1. - tdist.cdf(t[high], df))
+        return p
+    elif tails == 'high':
+        return 1 - tdist.cdf(t, df)
+    elif tails == 'low':
+        return tdist.cdf(t, df)
+    else:
+        raise ValueError('Unknown direction.')
+
+
+def _rank_rows(data):
+    """Returns the ranks of the values of each row of data, and tie sums
+
+    The ranks are computed as scipy.stats.rankdata computes them (tied values
+    get the average of their ranks, starting at 1), but for all rows at once.
+    The tie sums are sum(t**3 - t) over the groups of t tied values of each
+    row, as used by scipy.stats.tiecorrect.
+    """
+    data = asarray(data, dtype=float)
+    num_rows, n = data.shape
+    ranks = empty((num_rows, n))
+    if num_rows == 0 or n == 0:
+        return ranks, zeros(num_rows)
+    order = argsort(data, axis=1, kind='mergesort')
+    rows = arange(num_rows)[:, newaxis]
+    sorted_data = data[rows, order]
+    # each run of tied values starts where a sorted value differs from the
+    # previous one; runs never span rows since every row starts a run
+    run_starts = ones((num_rows, n), dtype=bool)
+    run_starts[:, 1:] = sorted_data[:, 1:] != sorted_data[:, :-1]
+    run_starts = nonzero(run_starts.ravel())[0]
+    run_sizes = diff(hstack([run_starts, [num_rows * n]])).astype(float)
+    run_ranks = run_starts % n + (run_sizes + 1) / 2
+    ranks[rows, order] = repeat(run_ranks, run_sizes.astype(int)).reshape(
+        num_rows, n)
+    tie_sums = bincount(run_starts // n, weights=run_sizes ** 3 - run_sizes,
+                        minlength=num_rows)
+    return ranks, tie_sums
+
+
+def _tie_correction(tie_sums, n):
+    """Returns scipy.stats.tiecorrect of rows of n values given tie sums"""
+    if n < 2:
+        return ones(len(tie_sums))
+    return 1 - tie_sums / (n ** 3 - n)
+
+
+def ANOVA_one_way_rows(groups):
+    """Performs ANOVA_one_way for each row of the groups of observations
+
+    groups: list of 2D arrays, one per group, with the observations of a
+     group for one test in each row (e.g. the values of each OTU in the
+     samples of each group). All arrays must have the same number of rows.
+
+    Returns arrays of the F statistics and p-values of each row, which are
+    nan where ANOVA_one_way would return nan (a group with less than two
+    observations, or no variance within groups).
+    """
+    groups = [asarray(g, dtype=float) for g in groups]
+    sizes = array([g.shape[1] for g in groups])
+    num_cases = sizes.sum()
+    dfn = len(groups) - 1
+    dfd = num_cases - len(groups)
+    with errstate(divide='ignore', invalid='ignore'):
+        group_means = column_stack([g.mean(axis=1) for g in groups])
+        within_groups = sum(((g - m[:, newaxis]) ** 2).sum(axis=1)
+                            for g, m in zip(groups, group_means.T)) / dfd
+        grand_mean = hstack(groups).mean(axis=1)
+        between_groups = ((group_means - grand_mean[:, newaxis]) ** 2 *
+                          sizes).sum(axis=1) / dfn
+        F = between_groups / within_groups
+    F[within_groups == 0] = nan
+    if (sizes < 2).any():
+        F[:] = nan
+    return F, 1. - fdist.cdf(F, dfn, dfd)
+
+
+def kruskal_wallis_rows(groups):
+    """Performs kruskal_wallis for each row of the groups of observations
+
+    groups: list of 2D arrays, one per group, with the observations of a
+     group for one test in each row. All arrays must have the same number of
+     rows.
+
+    Returns arrays of the H statistics and p-values of each row, which are
+    nan where all the observations of a row are identical.
+    """
+    groups = [asarray(g, dtype=float) for g in groups]
+    sizes = array([g.shape[1] for g in groups])
+    n = sizes.sum()
+    ranks, tie_sums = _rank_rows(hstack(groups))
+    bounds = hstack([[0], sizes.cumsum()])
+    with errstate(divide='ignore', invalid='ignore'):
+        ssbn = sum(ranks[:, start:end].sum(axis=1) ** 2 / size
+                   for start, end, size in zip(bounds[:-1], bounds[1:],
+                                               sizes))
+        H = 12.0 / (n * (n + 1)) * ssbn - 3 * (n + 1)
+        ties = _tie_correction(tie_sums, n)
+        H /= ties
+    H[ties == 0] = nan
+    return H, chi2.sf(H, len(groups) - 1)
+
+
+def g_fit_rows(groups, williams=True):
+    """Performs g_fit for each row of the groups of observations
+
+    groups: list of 2D arrays, one per group, with the observed frequencies
+     of a group for one test in each row. All arrays must have the same
+     number of rows.
+
+    Returns arrays of the G statistics and p-values of each row.
+    """
+    r_data = column_stack([asarray(g, dtype=float).mean(axis=1)
+                           for g in groups])
+    num_groups = r_data.shape[1]
+    total = r_data.sum(axis=1)
+    with errstate(divide='ignore', invalid='ignore'):
+        expected = total / num_groups
+        G = 2.0 * xlogy(r_data, r_data / expected[:, newaxis]).sum(axis=1)
+        if not williams:
+            return G, chi2.sf(G, num_groups - 1)
+        G = G / (1. + (num_groups + 1.) / (6. * total))
+        pvals = 1. - chi2.cdf(G, num_groups - 1)
+    pvals[~(G > 0)] = nan
+    return G, pvals
+
+
+def t_two_sample_rows(x, y, tails='two-sided', exp_diff=0):
+    """Performs t_two_sample for each row of x and y
+
+    x, y: 2D arrays with the observations of the two samples of each test in
+     their rows.
+
+    Returns arrays of the t statistics and p-values of each row.
+    """
+    x = asarray(x, dtype=float)
+    y = asarray(y, dtype=float)
+    len_x, len_y = x.shape[1], y.shape[1]
+    t = _t_two_sample_stats(x, y, exp_diff)
+    if len_x == 1 or len_y == 1:
+        df = max(len_x, len_y) - 1
+    else:
+        df = len_x + len_y - 2
+    return t, _tprob_array(t, df, tails)
+
+
+def _check_two_sample_sizes(len_x, len_y):
+    """Raises the ValueError of mc_t_two_sample for unusable sample sizes"""
+    if (len_x == 1 and len_y == 1) or (len_x < 1 or len_y < 1):
+        raise ValueError("At least one of the sequences of observations is "
+                         "empty, or the sequences each contain only a single "
+                         "observation. Cannot perform the t-test.")
+
+
+def mc_t_two_sample_rows(x, y, permutations=999, tails='two-sided',
+                         exp_diff=0, perms=None, seed=None):
+    """Performs mc_t_two_sample for each row of x and y
+
+    x, y: 2D arrays with the observations of the two samples of each test in
+     their rows.
+    permutations: number of permutations of the nonparametric test
+    perms: array of permutations of range(x.shape[1] + y.shape[1]), one per
+     row, to use instead of drawing random permutations (permutations is
+     then ignored)
+    seed: seed of the permutations (int or numpy RandomState). If None,
+     numpy's global random state is used
+
+    Unlike calling mc_t_two_sample for each row, the same permutations are
+    applied to all rows, so that the permuted t statistics of all rows can
+    be computed together with array operations, as many rows and
+    permutations at a time as fit in PERMUTATION_BLOCK_SIZE observations.
+
+    Returns arrays of the observed t statistics and nonparametric p-values
+    of each row.
+    """
+    x = asarray(x, dtype=float)
+    y = asarray(y, dtype=float)
+    len_x, len_y = x.shape[1], y.shape[1]
+    _check_two_sample_sizes(len_x, len_y)
+    obs_t, param_p = t_two_sample_rows(x, y, tails, exp_diff)
+    pvals = empty(len(obs_t))
+    pvals.fill(nan)
+    testable = ~(isnan(obs_t) | isnan(param_p))
+    if perms is not None:
+        permutations = len(perms)
+    if permutations == 0 or not testable.any():
+        return obs_t, pvals
+
+    # see _permute_observations
+    vals = hstack([x[testable], y[testable]])
+    vals.sort(axis=1)
+    obs = obs_t[testable][:, newaxis]
+    n = vals.shape[1]
+    block_size = max(1, PERMUTATION_BLOCK_SIZE // (len(vals) * n))
+    if perms is None:
+        blocks = _permutation_index_blocks(n, permutations, block_size, seed)
+    else:
+        blocks = (perms[i:i + block_size]
+                  for i in range(0, permutations, block_size))
+    better = zeros(len(vals))
+    for perm_inds in blocks:
+        perm_vals = vals[:, perm_inds]
+        perm_t = _t_two_sample_stats(perm_vals[..., :len_x],
+                                     perm_vals[..., len_x:], exp_diff)
+        with errstate(invalid='ignore'):
+            if tails == 'two-sided':
+                better += (abs(perm_t) >= abs(obs)).sum(axis=1)
+            elif tails == 'low':
+                better += (perm_t <= obs).sum(axis=1)
+            elif tails == 'high':
+                better += (perm_t >= obs).sum(axis=1)
+    pvals[testable] = (better + 1) / (permutations + 1)
+    return obs_t, pvals
+
+
+def _mw_u_rows(x, y):
+    """Returns the U statistics, tie corrections and z scores of mw_t rows"""
+    len_x, len_y = x.shape[1], y.shape[1]
+    n = len_x + len_y
+    ranks, tie_sums = _rank_rows(hstack([x, y]))
+    u1 = len_x * len_y + (len_x * (len_x + 1)) / 2.0 - \
+        ranks[:, :len_x].sum(axis=1)
+    u2 = len_x * len_y - u1
+    ties = _tie_correction(tie_sums, n)
+    with errstate(divide='ignore', invalid='ignore'):
+        sd = sqrt(ties * len_x * len_y * (n + 1) / 12.0)
+        z = abs((maximum(u1, u2) - 0.5 - len_x * len_y / 2.0) / sd)
+    u = minimum(u1, u2)
+    u[ties == 0] = nan
+    return u, z
+
+
+def mw_t_rows(x, y):
+    """Performs mw_t (two sided, with continuity correction) for each row
+
+    x, y: 2D arrays with the observations of the two samples of each test in
+     their rows.
+
+    Returns arrays of the U statistics and p-values of each row, which are
+    nan where all the observations of a row are identical (where mw_t raises
+    a ValueError).
+    """
+    x = asarray(x, dtype=float)
+    y = asarray(y, dtype=float)
+    u, z = _mw_u_rows(x, y)
+    pvals = 2. * norm.sf(z)
+    pvals[isnan(u)] = nan
+    return u, pvals
+
+
+def sample_bootstrap_indices(n, num_reps, seed=None):
+    """Returns num_reps random samples of range(n) with replacement, by row
+
+    The indices are drawn with randint like _get_bootstrap_sample draws
+    them.
+
+    seed: int or numpy RandomState the indices are drawn from instead of
+     numpy's global random state
+    """
+    randint_f = randint
+    random_state = _get_random_state(seed)
+    if random_state is not None:
+        randint_f = random_state.randint
+    return randint_f(0, n, (num_reps, n))
+
+
+def mw_boot_rows(x, y, num_reps=999, indices=None, seed=None):
+    """Performs mw_boot for each row of x and y
+
+    x, y: 2D arrays with the observations of the two samples of each test in
+     their rows.
+    num_reps: number of bootstrap samples
+    indices: array of bootstrap samples of range(x.shape[1] + y.shape[1]),
+     one per row (see sample_bootstrap_indices), to use instead of drawing
+     num_reps samples
+    seed: seed of the bootstrap samples (int or numpy RandomState). If None,
+     numpy's global random state is used
+
+    As in mc_t_two_sample_rows, the same bootstrap samples are applied to
+    all rows, and the U statistics of all rows are computed together.
+
+    Returns arrays of the observed U statistics and p-values of each row,
+    which are nan where all the observations of a row are identical.
+    """
+    x = asarray(x, dtype=float)
+    y = asarray(y, dtype=float)
+    len_x = x.shape[1]
+    combined = hstack([x, y])
+    num_rows, n = combined.shape
+    if indices is None:
+        indices = sample_bootstrap_indices(n, num_reps, seed)
+    num_reps = len(indices)
+    observed, _ = _mw_u_rows(x, y)
+    threshold = (observed - MACHEP * 100)[:, newaxis]
+    block_size = max(1, PERMUTATION_BLOCK_SIZE // max(num_rows * n, 1))
+    more_extreme = zeros(num_rows)
+    for start in range(0, num_reps, block_size):
+        sampled = combined[:, indices[start:start + block_size]]
+        block_reps = sampled.shape[1]
+        sampled = sampled.reshape(num_rows * block_reps, n)
+        u, _ = _mw_u_rows(sampled[:, :len_x], sampled[:, len_x:])
+        # the u statistic must be smaller than the observed u statistic to
+        # count as more extreme (see mw_boot); samples with identical values
+        # (nan) are not
+        with errstate(invalid='ignore'):
+            more_extreme += (u.reshape(num_rows, block_reps) <=
+                             threshold).sum(axis=1)
+    pvals = (more_extreme + 1) / (num_reps + 1)
+    pvals[isnan(observed)] = nan
+    return observed, pvals
+
+
 def permute_2d(m, p):
     """Performs 2D permutation of matrix m according to p."""
     return m[p][:, p]
@@ -2457,3 +3006,196 @@ def correlate(v1, v2, method):
     else:
         raise ValueError('Correlation function not recognized.')
     return corr_fn(v1, v2)
+
+
+def _correlation_vectors(data, method):
+    '''Transform the rows of data so correlations are their dot products.
+
+    For 'pearson' the rows are centered and scaled to unit length, for
+    'spearman' the same is done to their ranks, and for 'kendall' the rows
+    are the signs of the differences of all pairs of values (tau-b), scaled
+    to unit length. For 'cscore' the rows are presence/absence vectors, whose
+    dot products are the number of shared presences. Rows without any
+    variation are nan.
+    '''
+    data = asarray(data, dtype=float)
+    if method == 'spearman':
+        data = _rank_rows(data)[0]
+    if method in ('pearson', 'spearman'):
+        vectors = data - data.mean(axis=1)[:, newaxis]
+    elif method == 'kendall':
+        i, j = triu_indices(data.shape[1], 1)
+        vectors = sign(data[:, i] - data[:, j])
+    elif method == 'cscore':
+        return data.astype(bool).astype(float)
+    else:
+        raise ValueError('Correlation function not recognized.')
+    with errstate(divide='ignore', invalid='ignore'):
+        return vectors / sqrt((vectors ** 2).sum(axis=1))[:, newaxis]
+
+
+def _correlate_vectors(x, y, method):
+    '''Return the correlations of the rows of x with the rows of y.
+
+    x and y are rows transformed by _correlation_vectors. The result has a row
+    for each row of x and a column for each row of y.
+    '''
+    products = x.dot(y.T)
+    if method == 'cscore':
+        return (x.sum(axis=1)[:, newaxis] - products) * \
+            (y.sum(axis=1) - products)
+    # rounding can put perfect correlations slightly out of [-1, 1]
+    return minimum(maximum(products, -1.), 1.)
+
+
+def _row_blocks(num_rows, width):
+    '''Yield slices of blocks of rows of at most PERMUTATION_BLOCK_SIZE values
+    '''
+    block_size = max(1, PERMUTATION_BLOCK_SIZE // max(width, 1))
+    for start in range(0, num_rows, block_size):
+        yield slice(start, start + block_size)
+
+
+def correlate_rows(data, v, method):
+    '''Correlate each row of data with v using method.
+
+    Parameters
+    ----------
+    data : 2-D array-like
+        Rows of ints or floats to be correlated (e.g. the OTUs of a table).
+    v : array-like
+        Vector of ints or floats to correlate the rows with (e.g. sample
+        metadata).
+    method : str
+        One of 'spearman', 'pearson', 'kendall', 'cscore'.
+
+    Returns
+    -------
+    corrs : 1-D array
+        Correlation of each row with v, as correlate(row, v, method) returns
+        it (nan for rows without variation).
+
+    Notes
+    -----
+    The table is transformed once (e.g. ranked for 'spearman') and all
+    correlations are computed as a single matrix product, in blocks of rows
+    for 'kendall', whose transformed rows have a value per pair of samples.
+    '''
+    data = asarray(data, dtype=float)
+    y = _correlation_vectors(asarray(v, dtype=float)[newaxis], method)
+    corrs = empty(len(data))
+    for rows in _row_blocks(len(data), y.shape[1]):
+        x = _correlation_vectors(data[rows], method)
+        corrs[rows] = _correlate_vectors(x, y, method)[:, 0]
+    return corrs
+
+
+def bootstrapped_correlation_pvals(data, v, method, corrs, permutations,
+                                   perms=None, seed=None):
+    '''Assign bootstrapped pvals to the correlations of rows of data with v.
+
+    Parameters
+    ----------
+    data : 2-D array-like
+        Rows of ints or floats that were correlated.
+    v : array-like
+        Vector the rows were correlated with.
+    method : str
+        One of 'spearman', 'pearson', 'kendall', 'cscore'.
+    corrs : 1-D array-like
+        Correlations of the rows with v (see correlate_rows).
+    permutations : int
+        Number of permutations of v.
+    perms : 2-D array or None
+        Permutations of range(len(v)), one per row, to use instead of drawing
+        random permutations (permutations is then ignored).
+    seed : int, numpy RandomState or None
+        Seed of the permutations. If None, numpy's global random state is
+        used.
+
+    Returns
+    -------
+    pvals : 1-D array
+        Fraction of the permutations of v whose correlation with the row is
+        as or more extreme than its correlation with v, as computed by
+        assign_correlation_pval with method 'bootstrapped' (nan where the
+        correlation is nan or inf).
+
+    Notes
+    -----
+    Rather than permuting v for each row, the same permutations are used for
+    all rows, so that the permuted vectors are transformed once and all
+    permuted correlations are computed as matrix products.
+    '''
+    data = asarray(data, dtype=float)
+    v = asarray(v, dtype=float)
+    corrs = asarray(corrs, dtype=float)
+    if perms is None:
+        perms = sample_permutations(len(v), permutations, seed)
+    permutations = len(perms)
+    abs_corrs = abs(corrs)[:, newaxis]
+    more_extreme = zeros(len(data))
+    y = _correlation_vectors(v[newaxis], method)
+    perm_blocks = list(_row_blocks(permutations, y.shape[1]))
+    for rows in _row_blocks(len(data), y.shape[1]):
+        x = _correlation_vectors(data[rows], method)
+        for block in perm_blocks:
+            y = _correlation_vectors(v[perms[block]], method)
+            with errstate(invalid='ignore'):
+                more_extreme[rows] += (abs(_correlate_vectors(x, y, method)) >=
+                                       abs_corrs[rows]).sum(axis=1)
+    pvals = more_extreme / float(permutations)
+    pvals[isnan(corrs) | isinf(corrs)] = nan
+    return pvals
+
+
+def _normprob_two_sided(z):
+    '''Return normprob(z, direction='two-sided') for each value of array z.
+    '''
+    pvals = 2 * norm.cdf(z)
+    high = z >= 0
+    pvals[high] = 2 * (1. - norm.cdf(z[high]))
+    return pvals
+
+
+def assign_correlation_pvals(corrs, n, method):
+    '''Assign pvals to correlation scores with given method.
+
+    Vectorized assign_correlation_pval for the methods that don't permute the
+    correlated vectors.
+
+    Parameters
+    ----------
+    corrs : 1-D array-like
+        Correlation scores from Kendall's Tau, Spearman's Rho, or Pearson.
+    n : int
+        Length of the vectors that were correlated.
+    method : str
+        One of ['parametric_t_distribution', 'fisher_z_transform',
+        'kendall'].
+
+    Returns
+    -------
+    pvals : 1-D array
+    '''
+    corrs = asarray(corrs, dtype=float)
+    with errstate(divide='ignore', invalid='ignore'):
+        if method == 'parametric_t_distribution':
+            df = n - 2
+            if df <= 1:
+                raise ValueError("Must have more than 1 degree of freedom. "
+                                 "Can't Continue.")
+            ts = corrs * ((df / (1. - corrs ** 2)) ** .5)
+            return _tprob_array(ts, df, tails='two-sided')
+        elif method == 'fisher_z_transform':
+            if n <= 3:
+                # see z_transform_pval
+                return corrs * nan
+            z = .5 * log((1. + corrs) / (1. - corrs))
+            z[abs(corrs) >= 1] = nan
+            return _normprob_two_sided(z * ((n - 3) ** .5))
+        elif method == 'kendall':
+            return _normprob_two_sided(
+                corrs / ((2 * (2 * n + 5)) / float(9 * n * (n - 1))) ** .5)
+        else:
+            raise ValueError("'%s' method is unknown." % method)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""Array representation of phylogenetic trees.
+
+A tree is indexed once into flat NumPy arrays (see TreeIndex), which the
+phylogenetic alpha and beta diversity metrics use to process all samples of
+a table together rather than walking the tree objects for each sample.
+"""
+
+from __future__ import division
+
+__author__ = "The QIIME Development Team"
+__copyright__ = "Copyright 2011, The QIIME Project"
+__credits__ = ["The QIIME Development Team"]
+__license__ = "GPL"
+__version__ = "1.9.1-dev"
+__maintainer__ = "The QIIME Development Team"
+__email__ = "qiime.help@gmail.com"
+
+from numpy import (array, zeros, empty, arange, argsort, bincount, cumsum,
+                   split, log2, int32, float64)
+
+
+class TreeIndex(object):
+
+    """Array representation of a tree, for computing phylogenetic diversity
+
+    The nodes of the tree are numbered in postorder, and the tree is
+    represented by the Parent (-1 for the root) and Length (branch length,
+    0 if missing, and 0 for the root) arrays, and TipIndex, which maps tip
+    names to node numbers. The length of the root's own branch, if any, is
+    RootLength. The index is built once per tree, and can be
+    reused for any number of tables (e.g., all rarefied tables of a study).
+
+    To compute the length of the union of the paths from a set of tips to
+    the root, the index also holds each node's distance from the root, and
+    an Euler tour of the tree with a sparse table of range minimum queries
+    over it, which gives the lowest common ancestor of any two nodes in
+    constant time.
+
+    Values can be summed from the tips to the root one level at a time:
+    Levels[h] holds the nodes whose Height (number of branches from the
+    node to its furthest tip) is h, so all children of the nodes in a level
+    are in lower levels.
+    """
+
+    def __init__(self, tree):
+        nodes = list(tree.postorder(include_self=True))
+        num_nodes = len(nodes)
+        node_index = dict((id(node), i) for i, node in enumerate(nodes))
+        self.Parent = empty(num_nodes, dtype=int32)
+        self.Length = zeros(num_nodes, dtype=float64)
+        self.TipIndex = {}
+        children = [[] for node in nodes]
+        for i, node in enumerate(nodes):
+            if node.Parent is None:
+                self.Parent[i] = -1
+                self.RootLength = float(node.Length or 0)
+            else:
+                self.Parent[i] = node_index[id(node.Parent)]
+                children[self.Parent[i]].append(i)
+                if node.Length is not None:
+                    self.Length[i] = node.Length
+            if not node.Children:
+                self.TipIndex[node.Name] = i
+
+        # nodes are in postorder, so parents are visited before their
+        # children in reverse, and after them otherwise
+        self.Distance = zeros(num_nodes, dtype=float64)
+        for i in range(num_nodes - 2, -1, -1):
+            self.Distance[i] = self.Distance[self.Parent[i]] + self.Length[i]
+        self.Height = zeros(num_nodes, dtype=int32)
+        for i in range(num_nodes - 1):
+            parent = self.Parent[i]
+            if self.Height[i] >= self.Height[parent]:
+                self.Height[parent] = self.Height[i] + 1
+        order = argsort(self.Height, kind='mergesort')
+        level_sizes = bincount(self.Height)
+        self.Levels = split(order, cumsum(level_sizes)[:-1])
+
+        # Euler tour of the tree from the root (the last node), recording
+        # the number of edges between each visited node and the root
+        euler = []
+        levels = []
+        self.First = empty(num_nodes, dtype=int32)
+        stack = [(num_nodes - 1, 0, 0)]
+        while stack:
+            node, level, child = stack.pop()
+            if child == 0:
+                self.First[node] = len(euler)
+            euler.append(node)
+            levels.append(level)
+            if child < len(children[node]):
+                stack.append((node, level, child + 1))
+                stack.append((children[node][child], level + 1, 0))
+        self.Euler = array(euler, dtype=int32)
+        levels = array(levels, dtype=int32)
+
+        # Sparse[k][i] is the position in the Euler tour of the node with the
+        # lowest level among positions i to i + 2 ** k - 1
+        sparse = [arange(len(euler), dtype=int32)]
+        width = 1
+        while 2 * width <= len(euler):
+            prev = sparse[-1]
+            left = prev[:len(prev) - width]
+            right = prev[width:]
+            take_right = levels[right] < levels[left]
+            current = left.copy()
+            current[take_right] = right[take_right]
+            sparse.append(current)
+            width *= 2
+        self._sparse = sparse
+        self._levels = levels
+
+    def lowest_common_ancestors(self, a, b):
+        """Returns the lowest common ancestor of each pair of nodes in a, b
+        """
+        lo = self.First[a]
+        hi = self.First[b]
+        swap = lo > hi
+        lo[swap], hi[swap] = hi[swap], lo[swap]
+        k = log2(hi - lo + 1).astype(int32)
+        result = empty(len(lo), dtype=int32)
+        for j in set(k.tolist()):
+            # group queries by the size of the blocks they use
+            mask = k == j
+            left = self._sparse[j][lo[mask]]
+            right = self._sparse[j][hi[mask] - 2 ** j + 1]
+            take_right = self._levels[right] < self._levels[left]
+            left[take_right] = right[take_right]
+            result[mask] = self.Euler[left]
+        return result
+
+    def tip_indices(self, names):
+        """Returns the node number of each tip name, or -1 if not a tip"""
+        return array([self.TipIndex.get(name, -1) for name in names],
+                     dtype=int32)
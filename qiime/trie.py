@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""Array-backed replacement for skbio's CompressedTrie prefix map.
+
+Rather than building a Python object per trie node, sequences are packed
+into fixed-width rows of uint64 words (2 bits per base for ACGT-only input,
+falling back to 8 bits per character otherwise) and sorted once. In sorted
+order every sequence is immediately followed by the sequences it is a prefix
+of, so the structure of the compressed trie can be recovered by scanning the
+longest common prefixes of adjacent entries.
+"""
+
+from __future__ import division
+
+__author__ = "The QIIME Development Team"
+__copyright__ = "Copyright 2011, The QIIME Project"
+__credits__ = ["Jens Reeder", "The QIIME Development Team"]
+__license__ = "GPL"
+__version__ = "1.9.1-dev"
+__maintainer__ = "The QIIME Development Team"
+__email__ = "qiime.help@gmail.com"
+
+from numpy import (array, arange, concatenate, empty, floor, full, int64,
+                   lexsort, log2, maximum, minimum, uint8, uint64, where,
+                   zeros)
+
+_NUCLEOTIDES = 'ACGT'
+# maps characters onto 2-bit codes; 255 flags characters that can't be
+# packed into 2 bits. The null character pads sequences shorter than the
+# longest sequence in a chunk.
+_NUCLEOTIDE_CODES = full(256, 255, dtype=uint8)
+for _i, _c in enumerate(_NUCLEOTIDES):
+    _NUCLEOTIDE_CODES[ord(_c)] = _i
+_NUCLEOTIDE_CODES[0] = 0
+_NUCLEOTIDE_BYTES = array([ord(c) for c in _NUCLEOTIDES], dtype=uint8)
+
+
+def _pack_codes(codes, bits):
+    """Pack an n x L matrix of symbol codes into n x W uint64 words
+
+    Symbols are packed most significant first so that comparing rows of
+    words compares sequences lexicographically.
+    """
+    symbols_per_word = 64 // bits
+    n, length = codes.shape
+    num_words = max(-(-length // symbols_per_word), 1)
+    padded = zeros((n, num_words * symbols_per_word), dtype=uint8)
+    padded[:, :length] = codes
+    words = zeros((n, num_words), dtype=uint64)
+    for j in range(symbols_per_word):
+        shift = uint64((symbols_per_word - 1 - j) * bits)
+        words |= padded[:, j::symbols_per_word].astype(uint64) << shift
+    return words
+
+
+def _unpack_codes(words, bits):
+    """Unpack an n x W matrix of uint64 words into symbol codes"""
+    symbols_per_word = 64 // bits
+    mask = uint64((1 << bits) - 1)
+    n, num_words = words.shape
+    codes = empty((n, num_words * symbols_per_word), dtype=uint8)
+    for j in range(symbols_per_word):
+        shift = uint64((symbols_per_word - 1 - j) * bits)
+        codes[:, j::symbols_per_word] = (words >> shift) & mask
+    return codes
+
+
+def _msb(x):
+    """Return the index of the most significant set bit of each uint64
+
+    Values are split into 32-bit halves so the float conversion required by
+    log2 is exact.
+    """
+    hi = (x >> uint64(32)).astype(float)
+    lo = (x & uint64(0xFFFFFFFF)).astype(float)
+    return where(hi > 0,
+                 32 + floor(log2(maximum(hi, 1))),
+                 floor(log2(maximum(lo, 1)))).astype(int64)
+
+
+class ArrayCompressedTrie(object):
+
+    """Prefix map of a sequence collection backed by packed NumPy arrays
+
+    The prefix_map property is equivalent to that of
+    skbio.tree.CompressedTrie: each sequence that is not a prefix of any
+    other sequence represents a group, and every sequence that is a prefix
+    of others (or a duplicate of a representative) is assigned to the
+    largest group below it. Ties between equally sized groups are broken in
+    favor of the lexicographically smallest representative.
+    """
+
+    def __init__(self, seqs, chunk_size=10000):
+        """Return new ArrayCompressedTrie built from a single pass over seqs
+
+        seqs: iterable of (label, seq) tuples
+        chunk_size: number of sequences packed at a time
+        """
+        self.Labels = []
+        self._bits = 2
+        packed_chunks = []
+        chunk = []
+        for label, seq in seqs:
+            self.Labels.append(label)
+            chunk.append(seq)
+            if len(chunk) == chunk_size:
+                packed_chunks.append(self._pack_chunk(chunk, packed_chunks))
+                chunk = []
+        if chunk:
+            packed_chunks.append(self._pack_chunk(chunk, packed_chunks))
+
+        if packed_chunks:
+            num_words = max([w.shape[1] for w, _ in packed_chunks])
+            self._words = zeros((len(self.Labels), num_words), dtype=uint64)
+            start = 0
+            for words, _ in packed_chunks:
+                self._words[start:start + len(words), :words.shape[1]] = words
+                start += len(words)
+            self._lengths = concatenate([l for _, l in packed_chunks])
+        else:
+            self._words = zeros((0, 1), dtype=uint64)
+            self._lengths = zeros(0, dtype=int64)
+        self._groups = None
+
+    def __len__(self):
+        return len(self.Labels)
+
+    def _pack_chunk(self, seqs, packed_chunks):
+        """Pack a list of sequences, switching to 8-bit symbols if needed"""
+        lengths = array([len(s) for s in seqs], dtype=int64)
+        max_length = max(lengths.max(), 1)
+        raw = array(seqs, dtype='S%d' % max_length).view(uint8)
+        raw = raw.reshape(len(seqs), max_length)
+        if self._bits == 2:
+            codes = _NUCLEOTIDE_CODES[raw]
+            if (codes == 255).any():
+                self._convert_to_bytes(packed_chunks)
+                codes = raw
+        else:
+            codes = raw
+        return _pack_codes(codes, self._bits), lengths
+
+    def _convert_to_bytes(self, packed_chunks):
+        """Re-pack previously packed 2-bit chunks with 8 bits per symbol"""
+        for i, (words, lengths) in enumerate(packed_chunks):
+            raw = _NUCLEOTIDE_BYTES[_unpack_codes(words, 2)]
+            raw[arange(raw.shape[1]) >= lengths[:, None]] = 0
+            packed_chunks[i] = (_pack_codes(raw, 8), lengths)
+        self._bits = 8
+
+    def _adjacent_lcps(self, order, block_size=100000):
+        """Return lengths of common prefixes of adjacent sorted sequences"""
+        words = self._words
+        lengths = self._lengths
+        symbols_per_word = 64 // self._bits
+        max_lcp = words.shape[1] * symbols_per_word
+        n = len(order)
+        lcps = empty(max(n - 1, 0), dtype=int64)
+        for start in range(0, n - 1, block_size):
+            idx = order[start:start + block_size + 1]
+            diff = words[idx[:-1]] ^ words[idx[1:]]
+            differs = diff != 0
+            first = differs.argmax(axis=1)
+            first_diff = diff[arange(len(first)), first]
+            lcp = (first * symbols_per_word +
+                   (63 - _msb(first_diff)) // self._bits)
+            lcp[~differs.any(axis=1)] = max_lcp
+            lcps[start:start + len(lcp)] = minimum(
+                lcp, minimum(lengths[idx[:-1]], lengths[idx[1:]]))
+        return lcps
+
+    def _get_groups(self):
+        """Return list of [rep_index, member_indices] prefix groups"""
+        if self._groups is not None:
+            return self._groups
+
+        # lexsort treats the last key as the primary key, and is stable so
+        # identical sequences stay in input order
+        keys = [self._lengths] + [self._words[:, j] for j in
+                                  range(self._words.shape[1] - 1, -1, -1)]
+        order = lexsort(keys)
+        lcps = self._adjacent_lcps(order).tolist()
+        lengths = self._lengths[order].tolist()
+        order = order.tolist()
+        n = len(order)
+
+        groups = []
+        # stack of [length, indices, largest group] for sequences which
+        # are prefixes of the sequence currently being scanned
+        stack = []
+        i = 0
+        while i < n:
+            if i > 0:
+                while stack and stack[-1][0] > lcps[i - 1]:
+                    self._pop_prefix(stack)
+            # find the run of sequences identical to the current one
+            j = i
+            while j < n - 1 and lcps[j] == lengths[j] == lengths[j + 1]:
+                j += 1
+            indices = order[i:j + 1]
+            if j < n - 1 and lcps[j] >= lengths[j]:
+                # a prefix of the next sequence, so an internal node
+                stack.append([lengths[j], indices, None])
+            else:
+                group = [indices[0], indices[1:]]
+                groups.append(group)
+                self._update_largest_group(stack, group)
+            i = j + 1
+        while stack:
+            self._pop_prefix(stack)
+
+        self._groups = groups
+        return groups
+
+    def _pop_prefix(self, stack):
+        _, indices, group = stack.pop()
+        group[1].extend(indices)
+        self._update_largest_group(stack, group)
+
+    def _update_largest_group(self, stack, group):
+        if stack:
+            largest = stack[-1][2]
+            if largest is None or len(group[1]) > len(largest[1]):
+                stack[-1][2] = group
+
+    @property
+    def prefix_map(self):
+        """Dict of {rep label: [labels of seqs assigned to rep]}"""
+        labels = self.Labels
+        return dict((labels[rep], [labels[m] for m in members])
+                    for rep, members in self._get_groups())
+
+    def get_seq(self, index):
+        """Return the sequence at index (in input order)"""
+        codes = _unpack_codes(self._words[index:index + 1], self._bits)
+        codes = codes[0, :self._lengths[index]]
+        if self._bits == 2:
+            codes = _NUCLEOTIDE_BYTES[codes]
+        return codes.tostring()
+
+    def representative_seqs(self):
+        """Yield (label, seq) for each group representative in input order
+        """
+        for rep in sorted([rep for rep, _ in self._get_groups()]):
+            yield self.Labels[rep], self.get_seq(rep)
@@ -52,7 +52,6 @@ from burrito.util import ApplicationError, CommandLineApplication, FilePath
 from burrito.util import which
 from skbio.sequence import DNASequence
 from skbio.parse.sequences import parse_fasta
-from skbio.parse.sequences import FastaIterator, FastqIterator
 
 from bfillings.blast import Blastall, BlastResult
 from bfillings.formatdb import (build_blast_db_from_fasta_path,
@@ -72,8 +71,8 @@ from qiime.parse import (parse_qiime_config_files,
                          PhyloNode,
                          parse_mapping_file,
                          parse_denoiser_mapping,
-                         parse_fastq,
                          mapping_file_to_dict)
+from qiime.sequence_reader import read_fasta_records, read_fastq_records
 
 # for backward compatibility - compute_seqs_per_library_stats has
 # been removed in favor of biom.util.compute_counts_per_sample_stats,
@@ -613,24 +612,21 @@ def split_sequence_file_on_sample_ids_to_files(seqs,
     # Set these up here to reduce the number of checks that have to be
     # performed in the loop
     if file_type == 'fasta':
-        iter_ = FastaIterator([seqs])
+        iter_ = read_fasta_records(seqs)
         sequence_writer = write_seqs_to_fasta
         data_getter = lambda x: (x[0], x[1])
     elif file_type == 'fastq':
-        iter_ = FastqIterator([seqs])
+        iter_ = read_fastq_records(seqs)
         sequence_writer = write_seqs_to_fastq
-        data_getter = lambda x: x
+        data_getter = lambda x: (x[0], x[1], x[0], x[2])
     else:
         raise ValueError("file_type must be either fasta or fastq")
 
     old_file_position = seqs.tell()
     seqs.seek(0)
     for record in iter_:
-        seq_id = record['SequenceID']
-        seq = record['Sequence']
+        seq_id = record[0]
         sample_id = seq_id.split()[0].rsplit('_', 1)[0]
-        qual_id = record['QualID']
-        qual = record['Qual']
         # grab or create the list corresponding to the current sample id
         try:
             current_seqs = file_lookup[sample_id][1]
@@ -645,7 +641,7 @@ def split_sequence_file_on_sample_ids_to_files(seqs,
             file_lookup[sample_id] = [current_fp, current_seqs]
 
         # append the current sequence to the current seqs list
-        current_seqs.append(data_getter((seq_id, seq, qual_id, qual)))
+        current_seqs.append(data_getter(record))
 
         # compare current_seqs length to the buffer size, and write
         # if it has hit the buffer size
@@ -783,6 +779,13 @@ def get_options_lookup():
                     help='Number of seconds to sleep between checks for run ' +
                     ' completion when polling runs [default: %default]',
                     default=qiime_config['seconds_to_sleep'] or 60)
+    result['chunk_run_times_fp'] =\
+        make_option('--chunk_run_times_fp', type='new_filepath',
+                    help='path to a file where the run time of each chunk ' +
+                    'of the input is recorded when jobs are run with the ' +
+                    'multiprocessing parallel_backend. Chunk run times ' +
+                    'already recorded in this file are used to balance the ' +
+                    'work across jobs [default: %default]')
 
     return result
 
@@ -1368,7 +1371,7 @@ def count_seqs_in_filepaths(fasta_filepaths, seq_counter=count_seqs):
         # if the file is actually fastq, use the fastq parser.
         # otherwise use the fasta parser
         if fasta_filepath.endswith('.fastq') or fasta_filepath.endswith('.fq'):
-            parser = partial(parse_fastq, enforce_qual_range=False)
+            parser = partial(read_fastq_records, enforce_qual_range=False)
         elif fasta_filepath.endswith('.tre') or \
                 fasta_filepath.endswith('.ph') or \
                 fasta_filepath.endswith('.ntree'):
@@ -1378,7 +1381,7 @@ def count_seqs_in_filepaths(fasta_filepaths, seq_counter=count_seqs):
                 t = DndParser(f, constructor=PhyloNode)
                 return zip(t.iterTips(), repeat(''))
         else:
-            parser = parse_fasta
+            parser = read_fasta_records
 
         try:
             # get the count of sequences in the current file
@@ -14,11 +14,15 @@ __email__ = "gregcaporaso@gmail.com"
 
 from os.path import split, splitext, join
 from shutil import rmtree
+from functools import partial
 
 from biom import load_table
 from biom.util import compute_counts_per_sample_stats
+from skbio.stats import subsample
 
 from qiime.parse import parse_mapping_file
+from qiime.alpha_diversity import (collated_rarefied_alpha,
+                                   write_collated_alpha)
 from qiime.util import create_dir, get_interesting_mapping_fields
 from qiime.workflow.util import (print_to_stdout,
                                  generate_log_fp,
@@ -200,7 +204,8 @@ def run_alpha_rarefaction(otu_table_fp,
                           suppress_md5=False,
                           status_update_callback=print_to_stdout,
                           plot_stderr_and_stddev=False,
-                          retain_intermediate_files=True):
+                          retain_intermediate_files=True,
+                          in_process=False):
     """ Run the data preparation steps of Qiime
 
         The steps performed by this function are:
@@ -209,6 +214,12 @@ def run_alpha_rarefaction(otu_table_fp,
           3) Collate alpha diversity results;
           4) Generate alpha rarefaction plots.
 
+        If in_process is True, steps 1-3 are performed in this process by
+         qiime.alpha_diversity.collated_rarefied_alpha rather than by
+         calling scripts, so the rarefied OTU tables and their alpha
+         diversity are only written if retain_intermediate_files is True.
+         These steps are performed even if command_handler only prints
+         commands.
     """
     # Prepare some variables for the later steps
     otu_table_dir, otu_table_filename = split(otu_table_fp)
@@ -234,68 +245,80 @@ def run_alpha_rarefaction(otu_table_fp,
     step = int((max_rare_depth - min_rare_depth) / num_steps) or 1
     max_rare_depth = int(max_rare_depth)
 
-    rarefaction_dir = '%s/rarefaction/' % output_dir
-    create_dir(rarefaction_dir)
-    try:
-        params_str = get_params_str(params['multiple_rarefactions'])
-    except KeyError:
-        params_str = ''
-    if parallel:
-        params_str += ' %s' % get_params_str(params['parallel'])
-        # Build the rarefaction command
-        rarefaction_cmd = \
-            'parallel_multiple_rarefactions.py -T -i %s -m %s -x %s -s %s -o %s %s' %\
-            (otu_table_fp, min_rare_depth, max_rare_depth, step,
-             rarefaction_dir, params_str)
-    else:
-        # Build the rarefaction command
-        rarefaction_cmd = \
-            'multiple_rarefactions.py -i %s -m %s -x %s -s %s -o %s %s' %\
-            (otu_table_fp, min_rare_depth, max_rare_depth, step,
-             rarefaction_dir, params_str)
-    commands.append([('Alpha rarefaction', rarefaction_cmd)])
-
-    # Prep the alpha diversity command
-    alpha_diversity_dir = '%s/alpha_div/' % output_dir
-    create_dir(alpha_diversity_dir)
-    try:
-        params_str = get_params_str(params['alpha_diversity'])
-    except KeyError:
-        params_str = ''
-    if tree_fp:
-        params_str += ' -t %s' % tree_fp
-    if parallel:
-        params_str += ' %s' % get_params_str(params['parallel'])
-        # Build the alpha diversity command
-        alpha_diversity_cmd = \
-            "parallel_alpha_diversity.py -T -i %s -o %s %s" %\
-            (rarefaction_dir, alpha_diversity_dir, params_str)
+    if in_process:
+        _run_collated_rarefied_alpha(otu_table_fp,
+                                     output_dir,
+                                     params,
+                                     tree_fp,
+                                     range(min_rare_depth,
+                                           max_rare_depth + 1, step),
+                                     parallel,
+                                     logger,
+                                     retain_intermediate_files)
+        alpha_collated_dir = '%s/alpha_div_collated/' % output_dir
     else:
-        # Build the alpha diversity command
-        alpha_diversity_cmd = \
-            "alpha_diversity.py -i %s -o %s %s" %\
-            (rarefaction_dir, alpha_diversity_dir, params_str)
+        rarefaction_dir = '%s/rarefaction/' % output_dir
+        create_dir(rarefaction_dir)
+        try:
+            params_str = get_params_str(params['multiple_rarefactions'])
+        except KeyError:
+            params_str = ''
+        if parallel:
+            params_str += ' %s' % get_params_str(params['parallel'])
+            # Build the rarefaction command
+            rarefaction_cmd = \
+                'parallel_multiple_rarefactions.py -T -i %s -m %s -x %s -s %s -o %s %s' %\
+                (otu_table_fp, min_rare_depth, max_rare_depth, step,
+                 rarefaction_dir, params_str)
+        else:
+            # Build the rarefaction command
+            rarefaction_cmd = \
+                'multiple_rarefactions.py -i %s -m %s -x %s -s %s -o %s %s' %\
+                (otu_table_fp, min_rare_depth, max_rare_depth, step,
+                 rarefaction_dir, params_str)
+        commands.append([('Alpha rarefaction', rarefaction_cmd)])
+
+        # Prep the alpha diversity command
+        alpha_diversity_dir = '%s/alpha_div/' % output_dir
+        create_dir(alpha_diversity_dir)
+        try:
+            params_str = get_params_str(params['alpha_diversity'])
+        except KeyError:
+            params_str = ''
+        if tree_fp:
+            params_str += ' -t %s' % tree_fp
+        if parallel:
+            params_str += ' %s' % get_params_str(params['parallel'])
+            # Build the alpha diversity command
+            alpha_diversity_cmd = \
+                "parallel_alpha_diversity.py -T -i %s -o %s %s" %\
+                (rarefaction_dir, alpha_diversity_dir, params_str)
+        else:
+            # Build the alpha diversity command
+            alpha_diversity_cmd = \
+                "alpha_diversity.py -i %s -o %s %s" %\
+                (rarefaction_dir, alpha_diversity_dir, params_str)
 
-    commands.append(
-        [('Alpha diversity on rarefied OTU tables', alpha_diversity_cmd)])
+        commands.append(
+            [('Alpha diversity on rarefied OTU tables', alpha_diversity_cmd)])
 
-    # Prep the alpha diversity collation command
-    alpha_collated_dir = '%s/alpha_div_collated/' % output_dir
-    create_dir(alpha_collated_dir)
-    try:
-        params_str = get_params_str(params['collate_alpha'])
-    except KeyError:
-        params_str = ''
-    # Build the alpha diversity collation command
-    alpha_collated_cmd = 'collate_alpha.py -i %s -o %s %s' %\
-        (alpha_diversity_dir, alpha_collated_dir, params_str)
-    commands.append([('Collate alpha', alpha_collated_cmd)])
-
-    if not retain_intermediate_files:
-        commands.append([('Removing intermediate files',
-                          'rm -r %s %s' % (rarefaction_dir, alpha_diversity_dir))])
-    else:
-        commands.append([('Skipping removal of intermediate files.', '')])
+        # Prep the alpha diversity collation command
+        alpha_collated_dir = '%s/alpha_div_collated/' % output_dir
+        create_dir(alpha_collated_dir)
+        try:
+            params_str = get_params_str(params['collate_alpha'])
+        except KeyError:
+            params_str = ''
+        # Build the alpha diversity collation command
+        alpha_collated_cmd = 'collate_alpha.py -i %s -o %s %s' %\
+            (alpha_diversity_dir, alpha_collated_dir, params_str)
+        commands.append([('Collate alpha', alpha_collated_cmd)])
+
+        if not retain_intermediate_files:
+            commands.append([('Removing intermediate files',
+                              'rm -r %s %s' % (rarefaction_dir, alpha_diversity_dir))])
+        else:
+            commands.append([('Skipping removal of intermediate files.', '')])
 
     # Prep the make rarefaction plot command(s)
     try:
@@ -345,6 +368,67 @@ def run_alpha_rarefaction(otu_table_fp,
 run_qiime_alpha_rarefaction = run_alpha_rarefaction
 
 
+def _run_collated_rarefied_alpha(otu_table_fp,
+                                 output_dir,
+                                 params,
+                                 tree_fp,
+                                 depths,
+                                 parallel,
+                                 logger,
+                                 retain_intermediate_files):
+    """ Rarefy, compute alpha diversity and collate it in this process
+
+        Options for multiple_rarefactions.py and alpha_diversity.py are
+         taken from params, and the collated alpha diversity is written to
+         output_dir/alpha_div_collated/ as collate_alpha.py writes it.
+    """
+    rarefaction_params = params['multiple_rarefactions']
+    num_reps = int(rarefaction_params.get('num_reps', 10))
+    if 'subsample_multinomial' in rarefaction_params:
+        subsample_f = partial(subsample, replace=True)
+    else:
+        subsample_f = None
+    metrics = params['alpha_diversity'].get('metrics',
+                                            'PD_whole_tree,chao1,observed_otus')
+    if parallel:
+        jobs_to_start = int(params['parallel']['jobs_to_start'])
+    else:
+        jobs_to_start = 1
+
+    if retain_intermediate_files:
+        rarefaction_dir = '%s/rarefaction/' % output_dir
+        create_dir(rarefaction_dir)
+        alpha_diversity_dir = '%s/alpha_div/' % output_dir
+        create_dir(alpha_diversity_dir)
+    else:
+        rarefaction_dir = alpha_diversity_dir = None
+    alpha_collated_dir = '%s/alpha_div_collated/' % output_dir
+    create_dir(alpha_collated_dir)
+
+    collated_alpha = collated_rarefied_alpha(
+        load_table(otu_table_fp),
+        depths,
+        num_reps,
+        metrics,
+        tree=tree_fp,
+        empty_otus_removed=('keep_empty_otus' not in rarefaction_params),
+        subsample_f=subsample_f,
+        jobs_to_start=jobs_to_start,
+        rarefaction_dir=rarefaction_dir,
+        alpha_diversity_dir=alpha_diversity_dir)
+    write_collated_alpha(collated_alpha, alpha_collated_dir)
+
+    logger.write('# Rarefy OTU table, compute alpha diversity and collate '
+                 'it using API \n' +
+                 'python -c "import qiime; from biom import load_table; '
+                 'qiime.alpha_diversity.write_collated_alpha('
+                 'qiime.alpha_diversity.collated_rarefied_alpha('
+                 'load_table(\'%s\'), %r, %d, \'%s\', tree=%r, '
+                 'jobs_to_start=%d), \'%s\')"\n\n' %
+                 (otu_table_fp, list(depths), num_reps, metrics, tree_fp,
+                  jobs_to_start, alpha_collated_dir))
+
+
 def run_jackknifed_beta_diversity(otu_table_fp,
                                   tree_fp,
                                   seqs_per_sample,
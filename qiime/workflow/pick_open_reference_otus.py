@@ -27,12 +27,18 @@ from qiime.workflow.util import (print_to_stdout,
                                  generate_log_fp,
                                  log_input_md5s,
                                  get_params_str,
-                                 WorkflowError)
+                                 WorkflowError,
+                                 StepCache)
 from qiime.util import write_biom_table
 from qiime.workflow.core_diversity_analyses import (format_index_link,
                                                     generate_index_page,
                                                     _index_headers)
 
+# name of the file in each output directory which records the workflow steps
+# that have been completed (see qiime.workflow.util.StepCache)
+STEP_CACHE_FN = 'step_cache.txt'
+
+
 def final_repset_from_iteration_repsets(repset_fasta_fs):
     """
         The first observation of each otu is chosen as the representative -
@@ -58,6 +64,37 @@ def final_repset_from_iteration_repsets_fps(repset_fasta_fps, final_repset_fp):
         final_repset_f.write('>%s\n%s\n' % record)
     final_repset_f.close()
 
+def first_observed_repsets_from_iteration_repsets_fps(repset_fasta_fps,
+                                                     output_fps):
+    """ Split the final rep set by the iteration each OTU was first seen in
+
+        The representative sequences in each of repset_fasta_fps which are
+         chosen for the final rep set (see
+         final_repset_from_iteration_repsets) are written to the
+         corresponding filepath in output_fps.
+    """
+    observed = {}
+    for repset_fasta_fp, output_fp in zip(repset_fasta_fps, output_fps):
+        output_f = open(output_fp, 'w')
+        for otu_id, seq in parse_fasta(open(repset_fasta_fp, 'U')):
+            o = otu_id.split()[0]
+            if not o in observed:
+                output_f.write('>%s\n%s\n' % (otu_id, seq))
+                observed[o] = None
+        output_f.close()
+
+
+def concatenate_files(input_fps, output_fp):
+    """ Write the contents of input_fps to output_fp, one after another """
+    create_dir(split(output_fp)[0])
+    output_f = open(output_fp, 'w')
+    for input_fp in input_fps:
+        data = open(input_fp, 'U').read()
+        output_f.write(data)
+        if data and not data.endswith('\n'):
+            output_f.write('\n')
+    output_f.close()
+
 #####################
 # Start functions to port to new Qiime/qiime/workflow/util.py
 #####################
@@ -165,7 +202,8 @@ def assign_tax(repset_fasta_fp,
                qiime_config,
                parallel=False,
                logger=None,
-               status_update_callback=print_to_stdout):
+               status_update_callback=print_to_stdout,
+               step_cache=None):
 
     input_dir, input_filename = split(repset_fasta_fp)
     input_basename, input_ext = splitext(input_filename)
@@ -221,47 +259,54 @@ def assign_tax(repset_fasta_fp,
         # Build the taxonomy assignment command
         assign_taxonomy_cmd = 'assign_taxonomy.py -o %s -i %s %s' %\
             (assign_taxonomy_dir, repset_fasta_fp, params_str)
-    if exists(assign_taxonomy_dir):
-        rmtree(assign_taxonomy_dir)
     commands.append([('Assign taxonomy', assign_taxonomy_cmd)])
 
+    if step_cache is None:
+        step_cache = StepCache(None)
+    step_id = 'Assign taxonomy: %s' % taxonomy_fp
+    key = step_cache.get_key(
+        step_id, commands,
+        step_cache.get_command_input_fps(commands, [taxonomy_fp]))
+    if step_cache.is_complete(step_id, key):
+        logger.write('# Taxonomy assignments are up to date (%s).\n\n'
+                     % taxonomy_fp)
+        if close_logger_on_success:
+            logger.close()
+        return taxonomy_fp
+
+    if exists(assign_taxonomy_dir):
+        rmtree(assign_taxonomy_dir)
     # Call the command handler on the list of commands
     command_handler(commands,
                     status_update_callback,
                     logger=logger,
                     close_logger_on_success=close_logger_on_success)
+    step_cache.record(step_id, key, [taxonomy_fp])
     return taxonomy_fp
 
 
-def align_and_tree(repset_fasta_fp,
-                   output_dir,
-                   command_handler,
-                   params,
-                   qiime_config,
-                   parallel=False,
-                   logger=None,
-                   status_update_callback=print_to_stdout):
-
+def align_repset(repset_fasta_fp,
+                 output_dir,
+                 command_handler,
+                 params,
+                 logger,
+                 parallel=False,
+                 status_update_callback=print_to_stdout,
+                 step_cache=None):
+    """ Align repset_fasta_fp with PyNAST, returning the alignment and
+         failures filepaths
+    """
     input_dir, input_filename = split(repset_fasta_fp)
     input_basename, input_ext = splitext(input_filename)
     commands = []
-    if logger is None:
-        log_fp = generate_log_fp(output_dir)
-        logger = WorkflowLogger(log_fp,
-                                params=params,
-                                qiime_config=qiime_config)
-        close_logger_on_success = True
-    else:
-        close_logger_on_success = False
-
+    if step_cache is None:
+        step_cache = StepCache(None)
 
     # Prep the pynast alignment command
     alignment_method = 'pynast'
     pynast_dir = '%s/%s_aligned_seqs' % (output_dir, alignment_method)
     aln_fp = '%s/%s_aligned.fasta' % (pynast_dir, input_basename)
     failures_fp = '%s/%s_failures.fasta' % (pynast_dir, input_basename)
-    if exists(pynast_dir):
-        rmtree(pynast_dir)
 
     if parallel:
         # Grab the parallel-specific parameters
@@ -295,17 +340,55 @@ def align_and_tree(repset_fasta_fp,
             (repset_fasta_fp, pynast_dir, params_str)
     commands.append([('Align sequences', align_seqs_cmd)])
 
+    step_id = 'Align sequences: %s' % aln_fp
+    key = step_cache.get_key(
+        step_id, commands,
+        step_cache.get_command_input_fps(commands, [aln_fp, failures_fp]))
+    if step_cache.is_complete(step_id, key):
+        logger.write('# Alignment is up to date (%s).\n\n' % aln_fp)
+        return aln_fp, failures_fp
+
+    if exists(pynast_dir):
+        rmtree(pynast_dir)
+    command_handler(commands,
+                    status_update_callback,
+                    logger=logger,
+                    close_logger_on_success=False)
+    step_cache.record(step_id, key, [aln_fp, failures_fp])
+    return aln_fp, failures_fp
+
+
+def filter_alignment_and_tree(aln_fp,
+                              output_dir,
+                              command_handler,
+                              params,
+                              logger,
+                              status_update_callback=print_to_stdout,
+                              close_logger_on_success=False,
+                              step_cache=None):
+    """ Filter aln_fp and build a tree from it, returning the tree filepath
+    """
+    aln_dir, aln_filename = split(aln_fp)
+    aln_basename, aln_ext = splitext(aln_filename)
+    if step_cache is None:
+        step_cache = StepCache(None)
+
     # Prep the alignment filtering command
-    filtered_aln_fp = '%s/%s_aligned_pfiltered.fasta' %\
-        (pynast_dir, input_basename)
+    filtered_aln_fp = '%s/%s_pfiltered.fasta' % (aln_dir, aln_basename)
     try:
         params_str = get_params_str(params['filter_alignment'])
     except KeyError:
         params_str = ''
     # Build the alignment filtering command
     filter_alignment_cmd = 'filter_alignment.py -o %s -i %s %s' %\
-        (pynast_dir, aln_fp, params_str)
-    commands.append([('Filter alignment', filter_alignment_cmd)])
+        (aln_dir, aln_fp, params_str)
+    step_cache.run_step('Filter alignment: %s' % filtered_aln_fp,
+                        [[('Filter alignment', filter_alignment_cmd)]],
+                        [],
+                        [filtered_aln_fp],
+                        command_handler,
+                        status_update_callback,
+                        logger)
 
     # Prep the tree building command
     tree_fp = '%s/rep_set.tre' % output_dir
@@ -316,7 +399,17 @@ def align_and_tree(repset_fasta_fp,
     # Build the tree building command
     make_phylogeny_cmd = 'make_phylogeny.py -i %s -o %s %s' %\
         (filtered_aln_fp, tree_fp, params_str)
-    commands.append([('Build phylogenetic tree', make_phylogeny_cmd)])
+    commands = [[('Build phylogenetic tree', make_phylogeny_cmd)]]
+    step_id = 'Build phylogenetic tree: %s' % tree_fp
+    key = step_cache.get_key(
+        step_id, commands,
+        step_cache.get_command_input_fps(commands, [tree_fp]))
+    if step_cache.is_complete(step_id, key):
+        logger.write('# Tree is up to date (%s).\n\n' % tree_fp)
+        if close_logger_on_success:
+            logger.close()
+        return tree_fp
+
     if exists(tree_fp):
         remove_files([tree_fp])
 
@@ -325,6 +418,48 @@ def align_and_tree(repset_fasta_fp,
                     status_update_callback,
                     logger=logger,
                     close_logger_on_success=close_logger_on_success)
+    step_cache.record(step_id, key, [tree_fp])
+    return tree_fp
+
+
+def align_and_tree(repset_fasta_fp,
+                   output_dir,
+                   command_handler,
+                   params,
+                   qiime_config,
+                   parallel=False,
+                   logger=None,
+                   status_update_callback=print_to_stdout,
+                   step_cache=None):
+
+    if logger is None:
+        log_fp = generate_log_fp(output_dir)
+        logger = WorkflowLogger(log_fp,
+                                params=params,
+                                qiime_config=qiime_config)
+        close_logger_on_success = True
+    else:
+        close_logger_on_success = False
+
+    aln_fp, failures_fp = align_repset(
+        repset_fasta_fp=repset_fasta_fp,
+        output_dir=output_dir,
+        command_handler=command_handler,
+        params=params,
+        logger=logger,
+        parallel=parallel,
+        status_update_callback=status_update_callback,
+        step_cache=step_cache)
+
+    filter_alignment_and_tree(
+        aln_fp=aln_fp,
+        output_dir=output_dir,
+        command_handler=command_handler,
+        params=params,
+        logger=logger,
+        status_update_callback=status_update_callback,
+        close_logger_on_success=close_logger_on_success,
+        step_cache=step_cache)
     return failures_fp
 
 #####################
@@ -332,6 +467,28 @@ def align_and_tree(repset_fasta_fp,
 #####################
 
 
+def _remove_pynast_failures(otu_table_fp,
+                            pynast_failures_fp,
+                            output_fp,
+                            step_cache,
+                            logger):
+    """ Build OTU table without PyNAST failures """
+    step_id = 'Remove PyNAST failures from OTU table'
+    key = step_cache.get_key(step_id, output_fp,
+                             [otu_table_fp, pynast_failures_fp])
+    if step_cache.is_complete(step_id, key):
+        logger.write('# OTU table without PyNAST failures is up to date '
+                     '(%s).\n\n' % output_fp)
+        return
+
+    table = load_table(otu_table_fp)
+    filtered_otu_table = filter_otus_from_otu_table(table,
+        get_seq_ids_from_fasta_file(open(pynast_failures_fp, 'U')),
+        0, inf, 0, inf, negate_ids_to_keep=True)
+    write_biom_table(filtered_otu_table, output_fp)
+    step_cache.record(step_id, key, [output_fp])
+
+
 def iteration_output_exists(
         iteration_output_dir, min_otu_size, remove_partial_output=True):
     """  """
@@ -398,11 +555,19 @@ def iterative_pick_subsampled_open_reference_otus(
     if prefilter_refseqs_fp is None:
         prefilter_refseqs_fp = refseqs_fp
 
+    step_cache = StepCache(join(output_dir, STEP_CACHE_FN))
+
     otu_table_fps = []
     repset_fasta_fps = []
     for i, input_fp in enumerate(input_fps):
         iteration_output_dir = '%s/%d/' % (output_dir, i)
-        if iteration_output_exists(iteration_output_dir, min_otu_size):
+        # the steps of each iteration are cached in the iteration's output
+        # directory, so re-running an iteration whose inputs haven't changed
+        # is cheap. Output directories created before steps were cached are
+        # checked for complete output instead.
+        if not exists(join(iteration_output_dir, STEP_CACHE_FN)) and \
+                iteration_output_exists(iteration_output_dir, min_otu_size,
+                                        remove_partial_output=False):
             # if the output from an iteration already exists, skip that
             # iteration (useful for continuing failed runs)
             log_input_md5s(logger, [input_fp, refseqs_fp])
@@ -448,23 +613,30 @@ def iterative_pick_subsampled_open_reference_otus(
 
         repset_fasta_fps.append('%s/rep_set.fna' % iteration_output_dir)
 
-    # Merge OTU tables - check for existence first as this step has historically
-    # been a frequent failure, so is sometimes run manually in failed runs.
+    # Merge OTU tables
     otu_table_fp = '%s/otu_table_mc%d.biom' % (output_dir, min_otu_size)
-    if not (exists(otu_table_fp) and getsize(otu_table_fp) > 0):
-        merge_cmd = 'merge_otu_tables.py -i %s -o %s' %\
-            (','.join(otu_table_fps), otu_table_fp)
-        commands.append([("Merge OTU tables", merge_cmd)])
+    merge_cmd = 'merge_otu_tables.py -i %s -o %s' %\
+        (','.join(otu_table_fps), otu_table_fp)
+    commands.append([("Merge OTU tables", merge_cmd)])
+    step_cache.run_step('Merge OTU tables', commands, otu_table_fps,
+                        [otu_table_fp],
+                        command_handler, status_update_callback, logger)
+    commands = []
 
-    # Build master rep set
+    # Build master rep set. Each OTU's representative sequence comes from the
+    # first iteration in which it was observed, so taxonomy assignment and
+    # alignment are performed on the subset of the master rep set that was
+    # first observed in each iteration, and then merged. This way adding an
+    # input file (or changing a late one) only requires the representative
+    # sequences of the affected iterations to be processed again.
     final_repset_fp = '%s/rep_set.fna' % output_dir
     final_repset_from_iteration_repsets_fps(repset_fasta_fps, final_repset_fp)
-
-    command_handler(commands,
-                    status_update_callback,
-                    logger=logger,
-                    close_logger_on_success=False)
-    commands = []
+    first_observed_repset_fps = ['%s/first_observed_rep_set.fna' % split(fp)[0]
+                                 for fp in repset_fasta_fps]
+    first_observed_repsets_from_iteration_repsets_fps(
+        repset_fasta_fps, first_observed_repset_fps)
+    first_observed_repset_fps = [fp for fp in first_observed_repset_fps
+                                 if getsize(fp) > 0]
 
     # initialize output file names - these differ based on what combination of
     # taxonomy assignment and alignment/tree building is happening.
@@ -487,68 +659,73 @@ def iterative_pick_subsampled_open_reference_otus(
                                                            min_otu_size)
 
     if run_assign_tax:
-        if exists(otu_table_w_tax_fp) and getsize(otu_table_w_tax_fp) > 0:
-            logger.write(
-                "Final output file exists (%s). Will not rebuild." %
-                otu_table_w_tax_fp)
-        else:
-            # remove files from partially completed runs
-            remove_files([otu_table_w_tax_fp], error_on_missing=False)
-
-            taxonomy_fp = assign_tax(
-                repset_fasta_fp=final_repset_fp,
-                output_dir=output_dir,
+        taxonomy_fps = []
+        for repset_fp in first_observed_repset_fps:
+            taxonomy_fps.append(assign_tax(
+                repset_fasta_fp=repset_fp,
+                output_dir=split(repset_fp)[0],
                 command_handler=command_handler,
                 params=params,
                 qiime_config=qiime_config,
                 parallel=parallel,
                 logger=logger,
-                status_update_callback=status_update_callback)
+                status_update_callback=status_update_callback,
+                step_cache=step_cache))
 
-            # Add taxa to otu table
-            add_metadata_cmd = 'biom add-metadata -i %s --observation-metadata-fp %s -o %s --sc-separated taxonomy --observation-header OTUID,taxonomy' %\
-                (tax_input_otu_table_fp, taxonomy_fp, otu_table_w_tax_fp)
-            commands.append([("Add taxa to OTU table", add_metadata_cmd)])
-
-            command_handler(commands,
-                            status_update_callback,
-                            logger=logger,
-                            close_logger_on_success=False)
-            commands = []
+        try:
+            assignment_method = params['assign_taxonomy']['assignment_method']
+        except KeyError:
+            assignment_method = 'uclust'
+        taxonomy_fp = '%s/%s_assigned_taxonomy/rep_set_tax_assignments.txt' %\
+            (output_dir, assignment_method)
+        concatenate_files(taxonomy_fps, taxonomy_fp)
+
+        # Add taxa to otu table
+        add_metadata_cmd = 'biom add-metadata -i %s --observation-metadata-fp %s -o %s --sc-separated taxonomy --observation-header OTUID,taxonomy' %\
+            (tax_input_otu_table_fp, taxonomy_fp, otu_table_w_tax_fp)
+        commands.append([("Add taxa to OTU table", add_metadata_cmd)])
+
+        step_cache.run_step('Add taxa to OTU table', commands, [],
+                            [otu_table_w_tax_fp],
+                            command_handler, status_update_callback, logger)
+        commands = []
 
     if run_align_and_tree:
-        if exists(pynast_failure_filtered_otu_table_fp) and\
-           getsize(pynast_failure_filtered_otu_table_fp) > 0:
-            logger.write("Final output file exists (%s). Will not rebuild." %
-                         pynast_failure_filtered_otu_table_fp)
-        else:
-            # remove files from partially completed runs
-            remove_files([pynast_failure_filtered_otu_table_fp],
-                         error_on_missing=False)
-
-            pynast_failures_fp = align_and_tree(
-                repset_fasta_fp=final_repset_fp,
-                output_dir=output_dir,
+        aln_fps = []
+        pynast_failures_fps = []
+        for repset_fp in first_observed_repset_fps:
+            aln_fp, pynast_failures_fp = align_repset(
+                repset_fasta_fp=repset_fp,
+                output_dir=split(repset_fp)[0],
                 command_handler=command_handler,
                 params=params,
-                qiime_config=qiime_config,
-                parallel=parallel,
                 logger=logger,
-                status_update_callback=status_update_callback)
-
-            # Build OTU table without PyNAST failures
-            table = load_table(align_and_tree_input_otu_table)
-            filtered_otu_table = filter_otus_from_otu_table(table,
-                get_seq_ids_from_fasta_file(open(pynast_failures_fp, 'U')),
-                0, inf, 0, inf, negate_ids_to_keep=True)
-            write_biom_table(filtered_otu_table,
-                             pynast_failure_filtered_otu_table_fp)
-
-            command_handler(commands,
-                            status_update_callback,
-                            logger=logger,
-                            close_logger_on_success=False)
-            commands = []
+                parallel=parallel,
+                status_update_callback=status_update_callback,
+                step_cache=step_cache)
+            aln_fps.append(aln_fp)
+            pynast_failures_fps.append(pynast_failures_fp)
+
+        pynast_dir = '%s/pynast_aligned_seqs' % output_dir
+        aln_fp = '%s/rep_set_aligned.fasta' % pynast_dir
+        pynast_failures_fp = '%s/rep_set_failures.fasta' % pynast_dir
+        concatenate_files(aln_fps, aln_fp)
+        concatenate_files(pynast_failures_fps, pynast_failures_fp)
+
+        filter_alignment_and_tree(
+            aln_fp=aln_fp,
+            output_dir=output_dir,
+            command_handler=command_handler,
+            params=params,
+            logger=logger,
+            status_update_callback=status_update_callback,
+            step_cache=step_cache)
+
+        _remove_pynast_failures(align_and_tree_input_otu_table,
+                                pynast_failures_fp,
+                                pynast_failure_filtered_otu_table_fp,
+                                step_cache,
+                                logger)
 
     logger.close()
 
@@ -622,6 +799,7 @@ def pick_subsampled_open_reference_otus(input_fp,
     else:
         close_logger_on_success = False
 
+    step_cache = StepCache(join(output_dir, STEP_CACHE_FN))
 
     if not suppress_md5:
         log_input_md5s(logger, [input_fp,
@@ -667,10 +845,11 @@ def pick_subsampled_open_reference_otus(input_fp,
 
 
             # Call the command handler on the list of commands
-            command_handler(commands,
-                            status_update_callback,
-                            logger=logger,
-                            close_logger_on_success=False)
+            step_cache.run_step('Prefilter', commands, [],
+                                [prefilter_failures_list_fp,
+                                 prefiltered_input_fp],
+                                command_handler, status_update_callback,
+                                logger)
             commands = []
 
             input_fp = prefiltered_input_fp
@@ -707,10 +886,10 @@ def pick_subsampled_open_reference_otus(input_fp,
                           step1_filter_fasta_cmd)])
 
         # Call the command handler on the list of commands
-        command_handler(commands,
-                        status_update_callback,
-                        logger=logger,
-                        close_logger_on_success=False)
+        step_cache.run_step('Pick reference OTUs', commands, [],
+                            [step1_otu_map_fp, step1_failures_list_fp,
+                             step1_failures_fasta_fp],
+                            command_handler, status_update_callback, logger)
         commands = []
 
     step1_repset_fasta_fp = \
@@ -720,10 +899,9 @@ def pick_subsampled_open_reference_otus(input_fp,
     commands.append([('Pick rep set', step1_pick_rep_set_cmd)])
 
     # Call the command handler on the list of commands
-    command_handler(commands,
-                    status_update_callback,
-                    logger=logger,
-                    close_logger_on_success=False)
+    step_cache.run_step('Pick rep set', commands, [],
+                        [step1_repset_fasta_fp],
+                        command_handler, status_update_callback, logger)
     commands = []
     # name the final otu map
     merged_otu_map_fp = '%s/final_otu_map.txt' % output_dir
@@ -744,16 +922,25 @@ def pick_subsampled_open_reference_otus(input_fp,
         create_dir(step2_dir)
         step2_input_fasta_fp = \
                                '%s/subsampled_failures.fasta' % step2_dir
-        subsample_fasta(step1_failures_fasta_fp,
-                        step2_input_fasta_fp,
-                        percent_subsample)
-
-        logger.write('# Subsample the failures fasta file using API \n' +
-                 'python -c "import qiime; qiime.util.subsample_fasta' +
-                 '(\'%s\', \'%s\', \'%f\')\n\n"' % (abspath(step1_failures_fasta_fp),
-                                                    abspath(
-                                                        step2_input_fasta_fp),
-                                                    percent_subsample))
+        subsample_key = step_cache.get_key('Subsample failures',
+                                           percent_subsample,
+                                           [step1_failures_fasta_fp])
+        if step_cache.is_complete('Subsample failures', subsample_key):
+            logger.write('# Subsampled failures are up to date (%s).\n\n'
+                         % step2_input_fasta_fp)
+        else:
+            subsample_fasta(step1_failures_fasta_fp,
+                            step2_input_fasta_fp,
+                            percent_subsample)
+
+            logger.write('# Subsample the failures fasta file using API \n' +
+                     'python -c "import qiime; qiime.util.subsample_fasta' +
+                     '(\'%s\', \'%s\', \'%f\')\n\n"' % (abspath(step1_failures_fasta_fp),
+                                                        abspath(
+                                                            step2_input_fasta_fp),
+                                                        percent_subsample))
+            step_cache.record('Subsample failures', subsample_key,
+                              [step2_input_fasta_fp])
 
         # Prep the OTU picking command for the subsampled failures
         step2_cmd = pick_denovo_otus(step2_input_fasta_fp,
@@ -764,14 +951,22 @@ def pick_subsampled_open_reference_otus(input_fp,
                                      logger)
         step2_otu_map_fp = '%s/subsampled_failures_otus.txt' % step2_dir
 
-        commands.append([('Pick de novo OTUs for new clusters', step2_cmd)])
+        step_cache.run_step(
+            'Pick de novo OTUs for new clusters',
+            [[('Pick de novo OTUs for new clusters', step2_cmd)]], [],
+            [step2_otu_map_fp],
+            command_handler, status_update_callback, logger)
 
         # Prep the rep set picking command for the subsampled failures
         step2_repset_fasta_fp = '%s/step2_rep_set.fna' % step2_dir
         step2_rep_set_cmd = 'pick_rep_set.py -i %s -o %s -f %s' %\
             (step2_otu_map_fp, step2_repset_fasta_fp, step2_input_fasta_fp)
-        commands.append(
-            [('Pick representative set for subsampled failures', step2_rep_set_cmd)])
+        step_cache.run_step(
+            'Pick representative set for subsampled failures',
+            [[('Pick representative set for subsampled failures',
+               step2_rep_set_cmd)]], [],
+            [step2_repset_fasta_fp],
+            command_handler, status_update_callback, logger)
 
         step3_dir = '%s/step3_otus/' % output_dir
         step3_otu_map_fp = '%s/failures_otus.txt' % step3_dir
@@ -793,8 +988,11 @@ def pick_subsampled_open_reference_otus(input_fp,
             params,
             logger)
 
-        commands.append([
-            ('Pick reference OTUs using de novo rep set', step3_cmd)])
+        step_cache.run_step(
+            'Pick reference OTUs using de novo rep set',
+            [[('Pick reference OTUs using de novo rep set', step3_cmd)]], [],
+            [step3_otu_map_fp, step3_failures_list_fp],
+            command_handler, status_update_callback, logger)
 
         index_links.append(
             ('Final map of OTU identifier to sequence identifers (i.e., "OTU map")',
@@ -808,8 +1006,12 @@ def pick_subsampled_open_reference_otus(input_fp,
             step3_filter_fasta_cmd = 'filter_fasta.py -f %s -s %s -o %s' %\
                 (step1_failures_fasta_fp,
                  step3_failures_list_fp, step3_failures_fasta_fp)
-            commands.append([('Create fasta file of step3 failures',
-                            step3_filter_fasta_cmd)])
+            step_cache.run_step(
+                'Create fasta file of step3 failures',
+                [[('Create fasta file of step3 failures',
+                   step3_filter_fasta_cmd)]], [],
+                [step3_failures_fasta_fp],
+                command_handler, status_update_callback, logger)
 
             failures_fp = step3_failures_fasta_fp
             failures_otus_fp = 'failures_failures_otus.txt'
@@ -828,7 +1030,12 @@ def pick_subsampled_open_reference_otus(input_fp,
                                      logger)
 
         step4_otu_map_fp = '%s/%s' % (step4_dir, failures_otus_fp)
-        commands.append([('Pick de novo OTUs on %s failures' % failures_step, step4_cmd)])
+        step_cache.run_step(
+            'Pick de novo OTUs on failures',
+            [[('Pick de novo OTUs on %s failures' % failures_step,
+               step4_cmd)]], [],
+            [step4_otu_map_fp],
+            command_handler, status_update_callback, logger)
 
         # Merge the otu maps, note that we are explicitly using the '>' operator
         # otherwise passing the --force flag on the script interface would
@@ -836,12 +1043,20 @@ def pick_subsampled_open_reference_otus(input_fp,
         cat_otu_tables_cmd = 'cat %s %s %s > %s' %\
             (step1_otu_map_fp, step3_otu_map_fp,
              step4_otu_map_fp, merged_otu_map_fp)
-        commands.append([('Merge OTU maps', cat_otu_tables_cmd)])
+        step_cache.run_step(
+            'Merge OTU maps',
+            [[('Merge OTU maps', cat_otu_tables_cmd)]], [],
+            [merged_otu_map_fp],
+            command_handler, status_update_callback, logger)
         step4_repset_fasta_fp = '%s/step4_rep_set.fna' % step4_dir
         step4_rep_set_cmd = 'pick_rep_set.py -i %s -o %s -f %s' %\
             (step4_otu_map_fp, step4_repset_fasta_fp, failures_fp)
-        commands.append(
-            [('Pick representative set for subsampled failures', step4_rep_set_cmd)])
+        step_cache.run_step(
+            'Pick representative set for failures',
+            [[('Pick representative set for subsampled failures',
+               step4_rep_set_cmd)]], [],
+            [step4_repset_fasta_fp],
+            command_handler, status_update_callback, logger)
     else:
         # Merge the otu maps, note that we are explicitly using the '>' operator
         # otherwise passing the --force flag on the script interface would
@@ -854,17 +1069,22 @@ def pick_subsampled_open_reference_otus(input_fp,
 
         cat_otu_tables_cmd = 'cat %s %s > %s' %\
             (step1_otu_map_fp, step3_otu_map_fp, merged_otu_map_fp)
-        commands.append([('Merge OTU maps', cat_otu_tables_cmd)])
-
-        # Move the step 3 failures file to the top-level directory
-        commands.append([('Move final failures file to top-level directory',
-                          'mv %s %s/final_failures.txt' % (failures_fp, output_dir))])
-
-    command_handler(commands,
-                    status_update_callback,
-                    logger=logger,
-                    close_logger_on_success=False)
-    commands = []
+        step_cache.run_step(
+            'Merge OTU maps',
+            [[('Merge OTU maps', cat_otu_tables_cmd)]], [],
+            [merged_otu_map_fp],
+            command_handler, status_update_callback, logger)
+
+        # Copy the step 3 failures file to the top-level directory (it's
+        # copied rather than moved so that the output of step 3 is
+        # unchanged when the workflow is re-run)
+        final_failures_fp = '%s/final_failures.txt' % output_dir
+        step_cache.run_step(
+            'Copy final failures file to top-level directory',
+            [[('Copy final failures file to top-level directory',
+               'cp %s %s' % (failures_fp, final_failures_fp))]], [],
+            [final_failures_fp],
+            command_handler, status_update_callback, logger)
 
     otu_fp = merged_otu_map_fp
     # Filter singletons from the otu map
@@ -960,10 +1180,8 @@ def pick_subsampled_open_reference_otus(input_fp,
         ('OTU table exluding OTUs with fewer than %d sequences' % min_otu_size,
          otu_table_fp,
          _index_headers['otu_tables']))
-    command_handler(commands,
-                    status_update_callback,
-                    logger=logger,
-                    close_logger_on_success=False)
+    step_cache.run_step('Make the otu table', commands, [], [otu_table_fp],
+                        command_handler, status_update_callback, logger)
 
     commands = []
 
@@ -1011,39 +1229,31 @@ def pick_subsampled_open_reference_otus(input_fp,
              _index_headers['otu_tables']))
 
     if run_assign_tax:
-        if exists(otu_table_w_tax_fp) and getsize(otu_table_w_tax_fp) > 0:
-            logger.write(
-                "Final output file exists (%s). Will not rebuild." %
-                otu_table_w_tax_fp)
-        else:
-            # remove files from partially completed runs
-            remove_files([otu_table_w_tax_fp], error_on_missing=False)
-
-            taxonomy_fp = assign_tax(
-                repset_fasta_fp=final_repset_fp,
-                output_dir=output_dir,
-                command_handler=command_handler,
-                params=params,
-                qiime_config=qiime_config,
-                parallel=parallel,
-                logger=logger,
-                status_update_callback=status_update_callback)
+        taxonomy_fp = assign_tax(
+            repset_fasta_fp=final_repset_fp,
+            output_dir=output_dir,
+            command_handler=command_handler,
+            params=params,
+            qiime_config=qiime_config,
+            parallel=parallel,
+            logger=logger,
+            status_update_callback=status_update_callback,
+            step_cache=step_cache)
 
-            index_links.append(
-                    ('OTU taxonomic assignments',
-                    taxonomy_fp,
-                    _index_headers['taxa_assignments']))
-
-            # Add taxa to otu table
-            add_metadata_cmd = 'biom add-metadata -i %s --observation-metadata-fp %s -o %s --sc-separated taxonomy --observation-header OTUID,taxonomy' %\
-                (tax_input_otu_table_fp, taxonomy_fp, otu_table_w_tax_fp)
-            commands.append([("Add taxa to OTU table", add_metadata_cmd)])
-
-            command_handler(commands,
-                            status_update_callback,
-                            logger=logger,
-                            close_logger_on_success=False)
-            commands = []
+        index_links.append(
+                ('OTU taxonomic assignments',
+                taxonomy_fp,
+                _index_headers['taxa_assignments']))
+
+        # Add taxa to otu table
+        add_metadata_cmd = 'biom add-metadata -i %s --observation-metadata-fp %s -o %s --sc-separated taxonomy --observation-header OTUID,taxonomy' %\
+            (tax_input_otu_table_fp, taxonomy_fp, otu_table_w_tax_fp)
+        commands.append([("Add taxa to OTU table", add_metadata_cmd)])
+
+        step_cache.run_step('Add taxa to OTU table', commands, [],
+                            [otu_table_w_tax_fp],
+                            command_handler, status_update_callback, logger)
+        commands = []
 
     if run_align_and_tree:
         rep_set_tree_fp = join(output_dir, 'rep_set.tre')
@@ -1051,39 +1261,22 @@ def pick_subsampled_open_reference_otus(input_fp,
             ('OTU phylogenetic tree',
              rep_set_tree_fp,
              _index_headers['trees']))
-        if exists(pynast_failure_filtered_otu_table_fp) and\
-           getsize(pynast_failure_filtered_otu_table_fp) > 0:
-            logger.write("Final output file exists (%s). Will not rebuild." %
-                         pynast_failure_filtered_otu_table_fp)
-        else:
-            # remove files from partially completed runs
-            remove_files([pynast_failure_filtered_otu_table_fp],
-                         error_on_missing=False)
-
-            pynast_failures_fp = align_and_tree(
-                repset_fasta_fp=final_repset_fp,
-                output_dir=output_dir,
-                command_handler=command_handler,
-                params=params,
-                qiime_config=qiime_config,
-                parallel=parallel,
-                logger=logger,
-                status_update_callback=status_update_callback)
-
-            # Build OTU table without PyNAST failures
-            table = load_table(align_and_tree_input_otu_table)
-            filtered_otu_table = filter_otus_from_otu_table(table,
-                get_seq_ids_from_fasta_file(open(pynast_failures_fp, 'U')),
-                0, inf, 0, inf, negate_ids_to_keep=True)
-            write_biom_table(filtered_otu_table,
-                             pynast_failure_filtered_otu_table_fp)
-
-            command_handler(commands,
-                            status_update_callback,
-                            logger=logger,
-                            close_logger_on_success=False)
-            commands = []
-
+        pynast_failures_fp = align_and_tree(
+            repset_fasta_fp=final_repset_fp,
+            output_dir=output_dir,
+            command_handler=command_handler,
+            params=params,
+            qiime_config=qiime_config,
+            parallel=parallel,
+            logger=logger,
+            status_update_callback=status_update_callback,
+            step_cache=step_cache)
+
+        _remove_pynast_failures(align_and_tree_input_otu_table,
+                                pynast_failures_fp,
+                                pynast_failure_filtered_otu_table_fp,
+                                step_cache,
+                                logger)
 
     if close_logger_on_success:
         logger.close()
@@ -13,8 +13,10 @@ __maintainer__ = "Greg Caporaso"
 __email__ = "gregcaporaso@gmail.com"
 
 import sys
-from os.path import join
+from os import rename, stat
+from os.path import join, exists, isfile
 from datetime import datetime
+from hashlib import md5
 from cogent.util.misc import safe_md5
 from qiime.util import (qiime_system_call,
                         get_qiime_library_version)
@@ -169,3 +171,168 @@ def log_input_md5s(logger, fps):
         if fp is not None:
             logger.write("%s: %s\n" % (fp, safe_md5(open(fp)).hexdigest()))
     logger.write("\n")
+
+
+class StepCache(object):
+
+    """Record of completed workflow steps, keyed by their inputs
+
+    The key of a step is computed from its identifier, the commands (or
+    other parameters) that define it, and the md5 sums of its input files,
+    which include any existing file referenced by its commands. When a step
+    completes, its key and the size, modification time and md5 sum of each
+    of its output files are written to cache_fp. A step is complete if its
+    key matches the recorded key and its output files haven't changed since
+    they were recorded, so when a workflow is re-run with a changed input
+    file or parameter, only the steps that depend on it (directly, or
+    through the output of an earlier step) are re-run.
+
+    If cache_fp is None, nothing is cached and every step is run.
+    """
+
+    def __init__(self, cache_fp):
+        self.CacheFp = cache_fp
+        # step id -> (key, [output fp, ...])
+        self._steps = {}
+        # fp -> (size, mtime, md5), so unchanged files aren't re-hashed
+        self._md5s = {}
+        if cache_fp is not None and exists(cache_fp):
+            self._read()
+
+    def _read(self):
+        for line in open(self.CacheFp, 'U'):
+            fields = line.rstrip('\n').split('\t')
+            if fields[0] == 'step':
+                self._steps[fields[1]] = (fields[2], fields[3:])
+            elif fields[0] == 'md5':
+                fp, size, mtime, md5_sum = fields[1:]
+                self._md5s[fp] = (int(size), float(mtime), md5_sum)
+
+    def _write(self):
+        tmp_fp = '%s.tmp' % self.CacheFp
+        f = open(tmp_fp, 'w')
+        for step_id in sorted(self._steps):
+            key, output_fps = self._steps[step_id]
+            f.write('\t'.join(['step', step_id, key] + output_fps))
+            f.write('\n')
+        for fp in sorted(self._md5s):
+            size, mtime, md5_sum = self._md5s[fp]
+            f.write('md5\t%s\t%d\t%r\t%s\n' % (fp, size, mtime, md5_sum))
+        f.close()
+        rename(tmp_fp, self.CacheFp)
+
+    def _stat(self, fp):
+        s = stat(fp)
+        return s.st_size, s.st_mtime
+
+    def _is_unchanged(self, fp):
+        return (fp in self._md5s and exists(fp) and
+                self._stat(fp) == self._md5s[fp][:2])
+
+    def file_md5(self, fp):
+        """Return the md5 sum of fp, or None if fp doesn't exist"""
+        if not exists(fp):
+            return None
+        if not self._is_unchanged(fp):
+            size, mtime = self._stat(fp)
+            md5_sum = safe_md5(open(fp, 'rb')).hexdigest()
+            self._md5s[fp] = (size, mtime, md5_sum)
+        return self._md5s[fp][2]
+
+    def get_command_input_fps(self, commands, output_fps=()):
+        """Return the existing files referenced by commands
+
+            Files in output_fps are excluded, as they may have been created
+             by a previous run of the commands.
+        """
+        result = []
+        if self.CacheFp is None:
+            return result
+        for command_group in commands:
+            for description, command in command_group:
+                for token in command.split():
+                    if (token not in output_fps and token not in result and
+                            isfile(token)):
+                        result.append(token)
+        return result
+
+    def get_key(self, step_id, definition, input_fps):
+        """Return the key of a step
+
+            step_id: identifier of the step
+            definition: the commands (or any other object whose string
+             representation captures the parameters) defining the step
+            input_fps: filepaths of the step's input files
+        """
+        if self.CacheFp is None:
+            return None
+        result = md5()
+        result.update('%s\n%s\n' % (step_id, definition))
+        for fp in input_fps:
+            result.update('%s\n' % self.file_md5(fp))
+        return result.hexdigest()
+
+    def is_complete(self, step_id, key):
+        """Return True if step_id was completed with key"""
+        if self.CacheFp is None:
+            return False
+        try:
+            recorded_key, output_fps = self._steps[step_id]
+        except KeyError:
+            return False
+        if recorded_key != key:
+            return False
+        for fp in output_fps:
+            if not self._is_unchanged(fp):
+                return False
+        return True
+
+    def record(self, step_id, key, output_fps):
+        """Record step_id as completed with key
+
+            Nothing is recorded (and False is returned) if any of
+             output_fps doesn't exist, for example because the workflow's
+             commands were only printed.
+        """
+        if self.CacheFp is None:
+            return False
+        for fp in output_fps:
+            if not exists(fp):
+                return False
+            self.file_md5(fp)
+        self._steps[step_id] = (key, list(output_fps))
+        self._write()
+        return True
+
+    def run_step(self,
+                 step_id,
+                 commands,
+                 input_fps,
+                 output_fps,
+                 command_handler,
+                 status_update_callback,
+                 logger,
+                 close_logger_on_success=False):
+        """Run commands with command_handler unless the step is complete
+
+            input_fps: input files which aren't referenced directly by
+             commands
+            output_fps: files created by commands
+
+            Returns True if the commands were run, and False otherwise.
+        """
+        input_fps = list(input_fps) + \
+            self.get_command_input_fps(commands, output_fps)
+        key = self.get_key(step_id, commands, input_fps)
+        if self.is_complete(step_id, key):
+            logger.write('# Output of step "%s" is up to date, so its '
+                         'commands will not be run.\n\n' % step_id)
+            if close_logger_on_success:
+                logger.close()
+            return False
+        command_handler(commands,
+                        status_update_callback,
+                        logger=logger,
+                        close_logger_on_success=close_logger_on_success)
+        self.record(step_id, key, output_fps)
+        return True
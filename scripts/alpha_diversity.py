@@ -91,7 +91,12 @@ script_info['optional_options'] = [
     make_option('-t', '--tree_path', default=None,
                 help='Input newick tree filepath.' +
                 ' [default: %default; REQUIRED for phylogenetic metrics]',
-                type='existing_filepath')
+                type='existing_filepath'),
+    make_option('-O', '--jobs_to_start', type='int', default=1,
+                help='Number of processes used for metrics that must be '
+                'computed one sample at a time. Metrics with batched '
+                'implementations, and phylogenetic metrics, always run in a '
+                'single process. [default: %default]')
 ]
 
 script_info['version'] = __version__
@@ -105,6 +110,8 @@ def main():
         print("For more information, see http://scikit-bio.org/docs/latest/"
               "generated/skbio.diversity.alpha.html")
         exit(0)
+    if opts.jobs_to_start < 1:
+        option_parser.error("--jobs_to_start must be at least 1.")
     almost_required_options = ['input_path', 'output_path', 'metrics']
     for option in almost_required_options:
         if getattr(opts, option) is None:
@@ -112,7 +119,7 @@ def main():
 
     if os.path.isdir(opts.input_path):
         multiple_file_alpha(opts.input_path, opts.output_path, opts.metrics,
-                            opts.tree_path)
+                            opts.tree_path, opts.jobs_to_start)
     elif os.path.isfile(opts.input_path):
         try:
             f = open(opts.output_path, 'w')
@@ -124,7 +131,8 @@ def main():
             else:
                 option_parser.error("ioerror, couldn't create output file")
         single_file_alpha(opts.input_path, opts.metrics,
-                          opts.output_path, opts.tree_path)
+                          opts.output_path, opts.tree_path,
+                          opts.jobs_to_start)
 
 
 if __name__ == "__main__":
@@ -82,6 +82,14 @@ script_info['optional_options'] = [
                 'intermediate files: rarefied OTU tables (rarefaction) and alpha diversity '
                 'results (alpha_div). By default these will be erased [default: %default]',
                 default=False),
+    make_option('--in_process', action='store_true', help='rarefy the OTU '
+                'table, compute alpha diversity and collate it in this '
+                'process, without writing intermediate files unless '
+                '--retain_intermediate_files is passed. This is usually much '
+                'faster than calling multiple_rarefactions.py, '
+                'alpha_diversity.py and collate_alpha.py. If -a is passed, '
+                'alpha diversity is computed by -O processes on this machine '
+                '[default: %default]', default=False),
 ]
 script_info['version'] = __version__
 
@@ -155,7 +163,8 @@ def main():
                           min_rare_depth=min_rare_depth,
                           max_rare_depth=max_rare_depth,
                           status_update_callback=status_update_callback,
-                          retain_intermediate_files=retain_intermediate_files)
+                          retain_intermediate_files=retain_intermediate_files,
+                          in_process=opts.in_process)
 
 if __name__ == "__main__":
     main()
@@ -99,6 +99,18 @@ script_info['optional_options'] = [
                 'Pass to skip this step if you\'re already passing a minimal tree.' +
                 ' Beware with "full_tree" metrics, as extra tips in the tree' +
                 ' change the result'),
+    make_option('-O', '--jobs_to_start', type='int', default=1,
+                help='Number of threads used to compute UniFrac metrics. '
+                'Other metrics are computed by a single thread. '
+                '[default: %default]'),
+    make_option('-B', '--binary_output', action='store_true', default=False,
+                help='Write the distance matrices in a binary format, which '
+                'is smaller and much faster to read and write, as '
+                'METRIC_INPUT.dm rather than METRIC_INPUT.txt. QIIME scripts '
+                'that read distance matrices accept both formats. With -r, '
+                'the rows are written in place into existing binary distance '
+                'matrices in the output directory, as created by '
+                'parallel_beta_diversity.py [default: %default]'),
 ]
 script_info['option_label'] = {'input_path': 'OTU table filepath',
                                'rows': 'List of samples for compute',
@@ -129,6 +141,9 @@ def main():
                      ' automatically.  And we refuse to make .txt directories\n')
         exit(1)
 
+    if opts.jobs_to_start < 1:
+        option_parser.error("--jobs_to_start must be at least 1.")
+
     if opts.tree_path == "None":
         opts.tree_path = None
 
@@ -139,10 +154,14 @@ def main():
 
     if os.path.isdir(opts.input_path):
         multiple_file_beta(opts.input_path, opts.output_dir, opts.metrics,
-                           opts.tree_path, opts.rows, full_tree=opts.full_tree)
+                           opts.tree_path, opts.rows, full_tree=opts.full_tree,
+                           jobs_to_start=opts.jobs_to_start,
+                           binary_output=opts.binary_output)
     elif os.path.isfile(opts.input_path):
         single_file_beta(opts.input_path, opts.metrics, opts.tree_path,
-                         opts.output_dir, opts.rows, full_tree=opts.full_tree)
+                         opts.output_dir, opts.rows, full_tree=opts.full_tree,
+                         jobs_to_start=opts.jobs_to_start,
+                         binary_output=opts.binary_output)
     else:
         stderr.write("io error, input path not valid.  Does it exist?")
         exit(1)
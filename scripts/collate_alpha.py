@@ -5,7 +5,8 @@ import operator
 import numpy
 import os
 import sys
-from qiime.collate_alpha import write_output_file, make_output_row
+from qiime.collate_alpha import (write_output_file, make_output_row,
+                                 get_sample_index)
 from qiime.parse import parse_matrix, parse_rarefaction_fname
 from qiime.util import FunctionWithParams
 from qiime.util import parse_command_line_parameters, make_option
@@ -107,21 +108,29 @@ def main():
     num_cols = len(all_samples)
     f.close()
 
+    all_samples_index = get_sample_index(all_samples)
+
+    # parse each input file once
+    file_data = []
+    for fname in file_names:
+        # f_ here refers to the input file currently being processed
+        # to distinguish from the output file we're building
+        f = open(os.path.join(input_dir, fname), 'U')
+        f_metrics, f_samples, f_data = parse_matrix(f)
+        f.close()
+        file_data.append((fname, f_metrics, f_samples, f_data))
+
     # make the table 1 row at a time
     # we're building a rarefaction by sample mtx from
     # a sample by metric matrix
     # each metric is one output file
     for metric in all_metrics:
         metric_file_data = []
-        for fname in file_names:
-            # f_ here refers to the input file currently being processed
-            # to distinguish from the output file we're building
-            f = open(os.path.join(input_dir, fname), 'U')
-            f_metrics, f_samples, f_data = parse_matrix(f)
-            f.close()
+        for fname, f_metrics, f_samples, f_data in file_data:
             metric_file_data.append(
                 make_output_row(f_metrics, metric, f_samples,
-                                f_data, fname, num_cols, all_samples))
+                                f_data, fname, num_cols, all_samples,
+                                all_samples_index))
 
         write_output_file(metric_file_data, output_dir, metric, all_samples)
 
@@ -143,7 +143,11 @@ script_info['optional_options'] = [
     make_option('-c', '--control_dm',
                 help='the control matrix. Only applies (and is *required*) when '
                 'method is partial_mantel. [default: %default]', default=None,
-                type='existing_filepath')
+                type='existing_filepath'),
+    make_option('-O', '--jobs_to_start', type='int', default=1,
+                help='Number of threads computing the permutations of the '
+                'partial Mantel test and Mantel correlogram '
+                '[default: %default]'),
 ]
 script_info['version'] = __version__
 
@@ -168,6 +172,8 @@ def main():
     if opts.num_permutations < 1:
         option_parser.error(
             "--num_permutations must be greater than or equal to 1.")
+    if opts.jobs_to_start < 1:
+        option_parser.error("--jobs_to_start must be at least 1.")
 
     # Create the output dir if it doesn't already exist.
     try:
@@ -195,14 +201,16 @@ def main():
                        distmats, opts.num_permutations, opts.tail_type,
                        comment_mantel_pmantel, control_dm_fp=opts.control_dm,
                        control_dm=parse_distmat(open(opts.control_dm, 'U')),
-                       sample_id_map=sample_id_map))
+                       sample_id_map=sample_id_map,
+                       jobs_to_start=opts.jobs_to_start))
     elif opts.method == 'mantel_corr':
         output_f = open(path.join(opts.output_dir,
                         'mantel_correlogram_results.txt'), 'w')
         result_str, correlogram_fps, correlograms = run_mantel_correlogram(
             input_dm_fps, distmats, opts.num_permutations, comment_corr,
             opts.alpha, sample_id_map=sample_id_map,
-            variable_size_distance_classes=opts.variable_size_distance_classes)
+            variable_size_distance_classes=opts.variable_size_distance_classes,
+            jobs_to_start=opts.jobs_to_start)
 
         output_f.write(result_str)
         for corr_fp, corr in zip(correlogram_fps, correlograms):
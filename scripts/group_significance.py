@@ -18,9 +18,9 @@ from qiime.util import (parse_command_line_parameters, make_option,
 from qiime.stats import (benjamini_hochberg_step_down,
                                    bonferroni_correction)
 from qiime.otu_significance import (get_sample_cats, get_sample_indices,
-                                    get_cat_sample_groups, group_significance_row_generator,
+                                    get_cat_sample_groups, group_significance_groups,
                                     group_significance_output_formatter,
-                                    sort_by_pval, run_group_significance_test,
+                                    sort_by_pval, run_batched_group_significance_test,
                                     TWO_GROUP_TESTS, GROUP_TEST_CHOICES)
 from qiime.parse import parse_mapping_file_to_dict
 from biom import load_table
@@ -257,13 +257,18 @@ script_info['optional_options'] = [
                 'Only their intersecting samples will be used for calculations.'),
     make_option('--print_non_overlap', action='store_true', default=False,
                 help='If this flag is passed the script will display the samples that' +
-                ' do not overlap between the mapping file and the biom file.')]
+                ' do not overlap between the mapping file and the biom file.'),
+    make_option('-O', '--jobs_to_start', type='int', default=1,
+                help='Number of processes the OTUs are split over to run ' +
+                'the test [default: %default]')]
 
 script_info['version'] = __version__
 
 
 def main():
     option_parser, opts, args = parse_command_line_parameters(**script_info)
+    if opts.jobs_to_start < 1:
+        option_parser.error('--jobs_to_start must be at least 1.')
     # sync the mapping file and the biom file
     tmp_bt = load_table(opts.otu_table_fp)
     tmp_pmf, _ = parse_mapping_file_to_dict(opts.mapping_fp)
@@ -320,10 +325,10 @@ def main():
                 'of the reduced number of observations.')
 
     # run actual tests
-    data_feed = group_significance_row_generator(bt, cat_sam_indices)
-    test_stats, pvals, means = run_group_significance_test(
-        data_feed, opts.test,
-        GROUP_TEST_CHOICES, int(opts.permutations))
+    groups = group_significance_groups(bt, cat_sam_indices)
+    test_stats, pvals, means = run_batched_group_significance_test(
+        groups, opts.test, int(opts.permutations),
+        jobs_to_start=opts.jobs_to_start)
 
     # calculate corrected pvals
     fdr_pvals = array(benjamini_hochberg_step_down(pvals))
@@ -71,7 +71,11 @@ script_info['optional_options'] = [
     make_option('-e', '--exclude_otus_fp', type='existing_filepath',
                 help=("path to a file listing OTU identifiers that should not be included in the "
                       "OTU table (e.g., the output of identify_chimeric_seqs.py) or a fasta "
-                      "file where seq ids should be excluded (e.g., failures fasta file from align_seqs.py)"))
+                      "file where seq ids should be excluded (e.g., failures fasta file from align_seqs.py)")),
+    make_option('-O', '--jobs_to_start', type='int', default=1,
+                help=("number of processes to use for parsing the OTU map. "
+                      "Values greater than 1 can reduce run time for very "
+                      "large OTU maps [default: %default]"))
 ]
 
 script_info['version'] = __version__
@@ -82,6 +86,9 @@ def main():
 
     exclude_otus_fp = opts.exclude_otus_fp
 
+    if opts.jobs_to_start < 1:
+        option_parser.error("--jobs_to_start must be at least 1.")
+
     if not opts.taxonomy_fname:
         otu_to_taxonomy = None
     else:
@@ -110,7 +117,8 @@ def main():
         biom_otu_table = make_otu_table(otu_map_f,
                                         otu_to_taxonomy=otu_to_taxonomy,
                                         otu_ids_to_exclude=ids_to_exclude,
-                                        sample_metadata=sample_metadata)
+                                        sample_metadata=sample_metadata,
+                                        jobs_to_start=opts.jobs_to_start)
 
     write_biom_table(biom_otu_table, opts.output_biom_fp)
 
@@ -93,7 +93,8 @@ def main():
     if opts.subsample_multinomial:
         subsample_f = partial(subsample, replace=True)
     else:
-        subsample_f = subsample
+        # rarefy all depths of each rep together
+        subsample_f = None
 
     maker.rarefy_to_files(opts.output_path,
                           False,
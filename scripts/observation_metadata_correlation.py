@@ -12,11 +12,10 @@ __email__ = "wdwvt1@gmail.com"
 
 from qiime.util import (parse_command_line_parameters, make_option,
                         sync_biom_and_mf)
-from qiime.stats import (benjamini_hochberg_step_down, bonferroni_correction,
-                         assign_correlation_pval, correlate, pearson,
-                         spearman, kendall, cscore)
+from qiime.stats import benjamini_hochberg_step_down, bonferroni_correction
 from qiime.otu_significance import (correlate_output_formatter, sort_by_pval,
-                                    run_paired_t, is_computable_float)
+                                    run_paired_t, is_computable_float,
+                                    run_batched_correlation_test)
 from qiime.parse import parse_mapping_file_to_dict
 from biom import load_table
 from numpy import array, where
@@ -35,8 +34,6 @@ Roberts 1990 Oecologea paper 85: 74-79.'''
 correlation_assignment_choices = ['spearman', 'pearson', 'kendall', 'cscore']
 pvalue_assignment_choices = ['fisher_z_transform', 'parametric_t_distribution',
                             'bootstrapped', 'kendall']
-bootstrap_functions = {'spearman': spearman, 'pearson': pearson,
-                       'kendall': kendall, 'cscore': cscore}
 
 script_info = {}
 script_info['brief_description'] = """Correlation between observation abundances and continuous-valued metadata"""
@@ -204,20 +201,9 @@ def main():
     if bt.shape[1] <= 3:
         option_parser.error(filtration_error_text)
 
-    rhos = []
-    pvals = []
-    for feature_vector in bt.iter_data(axis='observation'):
-        rho = correlate(feature_vector, md_values_to_correlate,
-                        method=opts.test)
-        pval = assign_correlation_pval(rho, len(feature_vector),
-                                       method=opts.pval_assignment_method,
-                                       permutations=opts.permutations,
-                                       perm_test_fn=\
-                                            bootstrap_functions[opts.test],
-                                       v1=feature_vector,
-                                       v2=md_values_to_correlate)
-        rhos.append(rho)
-        pvals.append(pval)
+    rhos, pvals = run_batched_correlation_test(
+        bt.matrix_data.toarray(), array(md_values_to_correlate), opts.test,
+        opts.pval_assignment_method, permutations=opts.permutations)
 
     fdr_pvals = benjamini_hochberg_step_down(pvals)
     bon_pvals = bonferroni_correction(pvals)
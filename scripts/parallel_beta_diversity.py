@@ -74,7 +74,15 @@ script_info['optional_options'] = [
                 help='By default, each job removes calls _fast_unifrac_setup to remove\
  unused parts of the tree. pass -f if you already have a minimal tree, and\
  this script will run faster'),
-
+    make_option('-B', '--binary_output', action='store_true', default=False,
+                help='Write the distance matrices in a binary format, which '
+                'is smaller and much faster to read and write, as '
+                'METRIC_INPUT.dm rather than METRIC_INPUT.txt. QIIME scripts '
+                'that read distance matrices accept both formats. When a '
+                'single OTU table is passed, the jobs always write their rows '
+                'into a binary distance matrix, which is then moved to the '
+                'output directory rather than written as text '
+                '[default: %default]'),
 ]
 script_info['version'] = __version__
 
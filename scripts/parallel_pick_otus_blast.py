@@ -68,7 +68,8 @@ script_info['optional_options'] = [
     options_lookup['cluster_jobs_fp'],
     options_lookup['suppress_polling'],
     options_lookup['job_prefix'],
-    options_lookup['seconds_to_sleep']
+    options_lookup['seconds_to_sleep'],
+    options_lookup['chunk_run_times_fp']
 ]
 
 script_info['version'] = __version__
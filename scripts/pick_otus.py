@@ -380,6 +380,15 @@ script_info['optional_options'] = [
                 help="Don't collapse exact matches before calling "
                   "sortmerna, sumaclust or uclust [default: %default]"),
 
+    make_option('--prefilter_max_memory', type='int', default=None,
+                help="Approximate maximum amount of memory (in MB) to use "
+                  "when collapsing exact matches (or exact prefixes with "
+                  "cdhit) before OTU picking. Sequences are spilled to "
+                  "temp_dir (as defined in your qiime_config) in sorted "
+                  "partitions when this amount is exceeded. If not "
+                  "provided, all sequences are held in memory "
+                  "[default: %default]"),
+
     make_option('-d', '--save_uc_files', default=True, action='store_false',
                 help="Enable preservation of intermediate uclust (.uc) files "
                       "that are used to generate clusters via uclust.  Also enables "
@@ -513,6 +522,7 @@ def main():
     save_uc_files = opts.save_uc_files
     prefilter_identical_sequences =\
         not opts.suppress_prefilter_exact_match
+    prefilter_max_memory = opts.prefilter_max_memory
     derep_fullseq = opts.derep_fullseq
     chimeras_retention = opts.non_chimeras_retention
     verbose = opts.verbose
@@ -733,6 +743,13 @@ def main():
             option_parser.error('--swarm_resolution=INT must '
                                 'be a positive integer value.')
 
+    if prefilter_max_memory is not None:
+        if prefilter_max_memory < 1:
+            option_parser.error('--prefilter_max_memory must be a positive '
+                                'integer value.')
+        # the OTU pickers expect the memory budget in bytes
+        prefilter_max_memory *= 1024 * 1024
+
     # End input validation
 
     # use the otu_picking_method value to get the otu picker constructor
@@ -761,7 +778,8 @@ def main():
     # cd-hit
     if otu_picking_method == 'cdhit':
         params = {'Similarity': similarity,
-                  '-M': opts.max_cdhit_memory}
+                  '-M': opts.max_cdhit_memory,
+                  'prefilter_max_memory': prefilter_max_memory}
         otu_picker = otu_picker_constructor(params)
         otu_picker(input_seqs_filepath,
                    result_path=result_path, log_path=log_path,
@@ -786,7 +804,8 @@ def main():
                   'stable_sort': uclust_stable_sort,
                   'save_uc_files': save_uc_files,
                   'output_dir': output_dir,
-                  'prefilter_identical_sequences': prefilter_identical_sequences}
+                  'prefilter_identical_sequences': prefilter_identical_sequences,
+                  'prefilter_max_memory': prefilter_max_memory}
         otu_picker = otu_picker_constructor(params)
         otu_picker(input_seqs_filepath,
                    result_path=result_path, log_path=log_path, HALT_EXEC=False)
@@ -917,6 +936,7 @@ def main():
                   'output_dir': output_dir,
                   'prefilter_identical_sequences':
                   prefilter_identical_sequences,
+                  'prefilter_max_memory': prefilter_max_memory,
                   'chimeras_retention': chimeras_retention}
         otu_picker = otu_picker_constructor(params)
         otu_picker(input_seqs_filepath, refseqs_fp,
@@ -965,7 +985,8 @@ def main():
                   'best': sortmerna_best_N_alignments,
                   'max_pos': sortmerna_max_pos,
                   'prefilter_identical_sequences':
-                  prefilter_identical_sequences}
+                  prefilter_identical_sequences,
+                  'prefilter_max_memory': prefilter_max_memory}
         otu_picker = otu_picker_constructor(params)
         otu_picker(input_seqs_filepath,
                    result_path=result_path, log_path=log_path,
@@ -980,6 +1001,7 @@ def main():
                   'l': sumaclust_l,
                   'prefilter_identical_sequences':
                   prefilter_identical_sequences,
+                  'prefilter_max_memory': prefilter_max_memory,
                   'denovo_otu_id_prefix': denovo_otu_id_prefix}
         otu_picker = otu_picker_constructor(params)
         otu_picker(input_seqs_filepath,
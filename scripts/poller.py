@@ -11,7 +11,8 @@ __maintainer__ = "Greg Caporaso"
 __email__ = "gregcaporaso@gmail.com"
 
 from qiime.util import make_option
-from qiime.parallel.poller import poller, get_function_handle
+from qiime.parallel.poller import (poller, get_function_handle,
+                                   CompletionWatcher)
 from qiime.util import parse_command_line_parameters
 
 script_info = {}
@@ -52,20 +53,28 @@ script_info['optional_options'] = [
                 help='List of files and directories to remove after run'
                 ' [default: %default]'),
     make_option('-t', '--time_to_sleep', type='int',
-                help='time to wait between calls to status_callback_f'
-                ' (in seconds) [default: %default]', default=3)
+                help='maximum time to wait between calls to '
+                'check_run_complete_f (in seconds). The poller checks again '
+                'as soon as a change is detected in the directories '
+                'containing the files listed in check_run_complete_file, and '
+                'otherwise backs off exponentially up to this interval '
+                '[default: %default]', default=3)
 ]
 
 
 def main():
     option_parser, opts, args = parse_command_line_parameters(**script_info)
+    check_run_complete_file = list(open(opts.check_run_complete_file))
+    watcher = CompletionWatcher([l.strip() for l in check_run_complete_file],
+                                max_seconds_to_sleep=opts.time_to_sleep)
     poller(get_function_handle(opts.check_run_complete_f),
            get_function_handle(opts.process_run_results_f),
            get_function_handle(opts.clean_up_f),
-           list(open(opts.check_run_complete_file)),
+           check_run_complete_file,
            list(open(opts.process_run_results_file)),
            list(open(opts.clean_up_file)),
-           seconds_to_sleep=opts.time_to_sleep)
+           seconds_to_sleep=opts.time_to_sleep,
+           watcher=watcher)
 
 
 if __name__ == "__main__":
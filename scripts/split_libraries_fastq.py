@@ -15,15 +15,16 @@ from os import rename
 
 from skbio.util import safe_md5, create_dir
 from skbio.sequence import DNA
-from skbio.format.sequences import format_fastq_record
 
 from qiime.util import parse_command_line_parameters, make_option, gzip_open
 from qiime.parse import parse_mapping_file, parse_items
 from qiime.split_libraries_fastq import (process_fastq_single_end_read_file,
-                                         BARCODE_DECODER_LOOKUP, process_fastq_single_end_read_file_no_barcode)
+                                         BARCODE_DECODER_LOOKUP, process_fastq_single_end_read_file_no_barcode,
+                                         process_fastq_single_end_read_file_parallel)
 from qiime.split_libraries import check_map
 from qiime.split_libraries_fastq import get_illumina_qual_chars
 from qiime.golay import get_invalid_golay_barcodes
+from qiime.sequence_writer import SequenceWriter
 
 script_info = {}
 
@@ -147,7 +148,12 @@ script_info['optional_options'] = [
                 ', where the contents are one file-path or sample identifier '
                 'per line (depending on the flag). NOTE: In most cases regular'
                 ' users don\'t need to use this flag, as it is intended for '
-                'use in multiple_split_libraries_fastq.py [default: %default]')
+                'use in multiple_split_libraries_fastq.py [default: %default]'),
+    make_option('-O', '--jobs_to_start', type='int', default=1,
+                help='Number of processes each pair of barcoded read and '
+                'barcode files is split over. The output is identical to '
+                'that of a single process. Data which is not barcoded is '
+                'always processed by a single process [default: %default]')
     # NEED TO FIX THIS FUNCTIONALITY - CURRENTLY READING THE WRONG FIELD
     # make_option('--filter_bad_illumina_qual_digit',
     #    action='store_true',
@@ -200,6 +206,10 @@ def main():
     store_demultiplexed_fastq = opts.store_demultiplexed_fastq
     barcode_type = opts.barcode_type
     max_barcode_errors = opts.max_barcode_errors
+    jobs_to_start = opts.jobs_to_start
+
+    if jobs_to_start < 1:
+        option_parser.error('--jobs_to_start must be at least 1.')
 
     # if this is not a demultiplexed run,
     if barcode_type == 'not-barcoded':
@@ -252,32 +262,33 @@ def main():
 
     output_fp_temp = '%s/seqs.fna.incomplete' % output_dir
     output_fp = '%s/seqs.fna' % output_dir
-    output_f = open(output_fp_temp, 'w')
+    # output is buffered and written in large blocks by background threads
+    output_f = SequenceWriter(output_fp_temp, background=True)
     qual_fp_temp = '%s/qual.fna.incomplete' % output_dir
     qual_fp = '%s/seqs.qual' % output_dir
     output_fastq_fp_temp = '%s/seqs.fastq.incomplete' % output_dir
     output_fastq_fp = '%s/seqs.fastq' % output_dir
 
     if store_qual_scores:
-        qual_f = open(qual_fp_temp, 'w')
+        qual_f = SequenceWriter(qual_fp_temp, background=True)
         # define a qual writer whether we're storing
         # qual strings or not so we don't have to check
         # every time through the for loop below
 
         def qual_writer(h, q):
-            qual_f.write('>%s\n%s\n' % (h, q))
+            qual_f.write_qual(h, q)
     else:
         def qual_writer(h, q):
             pass
 
     if store_demultiplexed_fastq:
-        output_fastq_f = open(output_fastq_fp_temp, 'w')
+        output_fastq_f = SequenceWriter(output_fastq_fp_temp, background=True)
         # define a fastq writer whether we're storing
         # qual strings or not so we don't have to check
         # every time through the for loop below
 
         def fastq_writer(h, s, q):
-            output_fastq_f.write(format_fastq_record(h, s, q))
+            output_fastq_f.write_fastq(h, s, q)
     else:
         def fastq_writer(h, s, q):
             pass
@@ -324,7 +335,10 @@ def main():
                     (sequence_read_fp,
                      str(safe_md5(open(sequence_read_fp)).hexdigest())))
 
-        if sequence_read_fp.endswith('.gz'):
+        if barcode_read_fp is not None and jobs_to_start > 1:
+            # the parallel jobs open the input files themselves
+            sequence_read_f = None
+        elif sequence_read_fp.endswith('.gz'):
             sequence_read_f = gzip_open(sequence_read_fp)
         else:
             sequence_read_f = open(sequence_read_fp, 'U')
@@ -336,24 +350,40 @@ def main():
                         (barcode_read_fp,
                          safe_md5(open(barcode_read_fp)).hexdigest()))
 
-            if barcode_read_fp.endswith('.gz'):
-                barcode_read_f = gzip_open(barcode_read_fp)
+            if jobs_to_start > 1:
+                seq_generator = process_fastq_single_end_read_file_parallel(
+                    sequence_read_fp, barcode_read_fp, barcode_to_sample_id,
+                    jobs_to_start=jobs_to_start,
+                    store_unassigned=retain_unassigned_reads,
+                    max_bad_run_length=max_bad_run_length,
+                    phred_quality_threshold=phred_quality_threshold,
+                    min_per_read_length_fraction=min_per_read_length_fraction,
+                    rev_comp=rev_comp, rev_comp_barcode=rev_comp_barcode,
+                    seq_max_N=seq_max_N, start_seq_id=start_seq_id,
+                    filter_bad_illumina_qual_digit=filter_bad_illumina_qual_digit,
+                    log_f=log_f, histogram_f=histogram_f,
+                    barcode_correction_fn=barcode_correction_fn,
+                    max_barcode_errors=max_barcode_errors,
+                    phred_offset=phred_offset)
             else:
-                barcode_read_f = open(barcode_read_fp, 'U')
-
-            seq_generator = process_fastq_single_end_read_file(
-                sequence_read_f, barcode_read_f, barcode_to_sample_id,
-                store_unassigned=retain_unassigned_reads,
-                max_bad_run_length=max_bad_run_length,
-                phred_quality_threshold=phred_quality_threshold,
-                min_per_read_length_fraction=min_per_read_length_fraction,
-                rev_comp=rev_comp, rev_comp_barcode=rev_comp_barcode,
-                seq_max_N=seq_max_N, start_seq_id=start_seq_id,
-                filter_bad_illumina_qual_digit=filter_bad_illumina_qual_digit,
-                log_f=log_f, histogram_f=histogram_f,
-                barcode_correction_fn=barcode_correction_fn,
-                max_barcode_errors=max_barcode_errors,
-                phred_offset=phred_offset)
+                if barcode_read_fp.endswith('.gz'):
+                    barcode_read_f = gzip_open(barcode_read_fp)
+                else:
+                    barcode_read_f = open(barcode_read_fp, 'U')
+
+                seq_generator = process_fastq_single_end_read_file(
+                    sequence_read_f, barcode_read_f, barcode_to_sample_id,
+                    store_unassigned=retain_unassigned_reads,
+                    max_bad_run_length=max_bad_run_length,
+                    phred_quality_threshold=phred_quality_threshold,
+                    min_per_read_length_fraction=min_per_read_length_fraction,
+                    rev_comp=rev_comp, rev_comp_barcode=rev_comp_barcode,
+                    seq_max_N=seq_max_N, start_seq_id=start_seq_id,
+                    filter_bad_illumina_qual_digit=filter_bad_illumina_qual_digit,
+                    log_f=log_f, histogram_f=histogram_f,
+                    barcode_correction_fn=barcode_correction_fn,
+                    max_barcode_errors=max_barcode_errors,
+                    phred_offset=phred_offset)
         else:
             seq_generator = process_fastq_single_end_read_file_no_barcode(
                 sequence_read_f, sample_ids[i],
@@ -368,7 +398,7 @@ def main():
                 phred_offset=phred_offset)
 
         for fasta_header, sequence, quality, seq_id in seq_generator:
-            output_f.write('>%s\n%s\n' % (fasta_header, sequence))
+            output_f.write_fasta(fasta_header, sequence)
             qual_writer(fasta_header, quality)
             fastq_writer(fasta_header, sequence, quality)
 
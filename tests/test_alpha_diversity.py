@@ -10,8 +10,9 @@ __email__ = "justinak@gmail.com"
 
 """Contains tests for performing alpha diversity analyses within each sample."""
 
-from os import makedirs, close
-from tempfile import mkstemp
+from os import makedirs, close, listdir
+from shutil import rmtree
+from tempfile import mkstemp, mkdtemp
 from unittest import TestCase, main
 
 from biom.table import Table
@@ -22,7 +23,10 @@ from skbio.diversity.alpha import observed_otus, osd
 from skbio.util import remove_files
 
 from qiime.alpha_diversity import (AlphaDiversityCalc, AlphaDiversityCalcs,
-                                   single_file_cup)
+                                   single_file_cup, get_alpha_calcs,
+                                   collated_rarefied_alpha, get_sample_counts,
+                                   nonphylogenetic_metrics, TreeIndex,
+                                   faith_pd)
 from qiime.parse import parse_newick
 from qiime.util import get_qiime_temp_dir, write_biom_table
 
@@ -163,6 +167,159 @@ class AlphaDiversityCalcsTests(AlphaDiversitySharedSetUpTests):
         self.assertEqual(len(results[2]), 5)
 
 
+class BatchedMetricTests(AlphaDiversitySharedSetUpTests):
+
+    """Tests of batched metric implementations"""
+
+    def setUp(self):
+        super(BatchedMetricTests, self).setUp()
+        self.otu_table3 = Table(data=array([[2, 0, 0, 1, 5, 1],
+                                            [1, 1, 1, 1, 1, 1],
+                                            [0, 3, 2, 2, 9, 0],
+                                            [40, 0, 1, 0, 0, 0]]).T,
+                                sample_ids=list('WXYZ'),
+                                observation_ids=list('abcdef'))
+
+    def test_get_sample_counts(self):
+        """get_sample_counts returns integer counts with samples as rows"""
+        obs = get_sample_counts(self.otu_table1)
+        self.assertEqual(obs.shape, (3, 4))
+        self.assertEqual(obs.toarray().tolist(),
+                         [[2, 0, 0, 1], [1, 1, 1, 1], [0, 0, 0, 0]])
+
+    def test_batched_metrics(self):
+        """batched metrics match the per-sample metrics"""
+        sample_counts = get_sample_counts(self.otu_table3)
+        batched_metrics = [m for m in nonphylogenetic_metrics
+                           if hasattr(m, 'batched')]
+        self.assertTrue(len(batched_metrics) > 10)
+        for metric in batched_metrics:
+            exp = [metric(v.astype(int))
+                   for v in self.otu_table3.iter_data(axis='sample')]
+            assert_almost_equal(metric.batched(sample_counts), exp)
+
+    def test_pool(self):
+        """metrics without batched implementations can use a pool"""
+        calcs = AlphaDiversityCalcs([AlphaDiversityCalc(metric=osd),
+                                     AlphaDiversityCalc(metric=observed_otus),
+                                     AlphaDiversityCalc(metric=PD_whole_tree,
+                                                        is_phylogenetic=True)])
+        exp = calcs.getResult(self.otu_table1, self.tree1)
+        obs = calcs.getResult(self.otu_table1, self.tree1, jobs_to_start=2)
+        assert_almost_equal(obs[0], exp[0])
+        self.assertEqual(list(obs[1]), list(exp[1]))
+        self.assertEqual(obs[2], exp[2])
+        assert_almost_equal(exp[0][:, :3], [[2, 1, 1], [4, 4, 0], [0, 0, 0]])
+
+
+class FaithPDTests(AlphaDiversitySharedSetUpTests):
+
+    """Tests of faith_pd"""
+
+    def setUp(self):
+        super(FaithPDTests, self).setUp()
+        self.tree3 = parse_newick(
+            '((a:2,b:3):2,((c:1,d:2):1,e:4):7,f:0.5);')
+        self.otu_table3 = Table(data=array([[2, 0, 0, 1, 5, 1],
+                                            [1, 1, 1, 1, 1, 1],
+                                            [0, 3, 2, 2, 9, 0],
+                                            [40, 0, 1, 0, 0, 0]]).T,
+                                sample_ids=list('WXYZ'),
+                                observation_ids=list('abcdef'))
+
+    def test_faith_pd(self):
+        """faith_pd computes PD of all samples at once"""
+        obs = faith_pd(get_sample_counts(self.otu_table1),
+                       self.otu_table1.ids(axis='observation'),
+                       TreeIndex(self.tree1))
+        assert_almost_equal(obs, [13, 17, 0])
+        obs = faith_pd(get_sample_counts(self.otu_table3),
+                       self.otu_table3.ids(axis='observation'),
+                       TreeIndex(self.tree3))
+        assert_almost_equal(obs, [18.5, 22.5, 20, 13])
+
+    def test_faith_pd_reused_index(self):
+        """a TreeIndex can be used for several tables"""
+        index = TreeIndex(self.tree3)
+        c = AlphaDiversityCalc(metric=PD_whole_tree, is_phylogenetic=True)
+        assert_almost_equal(c(data_path=self.otu_table3, tree_index=index,
+                              sample_names=list('ZYXW')),
+                            [13, 20, 22.5, 18.5])
+        assert_almost_equal(c(data_path=self.otu_table1, tree_index=index),
+                            [14, 18, 0])
+
+    def test_faith_pd_root_length(self):
+        """faith_pd includes the branch of the root of rooted trees"""
+        index = TreeIndex(parse_newick(
+            '((a:2,b:3):2,((c:1,d:2):1,e:4):7,f:0.5):3;'))
+        self.assertEqual(index.RootLength, 3)
+        obs = faith_pd(get_sample_counts(self.otu_table3),
+                       self.otu_table3.ids(axis='observation'), index)
+        assert_almost_equal(obs, [21.5, 25.5, 23, 16])
+        # samples without OTUs in the tree have no diversity
+        obs = faith_pd(get_sample_counts(self.otu_table1),
+                       self.otu_table1.ids(axis='observation'), index)
+        assert_almost_equal(obs, [17, 21, 0])
+
+    def test_faith_pd_missing_tips(self):
+        """OTUs which aren't tips of the tree are ignored"""
+        obs = faith_pd(get_sample_counts(self.otu_table3),
+                       self.otu_table3.ids(axis='observation'),
+                       TreeIndex(self.tree1))
+        assert_almost_equal(obs, [13, 17, 15, 12])
+
+
+class CollatedRarefiedAlphaTests(AlphaDiversitySharedSetUpTests):
+
+    """Tests of collated_rarefied_alpha"""
+
+    def test_get_alpha_calcs(self):
+        """get_alpha_calcs finds phylogenetic and nonphylogenetic metrics"""
+        calcs = get_alpha_calcs('observed_otus,PD_whole_tree')
+        self.assertEqual([c.IsPhylogenetic for c in calcs], [False, True])
+        calcs = get_alpha_calcs(['observed_otus', 'PD_whole_tree'])
+        self.assertEqual([c.Name for c in calcs],
+                         ['observed_otus', 'PD_whole_tree'])
+        self.assertRaises(ValueError, get_alpha_calcs, 'not_a_metric')
+
+    def test_collated_rarefied_alpha(self):
+        """collated_rarefied_alpha collates alpha of each rarefied table"""
+        for jobs_to_start in 1, 2:
+            calc_names, all_samples, collated = collated_rarefied_alpha(
+                self.otu_table1, [3, 4], 2, 'observed_otus,PD_whole_tree',
+                tree=self.tree1, jobs_to_start=jobs_to_start)
+            self.assertEqual(calc_names, ['observed_otus', 'PD_whole_tree'])
+            # Z has no sequences, and X only has 3
+            self.assertEqual(all_samples, ['X', 'Y'])
+            self.assertEqual(
+                collated['observed_otus'],
+                [['alpha_rarefaction_3_0.txt', 3, 0, '2.0', '3.0'],
+                 ['alpha_rarefaction_4_0.txt', 4, 0, 'n/a', '4.0'],
+                 ['alpha_rarefaction_3_1.txt', 3, 1, '2.0', '3.0'],
+                 ['alpha_rarefaction_4_1.txt', 4, 1, 'n/a', '4.0']])
+            self.assertEqual([row[3] for row in collated['PD_whole_tree']],
+                             ['13.0', 'n/a', '13.0', 'n/a'])
+
+    def test_collated_rarefied_alpha_intermediate_files(self):
+        """collated_rarefied_alpha writes rarefied tables and alpha"""
+        rarefaction_dir = mkdtemp(dir=self.tmp_dir)
+        alpha_diversity_dir = mkdtemp(dir=self.tmp_dir)
+        try:
+            collated_rarefied_alpha(self.otu_table1, [3, 5], 1,
+                                    'observed_otus',
+                                    rarefaction_dir=rarefaction_dir,
+                                    alpha_diversity_dir=alpha_diversity_dir)
+            # no sample has 5 sequences, so no table is written at that
+            # depth
+            self.assertEqual(listdir(rarefaction_dir),
+                             ['rarefaction_3_0.biom'])
+            self.assertEqual(listdir(alpha_diversity_dir),
+                             ['alpha_rarefaction_3_0.txt'])
+        finally:
+            rmtree(rarefaction_dir)
+            rmtree(alpha_diversity_dir)
+
+
 class SingleFileCUPTests(TestCase):
     def setUp(self):
         self.files_to_remove = []
@@ -9,6 +9,7 @@ __version__ = "1.9.1-dev"
 __maintainer__ = "Justin Kuczynski"
 __email__ = "justinak@gmail.com"
 
+from itertools import product
 from unittest import TestCase, main
 
 import qiime.barcode as barcode
@@ -64,5 +65,59 @@ class BarcodeTests(TestCase):
         self.assertEqual(decoded, None)
         self.assertEqual(num_errors, 3)
 
+    def test_seq_to_int(self):
+        """ seq_to_int should pack the bits of the sequence into an int"""
+        nt_to_bits = {"A": "11", "C": "00", "T": "10", "G": "01"}
+        self.assertEqual(barcode.seq_to_int('AAG', nt_to_bits), 61)
+        self.assertEqual(barcode.seq_to_int('CCC', nt_to_bits), 0)
+
+    def test_cache_barcode_correction(self):
+        """ cache_barcode_correction should correct each barcode once"""
+        calls = []
+
+        def correction_fn(bc):
+            calls.append(bc)
+            return bc.upper(), 1
+
+        cached = barcode.cache_barcode_correction(correction_fn, 2)
+        self.assertEqual(cached('acg'), ('ACG', 1))
+        self.assertEqual(cached('acg'), ('ACG', 1))
+        self.assertEqual(cached('tta'), ('TTA', 1))
+        self.assertEqual(calls, ['acg', 'tta'])
+        # the cache is emptied when full
+        self.assertEqual(cached('ggg'), ('GGG', 1))
+        self.assertEqual(cached('acg'), ('ACG', 1))
+        self.assertEqual(calls, ['acg', 'tta', 'ggg', 'acg'])
+
+    def test_get_barcode_neighborhoods(self):
+        """ get_barcode_neighborhoods should agree with correct_barcode"""
+        possibilities = ['AACGT', 'AACTT', 'GTCAG', 'TTTTT']
+        neighborhoods = barcode.get_barcode_neighborhoods(possibilities, 2)
+        self.assertEqual(neighborhoods['AACGT'], ('AACGT', 0))
+        self.assertEqual(neighborhoods['AACCT'], (None, 1))
+        self.assertEqual(neighborhoods['GTCAA'], ('GTCAG', 1))
+        self.assertEqual(neighborhoods['TTTAA'], ('TTTTT', 2))
+        self.assertFalse('AACGN' in neighborhoods)
+        # every sequence within 2 mismatches of a barcode is included
+        all_seqs = [''.join(seq) for seq in product('ACGT', repeat=5)]
+        for seq in all_seqs:
+            expected = barcode.correct_barcode(seq, possibilities)
+            if expected[1] <= 2:
+                self.assertEqual(neighborhoods[seq], expected)
+            else:
+                self.assertFalse(seq in neighborhoods)
+
+    def test_correct_barcode_from_neighborhoods(self):
+        """ correct_barcode_from_neighborhoods should compare seqs not in
+        the neighborhoods with each barcode
+        """
+        possibilities = ['AACGT', 'AACTT', 'GTCAG', 'TTTTT']
+        neighborhoods = barcode.get_barcode_neighborhoods(possibilities, 1)
+        for seq in ['AACGT', 'AACCT', 'GTCAA', 'TTTAA', 'AACGN', 'CCCCC']:
+            self.assertEqual(
+                barcode.correct_barcode_from_neighborhoods(
+                    seq, possibilities, neighborhoods),
+                barcode.correct_barcode(seq, possibilities))
+
 if __name__ == '__main__':
     main()
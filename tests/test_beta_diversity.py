@@ -28,7 +28,8 @@ from cogent.maths.distance_transform import dist_chisq
 from qiime.util import get_qiime_temp_dir, write_biom_table
 from qiime.parse import parse_newick, parse_distmat, parse_matrix
 from qiime.beta_diversity import single_file_beta,\
-    list_known_nonphylogenetic_metrics, list_known_phylogenetic_metrics
+    list_known_nonphylogenetic_metrics, list_known_phylogenetic_metrics,\
+    is_symmetric_metric
 from qiime.beta_metrics import dist_unweighted_unifrac
 
 
@@ -229,6 +230,14 @@ class BetaDiversityTests(TestCase):
         self.single_file_beta(missing_otu_table, missing_tree,
                               missing_sams=['M'], use_metric_list=True)
 
+    def test_is_symmetric_metric(self):
+        for metric in ['bray_curtis', 'binary_jaccard', 'unweighted_unifrac',
+                       'weighted_normalized_unifrac']:
+            self.assertTrue(is_symmetric_metric(metric))
+        for metric in ['unifrac_g', 'unifrac_g_full_tree']:
+            self.assertFalse(is_symmetric_metric(metric))
+        self.assertRaises(AttributeError, is_symmetric_metric, 'not_a_metric')
+
 
 l19_otu_table = """{"rows": [{"id": "tax1", "metadata": {}}, {"id": "tax2",\
  "metadata": {}}, {"id": "tax3", "metadata": {}}, {"id": "tax4", "metadata":\
@@ -19,7 +19,22 @@ from qiime.parse import make_envs_dict
 from qiime.beta_metrics import (
     _reorder_unifrac_res,
     make_unifrac_metric,
-    make_unifrac_row_metric)
+    make_unifrac_row_metric,
+    UnifracBranches,
+    make_generalized_unifrac_block,
+    dist_unweighted_unifrac,
+    dist_unweighted_unifrac_full_tree,
+    dist_weighted_unifrac,
+    dist_weighted_normalized_unifrac,
+    dist_unifrac_g,
+    dist_unifrac_g_full_tree,
+    dist_generalized_unifrac)
+from qiime.tree_index import TreeIndex
+from qiime.beta_diversity import (get_nonphylogenetic_metric,
+                                  get_nonphylogenetic_rows_metric,
+                                  list_known_nonphylogenetic_metrics)
+import qiime.beta_metrics
+from scipy.sparse import csr_matrix
 from qiime.parse import parse_newick
 from cogent.core.tree import PhyloNode
 from cogent.maths.unifrac.fast_tree import (unifrac)
@@ -274,6 +289,138 @@ class FunctionTests(TestCase):
                 self.assertEqual(res_row[j], res[i, j])
         warnings.resetwarnings()
 
+class UnifracBranchesTests(TestCase):
+
+    """Tests of the batched UniFrac implementations"""
+
+    def setUp(self):
+        self.data = numpy.array([
+            [0, 0, 0, 0, 0, 0, 0, 0, 0],
+            [4, 2, 0, 0, 0, 1, 0, 0, 0],
+            [2, 4, 0, 0, 0, 1, 0, 0, 0],
+            [1, 7, 0, 0, 0, 0, 0, 0, 0],
+            [0, 7, 1, 0, 0, 0, 0, 0, 0],
+            [0, 4, 2, 0, 0, 0, 2, 0, 0],
+            [0, 0, 4, 2, 0, 0, 0, 3, 0],
+            [0, 0, 0, 4, 2, 0, 0, 0, 4],
+            [0, 0, 0, 1, 7, 0, 0, 0, 0]
+        ])
+        self.sample_names = ['s%d' % i for i in range(9)]
+        self.taxon_names = ['tax1', 'tax2', 'tax3', 'tax4', 'endbigtaxon',
+                            'tax6', 'tax7', 'tax8', 'tax9']
+        # tax2 and tax5 aren't in the tree, and tax5 isn't in the table
+        self.tree = parse_newick(
+            '((((tax7:0.1,tax3:0.2):.98,tax8:.3, tax4:.3):.4, '
+            '((tax1:0.3, tax6:.09):0.43,tax5:0.4):0.5):.2,'
+            '(tax9:0.3, endbigtaxon:.08));', PhyloNode)
+        self.metrics = [dist_unweighted_unifrac,
+                        dist_unweighted_unifrac_full_tree,
+                        dist_weighted_unifrac,
+                        dist_weighted_normalized_unifrac,
+                        dist_unifrac_g,
+                        dist_unifrac_g_full_tree]
+        warnings.filterwarnings('ignore', 'unifrac had no information')
+
+    def tearDown(self):
+        warnings.resetwarnings()
+
+    def get_branches(self, make_subtree=True, block_size=None):
+        return UnifracBranches(csr_matrix(self.data), self.sample_names,
+                               self.taxon_names, TreeIndex(self.tree),
+                               make_subtree, block_size)
+
+    def test_batched(self):
+        """batched metrics match the fast_unifrac metrics"""
+        for make_subtree in True, False:
+            branches = self.get_branches(make_subtree)
+            for metric in self.metrics:
+                exp = metric(self.data, self.taxon_names, self.tree,
+                             self.sample_names, make_subtree=make_subtree)
+                assert_almost_equal(metric.batched(branches), exp)
+
+    def test_batched_blocks(self):
+        """batched metrics don't depend on block size or threads"""
+        branches = self.get_branches()
+        blocked_branches = self.get_branches(block_size=2)
+        for metric in self.metrics:
+            exp = metric.batched(branches)
+            assert_almost_equal(metric.batched(blocked_branches), exp)
+            assert_almost_equal(metric.batched(blocked_branches,
+                                               jobs_to_start=3), exp)
+
+    def test_batched_rows(self):
+        """batched metrics compute only the requested rows"""
+        branches = self.get_branches(block_size=4)
+        for metric in self.metrics:
+            exp = metric.batched(branches)
+            assert_almost_equal(metric.batched(branches, rows=[5, 0, 2]),
+                                exp[[5, 0, 2]])
+
+    def test_no_samples(self):
+        """an error is raised if no sample has counts on the tree"""
+        self.data[:, [0, 2, 3, 4, 5, 6, 7, 8]] = 0
+        self.assertRaises(ValueError, dist_unweighted_unifrac.batched,
+                          self.get_branches())
+
+    def test_generalized_unifrac(self):
+        """generalized UniFrac with alpha=1 is weighted normalized UniFrac"""
+        branches = self.get_branches()
+        exp = dist_weighted_normalized_unifrac.batched(branches)
+        assert_almost_equal(
+            branches.distances(make_generalized_unifrac_block(1)), exp)
+        obs = dist_generalized_unifrac(self.data, self.taxon_names,
+                                       self.tree, self.sample_names)
+        assert_almost_equal(obs, dist_generalized_unifrac.batched(branches))
+        self.assertEqual(obs[0, 0], 0)
+        self.assertEqual(obs[0, 1], 1)
+
+class RowsMetricTests(TestCase):
+
+    """Tests of the rows functions of nonphylogenetic metrics"""
+
+    def setUp(self):
+        self.data = numpy.array([
+            [0, 0, 0, 0, 0, 0],
+            [4, 2, 0, 0, 1, 0],
+            [2, 4, 0, 0, 1, 0],
+            [1, 7, 0, 0, 0, 0],
+            [0, 7, 1, 0, 0, 0],
+            [0, 0, 0, 0, 0, 0],
+            [0, 4, 2, 0, 0, 2],
+            [0, 0, 4, 0, 3, 0],
+            [0, 0, 0, 0, 7, 0]
+        ], 'float')
+
+    def test_rows_metrics(self):
+        """rows functions match the distance_transform metrics"""
+        rows_metrics = [name for name in dir(qiime.beta_metrics)
+                        if name.startswith('rows_')]
+        self.assertTrue(len(rows_metrics) > 15)
+        for name in rows_metrics:
+            metric_f = get_nonphylogenetic_metric(name[len('rows_'):])
+            self.assertEqual(get_nonphylogenetic_rows_metric(metric_f),
+                             getattr(qiime.beta_metrics, name))
+            exp = metric_f(self.data)
+            rows_f = getattr(qiime.beta_metrics, name)
+            assert_almost_equal(rows_f(self.data, range(len(self.data))),
+                                exp)
+            # statistics are shared between blocks
+            stats = {}
+            assert_almost_equal(rows_f(self.data, [5, 1], stats),
+                                exp[[5, 1]])
+            assert_almost_equal(rows_f(self.data, [8, 0, 2], stats),
+                                exp[[8, 0, 2]])
+
+    def test_get_nonphylogenetic_rows_metric(self):
+        """metrics without rows functions return None"""
+        rows_metrics = [get_nonphylogenetic_rows_metric(
+                        get_nonphylogenetic_metric(name))
+                        for name in list_known_nonphylogenetic_metrics()]
+        self.assertTrue(None in rows_metrics)
+        self.assertEqual(get_nonphylogenetic_rows_metric(
+            get_nonphylogenetic_metric('binary_chisq')),
+            qiime.beta_metrics.rows_binary_chisq)
+
 # run tests if called from command line
 if __name__ == '__main__':
     main()
@@ -8,7 +8,7 @@ __version__ = "1.9.1-dev"
 __maintainer__ = "Justin Kuczynski"
 __email__ = "justinak@gmail.com"
 
-from qiime.collate_alpha import make_output_row
+from qiime.collate_alpha import make_output_row, get_sample_index
 from unittest import TestCase, main
 import os
 import numpy
@@ -30,6 +30,21 @@ class FunctionTests(TestCase):
                               f_data, fname, num_cols, all_samples)
         self.assertEqual(res, ['alpha_rarefaction_10_7', 10, 7, '0.4', '0.8'])
 
+        # samples are placed by all_samples_index, and missing samples are
+        # n/a
+        all_samples = ['s3', 's2', 's1']
+        res = make_output_row(f_metrics, metric, f_samples,
+                              f_data, fname, 3, all_samples,
+                              get_sample_index(all_samples))
+        self.assertEqual(res, ['alpha_rarefaction_10_7', 10, 7, 'n/a', '0.8',
+                               '0.4'])
+        self.assertRaises(ValueError, make_output_row, f_metrics, metric,
+                          f_samples, f_data, fname, 1, ['s1'])
+
+    def test_get_sample_index(self):
+        self.assertEqual(get_sample_index(['s1', 's2', 's1']),
+                         {'s1': 0, 's2': 1})
+
 # run tests if called from command line
 if __name__ == '__main__':
     main()
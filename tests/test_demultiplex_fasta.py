@@ -25,7 +25,8 @@ from qiime.demultiplex_fasta import (
     get_added_demultiplex_field, get_exact_bc_matches, attempt_bc_correction,
     get_curr_bc_added_field, get_demultiplex_data, write_qual_line,
     write_fasta_line, get_label_line, initialize_log_data,
-    get_output_ids, assign_seqs, process_files_and_demultiplex_sequences
+    get_output_ids, assign_seqs, process_files_and_demultiplex_sequences,
+    get_demultiplex_index
 )
 
 
@@ -511,6 +512,56 @@ class TopLevelTests(TestCase):
         expected_result = None
         self.assertEqual(actual_result, expected_result)
 
+    def test_get_added_demultiplex_field_indexed(self):
+        """ Returns added demultiplex data using precomputed index """
+
+        ids_bcs_added_field = {("AAAA", "ABC"): "S1", ("TTTT", "239A"): "S2",
+                               ("CCCC", "AB"): "S3", ("GGGG", "1"): "S4"}
+        demultiplex_index = get_demultiplex_index(ids_bcs_added_field)
+        for fasta_label, added_demultiplex_field, expected_result in [
+                ("ABC1234 region=1 length=229", "run_prefix", "ABC"),
+                ("ABX1234 region=1 length=229", "run_prefix", "AB"),
+                ("xxABC1234 region=1 length=229", "run_prefix", None),
+                ("ABC1234 region=1 length=229", "region", "1"),
+                ("ABC1234 region=239A length=229", "region", "239A"),
+                ("ABC1234 region=5 length=229", "region", None),
+                ("ABC1234 length=229", "region", None)]:
+            actual_result = get_added_demultiplex_field(ids_bcs_added_field,
+                                                        fasta_label, added_demultiplex_field, demultiplex_index)
+            self.assertEqual(actual_result, expected_result)
+
+    def test_get_demultiplex_index(self):
+        """ Indexes added fields, and generic barcodes by added field """
+
+        ids_bcs_added_field = {("AACT", "1"): "s1", ("AGCA", "1"): "s2",
+                               ("AACT", "23"): "s3"}
+        actual = get_demultiplex_index(ids_bcs_added_field, 4)
+
+        self.assertEqual(actual['added_fields'], set(["1", "23"]))
+        self.assertEqual(actual['added_field_lens'], [2, 1])
+        bcs, neighborhoods = actual['bc_neighborhoods']['1']
+        self.assertEqual(sorted(bcs), ["AACT", "AGCA"])
+        self.assertEqual(neighborhoods["AGCT"], (None, 1))
+        self.assertEqual(neighborhoods["TACT"], ("AACT", 1))
+        bcs, neighborhoods = actual['bc_neighborhoods']['23']
+        self.assertEqual(bcs, ["AACT"])
+        self.assertEqual(neighborhoods["AGCT"], ("AACT", 1))
+        self.assertEqual(neighborhoods["AGGT"], ("AACT", 2))
+        self.assertFalse("AGGG" in neighborhoods)
+
+        # Barcodes are not indexed for golay/hamming correction, variable
+        # length barcodes, or without barcode correction
+        for barcode_type, disable_bc_correction in [("golay_12", False),
+                                                    ("hamming_8", False),
+                                                    (4, True)]:
+            actual = get_demultiplex_index(ids_bcs_added_field, barcode_type,
+                                           disable_bc_correction)
+            self.assertEqual(actual['bc_neighborhoods'], None)
+        ids_bcs_added_field[("AGCAGC", "23")] = "s4"
+        actual = get_demultiplex_index(ids_bcs_added_field,
+                                       "variable_length")
+        self.assertEqual(actual['bc_neighborhoods'], None)
+
     def test_get_exact_bc_matches_hit(self):
         """ Returns exact matches to barcodes """
 
@@ -602,6 +653,22 @@ class TopLevelTests(TestCase):
         self.assertEqual(actual_bc, expected_bc)
         self.assertEqual(actual_errs, expected_errs)
 
+    def test_attempt_bc_correction_generic_indexed(self):
+        """ Corrects barcode using precomputed barcode neighborhoods """
+
+        all_bcs = ["AACTCGTCGA", "AGCAGCACTT", "ACAGAGTCGG"]
+        ids_bcs_added_field = dict([((bc, ""), "s%d" % i)
+                                    for i, bc in enumerate(all_bcs)])
+        bc_neighborhoods = get_demultiplex_index(ids_bcs_added_field,
+                                                 10)['bc_neighborhoods']['']
+        barcode_type = 10
+        for curr_bc in ["AGCAGCACTT", "GGCAGCACTA", "GGCAGCAGGA",
+                        "NGCAGCACTT"]:
+            actual = attempt_bc_correction(curr_bc, all_bcs, barcode_type,
+                                           bc_neighborhoods)
+            expected = attempt_bc_correction(curr_bc, all_bcs, barcode_type)
+            self.assertEqual(actual, expected)
+
     def test_attempt_bc_correction_no_barcode(self):
         """ Returns empty string, no errors for zero length barcode """
 
@@ -708,6 +775,39 @@ class TopLevelTests(TestCase):
         self.assertEqual(num_errors, expected_num_errors)
         self.assertEqual(added_field, expected_added_field)
 
+    def test_get_curr_bc_added_field_indexed(self):
+        """ Corrects generic barcodes to barcodes of the added field """
+
+        curr_bc = "AGCT"
+        ids_bcs_added_field = {("AACT", "1"): "s1", ("AGCA", "1"): "s2",
+                               ("AACT", "23"): "s3"}
+        all_bcs = ["AACT", "AGCA", "AACT"]
+        barcode_type = 4
+        disable_bc_correction = False
+        added_demultiplex_field = 'region'
+        demultiplex_index = get_demultiplex_index(ids_bcs_added_field,
+                                                  barcode_type)
+
+        # tie between the barcodes of region 1
+        corrected_bc, num_errors, added_field =\
+            get_curr_bc_added_field(curr_bc, ids_bcs_added_field,
+                                    "123ABC region=1 length=255", all_bcs, barcode_type,
+                                    disable_bc_correction, added_demultiplex_field,
+                                    demultiplex_index)
+        self.assertEqual(corrected_bc, None)
+        self.assertEqual(num_errors, 1)
+        self.assertEqual(added_field, "1")
+
+        # single barcode in region 23
+        corrected_bc, num_errors, added_field =\
+            get_curr_bc_added_field(curr_bc, ids_bcs_added_field,
+                                    "123ABC region=23 length=255", all_bcs, barcode_type,
+                                    disable_bc_correction, added_demultiplex_field,
+                                    demultiplex_index)
+        self.assertEqual(corrected_bc, "AACT")
+        self.assertEqual(num_errors, 1)
+        self.assertEqual(added_field, "23")
+
     def test_get_curr_bc_added_field_bc_and_added_field_no_hit(self):
         """ Gets corrected barcode and no matches to added demultiplex field"""
 
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "The QIIME Development Team"
+__copyright__ = "Copyright 2011, The QIIME Project"
+__credits__ = ["The QIIME Development Team"]
+__license__ = "GPL"
+__version__ = "1.9.1-dev"
+__maintainer__ = "The QIIME Development Team"
+__email__ = "qiime.help@gmail.com"
+
+from os import listdir
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase, main
+
+from qiime.dereplicate import SequenceDereplicator, dereplicate_seqs
+
+
+class SequenceDereplicatorTests(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.seqs = [('s1 comment1', 'ACCTTGTTACTTT'),
+                     ('s2 comment2', 'ACCTTGTTACTTTC'),
+                     ('s3 comment3', 'ACCTTGTTACTTTCC'),
+                     ('s4 comment4', 'ACCTTGTTACTTT'),
+                     ('s5 comment5', 'ACCTTGTTACTTTCC'),
+                     ('s6 comment6', 'ACCTTGTTACTTT')]
+        self.expected = [('s1', 'ACCTTGTTACTTT', ['s1', 's4', 's6']),
+                         ('s2', 'ACCTTGTTACTTTC', ['s2']),
+                         ('s3', 'ACCTTGTTACTTTCC', ['s3', 's5'])]
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def test_call_in_memory(self):
+        """SequenceDereplicator collapses identical seqs without spilling"""
+        d = SequenceDereplicator(temp_dir=self.temp_dir)
+        actual = list(d(self.seqs))
+        self.assertEqual(actual, self.expected)
+        self.assertEqual(d.NumPartitions, 0)
+
+    def test_call_spills_to_disk(self):
+        """SequenceDereplicator gives same result when spilling partitions
+        """
+        d = SequenceDereplicator(max_memory=1, temp_dir=self.temp_dir)
+        actual = list(d(self.seqs))
+        self.assertEqual(actual, self.expected)
+        # one partition per record in each of the two sorting passes
+        self.assertEqual(d.NumPartitions, 9)
+        # partition files are cleaned up
+        self.assertEqual(listdir(self.temp_dir), [])
+
+    def test_call_bounds_open_partitions(self):
+        """SequenceDereplicator merges partitions in passes when needed
+        """
+        seqs = [('s%d' % i, 'ACGT' * (i % 7 + 1)) for i in range(40)]
+        expected = list(SequenceDereplicator()(seqs))
+        self.assertEqual(len(expected), 7)
+
+        d = OpenPartitionCounter(max_memory=1, temp_dir=self.temp_dir,
+                                 max_open_partitions=3)
+        actual = list(d(seqs))
+        self.assertEqual(actual, expected)
+        # one partition per record in each of the two sorting passes
+        self.assertEqual(d.NumPartitions, 47)
+        self.assertTrue(d.NumMergedPartitions > 0)
+        self.assertEqual(d.open_partitions, 0)
+        self.assertTrue(d.max_open_partitions <= 3)
+        self.assertEqual(listdir(self.temp_dir), [])
+
+    def test_call_prefix_length(self):
+        """SequenceDereplicator collapses on prefixes, keeping longest seq
+        """
+        seqs = [('s1', 'ACGTAA'),
+                ('s2', 'ACGTAC'),
+                ('s3', 'ACGTAGAAAA'),
+                ('s4', 'ACGTAT'),
+                ('s5', 'ACGTCA'),
+                ('s6', 'ACGTCC')]
+        expected = [('s3', 'ACGTAGAAAA', ['s1', 's2', 's3', 's4']),
+                    ('s5', 'ACGTCA', ['s5', 's6'])]
+        for max_memory in (None, 1, 500):
+            actual = list(dereplicate_seqs(seqs, prefix_length=5,
+                                           max_memory=max_memory,
+                                           temp_dir=self.temp_dir))
+            self.assertEqual(actual, expected)
+
+    def test_call_empty(self):
+        """SequenceDereplicator handles empty input"""
+        self.assertEqual(list(dereplicate_seqs([])), [])
+
+
+class OpenPartitionCounter(SequenceDereplicator):
+
+    """SequenceDereplicator counting the partition files open at once"""
+
+    open_partitions = 0
+    max_open_partitions = 0
+
+    def _read_partition(self, partition_fp, parse_f):
+        self.open_partitions += 1
+        self.max_open_partitions = max(self.max_open_partitions,
+                                       self.open_partitions)
+        try:
+            for record in SequenceDereplicator._read_partition(
+                    self, partition_fp, parse_f):
+                yield record
+        finally:
+            self.open_partitions -= 1
+
+
+if __name__ == "__main__":
+    main()
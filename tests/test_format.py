@@ -22,7 +22,8 @@ from skbio.util import remove_files
 from unittest import TestCase, main
 from skbio.parse.sequences import parse_fasta
 from qiime.util import  get_qiime_library_version
-from qiime.parse import fields_to_dict, parse_mapping_file
+from qiime.parse import (fields_to_dict, parse_mapping_file, parse_distmat,
+                         load_binary_distmat)
 from qiime.format import (format_distance_matrix, build_prefs_string,
                           format_matrix, format_map_file, format_histograms,
                           write_Fasta_from_name_seq_pairs,
@@ -33,7 +34,13 @@ from qiime.format import (format_distance_matrix, build_prefs_string,
                           format_p_value_for_num_iters, format_mapping_file, illumina_data_to_fastq,
                           format_mapping_html_data, format_te_prefs,
                           format_tep_file_lines, format_jnlp_file_lines,
-                          format_fastq_record, format_histograms_two_bins)
+                          format_fastq_record, format_histograms_two_bins,
+                          format_binary_distance_matrix_header,
+                          write_binary_distance_matrix,
+                          convert_distance_matrix_to_binary,
+                          convert_distance_matrix_to_text,
+                          preallocate_binary_distance_matrix,
+                          write_binary_distance_matrix_rows)
 from biom.parse import parse_biom_table
 from biom.table import Table
 from StringIO import StringIO
@@ -330,6 +337,90 @@ class TopLevelTests(TestCase):
                          '\tfoo\tbar\tbaz\nfoo\t1e-05\t1.0\t1e-13\nbar\t1.0'
                          '\t0.0\t3.0\nbaz\t1e-13\t3.0\t0.0')
 
+    def test_format_binary_distance_matrix_header(self):
+        """format_binary_distance_matrix_header pads the header to 8 bytes"""
+        for labels in (['a', 'b', 'c'], ['sample1'], []):
+            header = format_binary_distance_matrix_header(labels)
+            self.assertEqual(len(header) % 8, 0)
+            lines = header.split('\n')
+            self.assertEqual(lines[0], '#QIIME binary distance matrix v1')
+            layout, dtype, num_ids, offset = lines[1].split('\t')
+            self.assertEqual((layout, int(num_ids), int(offset)),
+                             ('condensed', len(labels), len(header)))
+            self.assertEqual(lines[2], '\t'.join(labels))
+        self.assertRaises(ValueError, format_binary_distance_matrix_header,
+                          ['a'], dtype='int32')
+        self.assertRaises(ValueError, format_binary_distance_matrix_header,
+                          ['a'], layout='lower')
+
+    def test_write_binary_distance_matrix(self):
+        """write_binary_distance_matrix round trips through parse_distmat"""
+        fd, fp = mkstemp(prefix='FormatTests_', suffix='.dm')
+        close(fd)
+        self.files_to_remove.append(fp)
+        a = array([[0, 0.5, 0.25], [0.5, 0, 1.5], [0.25, 1.5, 0]])
+        write_binary_distance_matrix(fp, ['s1', 's2', 's3'], a)
+        labels, layout, data = load_binary_distmat(fp)
+        self.assertEqual(labels, ['s1', 's2', 's3'])
+        self.assertEqual(layout, 'condensed')
+        self.assertEqual(list(data), [0.5, 0.25, 1.5])
+        labels, data = parse_distmat(open(fp, 'U'))
+        self.assertEqual(labels, ['s1', 's2', 's3'])
+        self.assertTrue(array_equal(data, a))
+
+        # asymmetric matrices are written in full
+        b = array([[0, 1, 2], [3, 0, 4], [5, 6, 0]])
+        write_binary_distance_matrix(fp, ['s1', 's2', 's3'], b,
+                                     dtype='float32')
+        labels, layout, data = load_binary_distmat(fp)
+        self.assertEqual(layout, 'square')
+        self.assertEqual(data.dtype, 'float32')
+        self.assertTrue(array_equal(parse_distmat(open(fp, 'U'))[1], b))
+
+        self.assertRaises(ValueError, write_binary_distance_matrix, fp,
+                          ['s1', 's2'], a)
+
+    def test_write_binary_distance_matrix_rows(self):
+        """rows are written in place into a preallocated distance matrix"""
+        fd, fp = mkstemp(prefix='FormatTests_', suffix='.dm')
+        close(fd)
+        self.files_to_remove.append(fp)
+        labels = ['s1', 's2', 's3']
+        a = array([[0, 0.5, 0.25], [0.5, 0, 1.5], [0.25, 1.5, 0]])
+        for layout in ('condensed', 'square'):
+            preallocate_binary_distance_matrix(fp, labels, layout=layout)
+            self.assertTrue(array_equal(parse_distmat(open(fp, 'U'))[1],
+                                        [[0, 0, 0], [0, 0, 0], [0, 0, 0]]))
+            write_binary_distance_matrix_rows(fp, labels, ['s3', 's1'],
+                                              a[[2, 0]])
+            write_binary_distance_matrix_rows(fp, labels, ['s2'], a[[1]])
+            self.assertEqual(load_binary_distmat(fp)[1], layout)
+            self.assertTrue(array_equal(parse_distmat(open(fp, 'U'))[1], a))
+        self.assertRaises(ValueError, write_binary_distance_matrix_rows, fp,
+                          ['s1', 's3', 's2'], ['s2'], a[[1]])
+
+    def test_convert_distance_matrix(self):
+        """distance matrices are converted between text and binary"""
+        fd, text_fp = mkstemp(prefix='FormatTests_', suffix='.txt')
+        close(fd)
+        fd, binary_fp = mkstemp(prefix='FormatTests_', suffix='.dm')
+        close(fd)
+        self.files_to_remove.extend([text_fp, binary_fp])
+        labels = ['s1', 's2', 's3', 's4']
+        a = array([[0, 0.5, 0.25, 1],
+                   [0.5, 0, 1.5, 2],
+                   [0.25, 1.5, 0, 0.125],
+                   [1, 2, 0.125, 0]])
+        text = format_distance_matrix(labels, a)
+        f = open(text_fp, 'w')
+        f.write(text)
+        f.close()
+        convert_distance_matrix_to_binary(text_fp, binary_fp)
+        self.assertEqual(parse_distmat(open(binary_fp, 'U'))[0], labels)
+        remove_files([text_fp])
+        convert_distance_matrix_to_text(binary_fp, text_fp)
+        self.assertEqual(open(text_fp, 'U').read(), text)
+
     def test_format_matrix(self):
         """format_matrix should return tab-delimited mat"""
         a = [[1, 2, 3], [4, 5, 6], [7, 8, 9]]
@@ -75,6 +75,22 @@ class GolayTests(TestCase):
             err_bc = 'C' + bc[1:]
             self.assertEqual(golay.decode(err_bc), (bc, 2))
 
+    def test_decode_matches_decode_bits(self):
+        """ decode should give the results of decode_bits on the bitvector
+        """
+        nt_to_bits_choices = [golay.DEFAULT_GOLAY_NT_TO_BITS,
+                              {"A": "00", "C": "01", "T": "11", "G": "10"}]
+        for nt_to_bits in nt_to_bits_choices:
+            for bitvec in ten_bitvecs:
+                seq = golay._bits_to_seq(bitvec, nt_to_bits)
+                corr, num_errs = golay.decode_bits(
+                    golay._seq_to_bits(seq, nt_to_bits))
+                if corr is not None:
+                    corr = golay._bits_to_seq(corr, nt_to_bits)
+                self.assertEqual(golay.decode(seq, nt_to_bits),
+                                 (corr, num_errs))
+        self.assertRaises(ValueError, golay.decode, 'ACGT')
+
     def test_G_H(self):
         """ generator and parity check matrices should be s.t. G dot H.T = zeros
         """
@@ -15,7 +15,8 @@ __maintainer__ = "Justin Kuczynski"
 __email__ = "justinak@gmail.com"
 
 from unittest import TestCase, main
-from qiime.hamming import decode_barcode_8
+from qiime.hamming import (decode_barcode_8, nt_to_cw, calc_syndrome,
+                           unpack_bitstr, CUR_ENC_FO, CUR_REV_ENC_SI)
 
 
 class GeneralSetUp(TestCase):
@@ -116,5 +117,27 @@ class StandaloneHammingTests(GeneralSetUp):
         self.assertEqual(decode_barcode_8(self.double_error_1), (None, 1))
         self.assertEqual(decode_barcode_8(self.double_error_1), (None, 1))
 
+    def test_decode_barcode_8_matches_calc_syndrome(self):
+        """ Should decode as calc_syndrome on the codeword array """
+        valid = [self.valid_bc_1, self.valid_bc_2, self.valid_bc_3,
+                 self.valid_bc_4, self.valid_bc_5]
+        for bc in valid:
+            for i in range(8):
+                for nt in 'ACGT':
+                    received = bc[:i] + nt + bc[i + 1:]
+                    codeword = nt_to_cw(CUR_ENC_FO, received)
+                    num_errors, sym = calc_syndrome(codeword, 16)
+                    if num_errors == 0:
+                        exp = received
+                    elif num_errors == 1:
+                        exp = unpack_bitstr(CUR_REV_ENC_SI,
+                                            ''.join(map(str, codeword)))
+                    else:
+                        exp = None
+                    self.assertEqual(decode_barcode_8(received),
+                                     (exp, num_errors / 2.0))
+        self.assertRaises(ValueError, decode_barcode_8, 'ACGT')
+        self.assertRaises(ValueError, decode_barcode_8, 'ACGTNCGT')
+
 if __name__ == '__main__':
     main()
@@ -18,7 +18,7 @@ from biom.parse import parse_biom_table
 import numpy as np
 
 from qiime.make_otu_table import (libs_from_seqids, seqids_from_otu_to_seqid,
-                                  make_otu_table)
+                                  make_otu_table, otu_map_to_sparse_matrix)
 from qiime.parse import parse_mapping_file, mapping_file_to_dict
 
 class TopLevelTests(TestCase):
@@ -60,6 +60,37 @@ z	DEF_3	XYZ_1""".split('\n')
 
         self.assertEqual(obs, exp)
 
+    def test_otu_map_to_sparse_matrix(self):
+        """otu_map_to_sparse_matrix should tabulate the OTU map in chunks"""
+        otu_map_lines = """0	ABC_0	DEF_1
+1	ABC_1
+x	GHI_2	GHI_3	GHI_77
+z	DEF_3	XYZ_1""".split('\n')
+        exp = [[1, 1, 0, 0], [1, 0, 0, 0], [0, 0, 3, 0], [0, 1, 0, 1]]
+        for chunk_size in (1, 3, 10):
+            for jobs_to_start in (1, 2):
+                data, sample_ids, otu_ids = otu_map_to_sparse_matrix(
+                    otu_map_lines, jobs_to_start=jobs_to_start,
+                    chunk_size=chunk_size)
+                self.assertEqual(data.toarray().tolist(), exp)
+                self.assertEqual(sample_ids, ['ABC', 'DEF', 'GHI', 'XYZ'])
+                self.assertEqual(otu_ids, ['0', '1', 'x', 'z'])
+
+        data, sample_ids, otu_ids = otu_map_to_sparse_matrix(
+            otu_map_lines, otu_ids_to_exclude=['0', 'z'], chunk_size=1)
+        self.assertEqual(data.toarray().tolist(), [[1, 0], [0, 3]])
+        self.assertEqual(sample_ids, ['ABC', 'GHI'])
+        self.assertEqual(otu_ids, ['1', 'x'])
+
+    def test_make_otu_table_jobs_to_start(self):
+        """make_otu_table should give the same table with multiple jobs"""
+        otu_map_lines = """0	ABC_0	DEF_1
+1	ABC_1
+x	GHI_2	GHI_3	GHI_77
+z	DEF_3	XYZ_1""".split('\n')
+        self.assertEqual(make_otu_table(otu_map_lines, jobs_to_start=2),
+                         make_otu_table(otu_map_lines))
+
     def test_make_otu_table_taxonomy(self):
         """make_otu_table should work with taxonomy"""
         otu_map_lines = """0	ABC_0	DEF_1
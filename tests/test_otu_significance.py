@@ -18,10 +18,14 @@ from qiime.otu_significance import (get_sample_cats, get_cat_sample_groups,
                                     run_grouped_correlation, CORRELATION_TEST_CHOICES,
                                     grouped_correlation_formatter, correlation_row_generator,
                                     run_correlation_test, is_computable_float,
-                                    correlate_output_formatter, _add_metadata)
+                                    correlate_output_formatter, _add_metadata,
+                                    group_significance_groups,
+                                    run_batched_group_significance_test,
+                                    run_batched_correlation_test)
 from qiime.stats import (assign_correlation_pval, fisher, 
                          fisher_population_correlation)
-from numpy import array, hstack, corrcoef, asarray, nan, inf
+from numpy import (array, hstack, corrcoef, asarray, nan, inf, isnan,
+                   ravel)
 from numpy.random import seed
 from numpy.testing import assert_almost_equal
 from os import remove
@@ -562,6 +566,65 @@ class GroupSignificanceFunctionsTests(TestCase):
         assert_almost_equal(exp_pvals, obs_pvals)
         assert_almost_equal(exp_means, obs_means)
 
+    def test_group_significance_groups(self):
+        """Test group_significance_groups groups all rows at once."""
+        sample_indices = {'cat1': [0, 1], 'cat2': [3, 2], 'cat3': [4, 5]}
+        bt = parse_biom_table(BT_IN_1)
+        obs = group_significance_groups(bt, sample_indices)
+        exp = zip(*group_significance_row_generator(bt, sample_indices))
+        self.assertEqual(len(obs), 3)
+        for o, e in zip(obs, exp):
+            assert_almost_equal(o, array(e))
+
+    def test_run_batched_group_significance_test(self):
+        """Test batched tests match the tests of each row."""
+        bt = parse_biom_table(BT_IN_1)
+        bt_2 = parse_biom_table(BT_IN_2)
+        two_groups = {'cat1': [4, 1, 2], 'cat2': [5, 0, 3]}
+        one_obs = {'cat1': [4], 'cat2': [5, 0, 3, 1, 2]}
+        three_groups = {'cat1': [0, 3], 'cat2': [4, 5], 'cat3': [2, 1]}
+        cases = [(bt, two_groups, 'parametric_t_test'),
+                 (bt, one_obs, 'parametric_t_test'),
+                 (bt, two_groups, 'mann_whitney_u'),
+                 (bt, three_groups, 'ANOVA'),
+                 (bt, three_groups, 'g_test'),
+                 (bt, three_groups, 'kruskal_wallis'),
+                 (bt_2, three_groups, 'ANOVA'),
+                 (bt_2, three_groups, 'kruskal_wallis')]
+        for table, sample_indices, test in cases:
+            exp = run_group_significance_test(
+                group_significance_row_generator(table, sample_indices),
+                test, GROUP_TEST_CHOICES)
+            # with one observation in a group, the t tests of each row
+            # return one element arrays rather than scalars
+            obs = run_batched_group_significance_test(
+                group_significance_groups(table, sample_indices), test)
+            for o, e in zip(obs, exp):
+                assert_almost_equal(ravel(o), ravel(e))
+            obs = run_batched_group_significance_test(
+                group_significance_groups(table, sample_indices), test,
+                jobs_to_start=2)
+            for o, e in zip(obs, exp):
+                assert_almost_equal(ravel(o), ravel(e))
+
+        # the random tests share their permutations over rows, so only the
+        # statistics and the range of the p-values are comparable
+        for test in ['nonparametric_t_test', 'bootstrap_mann_whitney_u']:
+            exp_test_stats, _, exp_means = run_group_significance_test(
+                group_significance_row_generator(bt, two_groups), test,
+                GROUP_TEST_CHOICES, reps=100)
+            groups = group_significance_groups(bt, two_groups)
+            obs_test_stats, obs_pvals, obs_means = \
+                run_batched_group_significance_test(groups, test, reps=100,
+                                                    seed=0)
+            assert_almost_equal(obs_test_stats, exp_test_stats)
+            assert_almost_equal(obs_means, exp_means)
+            self.assertTrue(all(1 / 101. <= p <= 1. for p in obs_pvals))
+            # the same seed gives the same p-values with several processes
+            obs = run_batched_group_significance_test(groups, test, reps=100,
+                                                      seed=0, jobs_to_start=3)
+            assert_almost_equal(obs[1], obs_pvals)
+
     def test_group_significance_output_formatter(self):
         """output_formatter works"""
         # Using ANOVA test for example
@@ -967,6 +1030,47 @@ class GroupedCorrelationTests(TestCase):
                                                   permutations=1000)
         assert_almost_equal(exp_bootstrapped_pvals, obs_pvals)
 
+    def test_run_batched_correlation_test(self):
+        """Test batched correlations match run_correlation_test."""
+        data = array([[28., 52., 51., 78., 16., 77.],
+                      [25., 14., 11., 32., 48., 63.],
+                      [31., 2., 15., 69., 64., 27.],
+                      [36., 68., 70., 65., 33., 62.],
+                      [16., 41., 59., 40., 15., 3.],
+                      [32., 8., 54., 98., 29., 50.],
+                      [5., 5., 5., 5., 5., 5.]])
+        md_vals = array([1., 2., 3., 4., 5., 6.])
+        for test, method in [('pearson', 'parametric_t_distribution'),
+                             ('pearson', 'fisher_z_transform'),
+                             ('spearman', 'parametric_t_distribution'),
+                             ('spearman', 'fisher_z_transform'),
+                             ('kendall', 'kendall'),
+                             ('kendall', 'fisher_z_transform')]:
+            exp_ccs, exp_pvals = run_correlation_test(
+                ((row, md_vals) for row in data), test,
+                CORRELATION_TEST_CHOICES, pval_assignment_method=method)
+            obs_ccs, obs_pvals = run_batched_correlation_test(
+                data, md_vals, test, pval_assignment_method=method)
+            assert_almost_equal(obs_ccs, exp_ccs)
+            assert_almost_equal(obs_pvals, exp_pvals)
+
+        # the first row is permuted as run_correlation_test permutes it; the
+        # others share its permutations. Equal permuted correlations can
+        # differ by rounding, hence the smaller number of decimal places.
+        seed(0)
+        obs_ccs, obs_pvals = run_batched_correlation_test(
+            data, md_vals, 'pearson', 'bootstrapped', permutations=1000)
+        assert_almost_equal(obs_pvals[0], 0.486, decimal=2)
+        self.assertTrue(all(0 <= p <= 1 for p in obs_pvals[:-1]))
+        self.assertTrue(isnan(obs_pvals[-1]))
+        obs = run_batched_correlation_test(data, md_vals, 'cscore',
+                                           'bootstrapped', permutations=100,
+                                           seed=3)
+        exp = run_batched_correlation_test(data, md_vals, 'cscore',
+                                           'bootstrapped', permutations=100,
+                                           seed=3)
+        assert_almost_equal(obs, exp)
+
     def test_is_computable_float(self):
         '''Test that an arbitrary input can be converted to float.'''
         self.assertRaises(ValueError, is_computable_float, 'adkfjsdkfj')
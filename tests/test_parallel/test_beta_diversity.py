@@ -14,14 +14,15 @@ __email__ = "gregcaporaso@gmail.com"
 from glob import glob
 from shutil import rmtree
 from os import close
-from os.path import exists, join
+from os.path import exists, join, split
 from tempfile import mkstemp, mkdtemp
 
 from skbio.util import remove_files
 from unittest import TestCase, main
 from numpy.testing import assert_almost_equal
 from biom.parse import parse_biom_table
-from qiime.parse import parse_distmat
+from qiime.parse import parse_distmat, is_binary_distmat
+from qiime.beta_diversity import single_file_beta
 from qiime.util import get_qiime_temp_dir
 from qiime.test import initiate_timeout, disable_timeout
 from qiime.parallel.beta_diversity import (ParallelBetaDiversitySingle,
@@ -109,6 +110,110 @@ class ParallelBetaDiversitySingleTests(ParallelBetaDiversityTests):
             dm_sample_ids = parse_distmat(open(dm_fp))[0]
             self.assertItemsEqual(dm_sample_ids, input_sample_ids)
 
+    def test_parallel_beta_diversity_multiprocessing(self):
+        """ parallel beta diversity functions with multiprocessing backend """
+        params = {'metrics': 'weighted_unifrac,unweighted_unifrac',
+                  'tree_path': self.tree_fp,
+                  'jobs_to_start': 3,
+                  'full_tree': False
+                  }
+        app = ParallelBetaDiversitySingle(jobs_to_start=3,
+                                          backend='multiprocessing')
+        r = app(self.input1_fp,
+                self.test_out,
+                params,
+                job_prefix='BTEST',
+                poll_directly=False,
+                suppress_submit_jobs=False)
+        self.assertEqual(sorted(app.job_run_times), [0, 1, 2])
+        # the temporary working directory has been cleaned up
+        self.assertFalse(exists(join(self.test_out, 'BTEST')))
+        input_sample_ids = parse_biom_table(
+            open(self.input1_fp, 'U')).ids()
+        dm_fps = glob(join(self.test_out, '*weighted_unifrac*'))
+        self.assertEqual(len(dm_fps), 2)
+        for dm_fp in dm_fps:
+            dm_sample_ids = parse_distmat(open(dm_fp))[0]
+            self.assertItemsEqual(dm_sample_ids, input_sample_ids)
+
+    def test_parallel_beta_diversity_binary_output(self):
+        """ parallel beta diversity assembles binary distance matrices """
+        params = {'metrics': 'weighted_unifrac,bray_curtis',
+                  'tree_path': self.tree_fp,
+                  'jobs_to_start': 3,
+                  'full_tree': False,
+                  'binary_output': True
+                  }
+        app = ParallelBetaDiversitySingle(jobs_to_start=3,
+                                          backend='multiprocessing')
+        r = app(self.input1_fp,
+                self.test_out,
+                params,
+                job_prefix='BTEST',
+                poll_directly=False,
+                suppress_submit_jobs=False)
+        expected_dir = mkdtemp(dir=self.test_out)
+        single_file_beta(self.input1_fp, params['metrics'], self.tree_fp,
+                         expected_dir)
+        dm_fps = glob(join(self.test_out, '*.dm'))
+        self.assertEqual(len(dm_fps), 2)
+        for dm_fp in dm_fps:
+            self.assertTrue(is_binary_distmat(dm_fp))
+            expected_fp = join(expected_dir,
+                               split(dm_fp)[1].replace('.dm', '.txt'))
+            obs_ids, obs = parse_distmat(open(dm_fp))
+            exp_ids, exp = parse_distmat(open(expected_fp))
+            self.assertEqual(obs_ids, exp_ids)
+            assert_almost_equal(obs, exp)
+
+        # the text output is written from the same binary matrices
+        params['binary_output'] = False
+        text_out = mkdtemp(dir=self.test_out)
+        r = app(self.input1_fp,
+                text_out,
+                params,
+                job_prefix='BTEST',
+                poll_directly=False,
+                suppress_submit_jobs=False)
+        for dm_fp in dm_fps:
+            fn = split(dm_fp)[1].replace('.dm', '.txt')
+            self.assertFalse(is_binary_distmat(join(text_out, fn)))
+            obs_ids, obs = parse_distmat(open(join(text_out, fn)))
+            exp_ids, exp = parse_distmat(open(join(expected_dir, fn)))
+            self.assertEqual(obs_ids, exp_ids)
+            assert_almost_equal(obs, exp)
+
+    def test_parallel_beta_diversity_asymmetric_binary_output(self):
+        """ parallel beta diversity keeps asymmetric binary matrices """
+        params = {'metrics': 'unifrac_g,unifrac_g_full_tree',
+                  'tree_path': self.tree_fp,
+                  'jobs_to_start': 3,
+                  'full_tree': False,
+                  'binary_output': True
+                  }
+        app = ParallelBetaDiversitySingle(jobs_to_start=3,
+                                          backend='multiprocessing')
+        r = app(self.input1_fp,
+                self.test_out,
+                params,
+                job_prefix='BTEST',
+                poll_directly=False,
+                suppress_submit_jobs=False)
+        expected_dir = mkdtemp(dir=self.test_out)
+        single_file_beta(self.input1_fp, params['metrics'], self.tree_fp,
+                         expected_dir)
+        dm_fps = glob(join(self.test_out, '*.dm'))
+        self.assertEqual(len(dm_fps), 2)
+        for dm_fp in dm_fps:
+            expected_fp = join(expected_dir,
+                               split(dm_fp)[1].replace('.dm', '.txt'))
+            obs_ids, obs = parse_distmat(open(dm_fp))
+            exp_ids, exp = parse_distmat(open(expected_fp))
+            # both triangles of the matrix are needed
+            self.assertFalse((exp == exp.T).all())
+            self.assertEqual(obs_ids, exp_ids)
+            assert_almost_equal(obs, exp)
+
     def test_parallel_beta_diversity_wo_tree(self):
         """ parallel beta diveristy functions in single file mode """
         params = {'metrics': 'bray_curtis',
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "The QIIME Development Team"
+__copyright__ = "Copyright 2011, The QIIME Project"
+__credits__ = ["The QIIME Development Team"]
+__license__ = "GPL"
+__version__ = "1.9.1-dev"
+__maintainer__ = "The QIIME Development Team"
+__email__ = "qiime.help@gmail.com"
+
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Timer
+from unittest import TestCase, main
+
+from qiime.parallel.poller import (find_existing_filepaths,
+                                   basic_check_run_complete_f,
+                                   CompletionWatcher, poller)
+
+
+class PollerTests(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.fps = [join(self.temp_dir, 'f1.txt'),
+                    join(self.temp_dir, 'f2.txt'),
+                    join(self.temp_dir, 'missing', 'f3.txt')]
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def _touch(self, fp):
+        open(fp, 'w').close()
+
+    def test_find_existing_filepaths(self):
+        """find_existing_filepaths lists only existing files"""
+        self.assertEqual(find_existing_filepaths(self.fps), [])
+        self._touch(self.fps[1])
+        self.assertEqual(find_existing_filepaths(self.fps), [self.fps[1]])
+        self.assertEqual(find_existing_filepaths([]), [])
+
+    def test_basic_check_run_complete_f(self):
+        """basic_check_run_complete_f returns True when all files exist"""
+        fps = self.fps[:2]
+        self.assertFalse(basic_check_run_complete_f(fps))
+        self._touch(fps[0])
+        self.assertFalse(basic_check_run_complete_f(fps))
+        self._touch(fps[1])
+        self.assertTrue(basic_check_run_complete_f(fps))
+        # a listed file appearing twice doesn't prevent completion
+        self.assertTrue(basic_check_run_complete_f(fps + fps[:1]))
+
+    def test_completion_watcher_update(self):
+        """CompletionWatcher records the time each file first appeared"""
+        for use_inotify in (True, False):
+            fps = [join(self.temp_dir, 'a%s.txt' % use_inotify),
+                   join(self.temp_dir, 'b%s.txt' % use_inotify)]
+            watcher = CompletionWatcher(fps, use_inotify=use_inotify)
+            self.assertFalse(watcher.update())
+            self.assertEqual(watcher.CompletionTimes, {})
+            self._touch(fps[0])
+            self.assertFalse(watcher.update())
+            self.assertEqual(watcher.CompletionTimes.keys(), [fps[0]])
+            first_time = watcher.CompletionTimes[fps[0]]
+            self._touch(fps[1])
+            self.assertTrue(watcher.update())
+            self.assertEqual(watcher.CompletionTimes[fps[0]], first_time)
+            self.assertEqual(sorted(watcher.CompletionTimes), sorted(fps))
+            watcher.close()
+
+    def test_completion_watcher_wait(self):
+        """CompletionWatcher.wait returns soon after the files appear"""
+        for use_inotify in (True, False):
+            fp = join(self.temp_dir, 'f%s.txt' % use_inotify)
+            watcher = CompletionWatcher([fp],
+                                        min_seconds_to_sleep=0.01,
+                                        max_seconds_to_sleep=0.05,
+                                        use_inotify=use_inotify)
+            Timer(0.1, self._touch, [fp]).start()
+            elapsed = watcher.wait()
+            watcher.close()
+            self.assertTrue(0.1 <= elapsed < 5)
+            self.assertTrue(watcher.CompletionTimes[fp] <= elapsed)
+
+    def test_completion_watcher_wait_backoff(self):
+        """CompletionWatcher.wait backs off until more files appear"""
+        fps = [join(self.temp_dir, 'x.txt'), join(self.temp_dir, 'y.txt')]
+        timeouts = []
+
+        def wait_for_change(timeout):
+            timeouts.append(timeout)
+            if len(timeouts) == 3:
+                self._touch(fps[0])
+
+        watcher = CompletionWatcher(fps, min_seconds_to_sleep=1,
+                                    max_seconds_to_sleep=8,
+                                    use_inotify=False)
+        watcher.wait_for_change = wait_for_change
+        # the run is complete after 8 checks, although all (i.e., none)
+        # of the files of a watcher without files exist from the start
+        watcher.wait(lambda f: len(timeouts) == 8)
+        self.assertEqual(timeouts, [1, 2, 4, 1, 2, 4, 8, 8])
+
+        timeouts = []
+        watcher = CompletionWatcher([], min_seconds_to_sleep=1,
+                                    max_seconds_to_sleep=8,
+                                    use_inotify=False)
+        watcher.wait_for_change = wait_for_change
+        watcher.wait(lambda f: len(timeouts) == 5)
+        self.assertEqual(timeouts, [1, 2, 4, 8, 8])
+
+    def test_poller(self):
+        """poller processes and cleans up results once the run completes"""
+        calls = []
+        fps = self.fps[:1]
+        Timer(0.1, self._touch, fps).start()
+        watcher = CompletionWatcher(fps, min_seconds_to_sleep=0.01)
+        est_run_time = poller(basic_check_run_complete_f,
+                              lambda f: calls.append(('process', f)),
+                              lambda f: calls.append(('clean_up', f)),
+                              fps, ['p'], ['c'],
+                              seconds_to_sleep=1,
+                              watcher=watcher)
+        self.assertEqual(calls, [('process', ['p']), ('clean_up', ['c'])])
+        self.assertTrue(0.1 <= est_run_time < 5)
+
+        # the run is complete when all watched files exist if no
+        # check_run_complete_f is provided
+        calls = []
+        watcher = CompletionWatcher(fps)
+        poller(None,
+               lambda f: calls.append(('process', f)),
+               lambda f: calls.append(('clean_up', f)),
+               None, ['p'], ['c'],
+               seconds_to_sleep=1,
+               watcher=watcher)
+        self.assertEqual(calls, [('process', ['p']), ('clean_up', ['c'])])
+        self.assertRaises(ValueError, poller, None, None, None, None,
+                          None, None, 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,14 +12,19 @@ __email__ = "gregcaporaso@gmail.com"
 
 from os import close
 from os.path import exists
-from tempfile import mkstemp
+from shutil import rmtree
+from tempfile import mkstemp, mkdtemp
 from unittest import TestCase, main
 
 from skbio.util import remove_files
 
+import qiime.parallel.util
 from qiime.util import get_qiime_temp_dir
 from qiime.parallel.util import (ParallelWrapper,
-                                 BufferedWriter)
+                                 BufferedWriter,
+                                 estimate_chunk_costs,
+                                 parse_chunk_run_times,
+                                 format_chunk_run_times)
 
 
 class ParallelWrapperTests(TestCase):
@@ -30,6 +35,18 @@ class ParallelWrapperTests(TestCase):
         # stand-alone methods
         self.pw = ParallelWrapper()
 
+    def test_init_invalid_backend(self):
+        """ ParallelWrapper raises error on unknown backend """
+        self.assertRaises(ValueError, ParallelWrapper, backend='threads')
+
+    def test_get_local_command(self):
+        """ _get_local_command strips cluster-only subcommands """
+        self.assertEqual(self.pw._get_local_command(
+            '/bin/bash; pick_otus.py -h ; mv a.txt b.txt; exit'),
+            'pick_otus.py -h ; mv a.txt b.txt')
+        self.assertEqual(self.pw._get_local_command('pick_otus.py -h'),
+                         'pick_otus.py -h')
+
     def test_merge_to_n_commands_even(self):
         """ _merge_to_n_commands functions as expected (even number of cmds)"""
         commands = ['pick_otus.py -h ; mv somthing.txt something_else.txt',
@@ -241,6 +258,95 @@ class ParallelWrapperTests(TestCase):
         self.assertEqual(actual_5, 5)
         self.assertEqual(actual_40, 1)
 
+    def test_split_fasta_into_chunks(self):
+        """ _split_fasta_into_chunks balances chunks by number of bases """
+        temp_dir = mkdtemp(dir=get_qiime_temp_dir())
+        temp_fasta_fp = '%s/in.fasta' % temp_dir
+        seqs = [('s1', 'A' * 40), ('s2', 'C' * 10), ('s3', 'G' * 10),
+                ('s4', 'T' * 10), ('s5', 'A' * 10)]
+        open(temp_fasta_fp, 'w').write(
+            ''.join(['>%s\n%s\n' % s for s in seqs]))
+        self.pw._chunks_per_job = 2
+        try:
+            actual, remove = self.pw._split_fasta_into_chunks(
+                temp_fasta_fp, {}, 2, 'TEST', temp_dir)
+            self.assertTrue(remove)
+            self.assertEqual(actual, ['%s/TEST.%d.fasta' % (temp_dir, i)
+                                      for i in range(3)])
+            self.assertEqual(self.pw.chunk_sizes, [(1, 40), (2, 20), (2, 20)])
+            self.assertEqual(open(actual[2]).read(),
+                             '>s4\nTTTTTTTTTT\n>s5\nAAAAAAAAAA\n')
+        finally:
+            rmtree(temp_dir)
+
+    def test_schedule_chunks(self):
+        """ _schedule_chunks balances chunk commands over the jobs """
+        commands = ['/bin/bash; cmd%d; exit' % i for i in range(4)]
+        # commands are unchanged if the input wasn't split into chunks
+        self.assertEqual(self.pw._schedule_chunks(commands, {}), commands)
+
+        self.pw.chunk_sizes = [(1, 10), (1, 30), (1, 20), (1, 20)]
+        pw = ParallelWrapper(jobs_to_start=2)
+        pw.chunk_sizes = self.pw.chunk_sizes
+        self.assertEqual(pw._schedule_chunks(commands, {}),
+                         ['/bin/bash ; cmd0 ; cmd1 ; exit',
+                          '/bin/bash ; cmd2 ; cmd3 ; exit'])
+
+        # with the multiprocessing backend, each chunk is a job and the
+        # most expensive chunks are run first
+        pw = ParallelWrapper(jobs_to_start=2, backend='multiprocessing')
+        pw.chunk_sizes = self.pw.chunk_sizes
+        self.assertEqual(pw._schedule_chunks(commands, {}),
+                         [commands[1], commands[2], commands[3], commands[0]])
+        pw.job_run_times = {0: 3.0, 1: 2.0, 2: 2.0, 3: 1.0}
+        pw._record_chunk_run_times({})
+        self.assertEqual(pw.chunk_run_times, [(1, 30, 3.0), (1, 20, 2.0),
+                                              (1, 20, 2.0), (1, 10, 1.0)])
+
+    def test_record_chunk_run_times_file(self):
+        """ _record_chunk_run_times keeps the most recent run times """
+        temp_dir = mkdtemp(dir=get_qiime_temp_dir())
+        try:
+            fp = '%s/chunk_run_times.txt' % temp_dir
+            pw = ParallelWrapper(jobs_to_start=2, backend='multiprocessing')
+            pw.chunk_sizes = [(1, 10), (1, 30), (1, 20)]
+            pw._schedule_chunks(['cmd0', 'cmd1', 'cmd2'], {})
+            pw.job_run_times = {0: 3.0, 1: 2.0, 2: 1.0}
+            pw._record_chunk_run_times({'chunk_run_times_fp': fp})
+            self.assertEqual(parse_chunk_run_times(open(fp)),
+                             [(1, 30, 3.0), (1, 20, 2.0), (1, 10, 1.0)])
+
+            # run times of later runs are appended, up to a maximum number
+            pw.job_run_times = {0: 6.0, 1: 4.0, 2: 2.0}
+            original_max = qiime.parallel.util.MAX_CHUNK_RUN_TIMES
+            qiime.parallel.util.MAX_CHUNK_RUN_TIMES = 4
+            try:
+                pw._record_chunk_run_times({'chunk_run_times_fp': fp})
+            finally:
+                qiime.parallel.util.MAX_CHUNK_RUN_TIMES = original_max
+            self.assertEqual(parse_chunk_run_times(open(fp)),
+                             [(1, 10, 1.0), (1, 30, 6.0), (1, 20, 4.0),
+                              (1, 10, 2.0)])
+        finally:
+            rmtree(temp_dir)
+
+    def test_estimate_chunk_costs(self):
+        """ estimate_chunk_costs fits previous run times """
+        sizes = [(2, 10), (1, 20)]
+        self.assertEqual(estimate_chunk_costs(sizes), [10, 20])
+        # run time proportional to the number of sequences
+        run_times = [(1, 10, 2.0), (2, 10, 4.0), (3, 50, 6.0)]
+        actual = estimate_chunk_costs(sizes, run_times)
+        self.assertAlmostEqual(actual[0], 4.0)
+        self.assertAlmostEqual(actual[1], 2.0)
+
+    def test_parse_format_chunk_run_times(self):
+        """ chunk run times can be round-tripped through a file """
+        run_times = [(1, 10, 2.5), (3, 50, 6.0)]
+        lines = format_chunk_run_times(run_times)
+        self.assertEqual(lines[1], '1\t10\t2.500000')
+        self.assertEqual(parse_chunk_run_times(lines), run_times)
+
 
 class BufferedWriterTests(TestCase):
 
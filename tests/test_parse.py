@@ -34,7 +34,9 @@ from qiime.parse import (group_by_field, group_by_fields,
                          mapping_file_to_dict, MinimalQualParser, parse_denoiser_mapping,
                          parse_otu_map, parse_sample_id_map, parse_taxonomy_to_otu_metadata,
                          is_casava_v180_or_later, MinimalSamParser,
-                         parse_items)
+                         parse_items, parse_distmat_to_skbio,
+                         load_binary_distmat, is_binary_distmat)
+from qiime.format import write_binary_distance_matrix
 
 
 class TopLevelTests(TestCase):
@@ -318,6 +320,34 @@ c\t1\t3.5\t0
         self.assertEqual(obs[0], exp[0])
         assert_almost_equal(obs[1], exp[1])
 
+    def test_parse_distmat_binary(self):
+        """parse_distmat should read binary distmat files"""
+        fd, fp = mkstemp(prefix='test_parse_distmat', suffix='.dm')
+        close(fd)
+        self.files_to_remove.append(fp)
+        exp = array([[0, 1, 2], [1, 0, 3.5], [2, 3.5, 0]])
+        write_binary_distance_matrix(fp, ['a', 'b', 'c'], exp)
+        self.assertTrue(is_binary_distmat(fp))
+        obs = parse_distmat(open(fp, 'U'))
+        self.assertEqual(obs[0], ['a', 'b', 'c'])
+        assert_almost_equal(obs[1], exp)
+
+        ids, layout, data = load_binary_distmat(fp)
+        self.assertEqual(layout, 'condensed')
+        assert_almost_equal(data, [1, 2, 3.5])
+
+        dm = parse_distmat_to_skbio(fp)
+        self.assertEqual(dm.ids, ('a', 'b', 'c'))
+        assert_almost_equal(dm.data, exp)
+
+        # text files aren't mistaken for binary ones
+        f = open(fp, 'w')
+        f.write('\ta\tb\na\t0\t1\nb\t1\t0\n')
+        f.close()
+        self.assertFalse(is_binary_distmat(fp))
+        assert_almost_equal(parse_distmat(open(fp, 'U'))[1], [[0, 1], [1, 0]])
+        self.assertEqual(parse_distmat_to_skbio(fp).ids, ('a', 'b'))
+
     def test_parse_distmat_to_dict(self):
         """parse_distmat should return dict of distmat"""
         lines = """\ta\tb\tc
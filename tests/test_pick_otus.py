@@ -76,6 +76,11 @@ class OtuPickerTests(TestCase):
         actual = p._prefilter_exact_matches(seqs)
         self.assertEqual(actual, expected)
 
+        # same result when the de-replication spills to disk
+        p = OtuPicker({'prefilter_max_memory': 1})
+        actual = p._prefilter_exact_matches(seqs)
+        self.assertEqual(actual, expected)
+
 
 class SortmernaV2OtuPickerTests(TestCase):
     """ Tests for SortMeRNA (closed-reference) OTU picker """
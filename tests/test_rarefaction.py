@@ -21,8 +21,10 @@ import numpy.testing as npt
 import numpy as np
 from biom import load_table
 from biom.table import Table, TableException
+from skbio.stats import subsample
 
-from qiime.rarefaction import RarefactionMaker, get_rare_data
+from qiime.rarefaction import (RarefactionMaker, get_rare_data,
+                               get_multiple_rare_data)
 from qiime.util import get_qiime_temp_dir, write_biom_table
 
 
@@ -128,6 +130,61 @@ class FunctionTests(TestCase):
             self.otu_table.ids()[:2])
         # third sample had 0 seqs, so it's gone
 
+    def test_rarefy_to_files_subsample_f(self):
+        """rarefy_to_files should rarefy each table with subsample_f
+        """
+        maker = RarefactionMaker(self.otu_table_fp, 1, 2, 1, 2)
+        maker.rarefy_to_files(self.rare_dir, subsample_f=subsample)
+        for depth in 1, 2:
+            for rep in 0, 1:
+                fname = os.path.join(self.rare_dir,
+                                     "rarefaction_%d_%d.biom" % (depth, rep))
+                otu_table = load_table(fname)
+                self.assertItemsEqual(otu_table.ids(), ['Y', 'X'])
+
+    def test_get_multiple_rare_data(self):
+        """get_multiple_rare_data should rarefy to every depth and rep
+        """
+        res = list(get_multiple_rare_data(self.otu_table, [2, 1, 11], 2))
+        self.assertEqual([(depth, rep) for depth, rep, t in res],
+                         [(2, 0), (1, 0), (11, 0), (2, 1), (1, 1), (11, 1)])
+        for depth, rep, rare_otu_table in res:
+            self.assertItemsEqual(rare_otu_table.ids(axis='observation'),
+                                  self.otu_table.ids(axis='observation'))
+            if depth == 11:
+                self.assertEqual(list(rare_otu_table.ids()), ['X'])
+                npt.assert_array_equal(
+                    rare_otu_table.data('X'),
+                    self.otu_table.data('X'))
+            else:
+                self.assertEqual(list(rare_otu_table.ids()), ['Y', 'X'])
+                npt.assert_array_equal(
+                    rare_otu_table.sum(axis='sample'), [depth, depth])
+                # rarefied counts can't exceed the input counts
+                self.assertTrue(
+                    (rare_otu_table.matrix_data.toarray() <=
+                     self.otu_table_data[:, :2]).all())
+
+        # the tables of a rep are nested
+        for rep in 0, 1:
+            large, small = res[rep * 3][2], res[rep * 3 + 1][2]
+            self.assertTrue((small.matrix_data.toarray() <=
+                             large.matrix_data.toarray()).all())
+
+    def test_get_multiple_rare_data_small_samples(self):
+        """get_multiple_rare_data should handle small and empty samples
+        """
+        res = list(get_multiple_rare_data(self.otu_table, [12, 3], 1,
+                                          include_small_samples=True))
+        self.assertEqual(res[0][2], self.otu_table)
+        npt.assert_array_equal(res[1][2].sum(axis='sample'), [3, 3, 0])
+
+        # depths without any samples are skipped
+        res = list(get_multiple_rare_data(self.otu_table, [12, 50, 11], 2))
+        self.assertEqual([(depth, rep) for depth, rep, table in res],
+                         [(11, 0), (11, 1)])
+        self.assertEqual(res[0][2].ids(), ('X',))
+
     def test_get_empty_rare(self):
         """get_rare_data should be empty when depth > # seqs in any sample"""
         self.assertRaises(TableException, get_rare_data, self.otu_table,
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "The QIIME Development Team"
+__copyright__ = "Copyright 2011, The QIIME Project"
+__credits__ = ["The QIIME Development Team"]
+__license__ = "GPL"
+__version__ = "1.9.1-dev"
+__maintainer__ = "The QIIME Development Team"
+__email__ = "qiime.help@gmail.com"
+
+from gzip import GzipFile
+from itertools import cycle, islice
+from os.path import join
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp
+from unittest import TestCase, main
+
+import numpy as np
+from skbio.io import RecordError
+from skbio.parse.sequences import FastqParseError
+from qiime.sequence_reader import (read_fastq_records, read_fasta_records,
+                                   read_blocks, FastqRecord)
+
+
+class SequenceReaderTests(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.fastq_records = [
+            ('r1 extra', 'ACGTN', [40, 40, 30, 2, 2]),
+            ('r2', 'GG', [20, 10]),
+            ('r3', 'TTTA', [0, 1, 2, 62])]
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def assert_fastq_records_equal(self, actual, expected):
+        self.assertEqual(len(actual), len(expected))
+        for record, (header, sequence, quality) in zip(actual, expected):
+            self.assertEqual(record.header, header)
+            self.assertEqual(record.sequence, sequence)
+            np.testing.assert_equal(record.quality, quality)
+            self.assertEqual(record.quality.dtype, np.int8)
+
+    def test_read_fastq_records_inputs(self):
+        """read_fastq_records reads lists, files, filepaths and gzip files
+        """
+        fp = join(self.temp_dir, 'seqs.fastq')
+        open(fp, 'w').write(fastq1)
+        gz_fp = join(self.temp_dir, 'seqs.fastq.gz')
+        gz_f = GzipFile(gz_fp, 'w')
+        gz_f.write(fastq1)
+        gz_f.close()
+
+        # each input is built anew for each block size, as files are
+        # consumed by reading them
+        inputs = [lambda: fastq1.split('\n'),
+                  lambda: StringIO(fastq1),
+                  lambda: fp,
+                  lambda: open(fp, 'U'),
+                  lambda: gz_fp,
+                  lambda: GzipFile(gz_fp, 'r'),
+                  lambda: StringIO(fastq1.replace('\n', '\r\n')),
+                  lambda: StringIO(fastq1.rstrip('\n')),
+                  lambda: StringIO('\n' + fastq1.replace('\n@', '\n\n@'))]
+        for get_data in inputs:
+            for block_size in 3, 20, 2 ** 20:
+                actual = list(read_fastq_records(get_data(),
+                                                 block_size=block_size))
+                self.assert_fastq_records_equal(actual, self.fastq_records)
+
+    def test_read_fastq_records_as_tuples(self):
+        """read_fastq_records records can be indexed and unpacked
+        """
+        record = list(read_fastq_records(fastq1.split('\n')))[1]
+        header, sequence, quality = record
+        self.assertEqual(header, 'r2')
+        self.assertEqual(sequence, 'GG')
+        np.testing.assert_equal(quality, [20, 10])
+        self.assertEqual(record[0], 'r2')
+        self.assertEqual(record[-2], 'GG')
+        np.testing.assert_equal(record[2], [20, 10])
+        self.assertEqual(record.quality_string, '5+')
+        self.assertEqual(len(record), 3)
+        with self.assertRaises(IndexError):
+            record[3]
+
+    def test_read_fastq_records_phred_offset(self):
+        """read_fastq_records decodes qualities with phred_offset
+        """
+        actual = list(read_fastq_records(['@a', 'AC', '+', 'hB'],
+                                         phred_offset=64))
+        np.testing.assert_equal(actual[0].quality, [40, 2])
+        with self.assertRaises(ValueError):
+            list(read_fastq_records(fastq1.split('\n'), phred_offset=42))
+
+    def test_read_fastq_records_enforce_qual_range(self):
+        """read_fastq_records checks the quality range when parsing
+        """
+        lines = ['@a', 'AC', '+', 'hB']
+        records = read_fastq_records(lines)
+        with self.assertRaises(FastqParseError):
+            next(records)
+        with self.assertRaises(FastqParseError):
+            list(read_fastq_records(['@a', 'AC', '+', 'I I'], phred_offset=33))
+        record = list(read_fastq_records(lines, enforce_qual_range=False))[0]
+        np.testing.assert_equal(record.quality, [71, 33])
+
+    def test_read_fastq_records_trailing_whitespace(self):
+        """read_fastq_records ignores trailing whitespace, like skbio
+        """
+        actual = list(read_fastq_records(['@a  ', 'ACGT \t', '+a ', 'I5+I  '],
+                                         strict=True))
+        self.assertEqual(actual[0].header, 'a')
+        self.assertEqual(actual[0].sequence, 'ACGT')
+        self.assertEqual(actual[0].quality_string, 'I5+I')
+        np.testing.assert_equal(actual[0].quality, [40, 20, 10, 40])
+        with self.assertRaises(FastqParseError):
+            list(read_fastq_records(['@a ', 'AC', '+b ', 'II'], strict=True))
+
+    def test_read_fastq_records_iterator(self):
+        """read_fastq_records reads from infinite iterators of lines
+        """
+        actual = list(islice(read_fastq_records(
+            cycle(['@', 'AAAA', '+', 'AAAA']), enforce_qual_range=False), 3))
+        self.assertEqual([r.sequence for r in actual], ['AAAA'] * 3)
+
+    def test_read_fastq_records_errors(self):
+        """read_fastq_records raises errors on invalid records
+        """
+        with self.assertRaises(FastqParseError):
+            list(read_fastq_records(['a', 'AC', '+', 'II']))
+        with self.assertRaises(FastqParseError):
+            list(read_fastq_records(['@a', 'AC', '-', 'II']))
+        with self.assertRaises(FastqParseError):
+            list(read_fastq_records(['@a', 'AC', '+', 'II', '@b', 'AC']))
+        with self.assertRaises(FastqParseError):
+            list(read_fastq_records(['@a', 'AC', '+b', 'II'], strict=True))
+        actual = list(read_fastq_records(['@a', 'AC', '+a', 'II'],
+                                         strict=True))
+        self.assertEqual(actual[0].header, 'a')
+
+    def test_fastq_record_quality_is_cached(self):
+        """FastqRecord decodes its quality once
+        """
+        record = FastqRecord('a', 'AC', 'xx#+yy', 2, 4)
+        np.testing.assert_equal(record.quality, [2, 10])
+        self.assertTrue(record.quality is record.quality)
+
+    def test_read_blocks(self):
+        """read_blocks yields the full text of its input
+        """
+        self.assertEqual(''.join(read_blocks(StringIO(fastq1), 7)), fastq1)
+        self.assertEqual(''.join(read_blocks(['a', 'b\n', 'c'])), 'a\nb\nc\n')
+        self.assertEqual(list(read_blocks([])), [])
+
+    def test_read_fasta_records(self):
+        """read_fasta_records handles multi-line sequences and blank lines
+        """
+        expected = [('s1 comment', 'ACGTACGT'), ('s2', 'GG'), ('s3', 'T')]
+        fp = join(self.temp_dir, 'seqs.fasta')
+        open(fp, 'w').write(fasta1)
+        for get_data in (lambda: fasta1.split('\n'),
+                         lambda: StringIO(fasta1),
+                         lambda: fp,
+                         lambda: StringIO(fasta1.replace('\n', '\r\n'))):
+            for block_size in 1, 5, 2 ** 20:
+                actual = list(read_fasta_records(get_data(),
+                                                 block_size=block_size))
+                self.assertEqual(actual, expected)
+        self.assertEqual(list(read_fasta_records([])), [])
+
+    def test_read_fasta_records_errors(self):
+        """read_fasta_records raises RecordError on invalid records
+        """
+        with self.assertRaises(RecordError):
+            list(read_fasta_records(['ACGT', '>a', 'A']))
+        with self.assertRaises(RecordError):
+            list(read_fasta_records(['>a', '>b', 'A']))
+
+
+fastq1 = """@r1 extra
+ACGTN
++
+II?##
+@r2
+GG
++
+5+
+@r3
+TTTA
++
+!"#_
+"""
+
+fasta1 = """
+>s1 comment
+ACGT
+ACGT
+
+>s2
+GG
+>s3
+T
+"""
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "The QIIME Development Team"
+__copyright__ = "Copyright 2011, The QIIME Project"
+__credits__ = ["The QIIME Development Team"]
+__license__ = "GPL"
+__version__ = "1.9.1-dev"
+__maintainer__ = "The QIIME Development Team"
+__email__ = "qiime.help@gmail.com"
+
+from gzip import GzipFile
+from os.path import join, exists
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp
+from unittest import TestCase, main
+
+import numpy as np
+
+from qiime.sequence_writer import (SequenceWriter, format_qual_scores,
+                                   format_fastq_quality)
+
+
+class SequenceWriterTests(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def test_format_qual_scores(self):
+        """format_qual_scores writes lines of scores as ' '.join does
+        """
+        for num_scores in 0, 1, 59, 60, 61, 120, 250:
+            scores = np.arange(num_scores) % 256
+            expected = ''.join(
+                [' '.join(map(str, scores[i:i + 60])) + '\n'
+                 for i in range(0, num_scores, 60)])
+            self.assertEqual(format_qual_scores(scores), expected)
+            self.assertEqual(format_qual_scores(scores.astype(np.uint8)),
+                             expected)
+            self.assertEqual(format_qual_scores(list(scores)), expected)
+
+        self.assertEqual(format_qual_scores([40, 0, 255, 7], 3),
+                         '40 0 255\n7\n')
+        # scores that aren't in the lookup tables
+        self.assertEqual(format_qual_scores([-5, 300, 2]), '-5 300 2\n')
+        self.assertEqual(format_qual_scores(np.array([1.5, 2.0])),
+                         '1.5 2.0\n')
+
+    def test_format_fastq_quality(self):
+        """format_fastq_quality encodes phred scores as characters
+        """
+        self.assertEqual(format_fastq_quality([40, 0, 2]), 'I!#')
+        self.assertEqual(format_fastq_quality(np.array([40, 2]), 64), 'hB')
+        self.assertEqual(format_fastq_quality('II#'), 'II#')
+        self.assertEqual(format_fastq_quality([]), '')
+        self.assertRaises(ValueError, format_fastq_quality, [94])
+        self.assertRaises(ValueError, format_fastq_quality, [-2], 33)
+        with self.assertRaisesRegexp(ValueError, ': 94 using ascii_increment'):
+            format_fastq_quality([40, 94])
+
+    def test_sequence_writer(self):
+        """SequenceWriter writes fasta, qual and fastq records
+        """
+        for background in False, True:
+            for buffer_size in 1, 10, 2 ** 20:
+                fp = join(self.temp_dir, 'seqs.txt')
+                writer = SequenceWriter(fp, buffer_size, background)
+                self.assertEqual(writer.name, fp)
+                writer.write_fasta('s1 a', 'ACGT')
+                writer.write_qual('s1 a', [40, 30, 20, 10])
+                writer.write_fastq('s1 a', 'ACGT', [40, 30, 20, 10])
+                writer.write_fastq('s2', 'AC', 'II', quality_header='s2')
+                writer.write('text')
+                writer.close()
+                self.assertEqual(open(fp).read(), expected_output)
+
+    def test_sequence_writer_file(self):
+        """SequenceWriter writes to open files once flushed
+        """
+        f = StringIO()
+        writer = SequenceWriter(f, background=True)
+        writer.write_fasta('s1', 'AC')
+        self.assertEqual(f.getvalue(), '')
+        writer.flush()
+        self.assertEqual(f.getvalue(), '>s1\nAC\n')
+        writer.write_fasta('s2', 'GG')
+        writer.flush()
+        self.assertEqual(f.getvalue(), '>s1\nAC\n>s2\nGG\n')
+        writer.close()
+        self.assertTrue(f.closed)
+
+    def test_sequence_writer_gzip(self):
+        """SequenceWriter compresses .gz files
+        """
+        fp = join(self.temp_dir, 'seqs.fna.gz')
+        with SequenceWriter(fp, 5, background=True) as writer:
+            writer.write_fasta('s1', 'AC')
+            writer.write_fasta('s2', 'GG')
+        self.assertEqual(GzipFile(fp).read(), '>s1\nAC\n>s2\nGG\n')
+
+        fp = join(self.temp_dir, 'seqs.fna')
+        with SequenceWriter(fp, compress=True) as writer:
+            writer.write_fasta('s1', 'AC')
+        self.assertEqual(GzipFile(fp).read(), '>s1\nAC\n')
+
+    def test_sequence_writer_reopen(self):
+        """SequenceWriter can open its file only to write a buffer
+        """
+        fp = join(self.temp_dir, 'seqs.fna')
+        open(fp, 'w').write('old\n')
+        writer = SequenceWriter(fp, 10, reopen=True)
+        self.assertEqual(open(fp).read(), '')
+        writer.write_fasta('s1', 'AC')
+        self.assertEqual(open(fp).read(), '')
+        writer.write_fasta('s2', 'GGGG')
+        self.assertEqual(open(fp).read(), '>s1\nAC\n>s2\nGGGG\n')
+        writer.write_fasta('s3', 'T')
+        writer.close()
+        self.assertEqual(open(fp).read(), '>s1\nAC\n>s2\nGGGG\n>s3\nT\n')
+
+        # append to the existing file
+        writer = SequenceWriter(fp, append=True, reopen=True)
+        writer.write_fasta('s4', 'A')
+        writer.close()
+        self.assertEqual(open(fp).read(),
+                         '>s1\nAC\n>s2\nGGGG\n>s3\nT\n>s4\nA\n')
+
+        self.assertRaises(ValueError, SequenceWriter, StringIO(),
+                          reopen=True)
+
+    def test_sequence_writer_background_errors(self):
+        """SequenceWriter raises errors of its background thread
+        """
+        fp = join(self.temp_dir, 'missing_dir', 'seqs.fna')
+        writer = SequenceWriter(fp, 1, background=True, append=True,
+                                reopen=True)
+        writer.write_fasta('s1', 'AC')
+        self.assertRaises(IOError, writer.flush)
+        writer.close()
+        self.assertFalse(exists(fp))
+
+
+expected_output = """>s1 a
+ACGT
+>s1 a
+40 30 20 10
+@s1 a
+ACGT
++
+I?5+
+@s2
+AC
++s2
+II
+text"""
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,8 @@ __email__ = "gregcaporaso@gmail.com"
 
 import numpy as np
 
+from gzip import GzipFile
+from os.path import join
 from unittest import TestCase, main
 from tempfile import mkdtemp, NamedTemporaryFile
 from shutil import rmtree
@@ -27,7 +29,12 @@ from qiime.split_libraries_fastq import (
     check_header_match_180_or_later,
     correct_barcode,
     process_fastq_single_end_read_file_no_barcode,
-    extract_reads_from_interleaved
+    extract_reads_from_interleaved,
+    process_fastq_single_end_read_file_parallel,
+    get_fastq_record_offsets,
+    read_qual_score_filter,
+    reads_to_matrices,
+    quality_filter_sequences
 )
 from qiime.golay import decode_golay_12
 
@@ -245,6 +252,86 @@ class SplitLibrariesFastqTests(TestCase):
                                                 histogram_f=histogram))
         self.assertTrue(histogram.s.startswith("Length"))
 
+    def _write_fastq_files(self, read_lines, barcode_lines, gzipped=False):
+        """Writes lists of fastq lines to files in the temp dir"""
+        fps = []
+        for name, lines in (('reads', read_lines),
+                            ('barcodes', barcode_lines)):
+            if gzipped:
+                fp = join(self.temp_dir_path, name + '.fastq.gz')
+                f = GzipFile(fp, 'w')
+            else:
+                fp = join(self.temp_dir_path, name + '.fastq')
+                f = open(fp, 'w')
+            f.write('\n'.join(lines))
+            f.close()
+            fps.append(fp)
+        return fps
+
+    def test_process_fastq_single_end_read_file_parallel(self):
+        """process_fastq_single_end_read_file_parallel matches the serial path
+        """
+        for gzipped in False, True:
+            for read_lines, barcode_lines in \
+                    ((self.fastq1, self.barcode_fastq1),
+                     (self.fastq2, self.barcode_fastq2)):
+                read_fp, barcode_fp = self._write_fastq_files(
+                    read_lines, barcode_lines, gzipped)
+                for kwargs in ({'min_per_read_length_fraction': 0.45},
+                               {'store_unassigned': True,
+                                'min_per_read_length_fraction': 0.45,
+                                'barcode_correction_fn': decode_golay_12,
+                                'start_seq_id': 42}):
+                    expected_log = FakeFile()
+                    expected_histogram = FakeFile()
+                    expected = list(process_fastq_single_end_read_file(
+                        read_lines, barcode_lines, self.barcode_map1,
+                        log_f=expected_log, histogram_f=expected_histogram,
+                        **kwargs))
+                    for records_per_chunk in 1, 3, 100:
+                        log = FakeFile()
+                        histogram = FakeFile()
+                        actual = list(process_fastq_single_end_read_file_parallel(
+                            read_fp, barcode_fp, self.barcode_map1,
+                            jobs_to_start=2,
+                            records_per_chunk=records_per_chunk,
+                            log_f=log, histogram_f=histogram, **kwargs))
+                        self.assertEqual(len(actual), len(expected))
+                        for i in range(len(expected)):
+                            np.testing.assert_equal(actual[i], expected[i])
+                        self.assertEqual(log.s, expected_log.s)
+                        self.assertEqual(histogram.s, expected_histogram.s)
+
+    def test_process_fastq_single_end_read_file_parallel_header_mismatch(self):
+        """process_fastq_single_end_read_file_parallel raises on header mismatch
+        """
+        read_fp, barcode_fp = self._write_fastq_files(self.fastq1,
+                                                      self.barcode_fastq2)
+        with self.assertRaises(FastqParseError):
+            list(process_fastq_single_end_read_file_parallel(
+                read_fp, barcode_fp, self.barcode_map1, records_per_chunk=2))
+
+    def test_get_fastq_record_offsets(self):
+        """get_fastq_record_offsets splits fastq files at record boundaries
+        """
+        read_fp, _ = self._write_fastq_files(self.fastq1, self.barcode_fastq1)
+        data = open(read_fp).read()
+        record_starts = [i for i in range(len(data))
+                         if data[i] == '@' and (i == 0 or data[i - 1] == '\n')
+                         and data.count('\n', 0, i) % 4 == 0]
+        self.assertEqual(len(record_starts), 12)
+        for block_size in 7, 100, 2 ** 20:
+            offsets, num_records = get_fastq_record_offsets(
+                read_fp, 5, block_size=block_size)
+            self.assertEqual(num_records, 12)
+            self.assertEqual(offsets, record_starts[::5])
+
+            # the file ends with a newline, so the last offset is its end
+            offsets, num_records = get_fastq_record_offsets(
+                read_fp, 4, block_size=block_size)
+            self.assertEqual(num_records, 12)
+            self.assertEqual(offsets, record_starts[::4] + [len(data)])
+
     def test_check_header_match_pre180(self):
         """check_header_match_pre180 functions as expected with varied input """
 
@@ -1056,6 +1143,71 @@ class SplitLibrariesFastqTests(TestCase):
                     ascii_to_phred64("bbbbbbbbbbbbbbbbbbbbbbbbbY``\`bbbbbbbbbbbbb`bbbbab`a`_[ba_aa]b^_bIWTTQ^YR^"))
         np.testing.assert_equal(actual, expected)
 
+    def test_read_qual_score_filter(self):
+        """read_qual_score_filter truncates at the first long run of bad scores
+        """
+        qual = np.array([30, 2, 30, 2, 2, 30, 2, 2, 2, 30])
+        seq = 'ACGTACGTAC'
+        for max_run_length, expected_end in ((0, 1), (1, 3), (2, 6),
+                                              (3, 10)):
+            actual_seq, actual_qual = read_qual_score_filter(
+                seq, qual, max_run_length, 2)
+            self.assertEqual(actual_seq, seq[:expected_end])
+            np.testing.assert_equal(actual_qual, qual[:expected_end])
+
+        # runs of bad scores ending the read are truncated too
+        actual_seq, actual_qual = read_qual_score_filter(
+            seq, np.array([30] * 8 + [2, 2]), 1, 2)
+        self.assertEqual(actual_seq, 'ACGTACGT')
+
+    def test_reads_to_matrices(self):
+        """reads_to_matrices pads reads into uint8 matrices
+        """
+        sequences, qualities, lengths = reads_to_matrices(
+            ['ACG', 'T', 'GGNN'],
+            [np.array([1, 2, 3]), np.array([4]), np.array([5, 6, 7, 8])])
+        np.testing.assert_equal(lengths, [3, 1, 4])
+        np.testing.assert_equal(sequences,
+                                [[65, 67, 71, 0], [84, 0, 0, 0],
+                                 [71, 71, 78, 78]])
+        np.testing.assert_equal(qualities,
+                                [[1, 2, 3, 0], [4, 0, 0, 0], [5, 6, 7, 8]])
+        self.assertEqual(sequences.dtype, np.uint8)
+        self.assertEqual(qualities.dtype, np.uint8)
+
+    def test_quality_filter_sequences(self):
+        """quality_filter_sequences matches quality_filter_sequence
+        """
+        headers = ["990:2:4:11271:5323#1/1", "990:2:4:11271:5323#0/1",
+                   "990:2:4:11271:5323#1/1", "990:2:4:11271:5323#1/1",
+                   "990:2:4:11271:5323#1/1"]
+        sequences = ['ACGTACGTAC', 'ACGTACGTAC', 'ACNTACGTAN', 'ACGTA',
+                     'ACGTACGTNN']
+        qualities = [np.array([30] * 10), np.array([30] * 10),
+                     np.array([30] * 10), np.array([30, 30, 2, 2, 30]),
+                     np.array([30] * 8 + [2, 2])]
+        sequence_matrix, quality_matrix, lengths = reads_to_matrices(
+            sequences, qualities)
+        bad_digits = [h.split('#')[1][0] == '0' for h in headers]
+        results, truncated_lengths = quality_filter_sequences(
+            sequence_matrix, quality_matrix, lengths, max_bad_run_length=1,
+            phred_quality_threshold=2, min_per_read_length=4, seq_max_N=1,
+            bad_illumina_qual_digit=bad_digits)
+        np.testing.assert_equal(results, [0, 3, 2, 1, 0])
+        np.testing.assert_equal(truncated_lengths, [10, 10, 10, 2, 8])
+
+        for i in range(len(headers)):
+            expected = quality_filter_sequence(headers[i], sequences[i],
+                                               qualities[i], 1, 2, 4, 1, True)
+            self.assertEqual(expected[0], results[i])
+            self.assertEqual(expected[1],
+                             sequences[i][:truncated_lengths[i]])
+
+        # without the illumina quality digit filter
+        results, truncated_lengths = quality_filter_sequences(
+            sequence_matrix, quality_matrix, lengths, 1, 2, 4, 1)
+        np.testing.assert_equal(results, [0, 0, 2, 1, 0])
+
     def test_create_forward_and_reverse_fp(self):
         """ perform different tests for extract_reads_from_interleaved """
 
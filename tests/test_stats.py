@@ -28,8 +28,9 @@ from skbio.util import remove_files
 from numpy.testing import assert_almost_equal, assert_allclose
 from numpy import (array, asarray, roll, median, nan, arange, matrix,
                    concatenate, nan, ndarray, number, ones,
-                   reshape, testing, tril, var, log, fill_diagonal)
-from numpy.random import permutation, shuffle, seed
+                   reshape, testing, tril, var, log, fill_diagonal, isnan)
+from numpy import triu_indices
+from numpy.random import permutation, shuffle, seed, RandomState
 from biom import Table, load_table
 
 from qiime.stats import (all_pairs_t_test, _perform_pairwise_tests,
@@ -39,9 +40,11 @@ from qiime.stats import (all_pairs_t_test, _perform_pairwise_tests,
                          paired_difference_analyses,
                          G_2_by_2, g_fit, t_paired, t_one_sample,
                          t_two_sample, mc_t_two_sample,
-                         _permute_observations,
+                         _permute_observations, permuted_t_two_sample,
                          correlation_t, ZeroExpectedError, fisher,
                          safe_sum_p_log_p, permute_2d,
+                         condensed_permutation_indices,
+                         permuted_correlations, sample_permutations,
                          pearson, spearman, ANOVA_one_way, mw_t,
                          mw_boot, is_symmetric_and_hollow,
                          tail, fdr_correction,
@@ -52,7 +55,9 @@ from qiime.stats import (all_pairs_t_test, _perform_pairwise_tests,
                          z_transform_pval, kruskal_wallis, kendall,
                          kendall_pval, assign_correlation_pval,
                          cscore, williams_correction, t_one_observation,
-                         normprob, tprob, fprob, chi2prob)
+                         normprob, tprob, fprob, chi2prob, _rank_rows,
+                         ANOVA_one_way_rows, kruskal_wallis_rows,
+                         mw_t_rows, mw_boot_rows, sample_bootstrap_indices)
 from qiime.parse import parse_mapping_file_to_dict
 
 from skbio.stats.distance import (DissimilarityMatrix, DistanceMatrix)
@@ -676,6 +681,46 @@ class MantelCorrelogramTests(TestHelper):
                 break
         self.assertTrue(found_match)
 
+    def test_call_ties(self):
+        """Test permuted statistics equal to the original one are counted."""
+        # With integer distances, many permutations give the same statistic
+        # as the original distances. As the statistic is a monotone function
+        # of the sum of products of the distances, the expected p-values can
+        # be computed exactly from integer sums, with the same permutations.
+        n = 10
+        rs = RandomState(0)
+        eco = rs.randint(1, 4, (n, n))
+        eco = tril(eco, -1) + tril(eco, -1).T
+        geo = rs.randint(1, 10, (n, n))
+        geo = tril(geo, -1) + tril(geo, -1).T
+        ids = map(str, range(n))
+        mc = MantelCorrelogram(DistanceMatrix(eco, ids),
+                               DistanceMatrix(geo, ids))
+        seed(42)
+        obs = mc(999)
+
+        seed(42)
+        num_classes = len(obs['mantel_p'])
+        dist_classes = mc._find_distance_classes(
+            mc.DistanceMatrices[1], num_classes)[0][triu_indices(n, 1)]
+        eco_flat = eco[triu_indices(n, 1)]
+        num_ties = 0
+        for class_num in range(num_classes):
+            if obs['mantel_p'][class_num] is None:
+                continue
+            model = (dist_classes == class_num).astype(int)
+            orig_sum = (model * eco_flat).sum()
+            perm_sums = (model[condensed_permutation_indices(
+                sample_permutations(n, 999))] * eco_flat).sum(axis=1)
+            num_ties += (perm_sums == orig_sum).sum()
+            if obs['mantel_r'][class_num] > 0:
+                better = (perm_sums <= orig_sum).sum()
+            else:
+                better = (perm_sums >= orig_sum).sum()
+            assert_almost_equal(obs['mantel_p'][class_num],
+                                (better + 1) / 1000.)
+        self.assertTrue(num_ties > 0)
+
     def test_find_distance_classes(self):
         """Test finding the distance classes a matrix's elements are in."""
         exp = (array([[-1, 0, 1], [0, -1, 2], [1, 2, -1]]),
@@ -1240,6 +1285,37 @@ class TestsTests(TestCase):
                         array([[4, 5, 3], [7, 8, 6],
                                [1, 2, 0]]))
 
+    def test_condensed_permutation_indices(self):
+        """condensed_permutation_indices matches permute_2d."""
+        a = array([[0, 1, 2, 3], [1, 0, 4, 5], [2, 4, 0, 6], [3, 5, 6, 0]])
+        dm = DistanceMatrix(a, list('abcd'))
+        x = dm.condensed_form()
+        perms = [[0, 1, 2, 3], [3, 2, 1, 0], [1, 3, 0, 2]]
+        obs = condensed_permutation_indices(perms)
+        for perm, indices in zip(perms, obs):
+            exp = DistanceMatrix(permute_2d(a, perm),
+                                 list('abcd')).condensed_form()
+            assert_allclose(x[indices], exp)
+
+    def test_permuted_correlations(self):
+        """permuted_correlations matches pearson of permuted matrices."""
+        a = array([[0, 1, 2, 3], [1, 0, 4, 5], [2, 4, 0, 6], [3, 5, 6, 0]])
+        b = array([[0, 2, 7, 1], [2, 0, 3, 9], [7, 3, 0, 4], [1, 9, 4, 0]])
+        x = DistanceMatrix(a, list('abcd')).condensed_form()
+        y = DistanceMatrix(b, list('abcd')).condensed_form()
+        seed(0)
+        perms = sample_permutations(4, 10)
+        self.assertEqual(perms.shape, (10, 4))
+        exp = [[pearson(DistanceMatrix(permute_2d(a, perm),
+                                       list('abcd')).condensed_form(), v)
+                for v in (y, x)] for perm in perms]
+        assert_allclose(permuted_correlations(x, [y, x], perms), exp)
+        assert_allclose(permuted_correlations(x, [y, x], perms,
+                                              jobs_to_start=2), exp)
+        # constant distances can't be correlated
+        obs = permuted_correlations(x, [ones(6)], perms)
+        self.assertTrue(isnan(obs).all())
+
 
 class GTests(TestCase):
 
@@ -1576,6 +1652,37 @@ class StatTests(TestsHelper):
         self.assertRaises(ValueError, mc_t_two_sample, [1], [4.])
         self.assertRaises(ValueError, mc_t_two_sample, [1, 2], [])
 
+    def test_permuted_t_two_sample(self):
+        """Test matches t_two_sample applied to each permutation."""
+        I = [7.2, 7.1, 9.1, 7.2, 7.3, 7.2, 7.5]
+        II = [8.8, 7.5, 7.7, 7.6, 7.4, 6.7, 7.2]
+        for x, y in [(I, II), (I[:3], II), ([7.2], II), (II, [7.2])]:
+            seed(0)
+            px, py = _permute_observations(x, y, 50)
+            exp = [t_two_sample(px[i], py[i], exp_diff=0.5)[0]
+                   for i in range(50)]
+            seed(0)
+            obs = permuted_t_two_sample(x, y, 50, exp_diff=0.5)
+            assert_allclose(obs, exp)
+            # permutations computed in blocks, with a given seed
+            obs = permuted_t_two_sample(x, y, 50, exp_diff=0.5, seed=7,
+                                        block_size=3)
+            assert_allclose(obs, permuted_t_two_sample(x, y, 50,
+                                                       exp_diff=0.5, seed=7))
+
+        # no variance in permuted samples
+        obs = permuted_t_two_sample([1], [1, 1], 5)
+        self.assertTrue(all(map(isnan, obs)))
+
+    def test_mc_t_two_sample_seed(self):
+        """Test gives the same results for the same seed."""
+        I = [7.2, 7.1, 9.1, 7.2, 7.3, 7.2, 7.5]
+        II = [8.8, 7.5, 7.7, 7.6, 7.4, 6.7, 7.2]
+        obs1 = mc_t_two_sample(I, II, seed=42)
+        obs2 = mc_t_two_sample(I, II, seed=42)
+        assert_allclose(obs1[2], obs2[2])
+        self.assertEqual(obs1[3], obs2[3])
+
     def test_permute_observations(self):
         """Test works correctly on small input dataset."""
         I = [10, 20., 1]
@@ -1952,6 +2059,69 @@ class TestDistMatrixPermutationTest(TestCase):
         obs = kruskal_wallis([x_0, x_1, x_2])
         assert_allclose(obs, exp)
 
+    def test_rank_rows(self):
+        """Test _rank_rows matches scipy's rankdata and tiecorrect"""
+        data = array([[3, 1, 4, 1, 5, 9, 2, 6],
+                      [2, 2, 2, 2, 2, 2, 2, 2],
+                      [0, 7, 7, 0, 3, 3, 3, 1]])
+        ranks, tie_sums = _rank_rows(data)
+        assert_allclose(ranks, [[4, 1.5, 5, 1.5, 6, 8, 3, 7],
+                                [4.5] * 8,
+                                [1.5, 7.5, 7.5, 1.5, 5, 5, 5, 3]])
+        assert_allclose(tie_sums, [6, 504, 36])
+
+    def test_ANOVA_one_way_rows(self):
+        """Test rows match ANOVA_one_way, with nan where it's nan"""
+        g1 = array([[10.0, 11.0, 10.0, 5.0, 6.0], [1, 1, 1, 1, 1]])
+        g2 = array([[1.0, 2.0, 3.0, 4.0, 1.0, 2.0], [2, 2, 2, 2, 2, 2]])
+        g3 = array([[6.0, 7.0, 5.0, 6.0, 7.0], [3, 3, 3, 3, 3]])
+        F, pvals = ANOVA_one_way_rows([g1, g2, g3])
+        assert_allclose(F[0], 18.565450643776831)
+        assert_allclose(pvals[0], 0.00015486238993089464)
+        self.assertTrue(isnan(F[1]) and isnan(pvals[1]))
+
+    def test_kruskal_wallis_rows(self):
+        """Test rows match kruskal_wallis"""
+        x_0 = array([[0, 0, 0, 31, 12, 0, 25, 26, 775, 13],
+                     [75, 67, 70, 75, 65, 71, 67, 67, 76, 68]])
+        x_1 = array([[14, 15, 0, 15, 12, 13, 1, 2, 3, 4],
+                     [57, 58, 60, 59, 62, 60, 60, 57, 59, 61]])
+        x_2 = array([[0, 0, 0, 55, 92, 11, 11, 11, 555, 5],
+                     [58, 61, 56, 58, 57, 56, 61, 60, 57, 58]])
+        H, pvals = kruskal_wallis_rows([x_0, x_1, x_2])
+        for i in range(2):
+            exp = kruskal_wallis([x_0[i], x_1[i], x_2[i]])
+            assert_allclose((H[i], pvals[i]), exp)
+        # all values identical
+        H, pvals = kruskal_wallis_rows([ones((1, 3)), ones((1, 2))])
+        self.assertTrue(isnan(H[0]) and isnan(pvals[0]))
+
+    def test_mw_t_rows(self):
+        """Test rows match mw_t"""
+        x = array([[104, 109, 112, 114, 116, 118, 118, 119, 121, 123, 125,
+                    126, 126, 128, 128, 128],
+                   [1, 5, 3, 3, 9, 2, 4, 4, 7, 8, 1, 5, 3, 3, 9, 2]])
+        y = array([[100, 105, 107, 107, 108, 111, 116, 120, 121, 123],
+                   [3, 8, 8, 2, 9, 4, 1, 1, 7, 6]])
+        u, pvals = mw_t_rows(x, y)
+        for i in range(2):
+            assert_allclose((u[i], pvals[i]), mw_t(x[i], y[i]))
+
+    def test_mw_boot_rows(self):
+        """Test rows match mw_boot with the same bootstrap samples"""
+        x = array([[104, 109, 112, 114, 116, 118, 118, 119, 121, 123, 125,
+                    126, 126, 128, 128, 128],
+                   [1, 5, 3, 3, 9, 2, 4, 4, 7, 8, 1, 5, 3, 3, 9, 2]])
+        y = array([[100, 105, 107, 107, 108, 111, 116, 120, 121, 123],
+                   [3, 8, 8, 2, 9, 4, 1, 1, 7, 6]])
+        for i in range(2):
+            seed(0)
+            exp = mw_boot(x[i], y[i], 20)
+            seed(0)
+            indices = sample_bootstrap_indices(26, 20)
+            u, pvals = mw_boot_rows(x, y, indices=indices)
+            assert_allclose((u[i], pvals[i]), exp)
+
 
 class PvalueTests(TestCase):
 
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "The QIIME Development Team"
+__copyright__ = "Copyright 2011, The QIIME Project"
+__credits__ = ["The QIIME Development Team"]
+__license__ = "GPL"
+__version__ = "1.9.1-dev"
+__maintainer__ = "The QIIME Development Team"
+__email__ = "qiime.help@gmail.com"
+
+from unittest import TestCase, main
+
+from numpy import array
+
+from qiime.parse import parse_newick
+from qiime.tree_index import TreeIndex
+
+
+class TreeIndexTests(TestCase):
+
+    """Tests of the TreeIndex class"""
+
+    def setUp(self):
+        self.tree1 = parse_newick('((a:2,b:3):2,(c:1,d:2):7);')
+        self.tree2 = parse_newick('(((a:1,b:1):1,c:2):1,d:3,(e,f:1):1);')
+
+    def test_init(self):
+        """TreeIndex numbers the nodes in postorder"""
+        index = TreeIndex(self.tree1)
+        self.assertEqual(index.Parent.tolist(), [2, 2, 6, 5, 5, 6, -1])
+        self.assertEqual(index.Length.tolist(), [2, 3, 2, 1, 2, 7, 0])
+        self.assertEqual(index.Distance.tolist(), [4, 5, 2, 8, 9, 7, 0])
+        self.assertEqual(index.TipIndex, {'a': 0, 'b': 1, 'c': 3, 'd': 4})
+        self.assertEqual(index.Height.tolist(), [0, 0, 1, 0, 0, 1, 2])
+        self.assertEqual([level.tolist() for level in index.Levels],
+                         [[0, 1, 3, 4], [2, 5], [6]])
+
+    def test_init_missing_lengths(self):
+        """TreeIndex uses 0 for missing branch lengths"""
+        index = TreeIndex(self.tree2)
+        self.assertEqual(index.Parent.tolist(),
+                         [2, 2, 4, 4, 9, 9, 8, 8, 9, -1])
+        self.assertEqual(index.Length.tolist(),
+                         [1, 1, 1, 2, 1, 3, 0, 1, 1, 0])
+        self.assertEqual(index.Height.tolist(),
+                         [0, 0, 1, 0, 2, 0, 0, 0, 1, 3])
+
+    def test_lowest_common_ancestors(self):
+        """lowest_common_ancestors returns the LCA of each pair"""
+        index = TreeIndex(self.tree1)
+        obs = index.lowest_common_ancestors(array([0, 0, 3, 4, 2]),
+                                            array([1, 4, 4, 2, 2]))
+        self.assertEqual(obs.tolist(), [2, 6, 5, 6, 2])
+        index = TreeIndex(self.tree2)
+        obs = index.lowest_common_ancestors(array([0, 3, 0, 6]),
+                                            array([1, 1, 6, 7]))
+        self.assertEqual(obs.tolist(), [2, 4, 9, 8])
+
+    def test_tip_indices(self):
+        """tip_indices returns -1 for names which aren't tips"""
+        index = TreeIndex(self.tree1)
+        self.assertEqual(index.tip_indices(['d', 'x', 'a']).tolist(),
+                         [4, -1, 0])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "The QIIME Development Team"
+__copyright__ = "Copyright 2011, The QIIME Project"
+__credits__ = ["The QIIME Development Team"]
+__license__ = "GPL"
+__version__ = "1.9.1-dev"
+__maintainer__ = "The QIIME Development Team"
+__email__ = "qiime.help@gmail.com"
+
+from unittest import TestCase, main
+
+from skbio.tree import CompressedTrie, fasta_to_pairlist
+
+from qiime.trie import ArrayCompressedTrie
+
+
+class ArrayCompressedTrieTests(TestCase):
+
+    def setUp(self):
+        self.seqs = [('s1', 'ACGTAATGGT'),
+                     ('s2', 'ACGTATTTTAATTTGGCATGGT'),
+                     ('s3', 'ACGTAAT'),
+                     ('s4', 'ACGTA'),
+                     ('s5', 'ATTTAATGGT'),
+                     ('s6', 'ATTTAAT'),
+                     ('s7', 'AAATAAAAA'),
+                     ('s8', 'ATTTAAT'),
+                     ('s9', 'ACGTATTTTAATTTGGCATGGT')]
+        self.expected = {'s1': ['s3', 's4'],
+                         's2': ['s9'],
+                         's5': ['s6', 's8'],
+                         's7': []}
+
+    def test_prefix_map(self):
+        """ArrayCompressedTrie.prefix_map matches CompressedTrie"""
+        t = ArrayCompressedTrie(self.seqs)
+        self.assertEqual(len(t), 9)
+        self.assertEqual(t.prefix_map, self.expected)
+        # without ties between groups, CompressedTrie gives the same result
+        seqs = self.seqs[:7]
+        self.assertEqual(
+            ArrayCompressedTrie(seqs).prefix_map,
+            CompressedTrie(fasta_to_pairlist(seqs)).prefix_map)
+
+    def test_prefix_map_chunks(self):
+        """ArrayCompressedTrie gives same result when packing in chunks"""
+        for chunk_size in (1, 2, 4, 100):
+            t = ArrayCompressedTrie(self.seqs, chunk_size=chunk_size)
+            self.assertEqual(t.prefix_map, self.expected)
+
+    def test_prefix_map_long_seqs(self):
+        """ArrayCompressedTrie handles seqs spanning multiple words"""
+        seqs = [('a', 'A' * 40 + 'C' * 40),
+                ('b', 'A' * 40 + 'C' * 33),
+                ('c', 'A' * 40 + 'C' * 32 + 'G'),
+                ('d', 'A' * 40)]
+        t = ArrayCompressedTrie(seqs)
+        self.assertEqual(t.prefix_map, {'a': ['b', 'd'], 'c': []})
+
+    def test_prefix_map_non_acgt(self):
+        """ArrayCompressedTrie falls back to bytes for non-ACGT chars"""
+        seqs = self.seqs + [('s10', 'ACGTANNN'), ('s11', 'acgt')]
+        expected = dict(self.expected)
+        expected['s10'] = []
+        expected['s11'] = []
+        for chunk_size in (1, 3, 100):
+            t = ArrayCompressedTrie(seqs, chunk_size=chunk_size)
+            self.assertEqual(t.prefix_map, expected)
+            self.assertEqual(t.get_seq(0), 'ACGTAATGGT')
+            self.assertEqual(t.get_seq(9), 'ACGTANNN')
+
+    def test_prefix_map_empty(self):
+        """ArrayCompressedTrie handles empty input"""
+        self.assertEqual(ArrayCompressedTrie([]).prefix_map, {})
+
+    def test_representative_seqs(self):
+        """ArrayCompressedTrie yields representative seqs in input order"""
+        t = ArrayCompressedTrie(self.seqs)
+        self.assertEqual(list(t.representative_seqs()),
+                         [('s1', 'ACGTAATGGT'),
+                          ('s2', 'ACGTATTTTAATTTGGCATGGT'),
+                          ('s5', 'ATTTAATGGT'),
+                          ('s7', 'AAATAAAAA')])
+
+
+if __name__ == "__main__":
+    main()
@@ -271,6 +271,48 @@ class DownstreamWorkflowTests(TestCase):
         log_fp = glob(join(self.test_out, 'log*.txt'))[0]
         self.assertTrue(getsize(log_fp) > 0)
 
+    def test_run_alpha_rarefaction_in_process(self):
+        """ run_alpha_rarefaction generates expected results in process """
+
+        run_alpha_rarefaction(
+            self.test_data['biom'][0],
+            self.test_data['map'][0],
+            self.test_out,
+            call_commands_serially,
+            self.params,
+            self.qiime_config,
+            tree_fp=self.test_data['tree'][0],
+            num_steps=5,
+            parallel=False,
+            min_rare_depth=3,
+            max_rare_depth=18,
+            status_update_callback=no_status_updates,
+            retain_intermediate_files=False,
+            in_process=True)
+
+        html_fp = join(self.test_out, 'alpha_rarefaction_plots',
+                       'rarefaction_plots.html')
+        pd_collated_fp = join(self.test_out, 'alpha_div_collated',
+                              'PD_whole_tree.txt')
+
+        ttest_res, alpha_avg = compare_alpha_diversities(open(pd_collated_fp),
+                                                         open(
+                                                             self.test_data[
+                                                                 'map'][0]),
+                                                         'SampleType',
+                                                         18,
+                                                         test_type='parametric')
+        feces_palm_t = ttest_res[('feces', 'L_palm')][0]
+        self.assertTrue(feces_palm_t < 0,
+                        "t-statistic too high: %1.3f, but should be less than 0"
+                        % feces_palm_t)
+
+        # check that final output files have non-zero size, and that
+        # intermediate files weren't written
+        self.assertTrue(getsize(html_fp) > 0)
+        self.assertFalse(exists(join(self.test_out, 'rarefaction')))
+        self.assertFalse(exists(join(self.test_out, 'alpha_div')))
+
     def test_run_alpha_rarefaction_stderr_and_stddev(self):
         """ run_alpha_rarefaction generates expected results """
 
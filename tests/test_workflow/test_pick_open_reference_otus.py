@@ -12,7 +12,7 @@ __email__ = "gregcaporaso@gmail.com"
 
 from glob import glob
 from os import chdir, getcwd
-from os.path import exists
+from os.path import exists, join
 from shutil import rmtree
 from tempfile import mkdtemp
 from unittest import TestCase, main
@@ -29,7 +29,8 @@ from qiime.test import initiate_timeout, disable_timeout, get_test_data_fps
 from qiime.workflow.pick_open_reference_otus import (
     pick_subsampled_open_reference_otus,
     iterative_pick_subsampled_open_reference_otus,
-    final_repset_from_iteration_repsets)
+    final_repset_from_iteration_repsets,
+    first_observed_repsets_from_iteration_repsets_fps)
 from bfillings.sortmerna_v2 import build_database_sortmerna
 
 
@@ -1966,5 +1967,20 @@ A""".split('\n')
             final_repset_from_iteration_repsets([repset1, repset2, repset3]))
         self.assertEqual(actual, exp)
 
+    def test_first_observed_repsets_from_iteration_repsets_fps(self):
+        """ first_observed_repsets_from_iteration_repsets_fps splits rep set
+        """
+        repset_fps = [join(self.wf_out, 'rs1.fna'),
+                      join(self.wf_out, 'rs2.fna')]
+        output_fps = [join(self.wf_out, 'fo1.fna'),
+                      join(self.wf_out, 'fo2.fna')]
+        open(repset_fps[0], 'w').write('>o1 s1\nACCGT\n>o2\nAGG\n')
+        open(repset_fps[1], 'w').write('>o1\nCAT\n>o3 s3\nAAAA\n')
+        first_observed_repsets_from_iteration_repsets_fps(repset_fps,
+                                                          output_fps)
+        self.assertEqual(open(output_fps[0]).read(),
+                         '>o1 s1\nACCGT\n>o2\nAGG\n')
+        self.assertEqual(open(output_fps[1]).read(), '>o3 s3\nAAAA\n')
+
 if __name__ == "__main__":
     main()
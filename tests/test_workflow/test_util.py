@@ -13,6 +13,7 @@ __email__ = "gregcaporaso@gmail.com"
 from shutil import rmtree
 from glob import glob
 from os.path import exists, join, getsize
+from time import sleep
 from tempfile import mkdtemp
 
 from unittest import TestCase, main
@@ -24,7 +25,9 @@ from qiime.test import (initiate_timeout,
                         get_test_data_fps)
 from qiime.workflow.util import (call_commands_serially,
                                  no_status_updates,
-                                 WorkflowError)
+                                 WorkflowError,
+                                 WorkflowLogger,
+                                 StepCache)
 from qiime.workflow.downstream import run_beta_diversity_through_plots
 
 
@@ -77,5 +80,88 @@ class WorkflowTests(TestCase):
         log_fp = glob(join(self.test_out, 'log*.txt'))[0]
         self.assertTrue(getsize(log_fp) > 0)
 
+
+class StepCacheTests(TestCase):
+
+    def setUp(self):
+        self.test_out = mkdtemp(dir=get_qiime_temp_dir(),
+                                prefix='step_cache_test_',
+                                suffix='')
+        self.cache_fp = join(self.test_out, 'step_cache.txt')
+        self.input_fp = join(self.test_out, 'in.txt')
+        self.output_fp = join(self.test_out, 'out.txt')
+        open(self.input_fp, 'w').write('abc\n')
+        self.commands = [[('Copy', 'cp %s %s' % (self.input_fp,
+                                                 self.output_fp))]]
+        self.logger = WorkflowLogger(join(self.test_out, 'log.txt'))
+
+    def tearDown(self):
+        self.logger.close()
+        rmtree(self.test_out)
+
+    def _run_step(self, cache):
+        return cache.run_step('Copy', self.commands, [], [self.output_fp],
+                              call_commands_serially, no_status_updates,
+                              self.logger)
+
+    def test_run_step(self):
+        """StepCache.run_step only re-runs steps whose inputs changed"""
+        self.assertTrue(self._run_step(StepCache(self.cache_fp)))
+        self.assertEqual(open(self.output_fp).read(), 'abc\n')
+        # the cache persists across instances
+        self.assertFalse(self._run_step(StepCache(self.cache_fp)))
+
+        # changing the input file re-runs the step
+        sleep(0.01)
+        open(self.input_fp, 'w').write('abcd\n')
+        self.assertTrue(self._run_step(StepCache(self.cache_fp)))
+        self.assertEqual(open(self.output_fp).read(), 'abcd\n')
+        self.assertFalse(self._run_step(StepCache(self.cache_fp)))
+
+        # changing or removing the output re-runs the step
+        sleep(0.01)
+        open(self.output_fp, 'w').write('x\n')
+        self.assertTrue(self._run_step(StepCache(self.cache_fp)))
+        remove_files([self.output_fp])
+        self.assertTrue(self._run_step(StepCache(self.cache_fp)))
+
+        # changing the commands re-runs the step
+        self.commands[0].append(('Echo', 'echo'))
+        self.assertTrue(self._run_step(StepCache(self.cache_fp)))
+
+    def test_run_step_no_cache(self):
+        """StepCache.run_step always runs steps when caching is disabled"""
+        cache = StepCache(None)
+        self.assertTrue(self._run_step(cache))
+        self.assertTrue(self._run_step(cache))
+        self.assertFalse(exists(self.cache_fp))
+
+    def test_get_key(self):
+        """StepCache.get_key depends on step id, definition and inputs"""
+        cache = StepCache(self.cache_fp)
+        key = cache.get_key('a', 'b', [self.input_fp])
+        self.assertEqual(key, cache.get_key('a', 'b', [self.input_fp]))
+        self.assertNotEqual(key, cache.get_key('x', 'b', [self.input_fp]))
+        self.assertNotEqual(key, cache.get_key('a', 'x', [self.input_fp]))
+        self.assertNotEqual(key, cache.get_key('a', 'b', []))
+        self.assertEqual(StepCache(None).get_key('a', 'b', []), None)
+
+    def test_record(self):
+        """StepCache.record requires all outputs to exist"""
+        cache = StepCache(self.cache_fp)
+        self.assertFalse(cache.record('a', 'k', [self.output_fp]))
+        self.assertFalse(cache.is_complete('a', 'k'))
+        self.assertTrue(cache.record('a', 'k', [self.input_fp]))
+        self.assertTrue(cache.is_complete('a', 'k'))
+        self.assertFalse(cache.is_complete('a', 'j'))
+
+    def test_get_command_input_fps(self):
+        """StepCache.get_command_input_fps finds existing input files"""
+        cache = StepCache(self.cache_fp)
+        self.assertEqual(cache.get_command_input_fps(self.commands),
+                         [self.input_fp])
+        self.assertEqual(
+            cache.get_command_input_fps(self.commands, [self.input_fp]), [])
+
 if __name__ == "__main__":
     main()